@@ -0,0 +1,170 @@
+from networks.dense_layers import Linear, DLRTLayer, DLRTLayerAdaptive, DLRTLayerLinear
+from networks.convolutional_layers import DLRALayerConv
+from networks.benchmark import time_function, write_results, read_results, compare_results, parse_int_list
+
+import tensorflow as tf
+from optparse import OptionParser
+
+# fields that identify a measurement, see compare_results
+RESULT_KEYS = ("layer", "op", "input_dim", "units", "rank", "batch")
+# image size of the convolutional benchmark, the input dimension is size[0] * size[1] * channels
+CONV_IMAGE_SIZE = 16
+CONV_KERNEL_SIZE = (3, 3)
+STEP_NAMES = {0: "k", 1: "l", 2: "s", 3: "kl"}
+# pre- and postprocessing of the integrator, timed where the layer has them
+INTEGRATOR_FUNCTIONS = ("k_step_preprocessing", "k_step_postprocessing", "k_step_postprocessing_adapt",
+                        "l_step_preprocessing", "l_step_postprocessing", "l_step_postprocessing_adapt",
+                        "s_step_preprocessing")
+
+
+def benchmark(input_dims, units_list, ranks, batches, repeats=20, warmup=3, output="benchmark_layers.json",
+              baseline=None, threshold=0.1):
+    """
+    Times forward and backward pass of every integrator step, the pre- and postprocessing functions and the rank
+    adaption of the DLRT layers against the dense Linear baseline, for all combinations of the grid.
+    :param input_dims: input dimensions of the dense layers, the convolution uses input_dim // 9 channels
+    :param units_list: output dimensions (filters of the convolution)
+    :param ranks: ranks of the low-rank layers, combinations with rank > min(input_dim, units) / 2 are skipped
+    :param batches: batch sizes
+    :param repeats: timed calls per measurement
+    :param warmup: untimed calls before, includes the tracing of the compiled functions
+    :param output: json file for the results
+    :param baseline: json file of an earlier run, regressions against it are reported
+    :param threshold: relative increase of the median time reported as regression
+    """
+    results = []
+    for input_dim in input_dims:
+        for units in units_list:
+            for batch in batches:
+                inputs = tf.random.normal((batch, input_dim))
+                layer = Linear(input_dim=input_dim, units=units)
+                layer.build_model()
+                dense = benchmark_layer("Linear", layer, inputs, steps=[None], repeats=repeats, warmup=warmup)
+                results += [dict(r, input_dim=input_dim, units=units, rank=0, batch=batch) for r in dense]
+                dense_forward = dense[0]["median_ms"]
+
+                for rank in ranks:
+                    if rank > min(input_dim, units) // 2:
+                        continue
+                    layers = [
+                        ("DLRTLayer", DLRTLayer(input_dim=input_dim, units=units, low_rank=rank), inputs, [0, 1, 2]),
+                        ("DLRTLayerLinear", DLRTLayerLinear(input_dim=input_dim, units=units, low_rank=rank), inputs,
+                         [0, 1, 2]),
+                        # rmax_total = rank keeps the rank and the shapes fixed over the repeated rank adaptions
+                        ("DLRTLayerAdaptive", DLRTLayerAdaptive(input_dim=input_dim, units=units, low_rank=rank,
+                                                                rmax_total=rank), inputs, [0, 1, 2, 3])]
+                    channels = max(1, input_dim // (CONV_KERNEL_SIZE[0] * CONV_KERNEL_SIZE[1]))
+                    image_dims = (CONV_IMAGE_SIZE, CONV_IMAGE_SIZE, channels)
+                    layers.append(("DLRALayerConv", DLRALayerConv(low_rank=rank, rmax_total=rank, stride=(1, 1),
+                                                                  rate=(1, 1), size=CONV_KERNEL_SIZE, filters=units,
+                                                                  image_dims=image_dims),
+                                   tf.random.normal((batch,) + image_dims), [0, 1, 2]))
+                    for name, layer, layer_inputs, steps in layers:
+                        layer.build_model()
+                        timings = benchmark_layer(name, layer, layer_inputs, steps, repeats=repeats, warmup=warmup)
+                        for r in timings:
+                            # the convolution works on images, it has no dense counterpart in this grid
+                            if r["op"].startswith("forward") and layer_inputs is inputs:
+                                r["speedup_vs_dense"] = dense_forward / r["median_ms"]
+                        results += [dict(r, input_dim=input_dim, units=units, rank=rank, batch=batch)
+                                    for r in timings]
+
+                print("input_dim %d, units %d, batch %d done" % (input_dim, units, batch))
+
+    config = {"input_dims": input_dims, "units": units_list, "ranks": ranks, "batches": batches, "repeats": repeats,
+              "warmup": warmup}
+    write_results(output, results, config=config)
+    print("Results written to " + output)
+    print_summary(results)
+
+    if baseline is not None:
+        regressions = compare_results(read_results(baseline), results, RESULT_KEYS, threshold=threshold)
+        print(str(len(regressions)) + " regressions against " + baseline)
+        for key, old, new, change in regressions:
+            print(str(dict(zip(RESULT_KEYS, key))) + ": " + "%.3f ms -> %.3f ms (+%.0f%%)" % (old, new, 100 * change))
+    return results
+
+
+def benchmark_layer(name, layer, inputs, steps, repeats, warmup):
+    """
+    :param name: layer name in the results
+    :param layer: built layer
+    :param inputs: layer input
+    :param steps: integrator steps to time forward and backward for, [None] for layers without step argument
+    :return: list of timings {"layer", "op", "median_ms", ...}
+    """
+    results = []
+    for step in steps:
+        suffix = "" if step is None else "_" + STEP_NAMES[step]
+        forward, backward = compile_forward_backward(layer, inputs, step)
+        results.append(dict(time_function(forward, repeats, warmup), layer=name, op="forward" + suffix))
+        results.append(dict(time_function(backward, repeats, warmup), layer=name, op="backward" + suffix))
+
+    for op in INTEGRATOR_FUNCTIONS:
+        if hasattr(layer, op):
+            function = getattr(layer, op)
+            results.append(dict(time_function(function, repeats, warmup), layer=name, op=op))
+
+    if hasattr(layer, "rank_adaption"):
+        # reset the rank before every adaption, otherwise the timings drift with it
+        rank = layer.low_rank
+
+        def reset_rank():
+            layer.rank.assign(rank)
+
+        results.append(dict(time_function(layer.rank_adaption, repeats, warmup, setup=reset_rank), layer=name,
+                            op="rank_adaption"))
+    return results
+
+
+def compile_forward_backward(layer, inputs, step):
+    """
+    :return: compiled forward pass and compiled gradient of the summed output with respect to the trainable weights
+    """
+    def call():
+        if step is None:
+            return layer(inputs)
+        return layer(inputs, step=step)
+
+    def forward():
+        return call()
+
+    def backward():
+        with tf.GradientTape() as tape:
+            loss = tf.reduce_sum(call())
+        return tape.gradient(loss, layer.trainable_weights)
+
+    return tf.function(forward), tf.function(backward)
+
+
+def print_summary(results):
+    """
+    Prints the speedup of the low-rank forward passes over the dense Linear layer, > 1 means low-rank is faster.
+    """
+    print("layer;op;input_dim;units;rank;batch;median_ms;speedup_vs_dense")
+    for r in results:
+        if "speedup_vs_dense" in r:
+            print("%s;%s;%d;%d;%d;%d;%.3f;%.2f" % (r["layer"], r["op"], r["input_dim"], r["units"], r["rank"],
+                                                   r["batch"], r["median_ms"], r["speedup_vs_dense"]))
+    return 0
+
+if __name__ == '__main__':
+    print("---------- Start Layer Benchmark Suite ------------")
+    print("Parsing options")
+    # --- parse options ---
+    parser = OptionParser()
+    parser.add_option("-i", "--input_dims", dest="input_dims", default="256,1024")
+    parser.add_option("-u", "--units", dest="units", default="256,1024")
+    parser.add_option("-r", "--ranks", dest="ranks", default="16,64")
+    parser.add_option("-b", "--batches", dest="batches", default="64,256")
+    parser.add_option("-n", "--repeats", dest="repeats", default=20)
+    parser.add_option("-w", "--warmup", dest="warmup", default=3)
+    parser.add_option("-o", "--output", dest="output", default="benchmark_layers.json")
+    parser.add_option("-c", "--compare", dest="compare", default=None)
+    parser.add_option("-t", "--threshold", dest="threshold", default=0.1)
+
+    (options, args) = parser.parse_args()
+    benchmark(input_dims=parse_int_list(options.input_dims), units_list=parse_int_list(options.units),
+              ranks=parse_int_list(options.ranks), batches=parse_int_list(options.batches),
+              repeats=int(options.repeats), warmup=int(options.warmup), output=options.output,
+              baseline=options.compare, threshold=float(options.threshold))
@@ -0,0 +1,343 @@
+import networks.transformer
+import networks.transformer_dlrt
+from networks.dense_dlrt_nets import ReferenceNet, DLRTNetAdaptive
+from networks.dense_layers import step_weights
+from networks.optimizers import DLRTAdam
+from networks.trace_cache import RankBucketTraceCache
+from networks.benchmark import synchronize, get_peak_rss_mb, count_parameters, write_results
+
+import multiprocessing
+import time
+
+import tensorflow as tf
+from tensorflow import keras
+from optparse import OptionParser
+
+# driver pairs, reference network vs DLRT network on the same synthetic batches
+SCENARIOS = ("mnist_reference", "mnist_DLRT", "mnist_DLRT_fused", "transformer_reference", "transformer_DLRT")
+
+# global network properties, as in the speech transformer drivers
+loss_object = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True, reduction='none')
+
+
+def benchmark(scenarios, steps=50, warmup=5, max_warmup=100, batch_size=256, dim_layer=784, start_rank=10,
+              max_rank=200, tolerance=0.05, rank_bucket_size=8, seq_len=64, input_vocab_size=7765,
+              target_vocab_size=7010, output="benchmark_training.json"):
+    """
+    Runs a fixed number of training steps of the reference and DLRT drivers on synthetic data of identical shapes.
+    Every scenario runs in its own process, so the peak resident set size is the one of the scenario alone.
+    :param scenarios: names out of SCENARIOS
+    :param steps: timed training steps
+    :param warmup: minimal number of untimed training steps before, includes the tracing of the compiled functions.
+    The warmup goes on until a step runs without retracing, the rank adaption may reach new rank buckets for a while.
+    :param max_warmup: maximal number of warmup steps
+    :param batch_size: batch size of the mnist networks, the transformers use batch_size // 4
+    :return: list of results, see run_scenario
+    """
+    config = {"steps": steps, "warmup": warmup, "max_warmup": max_warmup, "batch_size": batch_size, "dim_layer": dim_layer,
+              "start_rank": start_rank, "max_rank": max_rank, "tolerance": tolerance,
+              "rank_bucket_size": rank_bucket_size, "seq_len": seq_len, "input_vocab_size": input_vocab_size,
+              "target_vocab_size": target_vocab_size}
+    results = []
+    # spawn instead of fork, the child must not inherit the TF runtime and memory of the parent
+    context = multiprocessing.get_context("spawn")
+    for scenario in scenarios:
+        with context.Pool(processes=1) as pool:
+            result = pool.apply(run_scenario, (scenario, config))
+        results.append(result)
+        print_result(result)
+
+    write_results(output, results, config=config)
+    print("Results written to " + output)
+    return results
+
+
+def run_scenario(scenario, config):
+    """
+    :param scenario: name out of SCENARIOS
+    :param config: benchmark options, see benchmark
+    :return: dict with samples per second, mean time per step and per integrator sub-step in ms, peak RSS in MB,
+    parameter counts of the network after the timed steps, the number of warmup steps and the timed steps that
+    retraced a compiled sub-step. The retracing steps are timed separately and left out of the other timings.
+    """
+    tf.random.set_seed(1)
+    if scenario.startswith("mnist"):
+        batch_size = config["batch_size"]
+        batch = make_mnist_batch(batch_size)
+    else:
+        batch_size = max(1, config["batch_size"] // 4)
+        batch = make_translation_batch(batch_size, config["seq_len"], config["input_vocab_size"],
+                                       config["target_vocab_size"])
+    model, phases, trace_caches = SCENARIO_BUILDERS[scenario](config)
+
+    warmup_steps = 0
+    retraced = True
+    while warmup_steps < config["warmup"] or (retraced and warmup_steps < config["max_warmup"]):
+        retraces = count_retraces(trace_caches)
+        for _, phase in phases:
+            phase(batch)
+        warmup_steps += 1
+        retraced = count_retraces(trace_caches) > retraces
+    synchronize()
+
+    phase_times = {name: 0.0 for name, _ in phases}
+    total = 0.0
+    retrace_steps = 0
+    retrace_total = 0.0
+    for _ in range(config["steps"]):
+        retraces = count_retraces(trace_caches)
+        step_times = {}
+        for name, phase in phases:
+            phase_start = time.perf_counter()
+            phase(batch)
+            synchronize()
+            step_times[name] = time.perf_counter() - phase_start
+        if count_retraces(trace_caches) > retraces:
+            retrace_steps += 1
+            retrace_total += sum(step_times.values())
+            continue
+        total += sum(step_times.values())
+        for name, t in step_times.items():
+            phase_times[name] += t
+    steps = config["steps"] - retrace_steps
+
+    return {"scenario": scenario, "batch_size": batch_size, "steps": steps,
+            "samples_per_s": batch_size * steps / total if total > 0 else 0.0,
+            "step_ms": 1e3 * total / max(steps, 1),
+            "phase_ms": {name: 1e3 * t / max(steps, 1) for name, t in phase_times.items()},
+            "peak_rss_mb": get_peak_rss_mb(), "parameters": count_parameters(model), "warmup_steps": warmup_steps,
+            "retrace_steps": retrace_steps, "retrace_step_ms": 1e3 * retrace_total / max(retrace_steps, 1)}
+
+
+def count_retraces(trace_caches):
+    return sum(cache.retraces for cache in trace_caches)
+
+
+def build_mnist_reference(config):
+    model = ReferenceNet(input_dim=784, output_dim=10, layer_dim=config["dim_layer"])
+    model.build_model()
+    optimizer = tf.keras.optimizers.Adam(learning_rate=1e-3)
+    loss_fn = keras.losses.SparseCategoricalCrossentropy(from_logits=False)
+
+    def train_step(batch):
+        # eager, as in mnist_reference
+        with tf.GradientTape() as tape:
+            out = tf.keras.activations.softmax(model(batch[0], training=True))
+            loss = loss_fn(batch[1], out)
+            loss += sum(model.losses)
+        grads = tape.gradient(loss, model.trainable_weights)
+        optimizer.apply_gradients(zip(grads, model.trainable_weights))
+
+    return model, [("train_step", train_step)], []
+
+
+def build_mnist_dlrt(config, fused=False):
+    model = DLRTNetAdaptive(input_dim=784, output_dim=10, low_rank=config["start_rank"],
+                            dlra_layer_dim=config["dim_layer"], tol=config["tolerance"],
+                            rmax_total=config["max_rank"], rank_bucket_size=config["rank_bucket_size"])
+    model.build_model()
+    optimizer = DLRTAdam(learning_rate=1e-3)
+    optimizer.track_factors(model)
+    loss_fn = keras.losses.SparseCategoricalCrossentropy(from_logits=False)
+
+    def rank_adaption(batch):
+        model.rank_adaption(optimizer=optimizer)
+
+    if fused:
+        def fused_step(batch):
+            model.fused_train_step(batch[0], batch[1], loss_fn, optimizer)
+
+        return model, [("fused_step", fused_step), ("rank_adaption", rank_adaption)], [model.fused_step_cache]
+
+    def compute_loss(batch, step):
+        out = tf.keras.activations.softmax(model(batch[0], step=step, training=True))
+        return loss_fn(batch[1], out) + sum(model.losses)
+
+    # eager, as in mnist_DLRT
+    phases, trace_caches = integrator_phases(model, optimizer, compute_loss, bias_grads_to_zero=True)
+    return model, phases + [("rank_adaption", rank_adaption)], trace_caches
+
+
+def build_transformer_reference(config):
+    transformer = networks.transformer.Transformer(num_layers=4, d_model=128, num_heads=8, dff=512,
+                                                   input_vocab_size=config["input_vocab_size"],
+                                                   target_vocab_size=config["target_vocab_size"], rate=0.1)
+    optimizer = tf.keras.optimizers.Adam(networks.transformer.CustomSchedule(128), beta_1=0.9, beta_2=0.98,
+                                         epsilon=1e-9)
+
+    @tf.function
+    def train_step(batch):
+        inp, tar = batch
+        with tf.GradientTape() as tape:
+            predictions, _ = transformer([inp, tar[:, :-1]], training=True)
+            loss = loss_function(tar[:, 1:], predictions)
+        gradients = tape.gradient(loss, transformer.trainable_variables)
+        optimizer.apply_gradients(zip(gradients, transformer.trainable_variables))
+
+    return transformer, [("train_step", train_step)], []
+
+
+def build_transformer_dlrt(config):
+    transformer = networks.transformer_dlrt.TransformerDLRT(num_layers=4, d_model=128, num_heads=8, dff=512,
+                                                            input_vocab_size=config["input_vocab_size"],
+                                                            target_vocab_size=config["target_vocab_size"], rate=0.1,
+                                                            tolerance=config["tolerance"],
+                                                            rank_bucket_size=config["rank_bucket_size"])
+    optimizer = DLRTAdam(networks.transformer.CustomSchedule(128), beta_1=0.9, beta_2=0.98, epsilon=1e-9)
+    # the factors are built on the first call
+    inp = tf.ones((1, 2), dtype=tf.int64)
+    transformer([inp, inp], training=False, step=0)
+    optimizer.track_factors(transformer)
+
+    def compute_loss(batch, step):
+        inp, tar = batch
+        predictions, _ = transformer([inp, tar[:, :-1]], training=True, step=step)
+        return loss_function(tar[:, 1:], predictions)
+
+    def rank_adaption(batch):
+        transformer.rank_adaption(optimizer=optimizer)
+
+    # speech_transformer_DLRT compiles the whole integrator step, here every sub-step is compiled on its own to time
+    # it, which adds a function call per sub-step
+    phases, trace_caches = integrator_phases(transformer, optimizer, compute_loss, compile_phases=True)
+    return transformer, phases + [("rank_adaption", rank_adaption)], trace_caches
+
+
+SCENARIO_BUILDERS = {"mnist_reference": build_mnist_reference, "mnist_DLRT": build_mnist_dlrt,
+                     "mnist_DLRT_fused": lambda config: build_mnist_dlrt(config, fused=True),
+                     "transformer_reference": build_transformer_reference,
+                     "transformer_DLRT": build_transformer_dlrt}
+
+
+def integrator_phases(model, optimizer, compute_loss, compile_phases=False, bias_grads_to_zero=False):
+    """
+    Sub-steps of one step of the unconventional integrator as in the DLRT drivers, without rank adaption.
+    :param model: DLRT network
+    :param compute_loss: function (batch, step) -> loss
+    :param compile_phases: compile every sub-step, keyed by the rank buckets of the network
+    :param bias_grads_to_zero: zero the bias gradients of the K and L step, as in mnist_DLRT
+    :return: list of (name, function(batch)) and the trace caches of the compiled sub-steps
+    """
+    gradients = {}
+
+    def preprocessing(batch):
+        model.k_step_preprocessing()
+        model.l_step_preprocessing()
+
+    def step_gradients(batch, step):
+        with tf.GradientTape() as tape:
+            loss = compute_loss(batch, step)
+        grads = tape.gradient(loss, step_weights(model, step), unconnected_gradients=tf.UnconnectedGradients.ZERO)
+        if bias_grads_to_zero:
+            model.set_dlra_bias_grads_to_zero(grads)
+        return grads
+
+    def k_step(batch):
+        if hasattr(model, "toggle_non_s_step_training"):
+            model.toggle_non_s_step_training()
+        return step_gradients(batch, 0)
+
+    def l_step(batch):
+        return step_gradients(batch, 1)
+
+    def kl_update(batch, grads_k_step, grads_l_step):
+        optimizer.apply_gradients(zip(grads_k_step, step_weights(model, 0)))
+        optimizer.apply_gradients(zip(grads_l_step, step_weights(model, 1)))
+        model.k_step_postprocessing_adapt()
+        model.l_step_postprocessing_adapt()
+
+    def s_step(batch):
+        model.s_step_preprocessing(optimizer=optimizer)
+        if hasattr(model, "toggle_s_step_training"):
+            model.toggle_s_step_training()
+        s_weights = step_weights(model, 2)
+        grads_s = step_gradients(batch, 2)
+        optimizer.apply_gradients(zip(grads_s, s_weights))
+
+    functions = {"kl_preprocessing": preprocessing, "k_step": k_step, "l_step": l_step, "kl_update": kl_update,
+                 "s_step": s_step}
+    trace_caches = []
+    if compile_phases:
+        # one trace per combination of rank buckets, see RankBucketTraceCache
+        trace_caches = {name: RankBucketTraceCache(function, max_size=8) for name, function in functions.items()}
+        functions = {name: compile_phase(model, cache) for name, cache in trace_caches.items()}
+        trace_caches = list(trace_caches.values())
+
+    def k_phase(batch):
+        gradients["k"] = functions["k_step"](batch)
+
+    def l_phase(batch):
+        gradients["l"] = functions["l_step"](batch)
+
+    def kl_update_phase(batch):
+        functions["kl_update"](batch, gradients.pop("k"), gradients.pop("l"))
+
+    return [("kl_preprocessing", functions["kl_preprocessing"]), ("k_step", k_phase), ("l_step", l_phase),
+            ("kl_update", kl_update_phase), ("s_step", functions["s_step"])], trace_caches
+
+
+def compile_phase(model, cache):
+    return lambda *args: cache(model.get_rank_buckets(), *args)
+
+
+def make_mnist_batch(batch_size):
+    x = tf.random.uniform((batch_size, 784))
+    y = tf.random.uniform((batch_size,), maxval=10, dtype=tf.int64)
+    return x, y
+
+
+def make_translation_batch(batch_size, seq_len, input_vocab_size, target_vocab_size):
+    # token 0 is padding, see loss_function
+    inp = tf.random.uniform((batch_size, seq_len), minval=1, maxval=input_vocab_size, dtype=tf.int64)
+    tar = tf.random.uniform((batch_size, seq_len + 1), minval=1, maxval=target_vocab_size, dtype=tf.int64)
+    return inp, tar
+
+
+def loss_function(real, pred):
+    mask = tf.math.logical_not(tf.math.equal(real, 0))
+    loss_ = loss_object(real, pred)
+
+    mask = tf.cast(mask, dtype=loss_.dtype)
+    loss_ *= mask
+
+    return tf.reduce_sum(loss_) / tf.reduce_sum(mask)
+
+
+def print_result(result):
+    parameters = result["parameters"]
+    print("----- " + result["scenario"] + " -----")
+    print("samples/s: %.1f | step: %.2f ms | peak RSS: %.1f MB" % (result["samples_per_s"], result["step_ms"],
+                                                                  result["peak_rss_mb"]))
+    print("parameters: %d in use, %d allocated, %d full rank" % (parameters["low_rank"], parameters["allocated"],
+                                                                  parameters["full_rank"]))
+    print("warmup steps: %d | timed steps: %d | retracing steps: %d (%.2f ms, not timed above)" % (
+        result["warmup_steps"], result["steps"], result["retrace_steps"], result["retrace_step_ms"]))
+    for name, phase_ms in result["phase_ms"].items():
+        print("  %s: %.2f ms" % (name, phase_ms))
+    return 0
+
+
+if __name__ == '__main__':
+    print("---------- Start Training Benchmark Suite ------------")
+    print("Parsing options")
+    # --- parse options ---
+    parser = OptionParser()
+    parser.add_option("-c", "--scenarios", dest="scenarios", default=",".join(SCENARIOS))
+    parser.add_option("-n", "--steps", dest="steps", default=50)
+    parser.add_option("-w", "--warmup", dest="warmup", default=5)
+    parser.add_option("--max_warmup", dest="max_warmup", default=100)
+    parser.add_option("-b", "--batch_size", dest="batch_size", default=256)
+    parser.add_option("-d", "--dim_layer", dest="dim_layer", default=784)
+    parser.add_option("-s", "--start_rank", dest="start_rank", default=10)
+    parser.add_option("-m", "--max_rank", dest="max_rank", default=200)
+    parser.add_option("-t", "--tolerance", dest="tolerance", default=0.05)
+    parser.add_option("-r", "--rank_bucket", dest="rank_bucket", default=8)
+    parser.add_option("-l", "--seq_len", dest="seq_len", default=64)
+    parser.add_option("-o", "--output", dest="output", default="benchmark_training.json")
+
+    (options, args) = parser.parse_args()
+    benchmark(scenarios=[s for s in options.scenarios.split(",") if s], steps=int(options.steps),
+              warmup=int(options.warmup), max_warmup=int(options.max_warmup), batch_size=int(options.batch_size),
+              dim_layer=int(options.dim_layer), start_rank=int(options.start_rank), max_rank=int(options.max_rank),
+              tolerance=float(options.tolerance), rank_bucket_size=int(options.rank_bucket),
+              seq_len=int(options.seq_len), output=options.output)
@@ -1,14 +1,21 @@
 from networks.dense_dlrt_nets import DLRTNetAdaptive
-from networks.utils import create_csv_logger_cb
+from networks.dense_layers import step_weights
+from networks.datasets import load_mnist, make_train_dataset
+from networks.utils import create_csv_logger_cb, make_eval_dataset, ClassificationEvaluator
+from networks.checkpoint import AsyncCheckpointWriter, load_checkpoint
+from networks.optimizers import DLRTAdam
+from networks.profiling import IntegratorProfiler
+from networks.rank_schedule import RankAdaptionSchedule
 
 import tensorflow as tf
 from tensorflow import keras
-import numpy as np
 from optparse import OptionParser
 from os import path, makedirs
 
 
-def train(start_rank, tolerance, load_model, dim_layer, rmax, epochs):
+def train(start_rank, tolerance, load_model, dim_layer, rmax, epochs, fused=0, rank_bucket_size=1, profile=0,
+          trace_start=10, trace_steps=0, svd_method="full", adapt_mode="every", adapt_interval=1, adapt_threshold=0.05,
+          data_cache=None, seed=0):
     # specify training
     epochs = epochs
     batch_size = 256
@@ -38,37 +45,28 @@ def train(start_rank, tolerance, load_model, dim_layer, rmax, epochs):
     dlra_layer_dim = dim_layer
 
     model = DLRTNetAdaptive(input_dim=input_dim, output_dim=output_dim, low_rank=starting_rank,
-                            dlra_layer_dim=dlra_layer_dim, tol=tol, rmax_total=max_rank)
+                            dlra_layer_dim=dlra_layer_dim, tol=tol, rmax_total=max_rank,
+                            rank_bucket_size=rank_bucket_size, svd_method=svd_method)
     model.build_model()
 
-    # Build optimizer
-    optimizer = tf.keras.optimizers.Adam(learning_rate=1e-3)
+    # Build optimizer, Adam with moments on the active rank blocks of the factors
+    optimizer = DLRTAdam(learning_rate=1e-3)
+    optimizer.track_factors(model)
     # Choose loss
     loss_fn = keras.losses.SparseCategoricalCrossentropy(from_logits=False)
     # Choose metrics (to monitor training, but not to optimize on)
     loss_metric = tf.keras.metrics.Mean()
     acc_metric = tf.keras.metrics.Accuracy()
-    loss_metric_acc_val = tf.keras.metrics.Accuracy()
 
     # Build dataset
-    (x_train, y_train), (x_test, y_test) = keras.datasets.mnist.load_data()
-    x_train = np.reshape(x_train, (-1, input_dim))
-    x_test = np.reshape(x_test, (-1, input_dim))
-
-    # Reserve 10,000 samples for validation.
-    val_size = 10000
-    x_val = x_train[-val_size:]
-    y_val = y_train[-val_size:]
-    (x_val, y_val) = normalize_img(x_val, y_val)
-
-    x_train = x_train[:-val_size]
-    y_train = y_train[:-val_size]
-    (x_train, y_train) = normalize_img(x_train, y_train)
-
-    (x_test, y_test) = normalize_img(x_test, y_test)
+    # normalized once, 10,000 training samples reserved for validation, memory-mapped from data_cache if given
+    (x_train, y_train), (x_val, y_val), (x_test, y_test) = load_mnist(cache_dir=data_cache)
+    val_dataset = make_eval_dataset(x_val, y_val)
+    test_dataset = make_eval_dataset(x_test, y_test)
+    # batched evaluation with a compiled inference step
+    evaluator = ClassificationEvaluator(model, loss_fn, step=0)
     # Prepare the training dataset.
-    train_dataset = tf.data.Dataset.from_tensor_slices((x_train, y_train))
-    train_dataset = train_dataset.shuffle(buffer_size=1024).batch(batch_size)
+    train_dataset = make_train_dataset(x_train, y_train, batch_size, seed=seed)
 
     # Create logger
     log_file, file_name = create_csv_logger_cb(folder_name=filename)
@@ -80,181 +78,215 @@ def train(start_rank, tolerance, load_model, dim_layer, rmax, epochs):
 
     # load weights
     if load_model == 1:
-        model.load(folder_name=folder_name)
-
-    best_acc = 0
-    best_loss = 10
-    # Iterate over epochs. (Training loop)
-    for epoch in range(epochs):
-        print("Start of epoch %d" % (epoch,))
-        # Iterate over the batches of the dataset.
-
-        for step, batch_train in enumerate(train_dataset):
-            # 1.a) K and L Step Preproccessing
-            model.dlraBlockInput.k_step_preprocessing()
-            model.dlraBlockInput.l_step_preprocessing()
-            model.dlraBlock1.k_step_preprocessing()
-            model.dlraBlock1.l_step_preprocessing()
-            model.dlraBlock2.k_step_preprocessing()
-            model.dlraBlock2.l_step_preprocessing()
-            model.dlraBlock3.k_step_preprocessing()
-            model.dlraBlock3.l_step_preprocessing()
-
-            # 1.b) Tape Gradients for K-Step
-            model.toggle_non_s_step_training()
-            with tf.GradientTape() as tape:
-                out = model(batch_train[0], step=0, training=True)
-                # softmax activation for classification
-                out = tf.keras.activations.softmax(out)
-                # Compute reconstruction loss
-                loss = loss_fn(batch_train[1], out)
-                loss += sum(model.losses)  # Add KLD regularization loss
-
-            if step == 0:
-                # Network monotoring and verbosity
-                loss_metric.update_state(loss)
-                prediction = tf.math.argmax(out, 1)
-                acc_metric.update_state(prediction, batch_train[1])
-
-                loss_value = loss_metric.result().numpy()
-                acc_value = acc_metric.result().numpy()
-                print("----- Training Metrics  ----")
-
-                print("step %d: mean loss S-Step = %.4f" % (step, loss_value))
-                print("Accuracy: " + str(acc_value))
-                print("Loss: " + str(loss_value))
-                print("Current Rank: " + str(int(model.dlraBlockInput.low_rank)) + " | " + str(
-                    int(model.dlraBlock1.low_rank)) + " | " + str(
-                    int(model.dlraBlock2.low_rank)) + " | " + str(int(model.dlraBlock3.low_rank)) + " )")
-                # Reset metrics
-                loss_metric.reset_state()
-                acc_metric.reset_state()
-
-                print("----- Validation Metrics----")
-                # Compute vallidation loss and accuracy
-                loss_val = 0
-                acc_val = 0
-
-                # Validate model
-                out = model(x_val, step=0, training=True)
-                out = tf.keras.activations.softmax(out)
-                loss_val = loss_fn(y_val, out)
-                loss_metric.update_state(loss_val)
-                loss_val = loss_metric.result().numpy()
-
-                prediction = tf.math.argmax(out, 1)
-                acc_metric.update_state(prediction, y_val)
-                acc_val = acc_metric.result().numpy()
-                print("Accuracy: " + str(acc_val))
-                print("Loss: " + str(loss_val))
-                # save current model if it's the best
-                if acc_val >= best_acc and loss_val <= best_loss:
-                    best_acc = acc_val
-                    best_loss = loss_val
-                    print("new best model with accuracy: " + str(best_acc) + " and loss " + str(best_loss))
-
-                    model.save(folder_name=folder_name_best)
-                model.save(folder_name=folder_name)
-                # Reset metrics
-                loss_metric.reset_state()
-                acc_metric.reset_state()
-
-                print("----- Test Metrics (not used for early stopping) ----")
-
-                # Test model
-                out = model(x_test, step=0, training=True)
-                out = tf.keras.activations.softmax(out)
-                loss_test = loss_fn(y_test, out)
-                loss_metric.update_state(loss_test)
-                loss_test = loss_metric.result().numpy()
-
-                prediction = tf.math.argmax(out, 1)
-                acc_metric.update_state(prediction, y_test)
-                acc_test = acc_metric.result().numpy()
-                print("Accuracy: " + str(acc_test))
-                print("Loss: " + str(loss_test))
-                # Reset metrics
-                loss_metric.reset_state()
-                acc_metric.reset_state()
-                print("-------------------------------------\n\n")
-
-            # Gradient updates for k step
-            grads_k_step = tape.gradient(loss, model.trainable_weights)
-            model.set_none_grads_to_zero(grads_k_step, model.trainable_weights)
-            model.set_dlra_bias_grads_to_zero(grads_k_step)
-
-            # 1.b) Tape Gradients for L-Step
-            with tf.GradientTape() as tape:
-                out = model(batch_train[0], step=1, training=True)
-                # softmax activation for classification
-                out = tf.keras.activations.softmax(out)
-                # Compute reconstruction loss
-                loss = loss_fn(batch_train[1], out)
-                loss += sum(model.losses)  # Add KLD regularization loss
-            grads_l_step = tape.gradient(loss, model.trainable_weights)
-            model.set_none_grads_to_zero(grads_l_step, model.trainable_weights)
-            model.set_dlra_bias_grads_to_zero(grads_l_step)
-
-            # Gradient update for K and L
-            optimizer.apply_gradients(zip(grads_k_step, model.trainable_weights))
-            optimizer.apply_gradients(zip(grads_l_step, model.trainable_weights))
-
-            # Postprocessing K and L (excplicitly writing down for each layer)
-            model.dlraBlockInput.k_step_postprocessing_adapt()
-            model.dlraBlockInput.l_step_postprocessing_adapt()
-            model.dlraBlock1.k_step_postprocessing_adapt()
-            model.dlraBlock1.l_step_postprocessing_adapt()
-            model.dlraBlock2.k_step_postprocessing_adapt()
-            model.dlraBlock2.l_step_postprocessing_adapt()
-            model.dlraBlock3.k_step_postprocessing_adapt()
-            model.dlraBlock3.l_step_postprocessing_adapt()
-
-            # S-Step Preprocessing
-            model.dlraBlockInput.s_step_preprocessing()
-            model.dlraBlock1.s_step_preprocessing()
-            model.dlraBlock2.s_step_preprocessing()
-            model.dlraBlock3.s_step_preprocessing()
-
-            model.toggle_s_step_training()
-
-            # 3.b) Tape Gradients
-            with tf.GradientTape() as tape:
-                out = model(batch_train[0], step=2, training=True)
-                # softmax activation for classification
-                out = tf.keras.activations.softmax(out)
-                # Compute reconstruction loss
-                loss = loss_fn(batch_train[1], out)
-                loss += sum(model.losses)  # Add KLD regularization loss
-            # 3.c) Apply Gradients
-            grads_s = tape.gradient(loss, model.trainable_weights)
-            model.set_none_grads_to_zero(grads_s, model.trainable_weights)
-            optimizer.apply_gradients(zip(grads_s, model.trainable_weights))  # All gradients except K and L matrix
-
-            # Rank Adaptivity
-            model.dlraBlockInput.rank_adaption()
-            model.dlraBlock1.rank_adaption()
-            model.dlraBlock2.rank_adaption()
-            model.dlraBlock3.rank_adaption()
-
-        # Log Data of current epoch
-        log_string = str(loss_value) + ";" + str(acc_value) + ";" + str(
-            loss_val) + ";" + str(acc_val) + ";" + str(
-            loss_test) + ";" + str(acc_test) + ";" + str(
-            int(model.dlraBlockInput.low_rank)) + ";" + str(
-            int(model.dlraBlock1.low_rank)) + ";" + str(int(model.dlraBlock2.low_rank)) + ";" + str(
-            int(model.dlraBlock3.low_rank)) + "\n"
-        with open(file_name, "a") as log:
-            log.write(log_string)
-        print("Epoch Data :" + log_string)
-
+        load_checkpoint(model, folder_name=folder_name)
+
+    # time per integrator phase and layer, optionally a TensorBoard trace of trace_steps steps
+    profiler = IntegratorProfiler(enabled=profile == 1, log_dir=filename + "/profile", trace_start=trace_start,
+                                  trace_steps=trace_steps)
+    profiler.instrument(model)
+    # steps between two rank adaptions take the fixed-rank path of the integrator
+    schedule = RankAdaptionSchedule(mode=adapt_mode, interval=adapt_interval, threshold=adapt_threshold)
+    train_step = 0
+
+    # checkpoints are written on a background thread, see AsyncCheckpointWriter
+    checkpoint_writer = AsyncCheckpointWriter()
+    try:
+        best_acc = 0
+        best_loss = 10
+        # Iterate over epochs. (Training loop)
+        for epoch in range(epochs):
+            print("Start of epoch %d" % (epoch,))
+            # Iterate over the batches of the dataset.
+
+            for step, batch_train in enumerate(train_dataset):
+                train_step += 1
+                adapt = schedule.adapt(train_step, model)
+                profiler.begin_step(train_step)
+                if fused == 1 and step != 0:
+                    # K, L and S step in one compiled function, K and L share a single forward pass.
+                    # The monitoring batch (step 0) takes the explicit path below.
+                    with profiler.phase("fused_step"):
+                        model.fused_train_step(batch_train[0], batch_train[1], loss_fn, optimizer, adapt=adapt)
+                    # Rank Adaptivity
+                    with profiler.phase("rank_adaption"):
+                        if adapt:
+                            model.rank_adaption(optimizer=optimizer)
+                            schedule.update(train_step, model)
+                        else:
+                            model.fixed_rank_update(optimizer=optimizer)
+                    continue
+
+                # 1.a) K and L Step Preproccessing
+                with profiler.phase("kl_preprocessing"):
+                    model.dlraBlockInput.k_step_preprocessing()
+                    model.dlraBlockInput.l_step_preprocessing()
+                    model.dlraBlock1.k_step_preprocessing()
+                    model.dlraBlock1.l_step_preprocessing()
+                    model.dlraBlock2.k_step_preprocessing()
+                    model.dlraBlock2.l_step_preprocessing()
+                    model.dlraBlock3.k_step_preprocessing()
+                    model.dlraBlock3.l_step_preprocessing()
+
+                # 1.b) Tape Gradients for K-Step
+                with profiler.phase("k_step"):
+                    model.toggle_non_s_step_training()
+                    with tf.GradientTape() as tape:
+                        out = model(batch_train[0], step=0, training=True)
+                        # softmax activation for classification
+                        out = tf.keras.activations.softmax(out)
+                        # Compute reconstruction loss
+                        loss = loss_fn(batch_train[1], out)
+                        loss += sum(model.losses)  # Add KLD regularization loss
+
+                    # Gradient updates for k step
+                    k_weights = step_weights(model, 0)
+                    grads_k_step = tape.gradient(loss, k_weights, unconnected_gradients=tf.UnconnectedGradients.ZERO)
+                    model.set_dlra_bias_grads_to_zero(grads_k_step)
+
+                if step == 0:
+                    # Network monotoring and verbosity
+                    loss_metric.update_state(loss)
+                    prediction = tf.math.argmax(out, 1)
+                    acc_metric.update_state(prediction, batch_train[1])
+
+                    loss_value = loss_metric.result().numpy()
+                    acc_value = acc_metric.result().numpy()
+                    print("----- Training Metrics  ----")
+
+                    print("step %d: mean loss S-Step = %.4f" % (step, loss_value))
+                    print("Accuracy: " + str(acc_value))
+                    print("Loss: " + str(loss_value))
+                    print("Current Rank: " + str(int(model.dlraBlockInput.low_rank)) + " | " + str(
+                        int(model.dlraBlock1.low_rank)) + " | " + str(
+                        int(model.dlraBlock2.low_rank)) + " | " + str(int(model.dlraBlock3.low_rank)) + " )")
+                    if fused == 1:
+                        print("Trace cache: " + str(model.fused_step_cache.get_stats()))
+                    print("Rank adaption: " + str(schedule.get_stats()))
+                    # Reset metrics
+                    loss_metric.reset_state()
+                    acc_metric.reset_state()
+
+                    print("----- Validation Metrics----")
+                    # Compute vallidation loss and accuracy
+                    loss_val = 0
+                    acc_val = 0
+
+                    # Validate model
+                    loss_val, acc_val = evaluator.evaluate(val_dataset)
+                    print("Accuracy: " + str(acc_val))
+                    print("Loss: " + str(loss_val))
+                    # save current model if it's the best
+                    if acc_val >= best_acc and loss_val <= best_loss:
+                        best_acc = acc_val
+                        best_loss = loss_val
+                        print("new best model with accuracy: " + str(best_acc) + " and loss " + str(best_loss))
+
+                        checkpoint_writer.save(model, folder_name=folder_name_best)
+                    checkpoint_writer.save(model, folder_name=folder_name)
+
+                    print("----- Test Metrics (not used for early stopping) ----")
+
+                    # Test model
+                    loss_test, acc_test = evaluator.evaluate(test_dataset)
+                    print("Accuracy: " + str(acc_test))
+                    print("Loss: " + str(loss_test))
+                    print("-------------------------------------\n\n")
+
+                # 1.b) Tape Gradients for L-Step
+                with profiler.phase("l_step"):
+                    with tf.GradientTape() as tape:
+                        out = model(batch_train[0], step=1, training=True)
+                        # softmax activation for classification
+                        out = tf.keras.activations.softmax(out)
+                        # Compute reconstruction loss
+                        loss = loss_fn(batch_train[1], out)
+                        loss += sum(model.losses)  # Add KLD regularization loss
+                    l_weights = step_weights(model, 1)
+                    grads_l_step = tape.gradient(loss, l_weights, unconnected_gradients=tf.UnconnectedGradients.ZERO)
+                    model.set_dlra_bias_grads_to_zero(grads_l_step)
+
+                # Gradient update for K and L
+                with profiler.phase("kl_update"):
+                    optimizer.apply_gradients(zip(grads_k_step, k_weights))
+                    optimizer.apply_gradients(zip(grads_l_step, l_weights))
+
+                # Postprocessing K and L (excplicitly writing down for each layer), augmented only before an adaption
+                with profiler.phase("kl_postprocessing"):
+                    if adapt:
+                        model.dlraBlockInput.k_step_postprocessing_adapt()
+                        model.dlraBlockInput.l_step_postprocessing_adapt()
+                        model.dlraBlock1.k_step_postprocessing_adapt()
+                        model.dlraBlock1.l_step_postprocessing_adapt()
+                        model.dlraBlock2.k_step_postprocessing_adapt()
+                        model.dlraBlock2.l_step_postprocessing_adapt()
+                        model.dlraBlock3.k_step_postprocessing_adapt()
+                        model.dlraBlock3.l_step_postprocessing_adapt()
+                    else:
+                        model.dlraBlockInput.k_step_postprocessing()
+                        model.dlraBlockInput.l_step_postprocessing()
+                        model.dlraBlock1.k_step_postprocessing()
+                        model.dlraBlock1.l_step_postprocessing()
+                        model.dlraBlock2.k_step_postprocessing()
+                        model.dlraBlock2.l_step_postprocessing()
+                        model.dlraBlock3.k_step_postprocessing()
+                        model.dlraBlock3.l_step_postprocessing()
+
+                # S-Step Preprocessing
+                with profiler.phase("s_preprocessing"):
+                    model.dlraBlockInput.s_step_preprocessing(optimizer=optimizer)
+                    model.dlraBlock1.s_step_preprocessing(optimizer=optimizer)
+                    model.dlraBlock2.s_step_preprocessing(optimizer=optimizer)
+                    model.dlraBlock3.s_step_preprocessing(optimizer=optimizer)
+
+                with profiler.phase("s_step"):
+                    model.toggle_s_step_training()
+
+                    # 3.b) Tape Gradients
+                    with tf.GradientTape() as tape:
+                        out = model(batch_train[0], step=2, training=True)
+                        # softmax activation for classification
+                        out = tf.keras.activations.softmax(out)
+                        # Compute reconstruction loss
+                        loss = loss_fn(batch_train[1], out)
+                        loss += sum(model.losses)  # Add KLD regularization loss
+                    # 3.c) Apply Gradients
+                    s_weights = step_weights(model, 2)
+                    grads_s = tape.gradient(loss, s_weights)
+                    optimizer.apply_gradients(zip(grads_s, s_weights))  # All gradients except K and L matrix
+
+                # Rank Adaptivity
+                with profiler.phase("rank_adaption"):
+                    if adapt:
+                        model.dlraBlockInput.rank_adaption(optimizer=optimizer)
+                        model.dlraBlock1.rank_adaption(optimizer=optimizer)
+                        model.dlraBlock2.rank_adaption(optimizer=optimizer)
+                        model.dlraBlock3.rank_adaption(optimizer=optimizer)
+                        schedule.update(train_step, model)
+                    else:
+                        model.dlraBlockInput.fixed_rank_update(optimizer=optimizer)
+                        model.dlraBlock1.fixed_rank_update(optimizer=optimizer)
+                        model.dlraBlock2.fixed_rank_update(optimizer=optimizer)
+                        model.dlraBlock3.fixed_rank_update(optimizer=optimizer)
+
+            profiler.end_step()
+
+            # Log Data of current epoch
+            log_string = str(loss_value) + ";" + str(acc_value) + ";" + str(
+                loss_val) + ";" + str(acc_val) + ";" + str(
+                loss_test) + ";" + str(acc_test) + ";" + str(
+                int(model.dlraBlockInput.low_rank)) + ";" + str(
+                int(model.dlraBlock1.low_rank)) + ";" + str(int(model.dlraBlock2.low_rank)) + ";" + str(
+                int(model.dlraBlock3.low_rank)) + "\n"
+            with open(file_name, "a") as log:
+                log.write(log_string)
+            print("Epoch Data :" + log_string)
+    finally:
+        # wait for the pending checkpoint writes, also if training raises
+        checkpoint_writer.close()
+    profiler.close(file_name=filename + "/profile_summary.csv")
     return 0
 
 
-def normalize_img(image, label):
-    """Normalizes images: `uint8` -> `float32`."""
-    return tf.cast(image, tf.float32) / 255., label
-
-
 if __name__ == '__main__':
     print("---------- Start Network Training Suite ------------")
     print("Parsing options")
@@ -267,6 +299,17 @@ if __name__ == '__main__':
     parser.add_option("-d", "--dim_layer", dest="dim_layer", default=200)
     parser.add_option("-m", "--max_rank", dest="max_rank", default=200)
     parser.add_option("-e", "--epochs", dest="epochs", default=10)
+    parser.add_option("-f", "--fused", dest="fused", default=0)
+    parser.add_option("-b", "--rank_bucket", dest="rank_bucket", default=1)
+    parser.add_option("-p", "--profile", dest="profile", default=0)
+    parser.add_option("--trace_start", dest="trace_start", default=10)
+    parser.add_option("--trace_steps", dest="trace_steps", default=0)
+    parser.add_option("--svd", dest="svd_method", default="full")
+    parser.add_option("--adapt_mode", dest="adapt_mode", default="every")
+    parser.add_option("--adapt_interval", dest="adapt_interval", default=1)
+    parser.add_option("--adapt_threshold", dest="adapt_threshold", default=0.05)
+    parser.add_option("--data_cache", dest="data_cache", default=None)
+    parser.add_option("--seed", dest="seed", default=0)
 
     (options, args) = parser.parse_args()
     options.start_rank = int(options.start_rank)
@@ -276,7 +319,19 @@ if __name__ == '__main__':
     options.dim_layer = int(options.dim_layer)
     options.max_rank = int(options.max_rank)
     options.epochs = int(options.epochs)
+    options.fused = int(options.fused)
+    options.rank_bucket = int(options.rank_bucket)
+    options.profile = int(options.profile)
+    options.trace_start = int(options.trace_start)
+    options.trace_steps = int(options.trace_steps)
+    options.adapt_interval = int(options.adapt_interval)
+    options.adapt_threshold = float(options.adapt_threshold)
+    options.seed = int(options.seed)
 
     if options.train == 1:
         train(start_rank=options.start_rank, tolerance=options.tolerance, load_model=options.load_model,
-              dim_layer=options.dim_layer, rmax=options.max_rank, epochs=options.epochs)
+              dim_layer=options.dim_layer, rmax=options.max_rank, epochs=options.epochs, fused=options.fused,
+              rank_bucket_size=options.rank_bucket, profile=options.profile, trace_start=options.trace_start,
+              trace_steps=options.trace_steps, svd_method=options.svd_method, adapt_mode=options.adapt_mode,
+              adapt_interval=options.adapt_interval, adapt_threshold=options.adapt_threshold,
+              data_cache=options.data_cache, seed=options.seed)
@@ -0,0 +1,186 @@
+from networks.dense_dlrt_nets import DLRTNetAdaptive, ReferenceNet
+from networks.datasets import load_mnist, make_train_dataset
+from networks.utils import create_csv_logger_cb, make_eval_dataset, ClassificationEvaluator
+from networks.checkpoint import AsyncCheckpointWriter
+from networks.optimizers import DLRTAdam
+from networks.rank_schedule import RankAdaptionSchedule
+from networks.distributed import DistributedIntegrator, get_strategy, is_chief, make_reference_step
+from networks.compression import PowerSGDCompressor
+
+import tensorflow as tf
+from tensorflow import keras
+from optparse import OptionParser
+from os import path, makedirs
+import time
+
+
+def train(start_rank, tolerance, dim_layer, rmax, epochs, batch_size_per_replica=256, reference=0,
+          compression_rank=0, svd_method="full", adapt_mode="every", adapt_interval=1, adapt_threshold=0.05,
+          data_cache=None, seed=0):
+    """
+    Data parallel training on MNIST under get_strategy: one process per worker, the cluster is described by TF_CONFIG,
+    e.g. TF_CONFIG='{"cluster": {"worker": ["localhost:12345", "localhost:12346"]}, "task": {"type": "worker",
+    "index": 0}}' and index 1 for the second process. Without TF_CONFIG all local devices are used.
+    Only the chief logs and writes checkpoints.
+    The reference network all-reduces its dense gradients, or their rank compression_rank approximations with
+    compression_rank > 0, see PowerSGDCompressor.
+    """
+    strategy = get_strategy()
+    chief = is_chief()
+    global_batch_size = batch_size_per_replica * strategy.num_replicas_in_sync
+
+    if reference == 1:
+        filename = "mnist_dense_distributed_ref" + ("_c" + str(compression_rank) if compression_rank > 0 else "")
+    else:
+        filename = "mnist_dense_distributed_sr" + str(start_rank) + "_v" + str(tolerance)
+    folder_name = filename + '/latest_model'
+    if chief and not path.exists(folder_name):
+        makedirs(folder_name)
+    if chief:
+        print("replicas in sync: " + str(strategy.num_replicas_in_sync))
+        print("save model as: " + filename)
+
+    input_dim = 784  # 28x28  pixel per image
+    output_dim = 10  # one-hot vector of digits 0-9
+
+    # model, optimizer and integrator hold mirrored variables
+    with strategy.scope():
+        if reference == 1:
+            model = ReferenceNet(input_dim=input_dim, output_dim=output_dim, layer_dim=dim_layer)
+            model.build_model()
+            optimizer = tf.keras.optimizers.Adam(learning_rate=1e-3)
+        else:
+            model = DLRTNetAdaptive(input_dim=input_dim, output_dim=output_dim, low_rank=start_rank,
+                                    dlra_layer_dim=dim_layer, tol=tolerance, rmax_total=rmax, svd_method=svd_method)
+            model.build_model()
+            optimizer = DLRTAdam(learning_rate=1e-3)
+            optimizer.track_factors(model)
+        # per example loss, averaged over the global batch by the step functions
+        loss_fn = keras.losses.SparseCategoricalCrossentropy(from_logits=False,
+                                                             reduction=keras.losses.Reduction.NONE)
+        if reference == 1:
+            compressor = None
+            allreduce_bytes = sum(weight.shape.num_elements() * weight.dtype.size
+                                  for weight in model.trainable_weights)
+            if compression_rank > 0:
+                compressor = PowerSGDCompressor(rank=compression_rank)
+                compressor.build(model.trainable_weights)
+                allreduce_bytes, _ = compressor.get_allreduce_bytes(model.trainable_weights)
+            train_step = make_reference_step(strategy, model, optimizer, loss_fn, global_batch_size,
+                                             compressor=compressor)
+        else:
+            schedule = RankAdaptionSchedule(mode=adapt_mode, interval=adapt_interval, threshold=adapt_threshold)
+            train_step = DistributedIntegrator(strategy, model, optimizer, loss_fn, global_batch_size,
+                                               schedule=schedule)
+
+    # Build dataset
+    # normalized once, 10,000 training samples reserved for validation, memory-mapped from data_cache if given
+    (x_train, y_train), (x_val, y_val), (x_test, y_test) = load_mnist(cache_dir=data_cache)
+    val_dataset = make_eval_dataset(x_val, y_val)
+    test_dataset = make_eval_dataset(x_test, y_test)
+    # evaluation runs on the replicated variables of each worker, outside of the strategy
+    eval_loss_fn = keras.losses.SparseCategoricalCrossentropy(from_logits=False)
+    evaluator = ClassificationEvaluator(model, eval_loss_fn, step=None if reference == 1 else 0)
+    # every worker shuffles with the same seed, the distributed dataset shards the global batches by data
+    train_dataset = make_train_dataset(x_train, y_train, global_batch_size, seed=seed, drop_remainder=True)
+    options = tf.data.Options()
+    options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.DATA
+    train_dataset = strategy.experimental_distribute_dataset(train_dataset.with_options(options))
+
+    # Create logger
+    if chief:
+        log_file, file_name = create_csv_logger_cb(folder_name=filename)
+        log_string = "loss_train;loss_val;acc_val;loss_test;acc_test;time;rank1;rank2;rank3;rank4\n"
+        with open(file_name, "a") as log:
+            log.write(log_string)
+
+    if reference != 1:
+        allreduce_bytes = train_step.get_allreduce_bytes()
+    if chief:
+        print("all-reduced gradient bytes per replica and step: " + str(allreduce_bytes))
+
+    # checkpoints are written on a background thread, only the chief saves
+    checkpoint_writer = AsyncCheckpointWriter()
+    try:
+        for epoch in range(epochs):
+            if chief:
+                print("Start of epoch %d" % (epoch,))
+            start = time.time()
+            loss_sum = 0.0
+            num_steps = 0
+            for batch_train in train_dataset:
+                if reference == 1:
+                    loss = train_step(batch_train[0], batch_train[1])
+                else:
+                    loss, _ = train_step(batch_train[0], batch_train[1])
+                loss_sum += float(loss)
+                num_steps += 1
+            epoch_time = time.time() - start
+
+            loss_value = loss_sum / max(num_steps, 1)
+            loss_val, acc_val = evaluator.evaluate(val_dataset)
+            loss_test, acc_test = evaluator.evaluate(test_dataset)
+            ranks = [0, 0, 0, 0] if reference == 1 else model.get_low_ranks()
+            if not chief:
+                continue
+            print("Loss: " + str(loss_value))
+            print("Validation accuracy: " + str(acc_val) + " loss: " + str(loss_val))
+            print("Test accuracy: " + str(acc_test) + " loss: " + str(loss_test))
+            print("Epoch time: " + str(epoch_time) + "s, all-reduced gradient bytes per replica and step: " + str(
+                allreduce_bytes if reference == 1 else train_step.get_allreduce_bytes()))
+            if reference != 1:
+                print("Current Rank: " + " | ".join(str(rank) for rank in ranks))
+                print("Rank adaption: " + str(schedule.get_stats()))
+                checkpoint_writer.save(model, folder_name=folder_name)
+            log_string = str(loss_value) + ";" + str(loss_val) + ";" + str(acc_val) + ";" + str(loss_test) + ";" + str(
+                acc_test) + ";" + str(epoch_time) + ";" + ";".join(str(rank) for rank in ranks) + "\n"
+            with open(file_name, "a") as log:
+                log.write(log_string)
+            print("Epoch Data :" + log_string)
+    finally:
+        # wait for the pending checkpoint writes, also if training raises
+        checkpoint_writer.close()
+    return 0
+
+
+if __name__ == '__main__':
+    print("---------- Start Network Training Suite ------------")
+    print("Parsing options")
+    # --- parse options ---
+    parser = OptionParser()
+    parser.add_option("-s", "--start_rank", dest="start_rank", default=10)
+    parser.add_option("-t", "--tolerance", dest="tolerance", default=0.05)
+    parser.add_option("-a", "--train", dest="train", default=1)
+    parser.add_option("-d", "--dim_layer", dest="dim_layer", default=200)
+    parser.add_option("-m", "--max_rank", dest="max_rank", default=200)
+    parser.add_option("-e", "--epochs", dest="epochs", default=10)
+    parser.add_option("-n", "--batch_size", dest="batch_size", default=256)
+    parser.add_option("-r", "--reference", dest="reference", default=0)
+    parser.add_option("-c", "--compression_rank", dest="compression_rank", default=0)
+    parser.add_option("--svd", dest="svd_method", default="full")
+    parser.add_option("--adapt_mode", dest="adapt_mode", default="every")
+    parser.add_option("--adapt_interval", dest="adapt_interval", default=1)
+    parser.add_option("--adapt_threshold", dest="adapt_threshold", default=0.05)
+    parser.add_option("--data_cache", dest="data_cache", default=None)
+    parser.add_option("--seed", dest="seed", default=0)
+
+    (options, args) = parser.parse_args()
+    options.start_rank = int(options.start_rank)
+    options.tolerance = float(options.tolerance)
+    options.train = int(options.train)
+    options.dim_layer = int(options.dim_layer)
+    options.max_rank = int(options.max_rank)
+    options.epochs = int(options.epochs)
+    options.batch_size = int(options.batch_size)
+    options.reference = int(options.reference)
+    options.compression_rank = int(options.compression_rank)
+    options.adapt_interval = int(options.adapt_interval)
+    options.adapt_threshold = float(options.adapt_threshold)
+    options.seed = int(options.seed)
+
+    if options.train == 1:
+        train(start_rank=options.start_rank, tolerance=options.tolerance, dim_layer=options.dim_layer,
+              rmax=options.max_rank, epochs=options.epochs, batch_size_per_replica=options.batch_size,
+              reference=options.reference, compression_rank=options.compression_rank, svd_method=options.svd_method,
+              adapt_mode=options.adapt_mode, adapt_interval=options.adapt_interval,
+              adapt_threshold=options.adapt_threshold, data_cache=options.data_cache, seed=options.seed)
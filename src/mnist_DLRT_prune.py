@@ -1,15 +1,17 @@
 from networks.dense_dlrt_nets import DLRTNet
-from networks.utils import create_csv_logger_cb
+from networks.dense_layers import step_weights
+from networks.datasets import load_mnist, make_train_dataset
+from networks.utils import create_csv_logger_cb, make_eval_dataset, ClassificationEvaluator
+from networks.checkpoint import AsyncCheckpointWriter, open_checkpoint
 
 import tensorflow as tf
 from tensorflow import keras
 
-import numpy as np
 from optparse import OptionParser
 from os import path, makedirs
 
 
-def train(start_rank, tolerance, load_model):
+def train(start_rank, tolerance, load_model, data_cache=None, seed=0):
     # specify training
     epochs = 200
     batch_size = 256
@@ -45,27 +47,16 @@ def train(start_rank, tolerance, load_model):
     # Choose metrics (to monitor training, but not to optimize on)
     loss_metric = tf.keras.metrics.Mean()
     acc_metric = tf.keras.metrics.Accuracy()
-    loss_metric_acc_val = tf.keras.metrics.Accuracy()
 
     # Build dataset
-    (x_train, y_train), (x_test, y_test) = keras.datasets.mnist.load_data()
-    x_train = np.reshape(x_train, (-1, input_dim))
-    x_test = np.reshape(x_test, (-1, input_dim))
-
-    # Reserve 10,000 samples for validation.
-    val_size = 10000
-    x_val = x_train[-val_size:]
-    y_val = y_train[-val_size:]
-    (x_val, y_val) = normalize_img(x_val, y_val)
-
-    x_train = x_train[:-val_size]
-    y_train = y_train[:-val_size]
-    (x_train, y_train) = normalize_img(x_train, y_train)
-
-    (x_test, y_test) = normalize_img(x_test, y_test)
+    # normalized once, 10,000 training samples reserved for validation, memory-mapped from data_cache if given
+    (x_train, y_train), (x_val, y_val), (x_test, y_test) = load_mnist(cache_dir=data_cache)
+    val_dataset = make_eval_dataset(x_val, y_val)
+    test_dataset = make_eval_dataset(x_test, y_test)
+    # batched evaluation with a compiled inference step
+    evaluator = ClassificationEvaluator(model, loss_fn, step=0)
     # Prepare the training dataset.
-    train_dataset = tf.data.Dataset.from_tensor_slices((x_train, y_train))
-    train_dataset = train_dataset.shuffle(buffer_size=1024).batch(batch_size)
+    train_dataset = make_train_dataset(x_train, y_train, batch_size, seed=seed)
 
     # Create logger
     log_file, file_name = create_csv_logger_cb(folder_name=filename)
@@ -78,170 +69,15 @@ def train(start_rank, tolerance, load_model):
     # load weights
     model.build_model()
     if load_model == 1:
-        model.load_from_fullW(folder_name=folder_dense_weights, rank=start_rank)
-
-    best_acc = 0
-    best_loss = 10
-
-    # Measure truncated performance
-    # Compute vallidation loss and accuracy
-    loss_val = 0
-    acc_val = 0
-
-    #  K  Step Preproccessing
-    model.dlraBlockInput.k_step_preprocessing()
-    model.dlraBlock1.k_step_preprocessing()
-    model.dlraBlock2.k_step_preprocessing()
-    model.dlraBlock3.k_step_preprocessing()
-
-    # Validate model
-    out = model(x_val, step=0, training=False)
-    out = tf.keras.activations.softmax(out)
-    loss = loss_fn(y_val, out)
-    loss_metric.update_state(loss)
-    loss_val = loss_metric.result().numpy()
-
-    prediction = tf.math.argmax(out, 1)
-    acc_metric.update_state(prediction, y_val)
-    acc_val = acc_metric.result().numpy()
-    print("--------------------------------------")
-    print("Val Accuracy for the truncaded SVD network (not re-trained): " + str(acc_val))
-
-    # Reset metrics
-    loss_metric.reset_state()
-    acc_metric.reset_state()
-
-    # Test model
-    out = model(x_test, step=0, training=False)
-    out = tf.keras.activations.softmax(out)
-    loss = loss_fn(y_test, out)
-    loss_metric.update_state(loss)
-    loss_test = loss_metric.result().numpy()
-
-    prediction = tf.math.argmax(out, 1)
-    acc_metric.update_state(prediction, y_test)
-    acc_test = acc_metric.result().numpy()
-    log_string = "Test Loss: " + str(loss_test) + "| Test Accuracy" + str(acc_test) + "\n"
-    print("Test :" + log_string)
-    # Reset metrics
-    loss_metric.reset_state()
-    acc_metric.reset_state()
-
-    # Log Data of current epoch
-    log_string = "nan" + ";" + "nan" + ";" + str(
-        loss_val) + ";" + str(acc_val) + ";" + str(
-        loss_test) + ";" + str(acc_test) + ";" + str(
-        int(model.dlraBlockInput.low_rank)) + ";" + str(
-        int(model.dlraBlock1.low_rank)) + ";" + str(int(model.dlraBlock2.low_rank)) + ";" + str(
-        int(model.dlraBlock3.low_rank)) + "\n"
-    with open(file_name, "a") as log:
-        log.write(log_string)
-    print(
-        "Epoch Data (trunced SVD Network) : Train Loss, Train Accuracy, Validation Loss, Validation Accuracy, Test Loss, Test  Accuracy, rank layer 1, rank layer 2, rank layer 4")
+        model.load_from_fullW(folder_name=open_checkpoint(folder_dense_weights), rank=start_rank)
 
-    print("Epoch Data (trunced SVD Network) :" + log_string)
-
-    print("-------------- Start Low-rank Finetuning--------------")
-    # Start Training
-    for epoch in range(epochs):
-        print("Start of epoch %d" % (epoch,))
-        # Iterate over the batches of the dataset.
-
-        for step, batch_train in enumerate(train_dataset):
-            # 1.a) K and L Step Preproccessing
-            model.dlraBlockInput.k_step_preprocessing()
-            model.dlraBlockInput.l_step_preprocessing()
-            model.dlraBlock1.k_step_preprocessing()
-            model.dlraBlock1.l_step_preprocessing()
-            model.dlraBlock2.k_step_preprocessing()
-            model.dlraBlock2.l_step_preprocessing()
-            model.dlraBlock3.k_step_preprocessing()
-            model.dlraBlock3.l_step_preprocessing()
-
-            # 1.b) Tape Gradients for K-Step
-            model.toggle_non_s_step_training()
-            with tf.GradientTape() as tape:
-                out = model(batch_train[0], step=0, training=True)
-                # softmax activation for classification
-                out = tf.keras.activations.softmax(out)
-                # Compute reconstruction loss
-                loss = loss_fn(batch_train[1], out)
-                loss += sum(model.losses)  # Add KLD regularization loss
-            grads_k_step = tape.gradient(loss, model.trainable_weights)
-            model.set_none_grads_to_zero(grads_k_step, model.trainable_weights)
-            model.set_dlra_bias_grads_to_zero(grads_k_step)
-
-            # 1.b) Tape Gradients for L-Step
-            with tf.GradientTape() as tape:
-                out = model(batch_train[0], step=1, training=True)
-                # softmax activation for classification
-                out = tf.keras.activations.softmax(out)
-                # Compute reconstruction loss
-                loss = loss_fn(batch_train[1], out)
-                loss += sum(model.losses)  # Add KLD regularization loss
-            grads_l_step = tape.gradient(loss, model.trainable_weights)
-            model.set_none_grads_to_zero(grads_l_step, model.trainable_weights)
-            model.set_dlra_bias_grads_to_zero(grads_l_step)
-
-            # Gradient update for K and L
-            optimizer.apply_gradients(zip(grads_k_step, model.trainable_weights))
-            optimizer.apply_gradients(zip(grads_l_step, model.trainable_weights))
-
-            # Postprocessing K and L
-            model.dlraBlockInput.k_step_postprocessing()
-            model.dlraBlockInput.l_step_postprocessing()
-            model.dlraBlock1.k_step_postprocessing()
-            model.dlraBlock1.l_step_postprocessing()
-            model.dlraBlock2.k_step_postprocessing()
-            model.dlraBlock2.l_step_postprocessing()
-            model.dlraBlock3.k_step_postprocessing()
-            model.dlraBlock3.l_step_postprocessing()
-
-            # S-Step Preprocessing
-            model.dlraBlockInput.s_step_preprocessing()
-            model.dlraBlock1.s_step_preprocessing()
-            model.dlraBlock2.s_step_preprocessing()
-            model.dlraBlock3.s_step_preprocessing()
-
-            model.toggle_s_step_training()
-
-            # 3.b) Tape Gradients
-            with tf.GradientTape() as tape:
-                out = model(batch_train[0], step=2, training=True)
-                # softmax activation for classification
-                out = tf.keras.activations.softmax(out)
-                # Compute reconstruction loss
-                loss = loss_fn(batch_train[1], out)
-                loss += sum(model.losses)  # Add KLD regularization loss
-            # 3.c) Apply Gradients
-            grads_s = tape.gradient(loss, model.trainable_weights)
-            model.set_none_grads_to_zero(grads_s, model.trainable_weights)
-            optimizer.apply_gradients(zip(grads_s, model.trainable_weights))  # All gradients except K and L matrix
-
-            # Rank Adaptivity
-            # model.dlraBlockInput.rank_adaption()
-            # model.dlraBlock1.rank_adaption()
-            # model.dlraBlock2.rank_adaption()
-            # model.dlraBlock3.rank_adaption()
-
-            # Network monotoring and verbosity
-            loss_metric.update_state(loss)
-            prediction = tf.math.argmax(out, 1)
-            acc_metric.update_state(prediction, batch_train[1])
-
-            loss_value = loss_metric.result().numpy()
-            acc_value = acc_metric.result().numpy()
-            if step % 100 == 0:
-                print("step %d: mean loss S-Step = %.4f" % (step, loss_value))
-                print("Accuracy: " + str(acc_value))
-                print("Current Rank: " + str(int(model.dlraBlockInput.low_rank)) + " | " + str(
-                    int(model.dlraBlock1.low_rank)) + " | " + str(
-                    int(model.dlraBlock2.low_rank)) + " | " + str(int(model.dlraBlock3.low_rank)) + " )")
-
-            # Reset metrics
-            loss_metric.reset_state()
-            acc_metric.reset_state()
+    # checkpoints are written on a background thread, see AsyncCheckpointWriter
+    checkpoint_writer = AsyncCheckpointWriter()
+    try:
+        best_acc = 0
+        best_loss = 10
 
+        # Measure truncated performance
         # Compute vallidation loss and accuracy
         loss_val = 0
         acc_val = 0
@@ -253,48 +89,17 @@ def train(start_rank, tolerance, load_model):
         model.dlraBlock3.k_step_preprocessing()
 
         # Validate model
-        out = model(x_val, step=0, training=False)
-        out = tf.keras.activations.softmax(out)
-        loss = loss_fn(y_val, out)
-        loss_metric.update_state(loss)
-        loss_val = loss_metric.result().numpy()
-
-        prediction = tf.math.argmax(out, 1)
-        acc_metric.update_state(prediction, y_val)
-        acc_val = acc_metric.result().numpy()
-        print("Val Accuracy: " + str(acc_val))
-
-        # save current model if it's the best
-        if acc_val >= best_acc and loss_val <= best_loss:
-            best_acc = acc_val
-            best_loss = loss_val
-            print("new best model with accuracy: " + str(best_acc) + " and loss " + str(best_loss))
-
-            model.save(folder_name=folder_name_best)
-        model.save(folder_name=folder_name)
-
-        # Reset metrics
-        loss_metric.reset_state()
-        acc_metric.reset_state()
+        loss_val, acc_val = evaluator.evaluate(val_dataset)
+        print("--------------------------------------")
+        print("Val Accuracy for the truncaded SVD network (not re-trained): " + str(acc_val))
 
         # Test model
-        out = model(x_test, step=0, training=False)
-        out = tf.keras.activations.softmax(out)
-        loss = loss_fn(y_test, out)
-        loss_metric.update_state(loss)
-        loss_test = loss_metric.result().numpy()
-
-        prediction = tf.math.argmax(out, 1)
-        acc_metric.update_state(prediction, y_test)
-        acc_test = acc_metric.result().numpy()
-        log_string = "Loss: " + str(loss_test) + "| Accuracy" + str(acc_test) + "\n"
+        loss_test, acc_test = evaluator.evaluate(test_dataset)
+        log_string = "Test Loss: " + str(loss_test) + "| Test Accuracy" + str(acc_test) + "\n"
         print("Test :" + log_string)
-        # Reset metrics
-        loss_metric.reset_state()
-        acc_metric.reset_state()
 
         # Log Data of current epoch
-        log_string = str(loss_value) + ";" + str(acc_value) + ";" + str(
+        log_string = "nan" + ";" + "nan" + ";" + str(
             loss_val) + ";" + str(acc_val) + ";" + str(
             loss_test) + ";" + str(acc_test) + ";" + str(
             int(model.dlraBlockInput.low_rank)) + ";" + str(
@@ -302,16 +107,156 @@ def train(start_rank, tolerance, load_model):
             int(model.dlraBlock3.low_rank)) + "\n"
         with open(file_name, "a") as log:
             log.write(log_string)
-        print("Epoch Data :" + log_string)
+        print(
+            "Epoch Data (trunced SVD Network) : Train Loss, Train Accuracy, Validation Loss, Validation Accuracy, Test Loss, Test  Accuracy, rank layer 1, rank layer 2, rank layer 4")
+
+        print("Epoch Data (trunced SVD Network) :" + log_string)
+
+        print("-------------- Start Low-rank Finetuning--------------")
+        # Start Training
+        for epoch in range(epochs):
+            print("Start of epoch %d" % (epoch,))
+            # Iterate over the batches of the dataset.
+
+            for step, batch_train in enumerate(train_dataset):
+                # 1.a) K and L Step Preproccessing
+                model.dlraBlockInput.k_step_preprocessing()
+                model.dlraBlockInput.l_step_preprocessing()
+                model.dlraBlock1.k_step_preprocessing()
+                model.dlraBlock1.l_step_preprocessing()
+                model.dlraBlock2.k_step_preprocessing()
+                model.dlraBlock2.l_step_preprocessing()
+                model.dlraBlock3.k_step_preprocessing()
+                model.dlraBlock3.l_step_preprocessing()
+
+                # 1.b) Tape Gradients for K-Step
+                model.toggle_non_s_step_training()
+                with tf.GradientTape() as tape:
+                    out = model(batch_train[0], step=0, training=True)
+                    # softmax activation for classification
+                    out = tf.keras.activations.softmax(out)
+                    # Compute reconstruction loss
+                    loss = loss_fn(batch_train[1], out)
+                    loss += sum(model.losses)  # Add KLD regularization loss
+                k_weights = step_weights(model, 0)
+                grads_k_step = tape.gradient(loss, k_weights, unconnected_gradients=tf.UnconnectedGradients.ZERO)
+                model.set_dlra_bias_grads_to_zero(grads_k_step)
+
+                # 1.b) Tape Gradients for L-Step
+                with tf.GradientTape() as tape:
+                    out = model(batch_train[0], step=1, training=True)
+                    # softmax activation for classification
+                    out = tf.keras.activations.softmax(out)
+                    # Compute reconstruction loss
+                    loss = loss_fn(batch_train[1], out)
+                    loss += sum(model.losses)  # Add KLD regularization loss
+                l_weights = step_weights(model, 1)
+                grads_l_step = tape.gradient(loss, l_weights, unconnected_gradients=tf.UnconnectedGradients.ZERO)
+                model.set_dlra_bias_grads_to_zero(grads_l_step)
+
+                # Gradient update for K and L
+                optimizer.apply_gradients(zip(grads_k_step, k_weights))
+                optimizer.apply_gradients(zip(grads_l_step, l_weights))
+
+                # Postprocessing K and L
+                model.dlraBlockInput.k_step_postprocessing()
+                model.dlraBlockInput.l_step_postprocessing()
+                model.dlraBlock1.k_step_postprocessing()
+                model.dlraBlock1.l_step_postprocessing()
+                model.dlraBlock2.k_step_postprocessing()
+                model.dlraBlock2.l_step_postprocessing()
+                model.dlraBlock3.k_step_postprocessing()
+                model.dlraBlock3.l_step_postprocessing()
+
+                # S-Step Preprocessing
+                model.dlraBlockInput.s_step_preprocessing()
+                model.dlraBlock1.s_step_preprocessing()
+                model.dlraBlock2.s_step_preprocessing()
+                model.dlraBlock3.s_step_preprocessing()
+
+                model.toggle_s_step_training()
+
+                # 3.b) Tape Gradients
+                with tf.GradientTape() as tape:
+                    out = model(batch_train[0], step=2, training=True)
+                    # softmax activation for classification
+                    out = tf.keras.activations.softmax(out)
+                    # Compute reconstruction loss
+                    loss = loss_fn(batch_train[1], out)
+                    loss += sum(model.losses)  # Add KLD regularization loss
+                # 3.c) Apply Gradients
+                s_weights = step_weights(model, 2)
+                grads_s = tape.gradient(loss, s_weights)
+                optimizer.apply_gradients(zip(grads_s, s_weights))  # All gradients except K and L matrix
+
+                # Rank Adaptivity
+                # model.dlraBlockInput.rank_adaption()
+                # model.dlraBlock1.rank_adaption()
+                # model.dlraBlock2.rank_adaption()
+                # model.dlraBlock3.rank_adaption()
+
+                # Network monotoring and verbosity
+                loss_metric.update_state(loss)
+                prediction = tf.math.argmax(out, 1)
+                acc_metric.update_state(prediction, batch_train[1])
+
+                loss_value = loss_metric.result().numpy()
+                acc_value = acc_metric.result().numpy()
+                if step % 100 == 0:
+                    print("step %d: mean loss S-Step = %.4f" % (step, loss_value))
+                    print("Accuracy: " + str(acc_value))
+                    print("Current Rank: " + str(int(model.dlraBlockInput.low_rank)) + " | " + str(
+                        int(model.dlraBlock1.low_rank)) + " | " + str(
+                        int(model.dlraBlock2.low_rank)) + " | " + str(int(model.dlraBlock3.low_rank)) + " )")
+
+                # Reset metrics
+                loss_metric.reset_state()
+                acc_metric.reset_state()
+
+            # Compute vallidation loss and accuracy
+            loss_val = 0
+            acc_val = 0
+
+            #  K  Step Preproccessing
+            model.dlraBlockInput.k_step_preprocessing()
+            model.dlraBlock1.k_step_preprocessing()
+            model.dlraBlock2.k_step_preprocessing()
+            model.dlraBlock3.k_step_preprocessing()
 
+            # Validate model
+            loss_val, acc_val = evaluator.evaluate(val_dataset)
+            print("Val Accuracy: " + str(acc_val))
+
+            # save current model if it's the best
+            if acc_val >= best_acc and loss_val <= best_loss:
+                best_acc = acc_val
+                best_loss = loss_val
+                print("new best model with accuracy: " + str(best_acc) + " and loss " + str(best_loss))
+
+                checkpoint_writer.save(model, folder_name=folder_name_best)
+            checkpoint_writer.save(model, folder_name=folder_name)
+
+            # Test model
+            loss_test, acc_test = evaluator.evaluate(test_dataset)
+            log_string = "Loss: " + str(loss_test) + "| Accuracy" + str(acc_test) + "\n"
+            print("Test :" + log_string)
+
+            # Log Data of current epoch
+            log_string = str(loss_value) + ";" + str(acc_value) + ";" + str(
+                loss_val) + ";" + str(acc_val) + ";" + str(
+                loss_test) + ";" + str(acc_test) + ";" + str(
+                int(model.dlraBlockInput.low_rank)) + ";" + str(
+                int(model.dlraBlock1.low_rank)) + ";" + str(int(model.dlraBlock2.low_rank)) + ";" + str(
+                int(model.dlraBlock3.low_rank)) + "\n"
+            with open(file_name, "a") as log:
+                log.write(log_string)
+            print("Epoch Data :" + log_string)
+    finally:
+        # wait for the pending checkpoint writes, also if training raises
+        checkpoint_writer.close()
     return 0
 
 
-def normalize_img(image, label):
-    """Normalizes images: `uint8` -> `float32`."""
-    return tf.cast(image, tf.float32) / 255., label
-
-
 if __name__ == '__main__':
     print("---------- Start Network Training Suite ------------")
     print("Parsing options")
@@ -321,11 +266,15 @@ if __name__ == '__main__':
     parser.add_option("-t", "--tolerance", dest="tolerance", default=10)
     parser.add_option("-l", "--load_model", dest="load_model", default=1)
     parser.add_option("-a", "--train", dest="train", default=0)
+    parser.add_option("--data_cache", dest="data_cache", default=None)
+    parser.add_option("--seed", dest="seed", default=0)
 
     (options, args) = parser.parse_args()
     options.start_rank = int(options.start_rank)
     options.tolerance = float(options.tolerance)
     options.load_model = int(options.load_model)
     options.train = int(options.train)
+    options.seed = int(options.seed)
 
-    train(start_rank=options.start_rank, tolerance=options.tolerance, load_model=options.load_model)
+    train(start_rank=options.start_rank, tolerance=options.tolerance, load_model=options.load_model,
+          data_cache=options.data_cache, seed=options.seed)
@@ -1,15 +1,16 @@
 from networks.dense_dlrt_nets import ReferenceNet
-from networks.utils import create_csv_logger_cb
+from networks.datasets import load_mnist, make_train_dataset
+from networks.utils import create_csv_logger_cb, make_eval_dataset, ClassificationEvaluator
+from networks.checkpoint import AsyncCheckpointWriter, load_checkpoint
 
 import tensorflow as tf
 from tensorflow import keras
 
-import numpy as np
 from optparse import OptionParser
 from os import path, makedirs
 
 
-def train(load_model=1):
+def train(load_model=1, data_cache=None, seed=0):
     # specify training
     epochs = 250
     batch_size = 256
@@ -41,24 +42,14 @@ def train(load_model=1):
     acc_metric = tf.keras.metrics.Accuracy()
 
     # Build dataset
-    (x_train, y_train), (x_test, y_test) = keras.datasets.mnist.load_data()
-    x_train = np.reshape(x_train, (-1, input_dim))
-    x_test = np.reshape(x_test, (-1, input_dim))
-
-    # Reserve 10,000 samples for validation.
-    val_size = 10000
-    x_val = x_train[-val_size:]
-    y_val = y_train[-val_size:]
-    (x_val, y_val) = normalize_img(x_val, y_val)
-
-    x_train = x_train[:-val_size]
-    y_train = y_train[:-val_size]
-    (x_train, y_train) = normalize_img(x_train, y_train)
-
-    (x_test, y_test) = normalize_img(x_test, y_test)
+    # normalized once, 10,000 training samples reserved for validation, memory-mapped from data_cache if given
+    (x_train, y_train), (x_val, y_val), (x_test, y_test) = load_mnist(cache_dir=data_cache)
+    val_dataset = make_eval_dataset(x_val, y_val)
+    test_dataset = make_eval_dataset(x_test, y_test)
+    # batched evaluation with a compiled inference step
+    evaluator = ClassificationEvaluator(model, loss_fn)
     # Prepare the training dataset.
-    train_dataset = tf.data.Dataset.from_tensor_slices((x_train, y_train))
-    train_dataset = train_dataset.shuffle(buffer_size=1024).batch(batch_size)
+    train_dataset = make_train_dataset(x_train, y_train, batch_size, seed=seed)
 
     # Create logger
     log_file, file_name = create_csv_logger_cb(folder_name=filename)
@@ -70,106 +61,83 @@ def train(load_model=1):
 
     # load weights
     if load_model == 1:
-        model.load(folder_name=folder_name)
-
-    best_acc = 0
-    best_loss = 10
-    # Iterate over epochs. (Training loop)
-    for epoch in range(epochs):
-        print("Start of epoch %d" % (epoch,))
-        # Iterate over the batches of the dataset.
-
-        for step, batch_train in enumerate(train_dataset):
-            # 1 evaluation
-            with tf.GradientTape() as tape:
-                out = model(batch_train[0], training=True)
-                # softmax activation for classification
-                out = tf.keras.activations.softmax(out)
-                # Compute reconstruction loss
-                loss = loss_fn(batch_train[1], out)
-                loss += sum(model.losses)  # Add KLD regularization loss
-            grads = tape.gradient(loss, model.trainable_weights)
-
-            # Gradient update for K and L
-            optimizer.apply_gradients(zip(grads, model.trainable_weights))
-
-            # Network monotoring and verbosity
-            loss_metric.update_state(loss)
-            prediction = tf.math.argmax(out, 1)
-            acc_metric.update_state(prediction, batch_train[1])
-
-            loss_value = loss_metric.result().numpy()
-            acc_value = acc_metric.result().numpy()
-            if step % 100 == 0:
-                print("step %d: mean loss = %.4f" % (step, loss_value))
-                print("Accuracy: " + str(acc_value))
-
-            # Reset metrics
-            loss_metric.reset_state()
-            acc_metric.reset_state()
-
-        # Compute vallidation loss and accuracy
-
-        # Validate model
-        out = model(x_val, training=False)
-        out = tf.keras.activations.softmax(out)
-        loss = loss_fn(y_val, out)
-        loss_metric.update_state(loss)
-        loss_val = loss_metric.result().numpy()
-
-        prediction = tf.math.argmax(out, 1)
-        acc_metric.update_state(prediction, y_val)
-        acc_val = acc_metric.result().numpy()
-        print("Val Accuracy: " + str(acc_val))
-
-        # save current model if it's the best
-        if acc_val >= best_acc and loss_val <= best_loss:
-            best_acc = acc_val
-            best_loss = loss_val
-            print("new best model with accuracy: " + str(best_acc) + " and loss " + str(best_loss))
-
-        model.save(folder_name=folder_name_best)
-        model.save(folder_name=folder_name)
-
-        # Reset metrics
-        loss_metric.reset_state()
-        acc_metric.reset_state()
-
-        # Test model
-        out = model(x_test, training=False)
-        out = tf.keras.activations.softmax(out)
-        loss = loss_fn(y_test, out)
-        loss_metric.update_state(loss)
-        loss_test = loss_metric.result().numpy()
-
-        prediction = tf.math.argmax(out, 1)
-        acc_metric.update_state(prediction, y_test)
-        acc_test = acc_metric.result().numpy()
-        log_string = "Loss: " + str(loss_test) + "| Accuracy" + str(acc_test) + "\n"
-        print("Test :" + log_string)
-        # Reset metrics
-        loss_metric.reset_state()
-        acc_metric.reset_state()
-
-        # Log Data of current epoch
-        log_string = str(loss_value) + ";" + str(acc_value) + ";" + str(
-            loss_val) + ";" + str(acc_val) + ";" + str(
-            loss_test) + ";" + str(acc_test) + ";" + str(
-            int(dlra_layer_dim)) + ";" + str(int(dlra_layer_dim)) + ";" + str(
-            int(dlra_layer_dim)) + ";" + str(
-            int(dlra_layer_dim)) + "\n"
-        with open(file_name, "a") as log:
-            log.write(log_string)
-        print("Epoch Data :" + log_string)
-
+        load_checkpoint(model, folder_name=folder_name)
+
+    # checkpoints are written on a background thread, see AsyncCheckpointWriter
+    checkpoint_writer = AsyncCheckpointWriter()
+    try:
+        best_acc = 0
+        best_loss = 10
+        # Iterate over epochs. (Training loop)
+        for epoch in range(epochs):
+            print("Start of epoch %d" % (epoch,))
+            # Iterate over the batches of the dataset.
+
+            for step, batch_train in enumerate(train_dataset):
+                # 1 evaluation
+                with tf.GradientTape() as tape:
+                    out = model(batch_train[0], training=True)
+                    # softmax activation for classification
+                    out = tf.keras.activations.softmax(out)
+                    # Compute reconstruction loss
+                    loss = loss_fn(batch_train[1], out)
+                    loss += sum(model.losses)  # Add KLD regularization loss
+                grads = tape.gradient(loss, model.trainable_weights)
+
+                # Gradient update for K and L
+                optimizer.apply_gradients(zip(grads, model.trainable_weights))
+
+                # Network monotoring and verbosity
+                loss_metric.update_state(loss)
+                prediction = tf.math.argmax(out, 1)
+                acc_metric.update_state(prediction, batch_train[1])
+
+                loss_value = loss_metric.result().numpy()
+                acc_value = acc_metric.result().numpy()
+                if step % 100 == 0:
+                    print("step %d: mean loss = %.4f" % (step, loss_value))
+                    print("Accuracy: " + str(acc_value))
+
+                # Reset metrics
+                loss_metric.reset_state()
+                acc_metric.reset_state()
+
+            # Compute vallidation loss and accuracy
+
+            # Validate model
+            loss_val, acc_val = evaluator.evaluate(val_dataset)
+            print("Val Accuracy: " + str(acc_val))
+
+            # save current model if it's the best
+            if acc_val >= best_acc and loss_val <= best_loss:
+                best_acc = acc_val
+                best_loss = loss_val
+                print("new best model with accuracy: " + str(best_acc) + " and loss " + str(best_loss))
+
+            checkpoint_writer.save(model, folder_name=folder_name_best)
+            checkpoint_writer.save(model, folder_name=folder_name)
+
+            # Test model
+            loss_test, acc_test = evaluator.evaluate(test_dataset)
+            log_string = "Loss: " + str(loss_test) + "| Accuracy" + str(acc_test) + "\n"
+            print("Test :" + log_string)
+
+            # Log Data of current epoch
+            log_string = str(loss_value) + ";" + str(acc_value) + ";" + str(
+                loss_val) + ";" + str(acc_val) + ";" + str(
+                loss_test) + ";" + str(acc_test) + ";" + str(
+                int(dlra_layer_dim)) + ";" + str(int(dlra_layer_dim)) + ";" + str(
+                int(dlra_layer_dim)) + ";" + str(
+                int(dlra_layer_dim)) + "\n"
+            with open(file_name, "a") as log:
+                log.write(log_string)
+            print("Epoch Data :" + log_string)
+    finally:
+        # wait for the pending checkpoint writes, also if training raises
+        checkpoint_writer.close()
     return 0
 
 
-def normalize_img(image, label):
-    """Normalizes images: `uint8` -> `float32`."""
-    return tf.cast(image, tf.float32) / 255., label
-
-
 if __name__ == '__main__':
     print("---------- Start Network Training Suite ------------")
     print("Parsing options")
@@ -177,8 +145,11 @@ if __name__ == '__main__':
     parser = OptionParser()
 
     parser.add_option("-l", "--load_model", dest="load_model", default=1)
+    parser.add_option("--data_cache", dest="data_cache", default=None)
+    parser.add_option("--seed", dest="seed", default=0)
 
     (options, args) = parser.parse_args()
     options.load_model = int(options.load_model)
+    options.seed = int(options.seed)
 
-    train(load_model=options.load_model)
+    train(load_model=options.load_model, data_cache=options.data_cache, seed=options.seed)
@@ -0,0 +1,126 @@
+import json
+import os
+import platform
+import resource
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+
+def time_function(function, repeats=20, warmup=3, setup=None):
+    """
+    Wall clock timing of a function, the first warmup calls (tracing, allocation) are not recorded.
+    :param function: function without arguments
+    :param repeats: number of timed calls
+    :param warmup: number of untimed calls before
+    :param setup: function without arguments, called untimed before every call, e.g. to reset a rank
+    :return: dict with median, mean, min and std of the call times in milliseconds
+    """
+    for _ in range(warmup):
+        if setup is not None:
+            setup()
+        function()
+    times = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        times.append(1e3 * (time.perf_counter() - start))
+    times = np.array(times)
+    return {"median_ms": float(np.median(times)), "mean_ms": float(times.mean()), "min_ms": float(times.min()),
+            "std_ms": float(times.std()), "repeats": repeats}
+
+
+def get_environment():
+    """
+    :return: dict describing the machine and software the benchmark ran on
+    """
+    return {"tensorflow": tf.__version__, "numpy": np.__version__, "python": platform.python_version(),
+            "platform": platform.platform(), "processor": platform.processor(), "cpu_count": os.cpu_count(),
+            "gpus": len(tf.config.list_physical_devices("GPU")),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def write_results(file_name, results, config=None):
+    """
+    Writes benchmark results as json file {"environment": ..., "config": ..., "results": [...]}.
+    :param file_name: output file
+    :param results: list of dicts, one per measurement
+    :param config: dict of the benchmark options
+    """
+    with open(file_name, "w") as f:
+        json.dump({"environment": get_environment(), "config": config or {}, "results": results}, f, indent=1)
+    return 0
+
+
+def read_results(file_name):
+    with open(file_name, "r") as f:
+        return json.load(f)["results"]
+
+
+def compare_results(baseline, results, keys, threshold=0.1):
+    """
+    :param baseline: results of an earlier run, see read_results
+    :param results: results of the current run
+    :param keys: fields that identify a measurement, e.g. ("layer", "op", "batch")
+    :param threshold: relative increase of the median time that counts as regression
+    :return: list of (key, baseline median, current median, relative change) for all regressions
+    """
+    baseline_medians = {tuple(r[k] for k in keys): r["median_ms"] for r in baseline}
+    regressions = []
+    for r in results:
+        key = tuple(r[k] for k in keys)
+        if key not in baseline_medians or baseline_medians[key] <= 0:
+            continue
+        change = r["median_ms"] / baseline_medians[key] - 1
+        if change > threshold:
+            regressions.append((key, baseline_medians[key], r["median_ms"], change))
+    return regressions
+
+
+def synchronize():
+    """
+    Waits for all pending device work, so the wall clock covers the kernels and not only their launch. Without
+    tf.test.experimental.sync_devices (TF < 2.12) this is a no-op, eager CPU execution is synchronous anyway.
+    """
+    sync_devices = getattr(tf.test.experimental, "sync_devices", None)
+    if sync_devices is not None:
+        sync_devices()
+    return 0
+
+
+def get_peak_rss_mb():
+    """
+    :return: peak resident set size of the current process in MB
+    """
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak_rss / 2 ** 20 if sys.platform == "darwin" else peak_rss / 2 ** 10
+
+
+def count_parameters(model):
+    """
+    :param model: network or single layer, the DLRT layers are found among model and its submodules by their
+    get_weights_num
+    :return: dict with the number of allocated trainable parameters, the parameters in use at the current ranks
+    (low-rank factors of the DLRT layers plus all other weights) and the parameters of the full-rank equivalent
+    """
+    dlrt_layers = [module for module in [model] + list(model.submodules) if hasattr(module, "aux_U")
+                   and hasattr(module, "get_weights_num")]
+    factor_refs = {weight.ref() for layer in dlrt_layers for weight in layer.trainable_weights}
+    other = sum(int(np.prod(weight.shape)) for weight in model.trainable_weights if weight.ref() not in factor_refs)
+    weights_num = [layer.get_weights_num() for layer in dlrt_layers]
+    return {"allocated": sum(int(np.prod(weight.shape)) for weight in model.trainable_weights),
+            "low_rank": other + sum(low_rank for low_rank, _ in weights_num),
+            "full_rank": other + sum(full_rank for _, full_rank in weights_num)}
+
+
+def parse_int_list(values):
+    """
+    :param values: comma separated integers, e.g. "64,256"
+    :return: list of int
+    """
+    return [int(v) for v in str(values).split(",") if v.strip()]
@@ -0,0 +1,24 @@
+# BLEU scoring, run in the process pool of test_transformer
+
+
+def sentence_bleu_scores(references, hypotheses):
+    """
+    :param references: reference translations, each a list of words
+    :param hypotheses: predicted translations, each a list of words
+    :return: list of sentence BLEU scores
+    """
+    from nltk.translate.bleu_score import sentence_bleu
+
+    return [sentence_bleu(references=[reference], hypothesis=hypothesis)
+            for reference, hypothesis in zip(references, hypotheses)]
+
+
+def corpus_bleu_score(references, hypotheses):
+    """
+    :param references: reference translations, each a list of words
+    :param hypotheses: predicted translations, each a list of words
+    :return: corpus BLEU score
+    """
+    from nltk.translate.bleu_score import corpus_bleu
+
+    return corpus_bleu(list_of_references=[[reference] for reference in references], hypotheses=hypotheses)
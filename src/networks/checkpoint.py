@@ -0,0 +1,206 @@
+import json
+import os
+import queue
+import struct
+import threading
+from concurrent.futures import Future
+
+import numpy as np
+
+# Single file checkpoint archive
+# layout: MAGIC | header length (uint64, little endian) | json index | tensor blobs, each aligned to ALIGNMENT bytes
+MAGIC = b"DLRTCKPT"
+ALIGNMENT = 64
+CHECKPOINT_FILE = "checkpoint.dlrt"
+
+
+class CheckpointWriter:
+    """
+    Collects the named tensors of a network save and writes them as one archive.
+    Pass it as folder_name to the save functions of the networks and layers, or use save_checkpoint.
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.tensors = {}
+
+    def add(self, name, array):
+        self.tensors[name] = np.ascontiguousarray(array)
+
+    def write(self):
+        index = {}
+        offset = 0
+        for name, array in self.tensors.items():
+            index[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+            offset = _align(offset + array.nbytes)
+        header = json.dumps({"alignment": ALIGNMENT, "tensors": index}).encode("utf-8")
+        # blob offsets are relative to data_start, which itself is aligned
+        data_start = _align(len(MAGIC) + 8 + len(header))
+
+        tmp_name = self.file_name + ".tmp"
+        with open(tmp_name, "wb") as f:
+            f.write(MAGIC)
+            f.write(struct.pack("<Q", len(header)))
+            f.write(header)
+            for name, array in self.tensors.items():
+                f.seek(data_start + index[name]["offset"])
+                f.write(array.tobytes())
+            f.truncate(data_start + offset)
+        os.replace(tmp_name, self.file_name)  # never leave a half written checkpoint behind
+        return 0
+
+
+class CheckpointReader:
+    """
+    Memory maps an archive written by CheckpointWriter. Tensors are returned as read-only views into the mapping,
+    their data is only read from disk when a layer materializes them.
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        with open(file_name, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(file_name + " is not a DLRT checkpoint archive")
+            header_len, = struct.unpack("<Q", f.read(8))
+            header = json.loads(f.read(header_len).decode("utf-8"))
+        self.index = header["tensors"]
+        self.data_start = _align(len(MAGIC) + 8 + header_len, header["alignment"])
+        self.data = np.memmap(file_name, dtype=np.uint8, mode="r")
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __getitem__(self, name):
+        entry = self.index[name]
+        dtype = np.dtype(entry["dtype"])
+        start = self.data_start + entry["offset"]
+        nbytes = dtype.itemsize * int(np.prod(entry["shape"]))
+        return self.data[start:start + nbytes].view(dtype).reshape(entry["shape"])
+
+    def keys(self):
+        return self.index.keys()
+
+
+class AsyncCheckpointWriter:
+    """
+    Writes checkpoint archives on a background thread. save() snapshots the variables into host buffers on the
+    calling thread and queues the file write. At most max_pending writes are queued; further saves block until the
+    worker catches up. The worker is a daemon thread, close the writer (or use it as context manager) so that pending
+    writes finish even if training raises.
+    """
+
+    def __init__(self, max_pending=2):
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.futures = []
+        self.closed = False
+        self.worker = threading.Thread(target=self._run, name="checkpoint_writer", daemon=True)
+        self.worker.start()
+
+    def save(self, model, folder_name):
+        """
+        :param model: network with save(folder_name)
+        :param folder_name: checkpoint folder, the archive is folder_name/CHECKPOINT_FILE
+        :return: Future, resolves to the archive file name once it is written
+        """
+        if self.closed:
+            raise RuntimeError("Checkpoint writer is closed, can not save to " + folder_name)
+        # finished writes only need to be kept until close if they failed
+        self.futures = [future for future in self.futures if not future.done() or future.exception() is not None]
+        writer = CheckpointWriter(os.path.join(folder_name, CHECKPOINT_FILE))
+        model.save(folder_name=writer)  # snapshot, .numpy() copies every tensor to the host
+        future = Future()
+        self.pending.put((writer, future))
+        self.futures.append(future)
+        return future
+
+    def close(self):
+        """
+        Waits for all queued writes and stops the worker. Raises the first error of a failed write.
+        """
+        if self.closed:
+            return 0
+        self.closed = True
+        self.pending.put(None)
+        self.worker.join()
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+        return 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def _run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            writer, future = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                writer.write()
+                future.set_result(writer.file_name)
+            except BaseException as e:
+                future.set_exception(e)
+
+
+def write_array(folder_name, name, array):
+    """
+    :param folder_name: checkpoint folder (one .npy file per tensor) or CheckpointWriter
+    :param name: tensor name, e.g. "k" + str(layer_id)
+    :param array: numpy array
+    """
+    if isinstance(folder_name, CheckpointWriter):
+        folder_name.add(name, array)
+    else:
+        np.save(folder_name + "/" + name + ".npy", array)
+    return 0
+
+
+def read_array(folder_name, name):
+    """
+    :param folder_name: checkpoint folder (one .npy file per tensor) or CheckpointReader
+    :param name: tensor name, e.g. "k" + str(layer_id)
+    :return: numpy array, a lazy memory mapped view for archives
+    """
+    if isinstance(folder_name, CheckpointReader):
+        return folder_name[name]
+    return np.load(folder_name + "/" + name + ".npy")
+
+
+def save_checkpoint(model, folder_name):
+    """
+    Saves a network with save(folder_name) as single archive folder_name/CHECKPOINT_FILE
+    """
+    writer = CheckpointWriter(os.path.join(folder_name, CHECKPOINT_FILE))
+    model.save(folder_name=writer)
+    writer.write()
+    return 0
+
+
+def open_checkpoint(folder_name):
+    """
+    :param folder_name: checkpoint folder
+    :return: CheckpointReader, if the folder holds an archive, else folder_name for the per tensor .npy format
+    """
+    file_name = os.path.join(folder_name, CHECKPOINT_FILE)
+    if os.path.exists(file_name):
+        return CheckpointReader(file_name)
+    return folder_name
+
+
+def load_checkpoint(model, folder_name):
+    """
+    Loads a network with load(folder_name) from folder_name, archive or per tensor .npy files
+    """
+    model.load(folder_name=open_checkpoint(folder_name))
+    return 0
+
+
+def _align(offset, alignment=ALIGNMENT):
+    return -(-offset // alignment) * alignment
@@ -0,0 +1,107 @@
+import numpy as np
+import tensorflow as tf
+
+
+class PowerSGDCompressor:
+    """
+    Low-rank all-reduce of the gradients of dense weight matrices (PowerSGD, Vogels et al. 2019) for data parallel
+    training of the full rank reference networks. The gradient G (n x m) of a replica plus its error feedback E is
+    projected onto a rank r basis: P = (G + E) Q is all-reduced and orthonormalized by a QR decomposition, as K in
+    k_step_postprocessing, then Q = (G + E)^T P is all-reduced, and P Q^T replaces the all-reduced gradient. Only
+    r (n + m) instead of n m entries cross the wire. The part of G + E outside the basis stays on the replica as new
+    error feedback, so it is sent in later steps. Q is kept as warm start of the next step, a single power iteration
+    per step then tracks the dominant subspace of the gradients.
+    Vectors, sparse gradients (e.g. of embeddings) and matrices too small to profit are all-reduced as they are.
+    """
+
+    def __init__(self, rank=4, seed=0):
+        """
+        :param rank: rank r of the compressed gradients
+        :param seed: seed of the initial bases Q, equal on all workers
+        """
+        self.rank = rank
+        self.seed = seed
+        self.bases = {}  # variable.ref() -> Q (m, r)
+        self.errors = {}  # variable.ref() -> error feedback E (n, m) of the replica
+
+    def build(self, variables):
+        """
+        Creates the bases and the error feedback of the compressed variables, call in strategy.scope(). Both are
+        replica local variables: the error feedback differs between the replicas, the bases are equal on all of them
+        after each all-reduce.
+        :param variables: trainable variables of the network
+        """
+        for i, variable in enumerate(variables):
+            if not self.is_compressed(variable):
+                continue
+            q_np = np.random.RandomState(self.seed + i).standard_normal((variable.shape[1], self.rank))
+            self.bases[variable.ref()] = tf.Variable(initial_value=q_np, trainable=False, name="powersgd_q_",
+                                                     dtype=variable.dtype,
+                                                     synchronization=tf.VariableSynchronization.ON_READ,
+                                                     aggregation=tf.VariableAggregation.MEAN)
+            self.errors[variable.ref()] = tf.Variable(initial_value=tf.zeros(variable.shape, variable.dtype),
+                                                      trainable=False, name="powersgd_e_", dtype=variable.dtype,
+                                                      synchronization=tf.VariableSynchronization.ON_READ,
+                                                      aggregation=tf.VariableAggregation.SUM)
+        return 0
+
+    def is_compressed(self, variable):
+        """
+        :return: True, if the gradient of variable is sent at rank r, i.e. it is a matrix with r (n + m) < n m
+        """
+        if len(variable.shape) != 2:
+            return False
+        rows, columns = variable.shape
+        return self.rank * (rows + columns) < rows * columns
+
+    def all_reduce(self, grads_and_vars):
+        """
+        Sum of the gradients over all replicas, call in replica context, e.g. in the step function of strategy.run.
+        :param grads_and_vars: list of (gradient, variable) of the replica
+        :return: list of (all-reduced gradient, variable), to be applied without further aggregation
+        """
+        context = tf.distribute.get_replica_context()
+        compressed, plain = [], []
+        for grad, variable in grads_and_vars:
+            if variable.ref() in self.bases and not isinstance(grad, tf.IndexedSlices):
+                compressed.append((grad, variable))
+            else:
+                plain.append((grad, variable))
+
+        # 1) P = (G + E) Q, all-reduced together with the uncompressed gradients
+        corrected = [grad + self.errors[variable.ref()] for grad, variable in compressed]
+        ps = [tf.matmul(m, self.bases[variable.ref()]) for m, (_, variable) in zip(corrected, compressed)]
+        reduced_ps, reduced_plain = context.all_reduce(tf.distribute.ReduceOp.SUM,
+                                                       (ps, [grad for grad, _ in plain]))
+
+        # 2) orthonormal basis of P, Q = (G + E)^T P, the remainder is the new error feedback
+        p_hats = [tf.linalg.qr(p)[0] for p in reduced_ps]
+        qs = []
+        for m, p_hat, (_, variable) in zip(corrected, p_hats, compressed):
+            q = tf.matmul(m, p_hat, transpose_a=True)
+            self.errors[variable.ref()].assign(m - tf.matmul(p_hat, q, transpose_b=True))
+            qs.append(q)
+        reduced_qs = context.all_reduce(tf.distribute.ReduceOp.SUM, qs)
+
+        # 3) decompressed sum P Q^T, Q is the warm start of the next step
+        result = list(zip(reduced_plain, [variable for _, variable in plain]))
+        for p_hat, q, (_, variable) in zip(p_hats, reduced_qs, compressed):
+            self.bases[variable.ref()].assign(q)
+            result.append((tf.matmul(p_hat, q, transpose_b=True), variable))
+        return result
+
+    def get_allreduce_bytes(self, variables):
+        """
+        :param variables: trainable variables of the network
+        :return: bytes all-reduced per replica and step with compression, and without
+        """
+        compressed = 0
+        dense = 0
+        for variable in variables:
+            size = variable.shape.num_elements() * variable.dtype.size
+            dense += size
+            if variable.ref() in self.bases:
+                compressed += self.rank * (variable.shape[0] + variable.shape[1]) * variable.dtype.size
+            else:
+                compressed += size
+        return compressed, dense
@@ -6,12 +6,12 @@ Date 12.04.2022
 '''
 import tensorflow as tf
 from tensorflow import keras
-import numpy as np
 
 from tensorflow.keras.applications.vgg16 import VGG16
 
 from networks.convolutional_layers import DLRALayerConvAdaptive, DLRALayerConv
-from networks.dense_layers import DLRALayer, DLRALayerAdaptive
+from networks.dense_layers import DLRALayer, DLRALayerAdaptive, export_layers_for_inference
+from networks.checkpoint import write_array, read_array
 
 
 class VGG15DLRANHead(keras.Model):
@@ -110,18 +110,6 @@ class VGG15DLRANHead(keras.Model):
         self.dlraBlock2.s_step_preprocessing()
         return 0
 
-    @staticmethod
-    def set_none_grads_to_zero(grads, weights):
-        """
-        :param grads: gradients of current tape
-        :param weights: weights of current model
-        :return: sets the nonexistent gradients to zero (i K step, the grads of S and L step are None, which throws annoying warnings)
-        """
-        for i in range(len(grads)):
-            if grads[i] is None:
-                grads[i] = tf.zeros(shape=weights[i].shape, dtype=tf.float32)
-        return 0
-
     @staticmethod
     def set_dlra_bias_grads_to_zero(grads):
         """
@@ -163,6 +151,13 @@ class VGG15DLRANHead(keras.Model):
                  self.dlraBlock2.low_rank]
         return ranks
 
+    def export_for_inference(self, batch_size=1):
+        """
+        :param batch_size: expected batch size at inference, see export_layers_for_inference
+        """
+        export_layers_for_inference(self, ["dlraBlock1", "dlraBlock2"], batch_size=batch_size)
+        return 0
+
 
 #  Convolutional DLRANets
 
@@ -170,8 +165,7 @@ class DLRANetConv(keras.Model):
     # VGG16 for Cifar10
 
     def __init__(self, low_rank=20, tol=0.07, rmax_total=100, image_dims=(32, 32, 3), output_dim=10,
-                 name="DLRANetConv",
-                 **kwargs):
+                 factorized=False, name="DLRANetConv", **kwargs):
         super(DLRANetConv, self).__init__(name=name, **kwargs)
         # dlra_layer_dim = 250
         self.image_dims = image_dims
@@ -180,16 +174,17 @@ class DLRANetConv(keras.Model):
         self.low_rank = low_rank
         self.tol = tol
         self.rmax_total = rmax_total
+        self.factorized = factorized  # conv layers without patch matrix, see first_factor_conv
 
         # ---- architecture
         # block 1)
         self.dlraBlock1a = DLRALayerConv(low_rank=self.low_rank, epsAdapt=self.tol, rmax_total=self.rmax_total,
                                          stride=(1, 1), rate=(1, 1), size=(3, 3), filters=64,
-                                         image_dims=image_dims)
+                                         image_dims=image_dims, factorized=self.factorized)
         next_image_dims = self.dlraBlock1a.output_shape_conv
         self.dlraBlock1b = DLRALayerConv(low_rank=self.low_rank, epsAdapt=self.tol, rmax_total=self.rmax_total,
                                          stride=(1, 1), rate=(1, 1), size=(3, 3), filters=64,
-                                         image_dims=next_image_dims)
+                                         image_dims=next_image_dims, factorized=self.factorized)
         next_image_dims = self.dlraBlock1b.output_shape_conv
         self.pool1 = keras.layers.MaxPool2D(pool_size=(2, 2), strides=2, padding='SAME')
         # test for next image shapes
@@ -200,11 +195,11 @@ class DLRANetConv(keras.Model):
         # block 2)
         self.dlraBlock2a = DLRALayerConv(low_rank=self.low_rank, epsAdapt=self.tol, rmax_total=self.rmax_total,
                                          stride=(1, 1), rate=(1, 1), size=(3, 3), filters=128,
-                                         image_dims=next_image_dims)
+                                         image_dims=next_image_dims, factorized=self.factorized)
         next_image_dims = self.dlraBlock2a.output_shape_conv
         self.dlraBlock2b = DLRALayerConv(low_rank=self.low_rank, epsAdapt=self.tol, rmax_total=self.rmax_total,
                                          stride=(1, 1), rate=(1, 1), size=(3, 3), filters=128,
-                                         image_dims=next_image_dims)
+                                         image_dims=next_image_dims, factorized=self.factorized)
         next_image_dims = self.dlraBlock2b.output_shape_conv
         self.pool2 = keras.layers.MaxPool2D(pool_size=(2, 2), strides=2, padding='SAME')
         # test for next image shapes
@@ -215,11 +210,11 @@ class DLRANetConv(keras.Model):
         # block 3)
         self.dlraBlock3a = DLRALayerConv(low_rank=self.low_rank, epsAdapt=self.tol, rmax_total=self.rmax_total,
                                          stride=(1, 1), rate=(1, 1), size=(3, 3), filters=256,
-                                         image_dims=next_image_dims)
+                                         image_dims=next_image_dims, factorized=self.factorized)
         next_image_dims = self.dlraBlock3a.output_shape_conv
         self.dlraBlock3b = DLRALayerConv(low_rank=self.low_rank, epsAdapt=self.tol, rmax_total=self.rmax_total,
                                          stride=(1, 1), rate=(1, 1), size=(3, 3), filters=256,
-                                         image_dims=next_image_dims)
+                                         image_dims=next_image_dims, factorized=self.factorized)
         next_image_dims = self.dlraBlock3b.output_shape_conv
         self.pool3 = keras.layers.MaxPool2D(pool_size=(2, 2), strides=2, padding='SAME')
         # test for next image shapes
@@ -230,11 +225,11 @@ class DLRANetConv(keras.Model):
         # block 4)
         self.dlraBlock4a = DLRALayerConv(low_rank=self.low_rank, epsAdapt=self.tol, rmax_total=self.rmax_total,
                                          stride=(1, 1), rate=(1, 1), size=(3, 3), filters=512,
-                                         image_dims=next_image_dims)
+                                         image_dims=next_image_dims, factorized=self.factorized)
         next_image_dims = self.dlraBlock4a.output_shape_conv
         self.dlraBlock4b = DLRALayerConv(low_rank=self.low_rank, epsAdapt=self.tol, rmax_total=self.rmax_total,
                                          stride=(1, 1), rate=(1, 1), size=(3, 3), filters=512,
-                                         image_dims=next_image_dims)
+                                         image_dims=next_image_dims, factorized=self.factorized)
         next_image_dims = self.dlraBlock4b.output_shape_conv
         self.pool4 = keras.layers.MaxPool2D(pool_size=(2, 2), strides=2, padding='SAME')
         # test for next image shapes
@@ -245,11 +240,11 @@ class DLRANetConv(keras.Model):
         # block 5)
         self.dlraBlock5a = DLRALayerConv(low_rank=self.low_rank, epsAdapt=self.tol, rmax_total=self.rmax_total,
                                          stride=(1, 1), rate=(1, 1), size=(3, 3), filters=512,
-                                         image_dims=next_image_dims)
+                                         image_dims=next_image_dims, factorized=self.factorized)
         next_image_dims = self.dlraBlock5a.output_shape_conv
         self.dlraBlock5b = DLRALayerConv(low_rank=self.low_rank, epsAdapt=self.tol, rmax_total=self.rmax_total,
                                          stride=(1, 1), rate=(1, 1), size=(3, 3), filters=512,
-                                         image_dims=next_image_dims)
+                                         image_dims=next_image_dims, factorized=self.factorized)
         next_image_dims = self.dlraBlock5b.output_shape_conv
         self.pool5 = keras.layers.MaxPool2D(pool_size=(2, 2), strides=2, padding='SAME')
         # test for next image shapes
@@ -386,18 +381,6 @@ class DLRANetConv(keras.Model):
         self.dlraDense2.s_step_preprocessing()
         return 0
 
-    @staticmethod
-    def set_none_grads_to_zero(grads, weights):
-        """
-        :param grads: gradients of current tape
-        :param weights: weights of current model
-        :return: sets the nonexistent gradients to zero (i K step, the grads of S and L step are None, which throws annoying warnings)
-        """
-        for i in range(len(grads)):
-            if grads[i] is None:
-                grads[i] = tf.zeros(shape=weights[i].shape, dtype=tf.float32)
-        return 0
-
     @staticmethod
     def set_dlra_bias_grads_to_zero(grads):
         """
@@ -471,13 +454,21 @@ class DLRANetConv(keras.Model):
                  self.dlraDense2.low_rank]
         return ranks
 
+    def export_for_inference(self, batch_size=1):
+        """
+        :param batch_size: expected batch size at inference, see export_layers_for_inference
+        """
+        export_layers_for_inference(self, ["dlraBlock1a", "dlraBlock1b", "dlraBlock2a", "dlraBlock2b", "dlraBlock3a",
+                                     "dlraBlock3b", "dlraBlock4a", "dlraBlock4b", "dlraBlock5a", "dlraBlock5b",
+                                     "dlraDense1", "dlraDense2"], batch_size=batch_size)
+        return 0
+
 
 class DLRANetConvAdapt(keras.Model):
     # VGG16 for Cifar10
 
     def __init__(self, low_rank=20, tol=0.07, rmax_total=100, image_dims=(32, 32, 3), output_dim=10,
-                 name="DLRANetConv",
-                 **kwargs):
+                 factorized=False, name="DLRANetConv", **kwargs):
         super(DLRANetConvAdapt, self).__init__(name=name, **kwargs)
         # dlra_layer_dim = 250
         self.image_dims = image_dims
@@ -486,16 +477,17 @@ class DLRANetConvAdapt(keras.Model):
         self.low_rank = low_rank
         self.tol = tol
         self.rmax_total = rmax_total
+        self.factorized = factorized  # conv layers without patch matrix, see first_factor_conv
 
         # ---- architecture
         # block 1)
         self.dlraBlock1a = DLRALayerConvAdaptive(low_rank=20, epsAdapt=self.tol, rmax_total=self.rmax_total,
                                                  stride=(1, 1), rate=(1, 1), size=(3, 3), filters=64,
-                                                 image_dims=image_dims)
+                                                 image_dims=image_dims, factorized=self.factorized)
         next_image_dims = self.dlraBlock1a.output_shape_conv
         self.dlraBlock1b = DLRALayerConvAdaptive(low_rank=20, epsAdapt=self.tol, rmax_total=self.rmax_total,
                                                  stride=(1, 1), rate=(1, 1), size=(3, 3), filters=64,
-                                                 image_dims=next_image_dims)
+                                                 image_dims=next_image_dims, factorized=self.factorized)
         next_image_dims = self.dlraBlock1b.output_shape_conv
         self.pool1 = keras.layers.MaxPool2D(pool_size=(2, 2), strides=2, padding='SAME')
         # test for next image shapes
@@ -506,11 +498,11 @@ class DLRANetConvAdapt(keras.Model):
         # block 2)
         self.dlraBlock2a = DLRALayerConvAdaptive(low_rank=60, epsAdapt=self.tol, rmax_total=self.rmax_total,
                                                  stride=(1, 1), rate=(1, 1), size=(3, 3), filters=128,
-                                                 image_dims=next_image_dims)
+                                                 image_dims=next_image_dims, factorized=self.factorized)
         next_image_dims = self.dlraBlock2a.output_shape_conv
         self.dlraBlock2b = DLRALayerConvAdaptive(low_rank=60, epsAdapt=self.tol, rmax_total=self.rmax_total,
                                                  stride=(1, 1), rate=(1, 1), size=(3, 3), filters=128,
-                                                 image_dims=next_image_dims)
+                                                 image_dims=next_image_dims, factorized=self.factorized)
         next_image_dims = self.dlraBlock2b.output_shape_conv
         self.pool2 = keras.layers.MaxPool2D(pool_size=(2, 2), strides=2, padding='SAME')
         # test for next image shapes
@@ -521,11 +513,11 @@ class DLRANetConvAdapt(keras.Model):
         # block 3)
         self.dlraBlock3a = DLRALayerConvAdaptive(low_rank=100, epsAdapt=self.tol, rmax_total=self.rmax_total,
                                                  stride=(1, 1), rate=(1, 1), size=(3, 3), filters=256,
-                                                 image_dims=next_image_dims)
+                                                 image_dims=next_image_dims, factorized=self.factorized)
         next_image_dims = self.dlraBlock3a.output_shape_conv
         self.dlraBlock3b = DLRALayerConvAdaptive(low_rank=100, epsAdapt=self.tol, rmax_total=self.rmax_total,
                                                  stride=(1, 1), rate=(1, 1), size=(3, 3), filters=256,
-                                                 image_dims=next_image_dims)
+                                                 image_dims=next_image_dims, factorized=self.factorized)
         next_image_dims = self.dlraBlock3b.output_shape_conv
         self.pool3 = keras.layers.MaxPool2D(pool_size=(2, 2), strides=2, padding='SAME')
         # test for next image shapes
@@ -536,11 +528,11 @@ class DLRANetConvAdapt(keras.Model):
         # block 4)
         self.dlraBlock4a = DLRALayerConvAdaptive(low_rank=200, epsAdapt=self.tol, rmax_total=self.rmax_total,
                                                  stride=(1, 1), rate=(1, 1), size=(3, 3), filters=512,
-                                                 image_dims=next_image_dims)
+                                                 image_dims=next_image_dims, factorized=self.factorized)
         next_image_dims = self.dlraBlock4a.output_shape_conv
         self.dlraBlock4b = DLRALayerConvAdaptive(low_rank=200, epsAdapt=self.tol, rmax_total=self.rmax_total,
                                                  stride=(1, 1), rate=(1, 1), size=(3, 3), filters=512,
-                                                 image_dims=next_image_dims)
+                                                 image_dims=next_image_dims, factorized=self.factorized)
         next_image_dims = self.dlraBlock4b.output_shape_conv
         self.pool4 = keras.layers.MaxPool2D(pool_size=(2, 2), strides=2, padding='SAME')
         # test for next image shapes
@@ -551,11 +543,11 @@ class DLRANetConvAdapt(keras.Model):
         # block 5)
         self.dlraBlock5a = DLRALayerConvAdaptive(low_rank=200, epsAdapt=self.tol, rmax_total=self.rmax_total,
                                                  stride=(1, 1), rate=(1, 1), size=(3, 3), filters=512,
-                                                 image_dims=next_image_dims)
+                                                 image_dims=next_image_dims, factorized=self.factorized)
         next_image_dims = self.dlraBlock5a.output_shape_conv
         self.dlraBlock5b = DLRALayerConvAdaptive(low_rank=200, epsAdapt=self.tol, rmax_total=self.rmax_total,
                                                  stride=(1, 1), rate=(1, 1), size=(3, 3), filters=512,
-                                                 image_dims=next_image_dims)
+                                                 image_dims=next_image_dims, factorized=self.factorized)
         next_image_dims = self.dlraBlock5b.output_shape_conv
         self.pool5 = keras.layers.MaxPool2D(pool_size=(2, 2), strides=2, padding='SAME')
         # test for next image shapes
@@ -731,18 +723,6 @@ class DLRANetConvAdapt(keras.Model):
         self.dlraDense2.s_step_preprocessing()
         return 0
 
-    @staticmethod
-    def set_none_grads_to_zero(grads, weights):
-        """
-        :param grads: gradients of current tape
-        :param weights: weights of current model
-        :return: sets the nonexistent gradients to zero (i K step, the grads of S and L step are None, which throws annoying warnings)
-        """
-        for i in range(len(grads)):
-            if grads[i] is None:
-                grads[i] = tf.zeros(shape=weights[i].shape, dtype=tf.float32)
-        return 0
-
     @staticmethod
     def set_dlra_bias_grads_to_zero(grads):
         """
@@ -816,12 +796,20 @@ class DLRANetConvAdapt(keras.Model):
                  self.dlraDense2.low_rank]
         return ranks
 
+    def export_for_inference(self, batch_size=1):
+        """
+        :param batch_size: expected batch size at inference, see export_layers_for_inference
+        """
+        export_layers_for_inference(self, ["dlraBlock1a", "dlraBlock1b", "dlraBlock2a", "dlraBlock2b", "dlraBlock3a",
+                                     "dlraBlock3b", "dlraBlock4a", "dlraBlock4b", "dlraBlock5a", "dlraBlock5b",
+                                     "dlraDense1", "dlraDense2"], batch_size=batch_size)
+        return 0
+
 
 class DLRANetVGG16(keras.Model):
 
     def __init__(self, low_rank=20, tol=0.07, rmax_total=100, image_dims=(28, 28, 1), output_dim=10,
-                 name="DLRANetConv",
-                 **kwargs):
+                 factorized=False, name="DLRANetConv", **kwargs):
         super(DLRANetVGG16, self).__init__(name=name, **kwargs)
         # dlra_layer_dim = 250
         self.image_dims = image_dims
@@ -830,16 +818,17 @@ class DLRANetVGG16(keras.Model):
         self.low_rank = low_rank
         self.tol = tol
         self.rmax_total = rmax_total
+        self.factorized = factorized  # conv layers without patch matrix, see first_factor_conv
 
         # ---- architecture
         # block 1)
         self.dlraBlock1a = DLRALayerConv(low_rank=self.low_rank, epsAdapt=self.tol, rmax_total=self.rmax_total,
                                          stride=(1, 1), rate=(1, 1), size=(3, 3), filters=64,
-                                         image_dims=image_dims)
+                                         image_dims=image_dims, factorized=self.factorized)
         next_image_dims = self.dlraBlock1a.output_shape_conv
         self.dlraBlock1b = DLRALayerConv(low_rank=self.low_rank, epsAdapt=self.tol, rmax_total=self.rmax_total,
                                          stride=(1, 1), rate=(1, 1), size=(3, 3), filters=64,
-                                         image_dims=next_image_dims)
+                                         image_dims=next_image_dims, factorized=self.factorized)
         next_image_dims = self.dlraBlock1b.output_shape_conv
         self.pool1 = keras.layers.MaxPool2D(pool_size=(2, 2), strides=2, padding='SAME')
         # test for next image shapes
@@ -850,11 +839,11 @@ class DLRANetVGG16(keras.Model):
         # block 2)
         self.dlraBlock2a = DLRALayerConv(low_rank=self.low_rank, epsAdapt=self.tol, rmax_total=self.rmax_total,
                                          stride=(1, 1), rate=(1, 1), size=(3, 3), filters=128,
-                                         image_dims=next_image_dims)
+                                         image_dims=next_image_dims, factorized=self.factorized)
         next_image_dims = self.dlraBlock2a.output_shape_conv
         self.dlraBlock2b = DLRALayerConv(low_rank=self.low_rank, epsAdapt=self.tol, rmax_total=self.rmax_total,
                                          stride=(1, 1), rate=(1, 1), size=(3, 3), filters=64,
-                                         image_dims=next_image_dims)
+                                         image_dims=next_image_dims, factorized=self.factorized)
         next_image_dims = self.dlraBlock2b.output_shape_conv
         self.pool2 = keras.layers.MaxPool2D(pool_size=(2, 2), strides=2, padding='SAME')
         # test for next image shapes
@@ -865,11 +854,11 @@ class DLRANetVGG16(keras.Model):
         # block 3)
         self.dlraBlock3a = DLRALayerConv(low_rank=self.low_rank, epsAdapt=self.tol, rmax_total=self.rmax_total,
                                          stride=(1, 1), rate=(1, 1), size=(3, 3), filters=256,
-                                         image_dims=next_image_dims)
+                                         image_dims=next_image_dims, factorized=self.factorized)
         next_image_dims = self.dlraBlock3a.output_shape_conv
         self.dlraBlock3b = DLRALayerConv(low_rank=self.low_rank, epsAdapt=self.tol, rmax_total=self.rmax_total,
                                          stride=(1, 1), rate=(1, 1), size=(3, 3), filters=256,
-                                         image_dims=next_image_dims)
+                                         image_dims=next_image_dims, factorized=self.factorized)
         next_image_dims = self.dlraBlock3b.output_shape_conv
         self.pool3 = keras.layers.MaxPool2D(pool_size=(2, 2), strides=2, padding='SAME')
         # test for next image shapes
@@ -880,11 +869,11 @@ class DLRANetVGG16(keras.Model):
         # block 4)
         self.dlraBlock4a = DLRALayerConv(low_rank=self.low_rank, epsAdapt=self.tol, rmax_total=self.rmax_total,
                                          stride=(1, 1), rate=(1, 1), size=(3, 3), filters=512,
-                                         image_dims=next_image_dims)
+                                         image_dims=next_image_dims, factorized=self.factorized)
         next_image_dims = self.dlraBlock4a.output_shape_conv
         self.dlraBlock4b = DLRALayerConv(low_rank=self.low_rank, epsAdapt=self.tol, rmax_total=self.rmax_total,
                                          stride=(1, 1), rate=(1, 1), size=(3, 3), filters=512,
-                                         image_dims=next_image_dims)
+                                         image_dims=next_image_dims, factorized=self.factorized)
         next_image_dims = self.dlraBlock4b.output_shape_conv
         self.pool4 = keras.layers.MaxPool2D(pool_size=(2, 2), strides=2, padding='SAME')
         # test for next image shapes
@@ -895,11 +884,11 @@ class DLRANetVGG16(keras.Model):
         # block 5)
         self.dlraBlock5a = DLRALayerConv(low_rank=self.low_rank, epsAdapt=self.tol, rmax_total=self.rmax_total,
                                          stride=(1, 1), rate=(1, 1), size=(3, 3), filters=512,
-                                         image_dims=next_image_dims)
+                                         image_dims=next_image_dims, factorized=self.factorized)
         next_image_dims = self.dlraBlock5a.output_shape_conv
         self.dlraBlock5b = DLRALayerConv(low_rank=self.low_rank, epsAdapt=self.tol, rmax_total=self.rmax_total,
                                          stride=(1, 1), rate=(1, 1), size=(3, 3), filters=512,
-                                         image_dims=next_image_dims)
+                                         image_dims=next_image_dims, factorized=self.factorized)
         next_image_dims = self.dlraBlock5b.output_shape_conv
         self.pool5 = keras.layers.MaxPool2D(pool_size=(2, 2), strides=2, padding='SAME')
         # test for next image shapes
@@ -1076,18 +1065,6 @@ class DLRANetVGG16(keras.Model):
         self.dlraDense2.s_step_preprocessing()
         return 0
 
-    @staticmethod
-    def set_none_grads_to_zero(grads, weights):
-        """
-        :param grads: gradients of current tape
-        :param weights: weights of current model
-        :return: sets the nonexistent gradients to zero (i K step, the grads of S and L step are None, which throws annoying warnings)
-        """
-        for i in range(len(grads)):
-            if grads[i] is None:
-                grads[i] = tf.zeros(shape=weights[i].shape, dtype=tf.float32)
-        return 0
-
     @staticmethod
     def set_dlra_bias_grads_to_zero(grads):
         """
@@ -1126,6 +1103,15 @@ class DLRANetVGG16(keras.Model):
         self.dlraBlockOutput.load(folder_name=folder_name)
         return 0
 
+    def export_for_inference(self, batch_size=1):
+        """
+        :param batch_size: expected batch size at inference, see export_layers_for_inference
+        """
+        export_layers_for_inference(self, ["dlraBlock1a", "dlraBlock1b", "dlraBlock2a", "dlraBlock2b", "dlraBlock3a",
+                                     "dlraBlock3b", "dlraBlock4a", "dlraBlock4b", "dlraBlock5a", "dlraBlock5b",
+                                     "dlraDense1", "dlraDense2"], batch_size=batch_size)
+        return 0
+
 
 class Linear(keras.layers.Layer):
     def __init__(self, units=32, input_dim=32, name="linear", **kwargs):
@@ -1145,15 +1131,15 @@ class Linear(keras.layers.Layer):
 
     def save(self, folder_name):
         w_np = self.w.numpy()
-        np.save(folder_name + "/w_out.npy", w_np)
+        write_array(folder_name, "w_out", w_np)
         b_np = self.b.numpy()
-        np.save(folder_name + "/b_out.npy", b_np)
+        write_array(folder_name, "b_out", b_np)
         return 0
 
     def load(self, folder_name):
-        a_np = np.load(folder_name + "/w_out.npy")
+        a_np = read_array(folder_name, "w_out")
         self.w = tf.Variable(initial_value=a_np,
                              trainable=True, name="w_", dtype=tf.float32)
-        b_np = np.load(folder_name + "/b_out.npy")
+        b_np = read_array(folder_name, "b_out")
         self.b1 = tf.Variable(initial_value=b_np,
                               trainable=True, name="b_", dtype=tf.float32)
@@ -46,18 +46,6 @@ class VGG15DLRANHead_NoDLRA(keras.Model):
 
         return z
 
-    @staticmethod
-    def set_none_grads_to_zero(grads, weights):
-        """
-        :param grads: gradients of current tape
-        :param weights: weights of current model
-        :return: sets the nonexistent gradients to zero (i K step, the grads of S and L step are None, which throws annoying warnings)
-        """
-        for i in range(len(grads)):
-            if grads[i] is None:
-                grads[i] = tf.zeros(shape=weights[i].shape, dtype=tf.float32)
-        return 0
-
     @staticmethod
     def set_dlra_bias_grads_to_zero(grads):
         """
@@ -212,18 +200,6 @@ class VGG16Conv(keras.Model):
         z = self.output_layer(z)
         return z
 
-    @staticmethod
-    def set_none_grads_to_zero(grads, weights):
-        """
-        :param grads: gradients of current tape
-        :param weights: weights of current model
-        :return: sets the nonexistent gradients to zero (i K step, the grads of S and L step are None, which throws annoying warnings)
-        """
-        for i in range(len(grads)):
-            if grads[i] is None:
-                grads[i] = tf.zeros(shape=weights[i].shape, dtype=tf.float32)
-        return 0
-
     @staticmethod
     def set_dlra_bias_grads_to_zero(grads):
         """
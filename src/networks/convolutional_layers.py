@@ -1,13 +1,16 @@
 import tensorflow as tf
 from tensorflow import keras
-import numpy as np
+
+from .dense_layers import prefer_dense_product
+from .decompositions import truncated_svd
+from .checkpoint import write_array, read_array
 
 
 # Layers-----
 class DLRALayerConv(keras.layers.Layer):
     def __init__(self, low_rank=10, epsAdapt=0.1, rmax_total=100, stride: tuple = (5, 5), rate: tuple = (2, 2),
-                 size: tuple = (3, 3), filters=10, image_dims=(28, 28, 1), name="dlra_block_Conv2D",
-                 **kwargs):
+                 size: tuple = (3, 3), filters=10, image_dims=(28, 28, 1), factorized: bool = False,
+                 name="dlra_block_Conv2D", **kwargs):
         super(DLRALayerConv, self).__init__(**kwargs)
         # DLRA options
         self.epsAdapt = epsAdapt  # for unconventional integrator
@@ -21,6 +24,8 @@ class DLRALayerConv(keras.layers.Layer):
         self.channels = image_dims[2]
         self.size = size
         self.image_dims = image_dims
+        # U as size[0] x size[1] x C_in x r convolution kernel instead of the patch matrix, see first_factor_conv
+        self.factorized = factorized and supports_factorized_conv(self.stride, self.rate)
         # Resulting shapes
         self.units = self.filters  # output dimension
         self.input_dim = self.size[0] * self.size[1] * self.channels
@@ -86,28 +91,29 @@ class DLRALayerConv(keras.layers.Layer):
         :param step: step conter: k:= 0, l:=1, s:=2
         :return:
         """
-        # Convert Input in Patched Convolution
-        patches = tf.image.extract_patches(images=inputs,
-                                           sizes=[1, self.size[0], self.size[1], 1],
-                                           strides=[1, self.stride[0], self.stride[1], 1],
-                                           rates=[1, self.rate[0], self.rate[1], 1],
-                                           padding='SAME')
-
         if step == 0:  # k-step
-            z = tf.tensordot(patches, self.k, axes=([-1], [0]))
+            z = self.conv_first_factor(inputs, self.k)
             z = tf.tensordot(z, self.aux_Vt, axes=([-1], [0]))
             z = z + self.aux_b
         elif step == 1:  # l-step
-            z = tf.tensordot(patches, self.aux_U, axes=([-1], [0]))
+            z = self.conv_first_factor(inputs, self.aux_U)
             z = tf.tensordot(z, self.l_t, axes=([-1], [0]))
             z = z + self.aux_b
         else:  # s-step
-            z = tf.tensordot(patches, self.aux_Unp1, axes=([-1], [0]))
+            z = self.conv_first_factor(inputs, self.aux_Unp1)
             z = tf.tensordot(z, self.s, axes=([-1], [0]))
             z = tf.tensordot(z, self.aux_Vtnp1, axes=([-1], [0]))
             z = z + self.b
         return tf.keras.activations.relu(z)
 
+    def conv_first_factor(self, inputs, u):
+        """
+        :param inputs: layer input
+        :param u: first factor (size[0]*size[1]*C_in, r), i.e. k, aux_U or aux_Unp1
+        :return: input patches times u (batch,row,col,r), the remaining factors act on the last axis (1x1 convolutions)
+        """
+        return first_factor_conv(inputs, u, self.size, self.stride, self.rate, self.factorized)
+
     @tf.function
     def k_step_preprocessing(self, ):
         k = tf.matmul(self.aux_U, self.s)
@@ -144,6 +150,17 @@ class DLRALayerConv(keras.layers.Layer):
         self.s.assign(s)  # = tf.Variable(initial_value=s, trainable=True, name="s_")
         return 0
 
+    def export_for_inference(self, batch_size=1):
+        """
+        Freezes the layer at the current rank to the factors U S and V^T of the last S-step (bias b), without any
+        integrator state.
+        :param batch_size: expected number of images per call, decides between dense and low-rank product
+        :return: DLRALayerConvInference
+        """
+        return DLRALayerConvInference(us=tf.matmul(self.aux_U, self.s), vt=self.aux_Vt, b=self.b, stride=self.stride,
+                                      rate=self.rate, size=self.size, output_shape_conv=self.output_shape_conv,
+                                      batch_size=batch_size, factorized=self.factorized)
+
     def get_config(self):
         config = super(DLRALayerConv, self).get_config()
         config.update({"units": self.units})
@@ -153,58 +170,58 @@ class DLRALayerConv(keras.layers.Layer):
     def save(self, folder_name, layer_id):
         # main_variables
         k_np = self.k.numpy()
-        np.save(folder_name + "/k" + str(layer_id) + ".npy", k_np)
+        write_array(folder_name, "k" + str(layer_id), k_np)
         l_t_np = self.l_t.numpy()
-        np.save(folder_name + "/l_t" + str(layer_id) + ".npy", l_t_np)
+        write_array(folder_name, "l_t" + str(layer_id), l_t_np)
         s_np = self.s.numpy()
-        np.save(folder_name + "/s" + str(layer_id) + ".npy", s_np)
+        write_array(folder_name, "s" + str(layer_id), s_np)
         b_np = self.b.numpy()
-        np.save(folder_name + "/b" + str(layer_id) + ".npy", b_np)
+        write_array(folder_name, "b" + str(layer_id), b_np)
         # aux_variables
         aux_U_np = self.aux_U.numpy()
-        np.save(folder_name + "/aux_U" + str(layer_id) + ".npy", aux_U_np)
+        write_array(folder_name, "aux_U" + str(layer_id), aux_U_np)
         aux_Unp1_np = self.aux_Unp1.numpy()
-        np.save(folder_name + "/aux_Unp1" + str(layer_id) + ".npy", aux_Unp1_np)
+        write_array(folder_name, "aux_Unp1" + str(layer_id), aux_Unp1_np)
         aux_Vt_np = self.aux_Vt.numpy()
-        np.save(folder_name + "/aux_Vt" + str(layer_id) + ".npy", aux_Vt_np)
+        write_array(folder_name, "aux_Vt" + str(layer_id), aux_Vt_np)
         aux_Vtnp1_np = self.aux_Vtnp1.numpy()
-        np.save(folder_name + "/aux_Vtnp1" + str(layer_id) + ".npy", aux_Vtnp1_np)
+        write_array(folder_name, "aux_Vtnp1" + str(layer_id), aux_Vtnp1_np)
         aux_N_np = self.aux_N.numpy()
-        np.save(folder_name + "/aux_N" + str(layer_id) + ".npy", aux_N_np)
+        write_array(folder_name, "aux_N" + str(layer_id), aux_N_np)
         aux_M_np = self.aux_M.numpy()
-        np.save(folder_name + "/aux_M" + str(layer_id) + ".npy", aux_M_np)
+        write_array(folder_name, "aux_M" + str(layer_id), aux_M_np)
         return 0
 
     def load(self, folder_name, layer_id):
 
         # main variables
-        k_np = np.load(folder_name + "/k" + str(layer_id) + ".npy")
+        k_np = read_array(folder_name, "k" + str(layer_id))
         self.low_rank = k_np.shape[1]
         self.k = tf.Variable(initial_value=k_np,
                              trainable=True, name="k_", dtype=tf.float32)
-        l_t_np = np.load(folder_name + "/l_t" + str(layer_id) + ".npy")
+        l_t_np = read_array(folder_name, "l_t" + str(layer_id))
         self.l_t = tf.Variable(initial_value=l_t_np,
                                trainable=True, name="lt_", dtype=tf.float32)
-        s_np = np.load(folder_name + "/s" + str(layer_id) + ".npy")
+        s_np = read_array(folder_name, "s" + str(layer_id))
         self.s = tf.Variable(initial_value=s_np,
                              trainable=True, name="s_", dtype=tf.float32)
         # aux variables
-        aux_U_np = np.load(folder_name + "/aux_U" + str(layer_id) + ".npy")
+        aux_U_np = read_array(folder_name, "aux_U" + str(layer_id))
         self.aux_U = tf.Variable(initial_value=aux_U_np,
                                  trainable=True, name="aux_U", dtype=tf.float32)
-        aux_Unp1_np = np.load(folder_name + "/aux_Unp1" + str(layer_id) + ".npy")
+        aux_Unp1_np = read_array(folder_name, "aux_Unp1" + str(layer_id))
         self.aux_Unp1 = tf.Variable(initial_value=aux_Unp1_np,
                                     trainable=True, name="aux_Unp1", dtype=tf.float32)
-        Vt_np = np.load(folder_name + "/aux_Vt" + str(layer_id) + ".npy")
+        Vt_np = read_array(folder_name, "aux_Vt" + str(layer_id))
         self.aux_Vt = tf.Variable(initial_value=Vt_np,
                                   trainable=True, name="Vt", dtype=tf.float32)
-        vtnp1_np = np.load(folder_name + "/aux_Vtnp1" + str(layer_id) + ".npy")
+        vtnp1_np = read_array(folder_name, "aux_Vtnp1" + str(layer_id))
         self.aux_Vtnp1 = tf.Variable(initial_value=vtnp1_np,
                                      trainable=True, name="vtnp1", dtype=tf.float32)
-        aux_N_np = np.load(folder_name + "/aux_N" + str(layer_id) + ".npy")
+        aux_N_np = read_array(folder_name, "aux_N" + str(layer_id))
         self.aux_N = tf.Variable(initial_value=aux_N_np,
                                  trainable=True, name="aux_N", dtype=tf.float32)
-        aux_M_np = np.load(folder_name + "/aux_M" + str(layer_id) + ".npy")
+        aux_M_np = read_array(folder_name, "aux_M" + str(layer_id))
         self.aux_M = tf.Variable(initial_value=aux_M_np,
                                  trainable=True, name="aux_M", dtype=tf.float32)
         return 0
@@ -212,13 +229,17 @@ class DLRALayerConv(keras.layers.Layer):
 
 class DLRALayerConvAdaptive(keras.layers.Layer):
     def __init__(self, low_rank=10, epsAdapt=0.1, rmax_total=100, stride: tuple = (5, 5), rate: tuple = (2, 2),
-                 size: tuple = (3, 3), filters=10, image_dims=(28, 28, 1), name="dlra_block_Conv2D",
-                 **kwargs):
+                 size: tuple = (3, 3), filters=10, image_dims=(28, 28, 1), factorized: bool = False,
+                 svd_method="full", svd_oversampling=8, svd_power_iterations=4, name="dlra_block_Conv2D", **kwargs):
         super(DLRALayerConvAdaptive, self).__init__(**kwargs)
         # DLRA options
         self.epsAdapt = epsAdapt  # for unconventional integrator
         self.low_rank = low_rank  # min(image_dims[2] * size[0] * size[1], filters)
         self.rmax_total = rmax_total
+        # decomposition of S in the rank adaption, see truncated_svd
+        self.svd_method = svd_method
+        self.svd_oversampling = svd_oversampling
+        self.svd_power_iterations = svd_power_iterations
 
         # Convolution options
         self.stride = stride
@@ -227,6 +248,8 @@ class DLRALayerConvAdaptive(keras.layers.Layer):
         self.channels = image_dims[2]
         self.size = size
         self.image_dims = image_dims
+        # U as size[0] x size[1] x C_in x r convolution kernel instead of the patch matrix, see first_factor_conv
+        self.factorized = factorized and supports_factorized_conv(self.stride, self.rate)
         # Resulting shapes
         self.units = self.filters  # output dimension
         self.input_dim = self.size[0] * self.size[1] * self.channels
@@ -266,6 +289,7 @@ class DLRALayerConvAdaptive(keras.layers.Layer):
         print("Start rank has been set to: " + str(self.low_rank) + " to match max rank")
         self.input_dim = self.input_dim
 
+        # the factors stay allocated at rmax_total, unlike DLRTLayerAdaptive there is no capacity growth (yet)
         self.k = self.add_weight(shape=(self.input_dim, self.rmax_total), initializer="random_normal",
                                  trainable=True, name="k_")
         self.l_t = self.add_weight(shape=(self.rmax_total, self.units), initializer="random_normal",
@@ -289,6 +313,8 @@ class DLRALayerConvAdaptive(keras.layers.Layer):
                                      trainable=False, name="aux_N")
         self.aux_M = self.add_weight(shape=(2 * self.rmax_total, self.rmax_total), initializer="random_normal",
                                      trainable=False, name="aux_M")
+        self.rank = self.add_weight(shape=(), initializer=tf.keras.initializers.Constant(self.low_rank),
+                                    dtype=tf.int32, trainable=False, name="rank")  # current rank, see rank_adaption
         # Todo: initializer with low rank
         return 0
 
@@ -298,27 +324,22 @@ class DLRALayerConvAdaptive(keras.layers.Layer):
         :param step: step conter: k:= 0, l:=1, s:=2
         :return:
         """
-        # Convert Input in Patched Convolution
-        patches = tf.image.extract_patches(images=inputs,
-                                           sizes=[1, self.size[0], self.size[1], 1],
-                                           strides=[1, self.stride[0], self.stride[1], 1],
-                                           rates=[1, self.rate[0], self.rate[1], 1],
-                                           padding='SAME')
-
+        # sliced at the exact rank, so compiled steps retrace on every rank change. Unlike the dense adaptive layers,
+        # the conv layers have no rank buckets (see bucket_rank in dense_layers).
         if step == 0:  # k-step
-            z = tf.tensordot(patches, self.k[:, :self.low_rank], axes=([-1], [0]))
+            z = self.conv_first_factor(inputs, self.k[:, :self.low_rank])
             z = tf.tensordot(z, self.aux_Vt[:self.low_rank, :], axes=([-1], [0]))
             # z = tf.matmul(tf.matmul(inputs, self.k), self.aux_Vt)
             z = z + self.aux_b
 
         elif step == 1:  # l-step
-            z = tf.tensordot(patches, self.aux_U[:, :self.low_rank], axes=([-1], [0]))
+            z = self.conv_first_factor(inputs, self.aux_U[:, :self.low_rank])
             z = tf.tensordot(z, self.l_t[:self.low_rank, :], axes=([-1], [0]))
             z = z + self.aux_b
 
             # z = tf.matmul(tf.matmul(inputs, self.aux_U), self.l_t)
         else:  # s-step
-            z = tf.tensordot(patches, self.aux_Unp1[:, :2 * self.low_rank], axes=([-1], [0]))
+            z = self.conv_first_factor(inputs, self.aux_Unp1[:, :2 * self.low_rank])
             z = tf.tensordot(z, self.s[:2 * self.low_rank, :2 * self.low_rank], axes=([-1], [0]))
             z = tf.tensordot(z, self.aux_Vtnp1[:2 * self.low_rank, :], axes=([-1], [0]))
             # z = tf.matmul(tf.matmul(tf.matmul(inputs, self.aux_Unp1), self.s), self.aux_Vtnp1)
@@ -326,6 +347,14 @@ class DLRALayerConvAdaptive(keras.layers.Layer):
 
         return tf.keras.activations.relu(z)
 
+    def conv_first_factor(self, inputs, u):
+        """
+        :param inputs: layer input
+        :param u: first factor (size[0]*size[1]*C_in, r), i.e. k, aux_U or aux_Unp1
+        :return: input patches times u (batch,row,col,r), the remaining factors act on the last axis (1x1 convolutions)
+        """
+        return first_factor_conv(inputs, u, self.size, self.stride, self.rate, self.factorized)
+
     # @tf.function
     def k_step_preprocessing(self):
         k = tf.matmul(self.aux_U[:, :self.low_rank], self.s[:self.low_rank, :self.low_rank])
@@ -366,22 +395,22 @@ class DLRALayerConvAdaptive(keras.layers.Layer):
 
         return 0
 
-    # @tf.function
     def rank_adaption(self):
+        # the adaption runs compiled on the rank variable, low_rank mirrors it for the static slices of the other steps
+        self.low_rank = int(self.rank_adaption_compiled())
+        return 0
+
+    @tf.function
+    def rank_adaption_compiled(self):
         # 1) compute SVD of S
         # d=singular values, u2 = left singuar vecs, v2= right singular vecs
-        s_small = self.s[:2 * self.low_rank, :2 * self.low_rank]
-        d, u2, v2 = tf.linalg.svd(s_small)
-
-        tmp = 0.0
-        tol = self.epsAdapt * tf.linalg.norm(d)  # absolute value treshold (try also relative one)
-        rmax = int(tf.floor(d.shape[0] / 2))
-        for j in range(0, 2 * rmax - 1):
-            tmp = tf.linalg.norm(d[j:2 * rmax - 1])
-            if tmp < tol:
-                rmax = j
-                break
-
+        low_rank = self.rank.read_value()
+        s_small = self.s[:2 * low_rank, :2 * low_rank]
+        # the right singular vectors come as rows, v2 = V^T, see truncated_svd
+        rmax, d, u2, v2 = truncated_svd(s_small, low_rank, self.epsAdapt, method=self.svd_method,
+                                        warm_start=self.aux_M[:2 * low_rank, :low_rank],
+                                        oversampling=self.svd_oversampling,
+                                        power_iterations=self.svd_power_iterations)  # tol=\vartheta in paper
         rmax = tf.minimum(rmax, self.rmax_total)
         rmax = tf.maximum(rmax, 2)
 
@@ -389,13 +418,25 @@ class DLRALayerConvAdaptive(keras.layers.Layer):
         self.s[:rmax, :rmax].assign(tf.linalg.tensor_diag(d[:rmax]))
 
         # update u and v
-        self.aux_U[:, :rmax].assign(tf.matmul(self.aux_Unp1[:, :2 * self.low_rank], u2[:, :rmax]))
-        self.aux_Vt[:rmax, :].assign(tf.matmul(v2[:rmax, :], self.aux_Vtnp1[:2 * self.low_rank, :]))
-        self.low_rank = int(rmax)
+        self.aux_U[:, :rmax].assign(tf.matmul(self.aux_Unp1[:, :2 * low_rank], u2[:, :rmax]))
+        self.aux_Vt[:rmax, :].assign(tf.matmul(v2[:rmax, :], self.aux_Vtnp1[:2 * low_rank, :]))
+        self.rank.assign(rmax)
 
         # update bias
         self.aux_b.assign(self.b)
-        return 0
+        return rmax
+
+    def export_for_inference(self, batch_size=1):
+        """
+        Freezes the layer at the current rank to the factors U S and V^T of the last rank adaption (bias b), without
+        any integrator state.
+        :param batch_size: expected number of images per call, decides between dense and low-rank product
+        :return: DLRALayerConvInference
+        """
+        us = tf.matmul(self.aux_U[:, :self.low_rank], self.s[:self.low_rank, :self.low_rank])
+        return DLRALayerConvInference(us=us, vt=self.aux_Vt[:self.low_rank, :], b=self.b, stride=self.stride,
+                                      rate=self.rate, size=self.size, output_shape_conv=self.output_shape_conv,
+                                      batch_size=batch_size, factorized=self.factorized)
 
     def get_config(self):
         config = super(DLRALayerConvAdaptive, self).get_config()
@@ -406,62 +447,80 @@ class DLRALayerConvAdaptive(keras.layers.Layer):
     def save(self, folder_name, layer_id):
         # main_variables
         k_np = self.k[:, :self.low_rank].numpy()
-        np.save(folder_name + "/k" + str(layer_id) + ".npy", k_np)
-        l_t_np = self.l_t[:self.low_rank, :self.low_rank].numpy()
-        np.save(folder_name + "/l_t" + str(layer_id) + ".npy", l_t_np)
+        write_array(folder_name, "k" + str(layer_id), k_np)
+        l_t_np = self.l_t[:self.low_rank, :].numpy()
+        write_array(folder_name, "l_t" + str(layer_id), l_t_np)
         s_np = self.s[:2 * self.low_rank, :2 * self.low_rank].numpy()
-        np.save(folder_name + "/s" + str(layer_id) + ".npy", s_np)
+        write_array(folder_name, "s" + str(layer_id), s_np)
         b_np = self.b.numpy()
-        np.save(folder_name + "/b" + str(layer_id) + ".npy", b_np)
+        write_array(folder_name, "b" + str(layer_id), b_np)
         # aux_variables
         aux_U_np = self.aux_U[:, :self.low_rank].numpy()
-        np.save(folder_name + "/aux_U" + str(layer_id) + ".npy", aux_U_np)
+        write_array(folder_name, "aux_U" + str(layer_id), aux_U_np)
         aux_Unp1_np = self.aux_Unp1[:, :2 * self.low_rank].numpy()
-        np.save(folder_name + "/aux_Unp1" + str(layer_id) + ".npy", aux_Unp1_np)
-        aux_Vt_np = self.aux_Vt[:, :self.low_rank].numpy()
-        np.save(folder_name + "/aux_Vt" + str(layer_id) + ".npy", aux_Vt_np)
-        aux_Vtnp1_np = self.aux_Vtnp1[:, :2 * self.low_rank].numpy()
-        np.save(folder_name + "/aux_Vtnp1" + str(layer_id) + ".npy", aux_Vtnp1_np)
+        write_array(folder_name, "aux_Unp1" + str(layer_id), aux_Unp1_np)
+        aux_Vt_np = self.aux_Vt[:self.low_rank, :].numpy()
+        write_array(folder_name, "aux_Vt" + str(layer_id), aux_Vt_np)
+        aux_Vtnp1_np = self.aux_Vtnp1[:2 * self.low_rank, :].numpy()
+        write_array(folder_name, "aux_Vtnp1" + str(layer_id), aux_Vtnp1_np)
         aux_N_np = self.aux_N[:2 * self.low_rank, :self.low_rank].numpy()
-        np.save(folder_name + "/aux_N" + str(layer_id) + ".npy", aux_N_np)
+        write_array(folder_name, "aux_N" + str(layer_id), aux_N_np)
         aux_M_np = self.aux_M[:2 * self.low_rank, :self.low_rank].numpy()
-        np.save(folder_name + "/aux_M" + str(layer_id) + ".npy", aux_M_np)
+        write_array(folder_name, "aux_M" + str(layer_id), aux_M_np)
         return 0
 
     def load(self, folder_name, layer_id):
 
         # main variables
-        k_np = np.load(folder_name + "/k" + str(layer_id) + ".npy")
+        k_np = read_array(folder_name, "k" + str(layer_id))
         self.low_rank = k_np.shape[1]
         self.k = tf.Variable(initial_value=k_np,
                              trainable=True, name="k_", dtype=tf.float32)
-        l_t_np = np.load(folder_name + "/l_t" + str(layer_id) + ".npy")
+        l_t_np = read_array(folder_name, "l_t" + str(layer_id))
         self.l_t = tf.Variable(initial_value=l_t_np,
                                trainable=True, name="lt_", dtype=tf.float32)
-        s_np = np.load(folder_name + "/s" + str(layer_id) + ".npy")
+        s_np = read_array(folder_name, "s" + str(layer_id))
         self.s = tf.Variable(initial_value=s_np,
                              trainable=True, name="s_", dtype=tf.float32)
+        bias = read_array(folder_name, "b" + str(layer_id))
+        self.b.assign(bias)
+        self.aux_b.assign(bias)
         # aux variables
-        aux_U_np = np.load(folder_name + "/aux_U" + str(layer_id) + ".npy")
+        aux_U_np = read_array(folder_name, "aux_U" + str(layer_id))
         self.aux_U = tf.Variable(initial_value=aux_U_np,
-                                 trainable=True, name="aux_U", dtype=tf.float32)
-        aux_Unp1_np = np.load(folder_name + "/aux_Unp1" + str(layer_id) + ".npy")
+                                 trainable=False, name="aux_U", dtype=tf.float32)
+        aux_Unp1_np = read_array(folder_name, "aux_Unp1" + str(layer_id))
         self.aux_Unp1 = tf.Variable(initial_value=aux_Unp1_np,
-                                    trainable=True, name="aux_Unp1", dtype=tf.float32)
-        Vt_np = np.load(folder_name + "/aux_Vt" + str(layer_id) + ".npy")
+                                    trainable=False, name="aux_Unp1", dtype=tf.float32)
+        Vt_np = read_array(folder_name, "aux_Vt" + str(layer_id))
         self.aux_Vt = tf.Variable(initial_value=Vt_np,
-                                  trainable=True, name="Vt", dtype=tf.float32)
-        vtnp1_np = np.load(folder_name + "/aux_Vtnp1" + str(layer_id) + ".npy")
+                                  trainable=False, name="Vt", dtype=tf.float32)
+        vtnp1_np = read_array(folder_name, "aux_Vtnp1" + str(layer_id))
         self.aux_Vtnp1 = tf.Variable(initial_value=vtnp1_np,
-                                     trainable=True, name="vtnp1", dtype=tf.float32)
-        aux_N_np = np.load(folder_name + "/aux_N" + str(layer_id) + ".npy")
+                                     trainable=False, name="vtnp1", dtype=tf.float32)
+        aux_N_np = read_array(folder_name, "aux_N" + str(layer_id))
         self.aux_N = tf.Variable(initial_value=aux_N_np,
-                                 trainable=True, name="aux_N", dtype=tf.float32)
-        aux_M_np = np.load(folder_name + "/aux_M" + str(layer_id) + ".npy")
+                                 trainable=False, name="aux_N", dtype=tf.float32)
+        aux_M_np = read_array(folder_name, "aux_M" + str(layer_id))
         self.aux_M = tf.Variable(initial_value=aux_M_np,
-                                 trainable=True, name="aux_M", dtype=tf.float32)
+                                 trainable=False, name="aux_M", dtype=tf.float32)
+        self.rank.assign(self.low_rank)
         return 0
 
+    def get_active_factors(self, auxiliary=False):
+        """
+        :param auxiliary: include the bases U, V^T, their augmentations and N, M, see memory_report
+        :return: (factor, rows, columns) of the blocks of K, L^T and S in use at the current rank, see DLRTAdam
+        """
+        low_rank = self.rank.read_value()
+        factors = [(self.k, self.input_dim, low_rank), (self.l_t, low_rank, self.units),
+                   (self.s, 2 * low_rank, 2 * low_rank)]
+        if auxiliary:
+            factors += [(self.aux_U, self.input_dim, low_rank), (self.aux_Unp1, self.input_dim, 2 * low_rank),
+                        (self.aux_Vt, low_rank, self.units), (self.aux_Vtnp1, 2 * low_rank, self.units),
+                        (self.aux_N, 2 * low_rank, low_rank), (self.aux_M, 2 * low_rank, low_rank)]
+        return factors
+
 
 class LayerConv(keras.layers.Layer):
     def __init__(self, stride: tuple = (5, 5), rate: tuple = (2, 2),
@@ -530,18 +589,95 @@ class LayerConv(keras.layers.Layer):
     def save(self, folder_name, layer_id):
         # main_variables
         W = self.W.numpy()
-        np.save(folder_name + "/W" + str(layer_id) + ".npy", W)
+        write_array(folder_name, "W" + str(layer_id), W)
 
         b_np = self.b.numpy()
-        np.save(folder_name + "/b" + str(layer_id) + ".npy", b_np)
+        write_array(folder_name, "b" + str(layer_id), b_np)
         return 0
 
     def load(self, folder_name, layer_id):
         # main variables
-        W = np.load(folder_name + "/k" + str(layer_id) + ".npy")
+        W = read_array(folder_name, "k" + str(layer_id))
         self.W = tf.Variable(initial_value=W,
                              trainable=True, name="W_", dtype=tf.float32)
-        b = np.load(folder_name + "/b" + str(layer_id) + ".npy")
+        b = read_array(folder_name, "b" + str(layer_id))
         self.b = tf.Variable(initial_value=b,
                              trainable=True, name="b_", dtype=tf.float32)
         return 0
+
+
+class DLRALayerConvInference(keras.layers.Layer):
+    # Frozen DLRA conv layer for serving, created by export_for_inference of the DLRA conv layers
+    def __init__(self, us, vt, b, stride: tuple = (5, 5), rate: tuple = (2, 2), size: tuple = (3, 3),
+                 output_shape_conv=(28, 28, 10), batch_size=1, factorized: bool = False, name="dlra_conv_inference",
+                 **kwargs):
+        """
+        :param us: factor U S (size[0]*size[1]*C_in, r)
+        :param vt: factor V^T (r, filters)
+        :param b: bias, of shape output_shape_conv or (filters,)
+        :param output_shape_conv: output shape (row, col, filters) of the layer
+        :param batch_size: expected number of images per call, decides between dense and low-rank product
+        :param factorized: convolution with the first factor as kernel instead of the patch matrix
+        """
+        super(DLRALayerConvInference, self).__init__(**kwargs)
+        self.stride = stride
+        self.rate = rate
+        self.size = size
+        self.factorized = factorized and supports_factorized_conv(stride, rate)
+        self.input_dim, self.low_rank = us.shape
+        self.units = vt.shape[1]
+        self.output_shape_conv = output_shape_conv
+        # every output pixel is one row of the patch matrix
+        rows = batch_size * self.output_shape_conv[0] * self.output_shape_conv[1]
+        self.dense = prefer_dense_product(self.input_dim, self.units, self.low_rank, rows)
+        if self.dense:
+            self.w = tf.Variable(initial_value=tf.matmul(us, vt), trainable=False, name="w_", dtype=tf.float32)
+        else:
+            self.us = tf.Variable(initial_value=us, trainable=False, name="us_", dtype=tf.float32)
+            self.vt = tf.Variable(initial_value=vt, trainable=False, name="vt_", dtype=tf.float32)
+        self.b = tf.Variable(initial_value=b, trainable=False, name="b_", dtype=tf.float32)
+
+    @tf.function
+    def call(self, inputs, step: int = 0):
+        """
+        :param inputs: layer input
+        :param step: unused, keeps the call signature of the training layers
+        :return:
+        """
+        if self.dense:
+            z = first_factor_conv(inputs, self.w, self.size, self.stride, self.rate, self.factorized)
+        else:
+            z = first_factor_conv(inputs, self.us, self.size, self.stride, self.rate, self.factorized)
+            z = tf.tensordot(z, self.vt, axes=([-1], [0]))
+        return tf.keras.activations.relu(z + self.b)
+
+
+def supports_factorized_conv(stride, rate):
+    """
+    :return: True, if the convolution with stride and dilation rate can run as tf.nn.convolution, which does not
+             support strides > 1 together with dilation rates > 1
+    """
+    return max(stride) == 1 or max(rate) == 1
+
+
+def first_factor_conv(inputs, u, size, stride, rate, factorized):
+    """
+    Contracts all input patches with the first factor u of a DLRA conv layer.
+    :param inputs: images (batch,row,col,C_in)
+    :param u: factor (size[0]*size[1]*C_in, r)
+    :param factorized: True: convolution with u reshaped to a size[0] x size[1] x C_in x r kernel, never builds the
+                       patch matrix. False: tf.image.extract_patches and tensordot with u. Both give the same result,
+                       extract_patches orders a patch as (row, col, channel), like the kernel layout of conv2d
+    :return: (batch,row,col,r)
+    """
+    if factorized:
+        kernel = tf.reshape(u, (size[0], size[1], -1, tf.shape(u)[-1]))
+        return tf.nn.convolution(inputs, kernel, strides=stride, padding='SAME', dilations=rate)
+
+    # Convert Input in Patched Convolution
+    patches = tf.image.extract_patches(images=inputs,
+                                       sizes=[1, size[0], size[1], 1],
+                                       strides=[1, stride[0], stride[1], 1],
+                                       rates=[1, rate[0], rate[1], 1],
+                                       padding='SAME')
+    return tf.tensordot(patches, u, axes=([-1], [0]))
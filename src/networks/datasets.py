@@ -0,0 +1,271 @@
+import hashlib
+
+import numpy as np
+import tensorflow as tf
+from os import path, makedirs, getpid
+
+MNIST_INPUT_DIM = 784  # 28x28  pixel per image
+MNIST_VALIDATION_SIZE = 10000
+MNIST_SPLITS = ("train", "val", "test")
+
+
+def load_mnist(cache_dir=None, val_size=MNIST_VALIDATION_SIZE):
+    """
+    MNIST as flattened float32 images in [0, 1], normalized once. The last val_size training images are the validation
+    split. With cache_dir, the normalized arrays are written there as .npy files at the first call and memory-mapped
+    afterwards: later runs (and the workers of a distributed run on the same machine) skip the download and the
+    normalization and share the pages of the file.
+    :param cache_dir: directory of the on-disk cache, None keeps the arrays in memory only
+    :param val_size: number of validation images
+    :return: (x_train, y_train), (x_val, y_val), (x_test, y_test)
+    """
+    if cache_dir is not None and all(path.exists(cache_file(cache_dir, split, "x")) for split in MNIST_SPLITS):
+        return tuple((np.load(cache_file(cache_dir, split, "x"), mmap_mode="r"),
+                      np.load(cache_file(cache_dir, split, "y"), mmap_mode="r")) for split in MNIST_SPLITS)
+
+    (x_train, y_train), (x_test, y_test) = tf.keras.datasets.mnist.load_data()
+    x_train = normalize_images(x_train)
+    x_test = normalize_images(x_test)
+    splits = ((x_train[:-val_size], y_train[:-val_size]), (x_train[-val_size:], y_train[-val_size:]),
+              (x_test, y_test))
+    if cache_dir is None:
+        return splits
+
+    if not path.exists(cache_dir):
+        makedirs(cache_dir)
+    for split, (x, y) in zip(MNIST_SPLITS, splits):
+        for name, array in (("y", y), ("x", x)):
+            write_array_atomic(cache_file(cache_dir, split, name), array)
+    return load_mnist(cache_dir=cache_dir, val_size=val_size)
+
+
+def make_train_dataset(x, y, batch_size, seed=0, num_shards=1, shard_index=0, drop_remainder=False):
+    """
+    Input pipeline of the training loops: a seeded shuffle over the whole split, reshuffled each epoch, so runs with
+    the same seed see the same batches. The batches are assembled in parallel and prefetched, they are ready while the
+    previous step runs. In-memory arrays are sliced by tf.data, memory-mapped arrays (see load_mnist) are read by
+    index in the background, one batch per read.
+    :param x: normalized images, see load_mnist
+    :param y: labels
+    :param batch_size: batch size
+    :param seed: shuffle seed
+    :param num_shards: number of workers reading disjoint parts of the split
+    :param shard_index: part of this worker
+    :param drop_remainder: drop the last incomplete batch
+    :return: tf.data.Dataset of (images, labels) batches
+    """
+    num_samples = len(x)
+    if isinstance(x, np.memmap):
+        def read_batch(indices):
+            # sorted indices read the file front to back
+            indices = np.sort(indices)
+            return np.asarray(x[indices]), np.asarray(y[indices])
+
+        def load(indices):
+            images, labels = tf.numpy_function(read_batch, [indices], (tf.float32, tf.as_dtype(y.dtype)))
+            images.set_shape((None,) + x.shape[1:])
+            labels.set_shape((None,))
+            return images, labels
+
+        dataset = tf.data.Dataset.range(num_samples).shard(num_shards, shard_index)
+        dataset = dataset.shuffle(buffer_size=num_samples, seed=seed, reshuffle_each_iteration=True)
+        dataset = dataset.batch(batch_size, drop_remainder=drop_remainder)
+        dataset = dataset.map(load, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+    else:
+        dataset = tf.data.Dataset.from_tensor_slices((x, y)).shard(num_shards, shard_index)
+        dataset = dataset.shuffle(buffer_size=num_samples, seed=seed, reshuffle_each_iteration=True)
+        dataset = dataset.batch(batch_size, drop_remainder=drop_remainder, num_parallel_calls=tf.data.AUTOTUNE,
+                                deterministic=True)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def make_bucketed_batches(examples, tokenizers, max_tokens=128, token_budget=4096, bucket_width=8,
+                          max_batch_size=256, buffer_size=20000, shuffle=True, batch_multiple=1,
+                          drop_remainder=False, tokenize_batch_size=256, cache_dir=None, cache_name=None):
+    """
+    Batches of tokenized sentence pairs, grouped by length: an example falls into the bucket of the longer of its two
+    sentences and is padded to the upper end of that bucket, so a batch carries at most bucket_width - 1 padding
+    tokens per sentence and the batches take one of a fixed set of shapes. The batch size of a bucket follows from
+    token_budget. Examples with max_tokens or more tokens are dropped one by one before batching.
+    With cache_dir, the token ids are read from the on-disk cache of load_tokenized_examples instead of tokenizing
+    the sentences in every epoch.
+    :param examples: tf.data.Dataset of (portuguese, english) sentence pairs
+    :param tokenizers: tokenizers with the members pt and en, e.g. ted_hrlr_translate_pt_en_converter
+    :param max_tokens: examples with a sentence of max_tokens or more tokens are dropped
+    :param token_budget: padded tokens per batch in each language (batch size times padded length)
+    :param bucket_width: width of the length buckets in tokens
+    :param max_batch_size: upper bound of the batch size of the short buckets
+    :param buffer_size: shuffle buffer of the sentence pairs
+    :param shuffle: shuffle the examples, e.g. False for validation
+    :param batch_multiple: the batch sizes are multiples of it, e.g. the number of replicas of a distributed run
+    :param drop_remainder: drop the last incomplete batch of each bucket
+    :param tokenize_batch_size: sentences tokenized at once
+    :param cache_dir: directory of the token cache, None tokenizes the cached raw sentences in every epoch
+    :param cache_name: name of examples in the token cache, e.g. dataset and split
+    :return: tf.data.Dataset of (pt, en) int64 batches, padded with zeros
+    """
+    boundaries = bucket_boundaries(max_tokens, bucket_width)
+    # the bucket above the last boundary stays empty after the length filter
+    batch_sizes = [bucket_batch_size(boundary - 1, token_budget, max_batch_size, batch_multiple)
+                   for boundary in boundaries] + [batch_multiple]
+
+    def below_max_tokens(pt, en):
+        return tf.maximum(tf.shape(pt)[0], tf.shape(en)[0]) < max_tokens
+
+    if cache_dir is not None:
+        dataset = load_tokenized_examples(examples, tokenizers, cache_dir, cache_name,
+                                          tokenize_batch_size=tokenize_batch_size)
+        if shuffle:
+            dataset = dataset.shuffle(buffer_size)
+    else:
+        dataset = examples.cache()
+        if shuffle:
+            dataset = dataset.shuffle(buffer_size)
+        dataset = tokenize_examples(dataset, tokenizers, tokenize_batch_size)
+    dataset = dataset.filter(below_max_tokens)
+    dataset = dataset.bucket_by_sequence_length(
+        element_length_func=lambda pt, en: tf.maximum(tf.shape(pt)[0], tf.shape(en)[0]),
+        bucket_boundaries=boundaries, bucket_batch_sizes=batch_sizes, pad_to_bucket_boundary=True,
+        drop_remainder=drop_remainder)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def tokenize_examples(examples, tokenizers, tokenize_batch_size=256):
+    """
+    :param examples: tf.data.Dataset of (portuguese, english) sentence pairs
+    :param tokenizers: tokenizers with the members pt and en
+    :param tokenize_batch_size: sentences tokenized at once
+    :return: tf.data.Dataset of (pt, en) int64 token id sequences
+    """
+
+    def tokenize(pt, en):
+        return tokenizers.pt.tokenize(pt), tokenizers.en.tokenize(en)
+
+    def to_tensor(pt, en):
+        # unbatched rows of a ragged batch come as ragged tensors without ragged dimension
+        return tf.convert_to_tensor(pt), tf.convert_to_tensor(en)
+
+    return (examples
+            .batch(tokenize_batch_size)
+            .map(tokenize, num_parallel_calls=tf.data.AUTOTUNE)
+            .unbatch()
+            .map(to_tensor, num_parallel_calls=tf.data.AUTOTUNE))
+
+
+def load_tokenized_examples(examples, tokenizers, cache_dir, cache_name, tokenize_batch_size=256):
+    """
+    Token ids of the sentence pairs from an on-disk cache, keyed by cache_name and the hash of the tokenizers (see
+    tokenizer_hash), so a changed vocabulary never reads stale ids. Each language is stored ragged, as the token ids of
+    all sentences in one flat array plus the offsets of the sentences in it (row splits), both memory-mapped when
+    loaded. The sentences are read from the mapped files by index in the background, one pair per read, so the cache
+    is never copied into memory as a whole. The first call tokenizes examples once and writes the cache.
+    :param examples: tf.data.Dataset of (portuguese, english) sentence pairs
+    :param tokenizers: tokenizers with the members pt and en
+    :param cache_dir: directory of the cache
+    :param cache_name: name of examples in the cache, e.g. dataset and split
+    :param tokenize_batch_size: sentences tokenized at once when the cache is written
+    :return: tf.data.Dataset of (pt, en) int64 token id sequences, in the order of examples
+    """
+    prefix = path.join(cache_dir, cache_name.replace("/", "_") + "_" + tokenizer_hash(tokenizers))
+    files = [prefix + "_" + language + "_" + name + ".npy" for language in ("pt", "en")
+             for name in ("values", "offsets")]
+    if not all(path.exists(file) for file in files):
+        write_tokenized_examples(examples, tokenizers, files, tokenize_batch_size)
+
+    pt_values, pt_offsets, en_values, en_offsets = [np.load(file, mmap_mode="r") for file in files]
+
+    def read_pair(index):
+        return (np.asarray(pt_values[pt_offsets[index]:pt_offsets[index + 1]]),
+                np.asarray(en_values[en_offsets[index]:en_offsets[index + 1]]))
+
+    def load(index):
+        pt, en = tf.numpy_function(read_pair, [index], (tf.int64, tf.int64))
+        pt.set_shape((None,))
+        en.set_shape((None,))
+        return pt, en
+
+    return tf.data.Dataset.range(len(pt_offsets) - 1).map(load, num_parallel_calls=tf.data.AUTOTUNE,
+                                                          deterministic=True)
+
+
+def write_tokenized_examples(examples, tokenizers, files, tokenize_batch_size=256):
+    """
+    Tokenizes examples and writes the flat token ids and the row offsets of both languages to files (pt values, pt
+    offsets, en values, en offsets), see load_tokenized_examples.
+    """
+    values = {"pt": [], "en": []}
+    lengths = {"pt": [], "en": []}
+    for pt, en in examples.batch(tokenize_batch_size):
+        for language, tokens in (("pt", tokenizers.pt.tokenize(pt)), ("en", tokenizers.en.tokenize(en))):
+            values[language].append(tokens.flat_values.numpy().astype(np.int64))
+            lengths[language].append(tokens.row_lengths().numpy())
+
+    directory = path.dirname(files[0])
+    if directory and not path.exists(directory):
+        makedirs(directory)
+    arrays = []
+    for language in ("pt", "en"):
+        row_lengths = np.concatenate(lengths[language]) if lengths[language] else np.zeros(0, np.int64)
+        arrays.append(np.concatenate(values[language]) if values[language] else np.zeros(0, np.int64))
+        arrays.append(np.concatenate([[0], np.cumsum(row_lengths)]).astype(np.int64))
+    for file, array in zip(files, arrays):
+        write_array_atomic(file, array)
+    return 0
+
+
+def tokenizer_hash(tokenizers):
+    """
+    :param tokenizers: tokenizers with the members pt and en
+    :return: hex digest over the vocabulary files of both tokenizers (if they expose get_vocab_path, as the
+    ted_hrlr_translate_pt_en_converter does) and the token ids of a fixed probe sentence
+    """
+    digest = hashlib.sha1()
+    probe = tf.constant(["DLRT tokenizer probe: 0123456789, ol\u00e1 mundo!"])
+    for tokenizer in (tokenizers.pt, tokenizers.en):
+        if hasattr(tokenizer, "get_vocab_path"):
+            vocab_path = tokenizer.get_vocab_path()
+            vocab_path = vocab_path.numpy().decode("utf-8") if hasattr(vocab_path, "numpy") else str(vocab_path)
+            with tf.io.gfile.GFile(vocab_path, "rb") as vocab:
+                digest.update(vocab.read())
+        digest.update(tokenizer.tokenize(probe).flat_values.numpy().astype(np.int64).tobytes())
+    return digest.hexdigest()[:16]
+
+
+def bucket_boundaries(max_tokens, bucket_width):
+    """
+    :return: upper bounds (exclusive) of the length buckets, every bucket_width tokens up to max_tokens
+    """
+    boundaries = list(range(bucket_width, max_tokens, bucket_width))
+    return boundaries + [max_tokens]
+
+
+def bucket_batch_size(length, token_budget, max_batch_size, batch_multiple=1):
+    """
+    :return: batch size of a bucket of padded length, token_budget // length rounded down to a multiple of
+    batch_multiple, between batch_multiple and max_batch_size
+    """
+    batch_size = min(max(token_budget // length, 1), max_batch_size)
+    return max(batch_size // batch_multiple, 1) * batch_multiple
+
+
+def normalize_images(images):
+    """
+    :param images: uint8 images (num_images, 28, 28)
+    :return: float32 array (num_images, 784) in [0, 1]
+    """
+    return np.reshape(images, (-1, MNIST_INPUT_DIM)).astype(np.float32) / 255.
+
+
+def cache_file(cache_dir, split, name):
+    return path.join(cache_dir, "mnist_" + split + "_" + name + ".npy")
+
+
+def write_array_atomic(file_name, array):
+    """
+    Writes array as .npy under a temporary name first and renames it, so an interrupted run (or another process
+    writing the same cache) never leaves a truncated file behind.
+    """
+    temporary = file_name + "." + str(getpid()) + ".tmp.npy"
+    np.save(temporary, array)
+    tf.io.gfile.rename(temporary, file_name, overwrite=True)
+    return 0
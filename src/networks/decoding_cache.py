@@ -0,0 +1,123 @@
+import tensorflow as tf
+
+# Key/value cache for incremental decoding, shared by Transformer, TransformerDLRT and TransformerDLRTFR.
+# The functions work on the attention and decoder layers of all three transformers, extra arguments (the step of
+# the DLRT layers) are passed on to the calls of the projection and decoder layers.
+# cache layout: {"position", "self_mask", "padding_mask", "layers": [{"k_self", "v_self", "k_enc", "v_enc"}, ...]}
+
+
+def project_kv(mha, v, k, *args):
+    """
+    Projects and splits keys and values, e.g. once for the encoder output during incremental decoding.
+    :param mha: MultiHeadAttention layer
+    :return: k, v with shape (batch_size, num_heads, seq_len, depth)
+    """
+    batch_size = tf.shape(k)[0]
+
+    k = mha.split_heads(mha.wk(k, *args), batch_size)  # (batch_size, num_heads, seq_len_k, depth)
+    v = mha.split_heads(mha.wv(v, *args), batch_size)  # (batch_size, num_heads, seq_len_v, depth)
+    return k, v
+
+
+def attend_cached(mha, v, k, q, mask, *args):
+    """
+    Attention of q against keys and values that are already projected by project_kv
+    :param mha: MultiHeadAttention layer
+    :return: attention output (batch_size, seq_len_q, d_model)
+    """
+    batch_size = tf.shape(q)[0]
+
+    q = mha.split_heads(mha.wq(q, *args), batch_size)  # (batch_size, num_heads, seq_len_q, depth)
+
+    # scaled_dot_product_attention of the transformers, the attention weights are not needed while decoding
+    logits = tf.matmul(q, k, transpose_b=True) / tf.math.sqrt(tf.cast(mha.depth, tf.float32))
+    if mask is not None:
+        logits += (mask * -1e9)
+    scaled_attention = tf.matmul(tf.nn.softmax(logits, axis=-1), v)  # (batch_size, num_heads, seq_len_q, depth)
+
+    scaled_attention = tf.transpose(scaled_attention, perm=[0, 2, 1, 3])  # (batch_size, seq_len_q, num_heads, depth)
+    concat_attention = tf.reshape(scaled_attention, (batch_size, -1, mha.d_model))  # (batch_size, seq_len_q, d_model)
+
+    return mha.dense(concat_attention, *args)  # (batch_size, seq_len_q, d_model)
+
+
+def init_layer_cache(layer, enc_output, max_length, *args):
+    """
+    :param layer: DecoderLayer with self attention mha1 and encoder attention mha2
+    :param enc_output: encoder output, (batch_size, input_seq_len, d_model)
+    :param max_length: number of target tokens the cache can hold
+    :return: decoding cache of the layer, self attention keys and values of the decoded tokens (zero until
+             written) and keys and values of the encoder output, projected once by the second attention block
+    """
+    k_enc, v_enc = project_kv(layer.mha2, enc_output, enc_output, *args)
+    empty = tf.zeros((tf.shape(enc_output)[0], layer.mha1.num_heads, max_length, layer.mha1.depth))
+    return {"k_self": empty, "v_self": empty, "k_enc": k_enc, "v_enc": v_enc}
+
+
+def attention_blocks_step(layer, x, cache, position, self_mask, padding_mask, *args):
+    """
+    Incremental version of the two attention blocks of a DecoderLayer for the newest target token, inference only.
+    The layers apply their feed forward block to the outputs.
+    :param x: newest token, (batch_size, 1, d_model)
+    :param cache: decoding cache of the layer, see init_layer_cache
+    :param position: position of the newest token
+    :param self_mask: padding mask of the cache slots, unwritten slots are masked
+    :return: outputs of the self attention and the encoder attention block, (batch_size, 1, d_model) each, and the
+             updated cache of the layer
+    """
+    k, v = project_kv(layer.mha1, x, x, *args)  # (batch_size, num_heads, 1, depth)
+    slot = tf.one_hot(position, tf.shape(cache["k_self"])[2])[:, tf.newaxis]  # (max_length, 1)
+    k_self = cache["k_self"] + slot * k  # the slot of the newest token is still zero
+    v_self = cache["v_self"] + slot * v
+
+    # the newest token may attend to all decoded tokens, the look ahead mask is not needed
+    attn1 = attend_cached(layer.mha1, v_self, k_self, x, self_mask, *args)  # (batch_size, 1, d_model)
+    out1 = layer.layernorm1(attn1 + x)
+
+    attn2 = attend_cached(layer.mha2, cache["v_enc"], cache["k_enc"], out1, padding_mask, *args)
+    out2 = layer.layernorm2(attn2 + out1)  # (batch_size, 1, d_model)
+
+    return out1, out2, {"k_self": k_self, "v_self": v_self, "k_enc": cache["k_enc"], "v_enc": cache["v_enc"]}
+
+
+def init_cache(decoder, enc_output, padding_mask, max_length, *args):
+    """
+    :param decoder: Decoder
+    :param enc_output: encoder output, (batch_size, input_seq_len, d_model)
+    :param padding_mask: padding mask of the encoder input
+    :param max_length: number of target tokens the cache can hold
+    :return: decoding cache for decode_step
+    """
+    batch_size = tf.shape(enc_output)[0]
+    layers = [init_layer_cache(decoder.dec_layers[i], enc_output, max_length, *args)
+              for i in range(decoder.num_layers)]
+    return {"position": tf.constant(0), "self_mask": tf.ones((batch_size, 1, 1, max_length)),
+            "padding_mask": padding_mask, "layers": layers}
+
+
+def decode_step(decoder, x, cache, *args):
+    """
+    Incremental version of Decoder.call, runs the decoder on the newest target token only.
+    The decoder layers implement decode_step(x, layer_cache, position, self_mask, padding_mask, *args).
+    :param decoder: Decoder
+    :param x: newest target token, (batch_size, 1)
+    :param cache: decoding cache, see init_cache
+    :return: decoder output for the newest token (batch_size, 1, d_model) and the updated cache
+    """
+    position = cache["position"]
+    slot = tf.one_hot(position, tf.shape(cache["self_mask"])[-1])
+    padding = tf.cast(tf.math.equal(x, 0), tf.float32)[:, tf.newaxis, tf.newaxis, :]  # (batch_size, 1, 1, 1)
+    self_mask = cache["self_mask"] * (1.0 - slot) + padding * slot
+
+    x = decoder.embedding(x)  # (batch_size, 1, d_model)
+    x *= tf.math.sqrt(tf.cast(decoder.d_model, tf.float32))
+    x += decoder.pos_encoding[:, position:position + 1, :]
+
+    layers = []
+    for i in range(decoder.num_layers):
+        x, layer_cache = decoder.dec_layers[i].decode_step(x, cache["layers"][i], position, self_mask,
+                                                           cache["padding_mask"], *args)
+        layers.append(layer_cache)
+
+    return x, {"position": position + 1, "self_mask": self_mask, "padding_mask": cache["padding_mask"],
+               "layers": layers}
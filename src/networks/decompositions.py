@@ -0,0 +1,125 @@
+import tensorflow as tf
+
+# decomposition backends of the rank adaption, see truncated_svd
+SVD_METHODS = ("full", "randomized", "incremental")
+
+
+def truncated_svd(s, low_rank, eps_adapt, method="full", warm_start=None, oversampling=8, power_iterations=4,
+                  power_tol=1e-3):
+    """
+    Decomposition of the augmented S (2r x 2r) for the rank adaption, truncated by the rule of truncation_rank.
+    "full" runs tf.linalg.svd. "randomized" sketches S with r + oversampling random vectors and refines the sketch with
+    power iterations, "incremental" starts the sketch from warm_start instead, the old right singular vectors in the
+    new basis, so a single iteration usually suffices. The power iterations stop early, once the energy captured by
+    the sketch changes less than power_tol. The tail norms of the truncation rule are bounded by ||S||_F^2 minus the
+    captured energy, see sketch_truncation_rank. Whenever these bounds do not pin down the rank of truncation_rank,
+    and whenever the sketch would span all of S (r <= oversampling), the full SVD is computed instead, so all backends
+    pick the same rank.
+    :param s: augmented S, (2r, 2r)
+    :param low_rank: current rank r, int32 tensor
+    :param eps_adapt: relative truncation tolerance
+    :param method: one of SVD_METHODS
+    :param warm_start: (2r, r) start vectors of the incremental sketch, e.g. M = V_np1^T V_old
+    :param oversampling: sketch width beyond r
+    :param power_iterations: maximal number of power iterations
+    :param power_tol: relative change of the captured energy that stops the power iterations
+    :return: new rank (before the bounds rmax_total and 2), singular values d, left singular vectors u (2r, k) and
+    right singular vectors as rows vt (k, 2r), k >= new rank
+    """
+    if method == "full":
+        return full_svd(s, eps_adapt)
+    if method not in SVD_METHODS:
+        raise ValueError("Unknown svd method " + str(method) + ", expected one of " + str(SVD_METHODS))
+
+    size = tf.shape(s)[0]
+    width = low_rank + oversampling
+
+    def sketched_svd():
+        if method == "incremental" and warm_start is not None:
+            omega = tf.concat([warm_start, tf.random.normal((size, oversampling), dtype=s.dtype)], axis=1)[:, :width]
+        else:
+            omega = tf.random.normal((size, width), dtype=s.dtype)
+        q, b = power_iteration(s, omega, power_iterations, power_tol)
+
+        # SVD of the small (k, 2r) projection B = Q^T S, S ~ Q B
+        d, u_b, v_b = tf.linalg.svd(b)
+        rank, resolved = sketch_truncation_rank(d, tf.reduce_sum(tf.square(s)), eps_adapt, size)
+        return tf.cond(resolved, lambda: (rank, d, tf.matmul(q, u_b), tf.transpose(v_b)),
+                       lambda: full_svd(s, eps_adapt))
+
+    return tf.cond(width < size, sketched_svd, lambda: full_svd(s, eps_adapt))
+
+
+def full_svd(s, eps_adapt):
+    """
+    :return: new rank, singular values, left singular vectors and right singular vectors as rows of s, see
+    truncated_svd
+    """
+    d, u, v = tf.linalg.svd(s)
+    return truncation_rank(d, eps_adapt), d, u, tf.transpose(v)
+
+
+def power_iteration(s, omega, power_iterations, power_tol):
+    """
+    Orthonormal basis Q of the range of S omega, refined by at most power_iterations steps Q <- orth(S S^T Q). Stops
+    once the captured energy ||Q^T S||_F^2 changes less than power_tol relative to itself.
+    :return: Q (2r, k) and the projection B = Q^T S (k, 2r)
+    """
+    q, _ = tf.linalg.qr(tf.matmul(s, omega))
+    b = tf.matmul(q, s, transpose_a=True)
+
+    def refine(i, q, b, converged):
+        z, _ = tf.linalg.qr(tf.transpose(b))
+        q_new, _ = tf.linalg.qr(tf.matmul(s, z))
+        b_new = tf.matmul(q_new, s, transpose_a=True)
+        energy, energy_new = tf.reduce_sum(tf.square(b)), tf.reduce_sum(tf.square(b_new))
+        return i + 1, q_new, b_new, tf.abs(energy_new - energy) <= power_tol * energy_new
+
+    _, q, b, _ = tf.while_loop(lambda i, q, b, converged: tf.logical_and(i < power_iterations,
+                                                                        tf.logical_not(converged)),
+                               refine, (tf.constant(0), q, b, tf.constant(False)),
+                               shape_invariants=(tf.TensorShape([]), tf.TensorShape([None, None]),
+                                                 tf.TensorShape([None, None]), tf.TensorShape([])))
+    return q, b
+
+
+def sketch_truncation_rank(singular_values, total_energy, eps_adapt, size):
+    """
+    Rank of truncation_rank on the spectrum of S (size x size), from the k < size singular values of a sketch
+    B = Q^T S with orthonormal Q. The energy ||d[:j]||^2 captured by B is at most the one of S, and at least that minus
+    the residual ||S||_F^2 - ||B||_F^2. The smallest singular value of S, which the rule leaves out of the tail, is at
+    most the residual spread over the size - k singular values outside the sketch. The rank is resolved only if these
+    bounds put the tail after rank - 1 values above tolerance and the tail after rank values below it.
+    :param singular_values: k singular values of the sketch in descending order
+    :param total_energy: squared Frobenius norm of S
+    :param eps_adapt: relative truncation tolerance
+    :param size: number of singular values of S, 2r
+    :return: new rank as int32 tensor, and whether it equals the one of truncation_rank on the spectrum of S
+    """
+    tol_sq = tf.square(eps_adapt) * total_energy
+    captured = tf.concat([tf.zeros([1], singular_values.dtype), tf.cumsum(tf.square(singular_values))], axis=0)
+    residual = tf.maximum(total_energy - captured[-1], 0)
+    smallest_sq = residual / tf.cast(size - tf.shape(singular_values)[0], singular_values.dtype)
+    # upper bounds of the tails after j values, the rule of truncation_rank resolves at size - 2 at the latest
+    below_tol = total_energy - captured < tol_sq
+    rank = tf.reduce_sum(tf.cast(tf.logical_not(below_tol), tf.int32))
+    # lower bound of the tail after rank - 1 values
+    above_tol = total_energy - captured[tf.maximum(rank - 1, 0)] - residual - smallest_sq >= tol_sq
+    resolved = tf.reduce_any(below_tol) & (rank < size - 1) & ((rank == 0) | above_tol)
+    return rank, resolved
+
+
+def truncation_rank(singular_values, eps_adapt):
+    """
+    Truncation rule of the rank adaptive integrator, vectorized over the singular values: the new rank is the first
+    index j with ||d[j:2r-1]|| < eps_adapt * ||d||, or r if there is no such index.
+    :param singular_values: singular values d of the 2r x 2r matrix S, in descending order
+    :param eps_adapt: relative truncation tolerance
+    :return: new rank as int32 tensor
+    """
+    tol = eps_adapt * tf.linalg.norm(singular_values)
+    # tail_norms_sq[j] = ||d[j:2r-1]||^2 is non-increasing in j, so the indices below tolerance form a suffix
+    tail_norms_sq = tf.cumsum(tf.square(singular_values[:-1]), reverse=True)
+    below_tol = tail_norms_sq < tf.square(tol)
+    first_below = tf.reduce_sum(tf.cast(tf.logical_not(below_tol), tf.int32))
+    return tf.where(tf.reduce_any(below_tol), first_below, tf.shape(singular_values)[0] // 2)
@@ -1,7 +1,8 @@
 import tensorflow as tf
 from tensorflow import keras
 
-from .dense_layers import Linear, DLRTLayer, DLRTLayerAdaptive
+from .dense_layers import Linear, DLRTLayer, DLRTLayerAdaptive, step_weights, export_layers_for_inference
+from .trace_cache import RankBucketTraceCache
 
 
 class DLRTNet(keras.Model):
@@ -38,18 +39,6 @@ class DLRTNet(keras.Model):
         z = self.dlraBlockOutput(z)
         return z
 
-    @staticmethod
-    def set_none_grads_to_zero(grads, weights):
-        """
-        :param grads: gradients of current tape
-        :param weights: weights of current model
-        :return: sets the nonexistent gradients to zero (i K step, the grads of S and L step are None, which throws annoying warnings)
-        """
-        for i in range(len(grads)):
-            if grads[i] is None:
-                grads[i] = tf.zeros(shape=weights[i].shape, dtype=tf.float32)
-        return 0
-
     @staticmethod
     def set_dlra_bias_grads_to_zero(grads):
         """
@@ -57,7 +46,7 @@ class DLRTNet(keras.Model):
         :return: sets the nonexistent gradients to zero (i K step, the grads of S and L step are None, which throws annoying warnings)
         """
         for i in range(len(grads)):
-            if len(grads[i].shape) == 1:
+            if grads[i] is not None and len(grads[i].shape) == 1:
                 grads[i] = tf.math.scalar_mul(0.0, grads[i])
         return 0
 
@@ -96,26 +85,40 @@ class DLRTNet(keras.Model):
         self.dlraBlockOutput.load(folder_name=folder_name, layer_id=4)
         return 0
 
+    def export_for_inference(self, batch_size=1):
+        """
+        :param batch_size: expected batch size at inference, see export_layers_for_inference
+        """
+        export_layers_for_inference(self, ["dlraBlockInput", "dlraBlock1", "dlraBlock2", "dlraBlock3"],
+                                    batch_size=batch_size)
+        return 0
+
 
 class DLRTNetAdaptive(keras.Model):
 
     def __init__(self, input_dim=1, output_dim=1, name="e2eDLRANet", tol=0.4, low_rank=20, dlra_layer_dim=200,
-                 rmax_total=100, **kwargs):
+                 rmax_total=100, rank_bucket_size=1, svd_method="full", trace_cache_size=8, **kwargs):
         super(DLRTNetAdaptive, self).__init__(name=name, **kwargs)
         # dlra_layer_dim = 250
         self.dlraBlockInput = DLRTLayerAdaptive(input_dim=input_dim, units=dlra_layer_dim, low_rank=low_rank,
                                                 epsAdapt=tol,
-                                                rmax_total=rmax_total, )
+                                                rmax_total=rmax_total, rank_bucket_size=rank_bucket_size,
+                                                svd_method=svd_method)
         self.dlraBlock1 = DLRTLayerAdaptive(input_dim=dlra_layer_dim, units=dlra_layer_dim, low_rank=low_rank,
                                             epsAdapt=tol,
-                                            rmax_total=rmax_total, )
+                                            rmax_total=rmax_total, rank_bucket_size=rank_bucket_size,
+                                            svd_method=svd_method)
         self.dlraBlock2 = DLRTLayerAdaptive(input_dim=dlra_layer_dim, units=dlra_layer_dim, low_rank=low_rank,
                                             epsAdapt=tol,
-                                            rmax_total=rmax_total, )
+                                            rmax_total=rmax_total, rank_bucket_size=rank_bucket_size,
+                                            svd_method=svd_method)
         self.dlraBlock3 = DLRTLayerAdaptive(input_dim=dlra_layer_dim, units=dlra_layer_dim, low_rank=low_rank,
                                             epsAdapt=tol,
-                                            rmax_total=rmax_total, )
+                                            rmax_total=rmax_total, rank_bucket_size=rank_bucket_size,
+                                            svd_method=svd_method)
         self.dlraBlockOutput = Linear(input_dim=dlra_layer_dim, units=output_dim)
+        # compiled fused steps, one per combination of rank buckets
+        self.fused_step_cache = RankBucketTraceCache(self.fused_integrator_step, max_size=trace_cache_size)
 
     def build_model(self):
         self.dlraBlockInput.build_model()
@@ -124,7 +127,8 @@ class DLRTNetAdaptive(keras.Model):
         self.dlraBlock3.build_model()
         self.dlraBlockOutput.build_model()
 
-    @tf.function
+    # no @tf.function here: the layers slice their factors with the current rank bucket, which a cached trace would
+    # freeze. Compiled training goes through fused_train_step, which keeps one trace per rank bucket.
     def call(self, inputs, step: int = 0):
         z = self.dlraBlockInput(inputs, step=step)
         z = self.dlraBlock1(z, step=step)
@@ -133,18 +137,191 @@ class DLRTNetAdaptive(keras.Model):
         z = self.dlraBlockOutput(z)
         return z
 
-    @staticmethod
-    def set_none_grads_to_zero(grads, weights):
+    def k_step_preprocessing(self):
+        self.dlraBlockInput.k_step_preprocessing()
+        self.dlraBlock1.k_step_preprocessing()
+        self.dlraBlock2.k_step_preprocessing()
+        self.dlraBlock3.k_step_preprocessing()
+        return 0
+
+    def l_step_preprocessing(self):
+        self.dlraBlockInput.l_step_preprocessing()
+        self.dlraBlock1.l_step_preprocessing()
+        self.dlraBlock2.l_step_preprocessing()
+        self.dlraBlock3.l_step_preprocessing()
+        return 0
+
+    def k_step_postprocessing(self):
+        self.dlraBlockInput.k_step_postprocessing()
+        self.dlraBlock1.k_step_postprocessing()
+        self.dlraBlock2.k_step_postprocessing()
+        self.dlraBlock3.k_step_postprocessing()
+        return 0
+
+    def l_step_postprocessing(self):
+        self.dlraBlockInput.l_step_postprocessing()
+        self.dlraBlock1.l_step_postprocessing()
+        self.dlraBlock2.l_step_postprocessing()
+        self.dlraBlock3.l_step_postprocessing()
+        return 0
+
+    def k_step_postprocessing_adapt(self):
+        self.dlraBlockInput.k_step_postprocessing_adapt()
+        self.dlraBlock1.k_step_postprocessing_adapt()
+        self.dlraBlock2.k_step_postprocessing_adapt()
+        self.dlraBlock3.k_step_postprocessing_adapt()
+        return 0
+
+    def l_step_postprocessing_adapt(self):
+        self.dlraBlockInput.l_step_postprocessing_adapt()
+        self.dlraBlock1.l_step_postprocessing_adapt()
+        self.dlraBlock2.l_step_postprocessing_adapt()
+        self.dlraBlock3.l_step_postprocessing_adapt()
+        return 0
+
+    def s_step_preprocessing(self, optimizer=None):
+        self.dlraBlockInput.s_step_preprocessing(optimizer=optimizer)
+        self.dlraBlock1.s_step_preprocessing(optimizer=optimizer)
+        self.dlraBlock2.s_step_preprocessing(optimizer=optimizer)
+        self.dlraBlock3.s_step_preprocessing(optimizer=optimizer)
+        return 0
+
+    def rank_adaption(self, optimizer=None):
         """
-        :param grads: gradients of current tape
-        :param weights: weights of current model
-        :return: sets the nonexistent gradients to zero (i K step, the grads of S and L step are None, which throws annoying warnings)
+        :param optimizer: optimizer of the training loop, its slots are carried over when a layer grows its factors
         """
-        for i in range(len(grads)):
-            if grads[i] is None:
-                grads[i] = tf.zeros(shape=weights[i].shape, dtype=tf.float32)
+        generations = self.get_buffer_generations()
+        self.dlraBlockInput.rank_adaption(optimizer=optimizer)
+        self.dlraBlock1.rank_adaption(optimizer=optimizer)
+        self.dlraBlock2.rank_adaption(optimizer=optimizer)
+        self.dlraBlock3.rank_adaption(optimizer=optimizer)
+        if generations != self.get_buffer_generations():
+            self.fused_step_cache.traces.clear()  # the cached steps hold on to the old factors
+        return 0
+
+    def fixed_rank_update(self, optimizer=None):
+        """
+        Completes a step without rank adaption, see RankAdaptionSchedule.
+        :param optimizer: optimizer of the training loop, a DLRTAdam moves the moments of K and L^T to the new bases
+        """
+        self.dlraBlockInput.fixed_rank_update(optimizer=optimizer)
+        self.dlraBlock1.fixed_rank_update(optimizer=optimizer)
+        self.dlraBlock2.fixed_rank_update(optimizer=optimizer)
+        self.dlraBlock3.fixed_rank_update(optimizer=optimizer)
+        return 0
+
+    def shrink_capacity(self, optimizer=None):
+        """
+        Releases the capacity of the layers above their current rank bucket.
+        :param optimizer: optimizer of the training loop, its slots are resized along
+        """
+        generations = self.get_buffer_generations()
+        self.dlraBlockInput.shrink_capacity(optimizer=optimizer)
+        self.dlraBlock1.shrink_capacity(optimizer=optimizer)
+        self.dlraBlock2.shrink_capacity(optimizer=optimizer)
+        self.dlraBlock3.shrink_capacity(optimizer=optimizer)
+        if generations != self.get_buffer_generations():
+            self.fused_step_cache.traces.clear()
+        return 0
+
+    def get_low_ranks(self):
+        ranks = [self.dlraBlockInput.low_rank,
+                 self.dlraBlock1.low_rank,
+                 self.dlraBlock2.low_rank,
+                 self.dlraBlock3.low_rank]
+        return ranks
+
+    def get_rank_buckets(self):
+        # a reallocation of the factors invalidates compiled steps as well, the buffer generation is part of the key
+        buckets = [(self.dlraBlockInput.rank_bucket, self.dlraBlockInput.buffer_generation),
+                   (self.dlraBlock1.rank_bucket, self.dlraBlock1.buffer_generation),
+                   (self.dlraBlock2.rank_bucket, self.dlraBlock2.buffer_generation),
+                   (self.dlraBlock3.rank_bucket, self.dlraBlock3.buffer_generation)]
+        return buckets
+
+    def get_buffer_generations(self):
+        generations = [self.dlraBlockInput.buffer_generation,
+                       self.dlraBlock1.buffer_generation,
+                       self.dlraBlock2.buffer_generation,
+                       self.dlraBlock3.buffer_generation]
+        return generations
+
+    def export_for_inference(self, batch_size=1):
+        """
+        :param batch_size: expected batch size at inference, see export_layers_for_inference
+        """
+        # the compiled fused steps hold on to the training variables
+        self.fused_step_cache.traces.clear()
+        export_layers_for_inference(self, ["dlraBlockInput", "dlraBlock1", "dlraBlock2", "dlraBlock3"],
+                                    batch_size=batch_size)
         return 0
 
+    def fused_train_step(self, inputs, labels, loss_fn, optimizer, adapt=True):
+        """
+        :param inputs: batch of network inputs
+        :param labels: batch of labels
+        :param loss_fn: loss function, evaluated on the softmax of the network output
+        :param optimizer: optimizer for the K, L and S updates
+        :param adapt: False takes the fixed-rank postprocessing, the step is then completed by fixed_rank_update
+        instead of rank_adaption
+        :return: loss and softmax output of the fused K/L forward pass
+        """
+        # rank changes within the buckets reuse the cached trace, leaving a bucket traces the step once more
+        return self.fused_step_cache(self.get_rank_buckets() + [adapt], inputs, labels, loss_fn, optimizer,
+                                     adapt=adapt)
+
+    def fused_integrator_step(self, inputs, labels, loss_fn, optimizer, adapt=True):
+        """
+        K, L and S step of the unconventional integrator in one compiled function. K and L gradients are taken
+        from a single shared forward pass (step=3), the S step needs its own pass on the augmented basis.
+        Rank adaption is not part of this step. Compiled through fused_step_cache, separately for adapt.
+        """
+        # 1.a) K and L Step Preproccessing
+        self.k_step_preprocessing()
+        self.l_step_preprocessing()
+
+        # 1.b) Tape Gradients for the fused K- and L-Step
+        self.toggle_non_s_step_training()
+        with tf.GradientTape() as tape:
+            out = self(inputs, step=3, training=True)
+            # softmax activation for classification
+            out = tf.keras.activations.softmax(out)
+            # Compute reconstruction loss
+            loss = loss_fn(labels, out)
+            loss += sum(self.losses)  # Add KLD regularization loss
+        # gradients with respect to K, L and the weights outside the DLRT layers only
+        kl_weights = step_weights(self, 3)
+        grads_kl_step = tape.gradient(loss, kl_weights, unconnected_gradients=tf.UnconnectedGradients.ZERO)
+        self.set_dlra_bias_grads_to_zero(grads_kl_step)
+
+        # Gradient update for K and L
+        optimizer.apply_gradients(zip(grads_kl_step, kl_weights))
+
+        # Postprocessing K and L, at width 2r only if the rank is adapted after this step
+        if adapt:
+            self.k_step_postprocessing_adapt()
+            self.l_step_postprocessing_adapt()
+        else:
+            self.k_step_postprocessing()
+            self.l_step_postprocessing()
+
+        # S-Step Preprocessing
+        self.s_step_preprocessing(optimizer=optimizer)
+        self.toggle_s_step_training()
+
+        # 2.a) Tape Gradients for S-Step
+        with tf.GradientTape() as tape:
+            out_s = self(inputs, step=2, training=True)
+            out_s = tf.keras.activations.softmax(out_s)
+            loss_s = loss_fn(labels, out_s)
+            loss_s += sum(self.losses)
+        # 2.b) Apply Gradients
+        s_weights = step_weights(self, 2)
+        grads_s = tape.gradient(loss_s, s_weights)
+        optimizer.apply_gradients(zip(grads_s, s_weights))  # All gradients except K and L matrix
+
+        return loss, out
+
     @staticmethod
     def set_dlra_bias_grads_to_zero(grads):
         """
@@ -152,7 +329,7 @@ class DLRTNetAdaptive(keras.Model):
         :return: sets the nonexistent gradients to zero (i K step, the grads of S and L step are None, which throws annoying warnings)
         """
         for i in range(len(grads)):
-            if len(grads[i].shape) == 1:
+            if grads[i] is not None and len(grads[i].shape) == 1:
                 grads[i] = tf.math.scalar_mul(0.0, grads[i])
         return 0
 
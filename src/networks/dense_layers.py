@@ -1,6 +1,8 @@
 import tensorflow as tf
 from tensorflow import keras
-import numpy as np
+from .checkpoint import write_array, read_array
+from .decompositions import truncated_svd
+from .optimizers import resize_slots
 
 
 class Linear(keras.layers.Layer):
@@ -25,16 +27,16 @@ class Linear(keras.layers.Layer):
 
     def save(self, folder_name, layer_id):
         w_np = self.w.numpy()
-        np.save(folder_name + "/w" + str(layer_id) + ".npy", w_np)
+        write_array(folder_name, "w" + str(layer_id), w_np)
         b_np = self.b.numpy()
-        np.save(folder_name + "/b" + str(layer_id) + ".npy", b_np)
+        write_array(folder_name, "b" + str(layer_id), b_np)
         return 0
 
     def load(self, folder_name, layer_id):
-        a_np = np.load(folder_name + "/w" + str(layer_id) + ".npy")
+        a_np = read_array(folder_name, "w" + str(layer_id))
         self.w = tf.Variable(initial_value=a_np,
                              trainable=True, name="w_", dtype=tf.float32)
-        b_np = np.load(folder_name + "/b" + str(layer_id) + ".npy")
+        b_np = read_array(folder_name, "b" + str(layer_id))
         self.b = tf.Variable(initial_value=b_np,
                              trainable=True, name="b_", dtype=tf.float32)
 
@@ -60,16 +62,16 @@ class DenseLinear(keras.layers.Layer):
 
     def save(self, folder_name, layer_id):
         w_np = self.w.numpy()
-        np.save(folder_name + "/w" + str(layer_id) + ".npy", w_np)
+        write_array(folder_name, "w" + str(layer_id), w_np)
         b_np = self.b.numpy()
-        np.save(folder_name + "/b" + str(layer_id) + ".npy", b_np)
+        write_array(folder_name, "b" + str(layer_id), b_np)
         return 0
 
     def load(self, folder_name, layer_id):
-        a_np = np.load(folder_name + "/w" + str(layer_id) + ".npy")
+        a_np = read_array(folder_name, "w" + str(layer_id))
         self.w = tf.Variable(initial_value=a_np,
                              trainable=True, name="w_", dtype=tf.float32)
-        b_np = np.load(folder_name + "/b" + str(layer_id) + ".npy")
+        b_np = read_array(folder_name, "b" + str(layer_id))
         self.b = tf.Variable(initial_value=b_np,
                              trainable=True, name="b_", dtype=tf.float32)
 
@@ -174,62 +176,62 @@ class DLRTLayer(keras.layers.Layer):
     def save(self, folder_name, layer_id):
         # main_variables
         k_np = self.k.numpy()
-        np.save(folder_name + "/k" + str(layer_id) + ".npy", k_np)
+        write_array(folder_name, "k" + str(layer_id), k_np)
         l_t_np = self.l_t.numpy()
-        np.save(folder_name + "/l_t" + str(layer_id) + ".npy", l_t_np)
+        write_array(folder_name, "l_t" + str(layer_id), l_t_np)
         s_np = self.s.numpy()
-        np.save(folder_name + "/s" + str(layer_id) + ".npy", s_np)
+        write_array(folder_name, "s" + str(layer_id), s_np)
         b_np = self.b.numpy()
-        np.save(folder_name + "/b" + str(layer_id) + ".npy", b_np)
+        write_array(folder_name, "b" + str(layer_id), b_np)
         # aux_variables
         aux_U_np = self.aux_U.numpy()
-        np.save(folder_name + "/aux_U" + str(layer_id) + ".npy", aux_U_np)
+        write_array(folder_name, "aux_U" + str(layer_id), aux_U_np)
         aux_Unp1_np = self.aux_Unp1.numpy()
-        np.save(folder_name + "/aux_Unp1" + str(layer_id) + ".npy", aux_Unp1_np)
+        write_array(folder_name, "aux_Unp1" + str(layer_id), aux_Unp1_np)
         aux_Vt_np = self.aux_Vt.numpy()
-        np.save(folder_name + "/aux_Vt" + str(layer_id) + ".npy", aux_Vt_np)
+        write_array(folder_name, "aux_Vt" + str(layer_id), aux_Vt_np)
         aux_Vtnp1_np = self.aux_Vtnp1.numpy()
-        np.save(folder_name + "/aux_Vtnp1" + str(layer_id) + ".npy", aux_Vtnp1_np)
+        write_array(folder_name, "aux_Vtnp1" + str(layer_id), aux_Vtnp1_np)
         aux_N_np = self.aux_N.numpy()
-        np.save(folder_name + "/aux_N" + str(layer_id) + ".npy", aux_N_np)
+        write_array(folder_name, "aux_N" + str(layer_id), aux_N_np)
         aux_M_np = self.aux_M.numpy()
-        np.save(folder_name + "/aux_M" + str(layer_id) + ".npy", aux_M_np)
+        write_array(folder_name, "aux_M" + str(layer_id), aux_M_np)
         return 0
 
     def load(self, folder_name, layer_id):
 
         # main variables
-        k_np = np.load(folder_name + "/k" + str(layer_id) + ".npy")
+        k_np = read_array(folder_name, "k" + str(layer_id))
         self.low_rank = k_np.shape[1]
         self.k = tf.Variable(initial_value=k_np,
                              trainable=True, name="k_", dtype=tf.float32)
-        l_t_np = np.load(folder_name + "/l_t" + str(layer_id) + ".npy")
+        l_t_np = read_array(folder_name, "l_t" + str(layer_id))
         self.l_t = tf.Variable(initial_value=l_t_np,
                                trainable=True, name="lt_", dtype=tf.float32)
-        s_np = np.load(folder_name + "/s" + str(layer_id) + ".npy")
+        s_np = read_array(folder_name, "s" + str(layer_id))
         self.s = tf.Variable(initial_value=s_np,
                              trainable=True, name="s_", dtype=tf.float32)
-        bias = np.load(folder_name + "/b" + str(layer_id) + ".npy")
+        bias = read_array(folder_name, "b" + str(layer_id))
         self.b = tf.Variable(initial_value=bias,
                              trainable=True, name="b_", dtype=tf.float32)
 
         # aux variables
-        aux_U_np = np.load(folder_name + "/aux_U" + str(layer_id) + ".npy")
+        aux_U_np = read_array(folder_name, "aux_U" + str(layer_id))
         self.aux_U = tf.Variable(initial_value=aux_U_np,
                                  trainable=False, name="aux_U", dtype=tf.float32)
-        aux_Unp1_np = np.load(folder_name + "/aux_Unp1" + str(layer_id) + ".npy")
+        aux_Unp1_np = read_array(folder_name, "aux_Unp1" + str(layer_id))
         self.aux_Unp1 = tf.Variable(initial_value=aux_Unp1_np,
                                     trainable=False, name="aux_Unp1", dtype=tf.float32)
-        Vt_np = np.load(folder_name + "/aux_Vt" + str(layer_id) + ".npy")
+        Vt_np = read_array(folder_name, "aux_Vt" + str(layer_id))
         self.aux_Vt = tf.Variable(initial_value=Vt_np,
                                   trainable=False, name="aux_Vt", dtype=tf.float32)
-        vtnp1_np = np.load(folder_name + "/aux_Vtnp1" + str(layer_id) + ".npy")
+        vtnp1_np = read_array(folder_name, "aux_Vtnp1" + str(layer_id))
         self.aux_Vtnp1 = tf.Variable(initial_value=vtnp1_np,
                                      trainable=False, name="aux_Vtnp1", dtype=tf.float32)
-        aux_N_np = np.load(folder_name + "/aux_N" + str(layer_id) + ".npy")
+        aux_N_np = read_array(folder_name, "aux_N" + str(layer_id))
         self.aux_N = tf.Variable(initial_value=aux_N_np,
                                  trainable=False, name="aux_N", dtype=tf.float32)
-        aux_M_np = np.load(folder_name + "/aux_M" + str(layer_id) + ".npy")
+        aux_M_np = read_array(folder_name, "aux_M" + str(layer_id))
         self.aux_M = tf.Variable(initial_value=aux_M_np,
                                  trainable=False, name="aux_M", dtype=tf.float32)
 
@@ -250,7 +252,7 @@ class DLRTLayer(keras.layers.Layer):
 
     def load_from_fullW(self, folder_name, layer_id, rank):
 
-        W_mat = np.load(folder_name + "/w" + str(layer_id) + ".npy")
+        W_mat = read_array(folder_name, "w" + str(layer_id))
         d, u, v = tf.linalg.svd(W_mat)  # d=singular values, u2 = left singuar vecs, v2= right singular vecss
 
         s_init = tf.linalg.tensor_diag(d[:rank])
@@ -273,10 +275,20 @@ class DLRTLayer(keras.layers.Layer):
         low_rank_weights = self.low_rank * (self.input_dim + self.units + self.low_rank)
         return low_rank_weights, full_rank_weights
 
+    def export_for_inference(self, batch_size=1):
+        """
+        Freezes the layer at the current rank to the factors U S and V^T of the last S-step (bias b), without any
+        integrator state.
+        :param batch_size: expected number of input rows per call, decides between dense and low-rank product
+        :return: DLRTLayerInference
+        """
+        return DLRTLayerInference(us=tf.matmul(self.aux_U, self.s), vt=self.aux_Vt, b=self.b, activation=True,
+                                  batch_size=batch_size)
+
 
 class DLRTLayerAdaptive(keras.layers.Layer):
-    def __init__(self, input_dim: int, units=32, low_rank=10, epsAdapt=0.1, rmax_total=100, name="dlra_block",
-                 **kwargs):
+    def __init__(self, input_dim: int, units=32, low_rank=10, epsAdapt=0.1, rmax_total=100, rank_bucket_size=1,
+                 svd_method="full", svd_oversampling=8, svd_power_iterations=4, name="dlra_block", **kwargs):
         super(DLRTLayerAdaptive, self).__init__(**kwargs)
         self.epsAdapt = epsAdapt  # for unconventional integrator
         self.units = units
@@ -290,128 +302,294 @@ class DLRTLayerAdaptive(keras.layers.Layer):
             self.low_rank = int(self.rmax_total)
         print("Start rank has been set to: " + str(self.low_rank) + " to match max rank")
         self.input_dim = input_dim
+        # the forward pass slices the factors at the bucketed rank and zero pads beyond the current rank,
+        # so compiled steps only retrace when the rank leaves its bucket
+        self.rank_bucket_size = rank_bucket_size
+        self.rank_bucket = bucket_rank(self.low_rank, self.rank_bucket_size, self.rmax_total)
+        # the factors are allocated at a capacity of at least rank_bucket (the augmented ones at twice that), which
+        # grows geometrically when the rank outgrows it, see set_capacity
+        self.capacity = self.rank_bucket
+        self.buffer_generation = 0  # counts the reallocations of the factors, compiled steps are keyed on it
+        # decomposition of S in the rank adaption, see truncated_svd
+        self.svd_method = svd_method
+        self.svd_oversampling = svd_oversampling
+        self.svd_power_iterations = svd_power_iterations
 
     def build_model(self):
 
-        self.k = self.add_weight(shape=(self.input_dim, self.rmax_total), initializer="random_normal",
+        self.k = self.add_weight(shape=(self.input_dim, self.capacity), initializer="random_normal",
                                  trainable=True, name="k_")
-        self.l_t = self.add_weight(shape=(self.rmax_total, self.units), initializer="random_normal",
+        self.l_t = self.add_weight(shape=(self.capacity, self.units), initializer="random_normal",
                                    trainable=True, name="lt_")
-        self.s = self.add_weight(shape=(2 * self.rmax_total, 2 * self.rmax_total), initializer="random_normal",
+        self.s = self.add_weight(shape=(2 * self.capacity, 2 * self.capacity), initializer="random_normal",
                                  trainable=True, name="s_")
         self.b = self.add_weight(shape=(self.units,), initializer="random_normal", trainable=True, name="b_")
         # auxiliary variables
         self.aux_b = self.add_weight(shape=(self.units,), initializer="random_normal", trainable=False, name="aux_b")
         self.aux_b.assign(self.b)  # non trainable bias or k and l step
 
-        self.aux_U = self.add_weight(shape=(self.input_dim, self.rmax_total), initializer="random_normal",
+        self.aux_U = self.add_weight(shape=(self.input_dim, self.capacity), initializer="random_normal",
                                      trainable=False, name="aux_U")
-        self.aux_Unp1 = self.add_weight(shape=(self.input_dim, 2 * self.rmax_total), initializer="random_normal",
+        self.aux_Unp1 = self.add_weight(shape=(self.input_dim, 2 * self.capacity), initializer="random_normal",
                                         trainable=False, name="aux_Unp1")
-        self.aux_Vt = self.add_weight(shape=(self.rmax_total, self.units), initializer="random_normal",
+        self.aux_Vt = self.add_weight(shape=(self.capacity, self.units), initializer="random_normal",
                                       trainable=False, name="Vt")
-        self.aux_Vtnp1 = self.add_weight(shape=(2 * self.rmax_total, self.units), initializer="random_normal",
+        self.aux_Vtnp1 = self.add_weight(shape=(2 * self.capacity, self.units), initializer="random_normal",
                                          trainable=False, name="vtnp1")
-        self.aux_N = self.add_weight(shape=(2 * self.rmax_total, self.rmax_total), initializer="random_normal",
+        self.aux_N = self.add_weight(shape=(2 * self.capacity, self.capacity), initializer="random_normal",
                                      trainable=False, name="aux_N")
-        self.aux_M = self.add_weight(shape=(2 * self.rmax_total, self.rmax_total), initializer="random_normal",
+        self.aux_M = self.add_weight(shape=(2 * self.capacity, self.capacity), initializer="random_normal",
                                      trainable=False, name="aux_M")
+        self.rank = self.add_weight(shape=(), initializer=tf.keras.initializers.Constant(self.low_rank),
+                                    dtype=tf.int32, trainable=False, name="rank")  # current rank, see rank_adaption
+        # relative norm of K and L^T outside U and V at the last postprocessing, see tail_energy_estimate
+        self.tail_energy = self.add_weight(shape=(2,), initializer="zeros", trainable=False, name="tail_energy")
+        # compiled on the current factors, rebuilt whenever they are reallocated
+        self.rank_adaption_compiled = tf.function(self.truncate_rank)
         # Todo: initializer with low rank
 
-    @tf.function
     def call(self, inputs, step: int = 0):
         """
         :param
         inputs: layer         input
         :param
-        step: step         counter: k := 0, l := 1, s := 2
+        step: step         counter: k := 0, l := 1, s := 2, fused k and l := 3
         :return:
         """
+        width = self.rank_bucket
+        mask = tf.sequence_mask(self.rank, width, dtype=self.k.dtype)  # zero pads the factors beyond the rank
         if step == 0:  # k-step
-            z = tf.matmul(tf.matmul(inputs, self.k[:, :self.low_rank]), self.aux_Vt[:self.low_rank, :])
+            z = tf.matmul(tf.matmul(inputs, self.k[:, :width] * mask), self.aux_Vt[:width, :])
             z = z + self.aux_b
         elif step == 1:  # l-step
-            z = tf.matmul(tf.matmul(inputs, self.aux_U[:, :self.low_rank]), self.l_t[:self.low_rank, :])
+            z = tf.matmul(tf.matmul(inputs, self.aux_U[:, :width]), self.l_t[:width, :] * mask[:, None])
+            z = z + self.aux_b
+        elif step == 3:  # fused k- and l-step
+            z = fused_kl_matmul(inputs, self.k[:, :width] * mask, self.aux_U[:, :width],
+                                self.l_t[:width, :] * mask[:, None], self.aux_Vt[:width, :])
             z = z + self.aux_b
         else:  # s-step
+            mask = tf.sequence_mask(2 * self.rank, 2 * width, dtype=self.s.dtype)
             z = tf.matmul(
-                tf.matmul(tf.matmul(inputs, self.aux_Unp1[:, :2 * self.low_rank]),
-                          self.s[:2 * self.low_rank, :2 * self.low_rank]), self.aux_Vtnp1[:2 * self.low_rank, :])
+                tf.matmul(tf.matmul(inputs, self.aux_Unp1[:, :2 * width]),
+                          self.s[:2 * width, :2 * width] * mask[:, None] * mask[None, :]),
+                self.aux_Vtnp1[:2 * width, :])
             z = z + self.b
 
         return tf.keras.activations.relu(z)
 
     # @tf.function
     def k_step_preprocessing(self):
-        k = tf.matmul(self.aux_U[:, :self.low_rank], self.s[:self.low_rank, :self.low_rank])
-        self.k[:, :self.low_rank].assign(k)
+        low_rank = self.rank.read_value()
+        k = tf.matmul(self.aux_U[:, :low_rank], self.s[:low_rank, :low_rank])
+        self.k[:, :low_rank].assign(k)
+        return 0
+
+    # @tf.function
+    def k_step_postprocessing(self):
+        """
+        Postprocessing of the K step without rank adaption: QR of K at the current rank instead of the augmented
+        [K, U]. The augmented half of the new basis stays zero, so the S step only trains the leading r x r block of S.
+        Followed by fixed_rank_update instead of rank_adaption.
+        """
+        low_rank = self.rank.read_value()
+        self.tail_energy[0].assign(basis_residual(self.k[:, :low_rank], self.aux_U[:, :low_rank]))
+        aux_Unp1, _ = tf.linalg.qr(self.k[:, :low_rank])
+        self.aux_Unp1[:, :2 * low_rank].assign(tf.concat((aux_Unp1, tf.zeros_like(aux_Unp1)), axis=1))
+        aux_N = tf.matmul(tf.transpose(self.aux_Unp1[:, :2 * low_rank]), self.aux_U[:, : low_rank])
+        self.aux_N[:2 * low_rank, :low_rank].assign(aux_N)
         return 0
 
     # @tf.function
     def k_step_postprocessing_adapt(self):
-        k_extended = tf.concat((self.k[:, :self.low_rank], self.aux_U[:, :self.low_rank]), axis=1)
+        low_rank = self.rank.read_value()
+        self.tail_energy[0].assign(basis_residual(self.k[:, :low_rank], self.aux_U[:, :low_rank]))
+        k_extended = tf.concat((self.k[:, :low_rank], self.aux_U[:, :low_rank]), axis=1)
         aux_Unp1, _ = tf.linalg.qr(k_extended)
-        self.aux_Unp1[:, :2 * self.low_rank].assign(aux_Unp1)
-        aux_N = tf.matmul(tf.transpose(self.aux_Unp1[:, :2 * self.low_rank]), self.aux_U[:, : self.low_rank])
-        self.aux_N[:2 * self.low_rank, :self.low_rank].assign(aux_N)
+        self.aux_Unp1[:, :2 * low_rank].assign(aux_Unp1)
+        aux_N = tf.matmul(tf.transpose(self.aux_Unp1[:, :2 * low_rank]), self.aux_U[:, : low_rank])
+        self.aux_N[:2 * low_rank, :low_rank].assign(aux_N)
         return 0
 
     # @tf.function
     def l_step_preprocessing(self):
-        l_t = tf.matmul(self.s[:self.low_rank, :self.low_rank], self.aux_Vt[:self.low_rank, :])
-        self.l_t[:self.low_rank, :].assign(l_t)  # = tf.Variable(initial_value=l_t, trainable=True, name="lt_")
+        low_rank = self.rank.read_value()
+        l_t = tf.matmul(self.s[:low_rank, :low_rank], self.aux_Vt[:low_rank, :])
+        self.l_t[:low_rank, :].assign(l_t)  # = tf.Variable(initial_value=l_t, trainable=True, name="lt_")
+        return 0
+
+    # @tf.function
+    def l_step_postprocessing(self):
+        """
+        Postprocessing of the L step without rank adaption, see k_step_postprocessing.
+        """
+        low_rank = self.rank.read_value()
+        self.tail_energy[1].assign(basis_residual(tf.transpose(self.l_t[:low_rank, :]),
+                                                  tf.transpose(self.aux_Vt[:low_rank, :])))
+        aux_Vnp1, _ = tf.linalg.qr(tf.transpose(self.l_t[:low_rank, :]))
+        aux_Vtnp1 = tf.transpose(aux_Vnp1)
+        self.aux_Vtnp1[:2 * low_rank, :].assign(tf.concat((aux_Vtnp1, tf.zeros_like(aux_Vtnp1)), axis=0))
+        aux_M = tf.matmul(self.aux_Vtnp1[:2 * low_rank, :], tf.transpose(self.aux_Vt[: low_rank, :]))
+        self.aux_M[:2 * low_rank, :low_rank].assign(aux_M)
         return 0
 
     # @tf.function
     def l_step_postprocessing_adapt(self):
+        low_rank = self.rank.read_value()
+        self.tail_energy[1].assign(basis_residual(tf.transpose(self.l_t[:low_rank, :]),
+                                                  tf.transpose(self.aux_Vt[:low_rank, :])))
         l_extended = tf.concat(
-            (tf.transpose(self.l_t[:self.low_rank, :]), tf.transpose(self.aux_Vt[:self.low_rank, :])), axis=1)
+            (tf.transpose(self.l_t[:low_rank, :]), tf.transpose(self.aux_Vt[:low_rank, :])), axis=1)
         aux_Vnp1, _ = tf.linalg.qr(l_extended)
-        self.aux_Vtnp1[:2 * self.low_rank, :].assign(tf.transpose(aux_Vnp1))
-        aux_M = tf.matmul(self.aux_Vtnp1[:2 * self.low_rank, :], tf.transpose(self.aux_Vt[: self.low_rank, :]))
-        self.aux_M[:2 * self.low_rank, :self.low_rank].assign(aux_M)
+        self.aux_Vtnp1[:2 * low_rank, :].assign(tf.transpose(aux_Vnp1))
+        aux_M = tf.matmul(self.aux_Vtnp1[:2 * low_rank, :], tf.transpose(self.aux_Vt[: low_rank, :]))
+        self.aux_M[:2 * low_rank, :low_rank].assign(aux_M)
         return 0
 
     # @tf.function
-    def s_step_preprocessing(self):
+    def s_step_preprocessing(self, optimizer=None):
+        """
+        :param optimizer: optimizer of the training loop, a DLRTAdam moves the moments of S to the augmented bases
+        """
+        low_rank = self.rank.read_value()
         s = tf.matmul(
-            tf.matmul(self.aux_N[:2 * self.low_rank, :self.low_rank], self.s[: self.low_rank, :self.low_rank]),
-            tf.transpose(self.aux_M[:2 * self.low_rank, :self.low_rank]))
-        self.s[:2 * self.low_rank, :2 * self.low_rank].assign(s)
+            tf.matmul(self.aux_N[:2 * low_rank, :low_rank], self.s[: low_rank, :low_rank]),
+            tf.transpose(self.aux_M[:2 * low_rank, :low_rank]))
+        self.s[:2 * low_rank, :2 * low_rank].assign(s)
+        if hasattr(optimizer, "change_basis"):
+            optimizer.change_basis(self.s, left=self.aux_N[:2 * low_rank, :low_rank],
+                                   right=self.aux_M[:2 * low_rank, :low_rank])
 
         return 0
 
-    # @tf.function
-    def rank_adaption(self):
-        # 1) compute SVD of S
-        # d=singular values, u2 = left singuar vecs, v2= right singular vecs
-        s_small = self.s[:2 * self.low_rank, :2 * self.low_rank]
-        d, u2, v2 = tf.linalg.svd(s_small)
-
-        tmp = 0.0
-        tol = self.epsAdapt * tf.linalg.norm(d)  # tol=\vartheta in paper
-        rmax = int(tf.floor(d.shape[0] / 2))
-        for j in range(0, 2 * rmax - 1):
-            tmp = tf.linalg.norm(d[j:2 * rmax - 1])
-            if tmp < tol:
-                rmax = j
-                break
+    def fixed_rank_update(self, optimizer=None):
+        """
+        Completes a step without rank adaption, in place of rank_adaption after k_step_postprocessing and
+        l_step_postprocessing: the QR factors of K and L become the new bases and S keeps its leading r x r block,
+        there is no SVD and the rank stays.
+        :param optimizer: optimizer of the training loop, a DLRTAdam moves the moments of K and L^T to the new bases
+        """
+        low_rank = self.rank.read_value()
+        if hasattr(optimizer, "change_basis"):
+            # U_new^T U_old and V_new^T V_old are the leading blocks of N and M
+            optimizer.change_basis(self.k, right=self.aux_M[:low_rank, :low_rank])
+            optimizer.change_basis(self.l_t, left=self.aux_N[:low_rank, :low_rank])
+        self.aux_U[:, :low_rank].assign(self.aux_Unp1[:, :low_rank])
+        self.aux_Vt[:low_rank, :].assign(self.aux_Vtnp1[:low_rank, :])
 
-        rmax = tf.minimum(rmax, self.rmax_total)
-        rmax = tf.maximum(rmax, 2)
+        # update bias
+        self.aux_b.assign(self.b)
+        return 0
+
+    def tail_energy_estimate(self):
+        """
+        Cheap estimate of the tail energy of the augmented S, without QR or SVD: the relative norm of the parts of K
+        and L^T outside the bases U and V, which make up the augmented blocks of S. Updated by the K and L
+        postprocessing.
+        :return: estimate as float tensor
+        """
+        return tf.reduce_max(self.tail_energy)
+
+    def rank_adaption(self, optimizer=None):
+        """
+        :param optimizer: optimizer of the training loop, its slots are carried over if the factors have to grow. A
+        DLRTAdam moves the moments of K, L^T and S to the new bases.
+        """
+        # the truncation runs compiled on the rank variable, low_rank mirrors it for the rank bucket and save
+        rmax, d, aux_U, aux_Vt, u2, v2, basis_u, basis_v = self.rank_adaption_compiled()
+        self.low_rank = int(rmax)
+        self.rank_bucket = bucket_rank(self.low_rank, self.rank_bucket_size, self.rmax_total)
+        if self.rank_bucket > self.capacity:
+            # geometric growth, so a rank that keeps rising reallocates only a logarithmic number of times
+            self.set_capacity(min(max(2 * self.capacity, self.rank_bucket), self.rmax_total), optimizer=optimizer)
+        if hasattr(optimizer, "change_basis"):
+            # the columns of K are coefficients in the basis V, the rows of L^T in U and S lives in both
+            optimizer.change_basis(self.k, right=basis_v)
+            optimizer.change_basis(self.l_t, left=basis_u)
+            optimizer.change_basis(self.s, left=tf.transpose(u2), right=v2)
 
         # update s
-        self.s[:rmax, :rmax].assign(tf.linalg.tensor_diag(d[:rmax]))
+        self.s[:self.low_rank, :self.low_rank].assign(tf.linalg.tensor_diag(d))
 
         # update u and v
-        self.aux_U[:, :rmax].assign(tf.matmul(self.aux_Unp1[:, :2 * self.low_rank], u2[:, :rmax]))
-        self.aux_Vt[:rmax, :].assign(tf.matmul(v2[:rmax, :], self.aux_Vtnp1[:2 * self.low_rank, :]))
-        self.low_rank = int(rmax)
+        self.aux_U[:, :self.low_rank].assign(aux_U)
+        self.aux_Vt[:self.low_rank, :].assign(aux_Vt)
+        self.rank.assign(self.low_rank)
 
         # update bias
         self.aux_b.assign(self.b)
         return 0
 
+    def truncate_rank(self):
+        """
+        SVD of the augmented S and truncation to the new rank, compiled as rank_adaption_compiled. Nothing is assigned
+        here, the new rank may not fit into the current capacity.
+        :return: new rank, its singular values, new basis U (input_dim, rank), new basis V^T (rank, units), the
+        truncated singular vectors of S and the changes of basis from the old U and V to the new ones
+        """
+        # 1) compute SVD of S
+        # d=singular values, u2 = left singuar vecs, v2= right singular vecs
+        low_rank = self.rank.read_value()
+        s_small = self.s[:2 * low_rank, :2 * low_rank]
+        # the right singular vectors come as rows, v2 = V^T, see truncated_svd
+        rmax, d, u2, v2 = truncated_svd(s_small, low_rank, self.epsAdapt, method=self.svd_method,
+                                        warm_start=self.aux_M[:2 * low_rank, :low_rank],
+                                        oversampling=self.svd_oversampling,
+                                        power_iterations=self.svd_power_iterations)  # tol=\vartheta in paper
+        rmax = tf.minimum(rmax, self.rmax_total)
+        rmax = tf.maximum(rmax, 2)
+
+        aux_U = tf.matmul(self.aux_Unp1[:, :2 * low_rank], u2[:, :rmax])
+        aux_Vt = tf.matmul(v2[:rmax, :], self.aux_Vtnp1[:2 * low_rank, :])
+        # U_new^T U_old and V_new^T V_old, through N = U_np1^T U_old and M = V_np1^T V_old
+        basis_u = tf.matmul(u2[:, :rmax], self.aux_N[:2 * low_rank, :low_rank], transpose_a=True)
+        basis_v = tf.matmul(v2[:rmax, :], self.aux_M[:2 * low_rank, :low_rank])
+        return rmax, d[:rmax], aux_U, aux_Vt, u2[:, :rmax], v2[:rmax, :], basis_u, basis_v
+
+    def set_capacity(self, capacity, optimizer=None):
+        """
+        Reallocates the factors at width capacity (S and the augmented bases at 2 * capacity) and keeps their leading
+        blocks. Compiled functions still hold the old variables, buffer_generation is incremented to retrace them.
+        :param capacity: new capacity, between rank_bucket and rmax_total
+        :param optimizer: optimizer holding slots for the factors (e.g. Adam moments), they are resized along
+        """
+        self.capacity = capacity
+        self.k = resize_factor(self.k, (self.input_dim, capacity), optimizer)
+        self.l_t = resize_factor(self.l_t, (capacity, self.units), optimizer)
+        self.s = resize_factor(self.s, (2 * capacity, 2 * capacity), optimizer)
+        self.aux_U = resize_factor(self.aux_U, (self.input_dim, capacity), optimizer)
+        self.aux_Unp1 = resize_factor(self.aux_Unp1, (self.input_dim, 2 * capacity), optimizer)
+        self.aux_Vt = resize_factor(self.aux_Vt, (capacity, self.units), optimizer)
+        self.aux_Vtnp1 = resize_factor(self.aux_Vtnp1, (2 * capacity, self.units), optimizer)
+        self.aux_N = resize_factor(self.aux_N, (2 * capacity, capacity), optimizer)
+        self.aux_M = resize_factor(self.aux_M, (2 * capacity, capacity), optimizer)
+        self.buffer_generation += 1
+        self.rank_adaption_compiled = tf.function(self.truncate_rank)
+        return 0
+
+    def shrink_capacity(self, optimizer=None):
+        """
+        Releases the capacity above the current rank bucket.
+        :param optimizer: optimizer holding slots for the factors, they are resized along
+        """
+        if self.capacity > self.rank_bucket:
+            self.set_capacity(self.rank_bucket, optimizer=optimizer)
+        return 0
+
+    def get_active_factors(self, auxiliary=False):
+        """
+        :param auxiliary: include the bases U, V^T, their augmentations and N, M, see memory_report
+        :return: (factor, rows, columns) of the blocks of K, L^T and S in use at the current rank, see DLRTAdam
+        """
+        low_rank = self.rank.read_value()
+        factors = [(self.k, self.input_dim, low_rank), (self.l_t, low_rank, self.units),
+                   (self.s, 2 * low_rank, 2 * low_rank)]
+        if auxiliary:
+            factors += [(self.aux_U, self.input_dim, low_rank), (self.aux_Unp1, self.input_dim, 2 * low_rank),
+                        (self.aux_Vt, low_rank, self.units), (self.aux_Vtnp1, 2 * low_rank, self.units),
+                        (self.aux_N, 2 * low_rank, low_rank), (self.aux_M, 2 * low_rank, low_rank)]
+        return factors
+
     def get_config(self):
         config = super(DLRTLayer, self).get_config()
         config.update({"units": self.units})
@@ -421,60 +599,69 @@ class DLRTLayerAdaptive(keras.layers.Layer):
     def save(self, folder_name, layer_id):
         # main_variables
         k_np = self.k[:, :self.low_rank].numpy()
-        np.save(folder_name + "/k" + str(layer_id) + ".npy", k_np)
-        l_t_np = self.l_t[:self.low_rank, :self.low_rank].numpy()
-        np.save(folder_name + "/l_t" + str(layer_id) + ".npy", l_t_np)
+        write_array(folder_name, "k" + str(layer_id), k_np)
+        l_t_np = self.l_t[:self.low_rank, :].numpy()
+        write_array(folder_name, "l_t" + str(layer_id), l_t_np)
         s_np = self.s[:2 * self.low_rank, :2 * self.low_rank].numpy()
-        np.save(folder_name + "/s" + str(layer_id) + ".npy", s_np)
+        write_array(folder_name, "s" + str(layer_id), s_np)
         b_np = self.b.numpy()
-        np.save(folder_name + "/b" + str(layer_id) + ".npy", b_np)
+        write_array(folder_name, "b" + str(layer_id), b_np)
         # aux_variables
         aux_U_np = self.aux_U[:, :self.low_rank].numpy()
-        np.save(folder_name + "/aux_U" + str(layer_id) + ".npy", aux_U_np)
+        write_array(folder_name, "aux_U" + str(layer_id), aux_U_np)
         aux_Unp1_np = self.aux_Unp1[:, :2 * self.low_rank].numpy()
-        np.save(folder_name + "/aux_Unp1" + str(layer_id) + ".npy", aux_Unp1_np)
-        aux_Vt_np = self.aux_Vt[:, :self.low_rank].numpy()
-        np.save(folder_name + "/aux_Vt" + str(layer_id) + ".npy", aux_Vt_np)
-        aux_Vtnp1_np = self.aux_Vtnp1[:, :2 * self.low_rank].numpy()
-        np.save(folder_name + "/aux_Vtnp1" + str(layer_id) + ".npy", aux_Vtnp1_np)
+        write_array(folder_name, "aux_Unp1" + str(layer_id), aux_Unp1_np)
+        aux_Vt_np = self.aux_Vt[:self.low_rank, :].numpy()
+        write_array(folder_name, "aux_Vt" + str(layer_id), aux_Vt_np)
+        aux_Vtnp1_np = self.aux_Vtnp1[:2 * self.low_rank, :].numpy()
+        write_array(folder_name, "aux_Vtnp1" + str(layer_id), aux_Vtnp1_np)
         aux_N_np = self.aux_N[:2 * self.low_rank, :self.low_rank].numpy()
-        np.save(folder_name + "/aux_N" + str(layer_id) + ".npy", aux_N_np)
+        write_array(folder_name, "aux_N" + str(layer_id), aux_N_np)
         aux_M_np = self.aux_M[:2 * self.low_rank, :self.low_rank].numpy()
-        np.save(folder_name + "/aux_M" + str(layer_id) + ".npy", aux_M_np)
+        write_array(folder_name, "aux_M" + str(layer_id), aux_M_np)
         return 0
 
     def load(self, folder_name, layer_id):
 
         # main variables
-        k_np = np.load(folder_name + "/k" + str(layer_id) + ".npy")
+        k_np = read_array(folder_name, "k" + str(layer_id))
         self.low_rank = k_np.shape[1]
         self.k = tf.Variable(initial_value=k_np,
                              trainable=True, name="k_", dtype=tf.float32)
-        l_t_np = np.load(folder_name + "/l_t" + str(layer_id) + ".npy")
+        l_t_np = read_array(folder_name, "l_t" + str(layer_id))
         self.l_t = tf.Variable(initial_value=l_t_np,
                                trainable=True, name="lt_", dtype=tf.float32)
-        s_np = np.load(folder_name + "/s" + str(layer_id) + ".npy")
+        s_np = read_array(folder_name, "s" + str(layer_id))
         self.s = tf.Variable(initial_value=s_np,
                              trainable=True, name="s_", dtype=tf.float32)
+        bias = read_array(folder_name, "b" + str(layer_id))
+        self.b.assign(bias)
+        self.aux_b.assign(bias)
         # aux variables
-        aux_U_np = np.load(folder_name + "/aux_U" + str(layer_id) + ".npy")
+        aux_U_np = read_array(folder_name, "aux_U" + str(layer_id))
         self.aux_U = tf.Variable(initial_value=aux_U_np,
-                                 trainable=True, name="aux_U", dtype=tf.float32)
-        aux_Unp1_np = np.load(folder_name + "/aux_Unp1" + str(layer_id) + ".npy")
+                                 trainable=False, name="aux_U", dtype=tf.float32)
+        aux_Unp1_np = read_array(folder_name, "aux_Unp1" + str(layer_id))
         self.aux_Unp1 = tf.Variable(initial_value=aux_Unp1_np,
-                                    trainable=True, name="aux_Unp1", dtype=tf.float32)
-        Vt_np = np.load(folder_name + "/aux_Vt" + str(layer_id) + ".npy")
+                                    trainable=False, name="aux_Unp1", dtype=tf.float32)
+        Vt_np = read_array(folder_name, "aux_Vt" + str(layer_id))
         self.aux_Vt = tf.Variable(initial_value=Vt_np,
-                                  trainable=True, name="Vt", dtype=tf.float32)
-        vtnp1_np = np.load(folder_name + "/aux_Vtnp1" + str(layer_id) + ".npy")
+                                  trainable=False, name="Vt", dtype=tf.float32)
+        vtnp1_np = read_array(folder_name, "aux_Vtnp1" + str(layer_id))
         self.aux_Vtnp1 = tf.Variable(initial_value=vtnp1_np,
-                                     trainable=True, name="vtnp1", dtype=tf.float32)
-        aux_N_np = np.load(folder_name + "/aux_N" + str(layer_id) + ".npy")
+                                     trainable=False, name="vtnp1", dtype=tf.float32)
+        aux_N_np = read_array(folder_name, "aux_N" + str(layer_id))
         self.aux_N = tf.Variable(initial_value=aux_N_np,
-                                 trainable=True, name="aux_N", dtype=tf.float32)
-        aux_M_np = np.load(folder_name + "/aux_M" + str(layer_id) + ".npy")
+                                 trainable=False, name="aux_N", dtype=tf.float32)
+        aux_M_np = read_array(folder_name, "aux_M" + str(layer_id))
         self.aux_M = tf.Variable(initial_value=aux_M_np,
-                                 trainable=True, name="aux_M", dtype=tf.float32)
+                                 trainable=False, name="aux_M", dtype=tf.float32)
+        # set_capacity pads whatever it gets, a factor of another layout has to fail here
+        check_factor_shapes(self, layer_id)
+        self.rank.assign(self.low_rank)
+        self.rank_bucket = bucket_rank(self.low_rank, self.rank_bucket_size, self.rmax_total)
+        # the archive holds the factors at the saved rank, pad them to the capacity of the rank bucket
+        self.set_capacity(self.rank_bucket)
         return 0
 
     def get_rank(self):
@@ -485,6 +672,17 @@ class DLRTLayerAdaptive(keras.layers.Layer):
         low_rank_weights = self.low_rank * (self.input_dim + self.units + self.low_rank)
         return low_rank_weights, full_rank_weights
 
+    def export_for_inference(self, batch_size=1):
+        """
+        Freezes the layer at the current rank to the factors U S and V^T of the last rank adaption (bias b), without
+        any integrator state.
+        :param batch_size: expected number of input rows per call, decides between dense and low-rank product
+        :return: DLRTLayerInference
+        """
+        us = tf.matmul(self.aux_U[:, :self.low_rank], self.s[:self.low_rank, :self.low_rank])
+        return DLRTLayerInference(us=us, vt=self.aux_Vt[:self.low_rank, :], b=self.b, activation=True,
+                                  batch_size=batch_size)
+
 
 class DLRTLayerLinear(keras.layers.Layer):
     # Same as DLRTLayer but without activation function (legacy reasons)
@@ -587,62 +785,62 @@ class DLRTLayerLinear(keras.layers.Layer):
     def save(self, folder_name, layer_id):
         # main_variables
         k_np = self.k.numpy()
-        np.save(folder_name + "/k" + str(layer_id) + ".npy", k_np)
+        write_array(folder_name, "k" + str(layer_id), k_np)
         l_t_np = self.l_t.numpy()
-        np.save(folder_name + "/l_t" + str(layer_id) + ".npy", l_t_np)
+        write_array(folder_name, "l_t" + str(layer_id), l_t_np)
         s_np = self.s.numpy()
-        np.save(folder_name + "/s" + str(layer_id) + ".npy", s_np)
+        write_array(folder_name, "s" + str(layer_id), s_np)
         b_np = self.b.numpy()
-        np.save(folder_name + "/b" + str(layer_id) + ".npy", b_np)
+        write_array(folder_name, "b" + str(layer_id), b_np)
         # aux_variables
         aux_U_np = self.aux_U.numpy()
-        np.save(folder_name + "/aux_U" + str(layer_id) + ".npy", aux_U_np)
+        write_array(folder_name, "aux_U" + str(layer_id), aux_U_np)
         aux_Unp1_np = self.aux_Unp1.numpy()
-        np.save(folder_name + "/aux_Unp1" + str(layer_id) + ".npy", aux_Unp1_np)
+        write_array(folder_name, "aux_Unp1" + str(layer_id), aux_Unp1_np)
         aux_Vt_np = self.aux_Vt.numpy()
-        np.save(folder_name + "/aux_Vt" + str(layer_id) + ".npy", aux_Vt_np)
+        write_array(folder_name, "aux_Vt" + str(layer_id), aux_Vt_np)
         aux_Vtnp1_np = self.aux_Vtnp1.numpy()
-        np.save(folder_name + "/aux_Vtnp1" + str(layer_id) + ".npy", aux_Vtnp1_np)
+        write_array(folder_name, "aux_Vtnp1" + str(layer_id), aux_Vtnp1_np)
         aux_N_np = self.aux_N.numpy()
-        np.save(folder_name + "/aux_N" + str(layer_id) + ".npy", aux_N_np)
+        write_array(folder_name, "aux_N" + str(layer_id), aux_N_np)
         aux_M_np = self.aux_M.numpy()
-        np.save(folder_name + "/aux_M" + str(layer_id) + ".npy", aux_M_np)
+        write_array(folder_name, "aux_M" + str(layer_id), aux_M_np)
         return 0
 
     def load(self, folder_name, layer_id):
 
         # main variables
-        k_np = np.load(folder_name + "/k" + str(layer_id) + ".npy")
+        k_np = read_array(folder_name, "k" + str(layer_id))
         self.low_rank = k_np.shape[1]
         self.k = tf.Variable(initial_value=k_np,
                              trainable=True, name="k_", dtype=tf.float32)
-        l_t_np = np.load(folder_name + "/l_t" + str(layer_id) + ".npy")
+        l_t_np = read_array(folder_name, "l_t" + str(layer_id))
         self.l_t = tf.Variable(initial_value=l_t_np,
                                trainable=True, name="lt_", dtype=tf.float32)
-        s_np = np.load(folder_name + "/s" + str(layer_id) + ".npy")
+        s_np = read_array(folder_name, "s" + str(layer_id))
         self.s = tf.Variable(initial_value=s_np,
                              trainable=True, name="s_", dtype=tf.float32)
-        bias = np.load(folder_name + "/b" + str(layer_id) + ".npy")
+        bias = read_array(folder_name, "b" + str(layer_id))
         self.b = tf.Variable(initial_value=bias,
                              trainable=True, name="b_", dtype=tf.float32)
 
         # aux variables
-        aux_U_np = np.load(folder_name + "/aux_U" + str(layer_id) + ".npy")
+        aux_U_np = read_array(folder_name, "aux_U" + str(layer_id))
         self.aux_U = tf.Variable(initial_value=aux_U_np,
                                  trainable=False, name="aux_U", dtype=tf.float32)
-        aux_Unp1_np = np.load(folder_name + "/aux_Unp1" + str(layer_id) + ".npy")
+        aux_Unp1_np = read_array(folder_name, "aux_Unp1" + str(layer_id))
         self.aux_Unp1 = tf.Variable(initial_value=aux_Unp1_np,
                                     trainable=False, name="aux_Unp1", dtype=tf.float32)
-        Vt_np = np.load(folder_name + "/aux_Vt" + str(layer_id) + ".npy")
+        Vt_np = read_array(folder_name, "aux_Vt" + str(layer_id))
         self.aux_Vt = tf.Variable(initial_value=Vt_np,
                                   trainable=False, name="aux_Vt", dtype=tf.float32)
-        vtnp1_np = np.load(folder_name + "/aux_Vtnp1" + str(layer_id) + ".npy")
+        vtnp1_np = read_array(folder_name, "aux_Vtnp1" + str(layer_id))
         self.aux_Vtnp1 = tf.Variable(initial_value=vtnp1_np,
                                      trainable=False, name="aux_Vtnp1", dtype=tf.float32)
-        aux_N_np = np.load(folder_name + "/aux_N" + str(layer_id) + ".npy")
+        aux_N_np = read_array(folder_name, "aux_N" + str(layer_id))
         self.aux_N = tf.Variable(initial_value=aux_N_np,
                                  trainable=False, name="aux_N", dtype=tf.float32)
-        aux_M_np = np.load(folder_name + "/aux_M" + str(layer_id) + ".npy")
+        aux_M_np = read_array(folder_name, "aux_M" + str(layer_id))
         self.aux_M = tf.Variable(initial_value=aux_M_np,
                                  trainable=False, name="aux_M", dtype=tf.float32)
 
@@ -663,7 +861,7 @@ class DLRTLayerLinear(keras.layers.Layer):
 
     def load_from_fullW(self, folder_name, layer_id, rank):
 
-        W_mat = np.load(folder_name + "/w_" + str(layer_id) + ".npy")
+        W_mat = read_array(folder_name, "w_" + str(layer_id))
         d, u, v = tf.linalg.svd(W_mat)  # d=singular values, u2 = left singuar vecs, v2= right singular vecss
 
         s_init = tf.linalg.tensor_diag(d[:rank])
@@ -686,11 +884,21 @@ class DLRTLayerLinear(keras.layers.Layer):
         low_rank_weights = self.low_rank * (self.input_dim + self.units + self.low_rank)
         return low_rank_weights, full_rank_weights
 
+    def export_for_inference(self, batch_size=1):
+        """
+        Freezes the layer at the current rank to the factors U S and V^T of the last S-step (bias b), without any
+        integrator state.
+        :param batch_size: expected number of input rows per call, decides between dense and low-rank product
+        :return: DLRTLayerInference
+        """
+        return DLRTLayerInference(us=tf.matmul(self.aux_U, self.s), vt=self.aux_Vt, b=self.b, activation=False,
+                                  batch_size=batch_size)
+
 
 class DLRTLayerAdaptiveLinear(keras.layers.Layer):
     # Same as DLRTLayerAdaptive but without activation function (legacy reasons)
-    def __init__(self, input_dim: int, units=32, low_rank=10, epsAdapt=0.1, rmax_total=100, name="dlra_block",
-                 **kwargs):
+    def __init__(self, input_dim: int, units=32, low_rank=10, epsAdapt=0.1, rmax_total=100, rank_bucket_size=1,
+                 svd_method="full", svd_oversampling=8, svd_power_iterations=4, name="dlra_block", **kwargs):
         super(DLRTLayerAdaptiveLinear, self).__init__(**kwargs)
         self.epsAdapt = epsAdapt  # for unconventional integrator
         self.units = units
@@ -704,32 +912,50 @@ class DLRTLayerAdaptiveLinear(keras.layers.Layer):
             self.low_rank = int(self.rmax_total)
         print("Start rank has been set to: " + str(self.low_rank) + " to match max rank")
         self.input_dim = input_dim
+        # the forward pass slices the factors at the bucketed rank and zero pads beyond the current rank,
+        # so compiled steps only retrace when the rank leaves its bucket
+        self.rank_bucket_size = rank_bucket_size
+        self.rank_bucket = bucket_rank(self.low_rank, self.rank_bucket_size, self.rmax_total)
+        # the factors are allocated at a capacity of at least rank_bucket (the augmented ones at twice that), which
+        # grows geometrically when the rank outgrows it, see set_capacity
+        self.capacity = self.rank_bucket
+        self.buffer_generation = 0  # counts the reallocations of the factors, compiled steps are keyed on it
+        # decomposition of S in the rank adaption, see truncated_svd
+        self.svd_method = svd_method
+        self.svd_oversampling = svd_oversampling
+        self.svd_power_iterations = svd_power_iterations
 
     def build_model(self):
 
-        self.k = self.add_weight(shape=(self.input_dim, self.rmax_total), initializer="random_normal",
+        self.k = self.add_weight(shape=(self.input_dim, self.capacity), initializer="random_normal",
                                  trainable=True, name="k_")
-        self.l_t = self.add_weight(shape=(self.rmax_total, self.units), initializer="random_normal",
+        self.l_t = self.add_weight(shape=(self.capacity, self.units), initializer="random_normal",
                                    trainable=True, name="lt_")
-        self.s = self.add_weight(shape=(2 * self.rmax_total, 2 * self.rmax_total), initializer="random_normal",
+        self.s = self.add_weight(shape=(2 * self.capacity, 2 * self.capacity), initializer="random_normal",
                                  trainable=True, name="s_")
         self.b = self.add_weight(shape=(self.units,), initializer="random_normal", trainable=True, name="b_")
         # auxiliary variables
         self.aux_b = self.add_weight(shape=(self.units,), initializer="random_normal", trainable=False, name="aux_b")
         self.aux_b.assign(self.b)  # non trainable bias or k and l step
 
-        self.aux_U = self.add_weight(shape=(self.input_dim, self.rmax_total), initializer="random_normal",
+        self.aux_U = self.add_weight(shape=(self.input_dim, self.capacity), initializer="random_normal",
                                      trainable=False, name="aux_U")
-        self.aux_Unp1 = self.add_weight(shape=(self.input_dim, 2 * self.rmax_total), initializer="random_normal",
+        self.aux_Unp1 = self.add_weight(shape=(self.input_dim, 2 * self.capacity), initializer="random_normal",
                                         trainable=False, name="aux_Unp1")
-        self.aux_Vt = self.add_weight(shape=(self.rmax_total, self.units), initializer="random_normal",
+        self.aux_Vt = self.add_weight(shape=(self.capacity, self.units), initializer="random_normal",
                                       trainable=False, name="Vt")
-        self.aux_Vtnp1 = self.add_weight(shape=(2 * self.rmax_total, self.units), initializer="random_normal",
+        self.aux_Vtnp1 = self.add_weight(shape=(2 * self.capacity, self.units), initializer="random_normal",
                                          trainable=False, name="vtnp1")
-        self.aux_N = self.add_weight(shape=(2 * self.rmax_total, self.rmax_total), initializer="random_normal",
+        self.aux_N = self.add_weight(shape=(2 * self.capacity, self.capacity), initializer="random_normal",
                                      trainable=False, name="aux_N")
-        self.aux_M = self.add_weight(shape=(2 * self.rmax_total, self.rmax_total), initializer="random_normal",
+        self.aux_M = self.add_weight(shape=(2 * self.capacity, self.capacity), initializer="random_normal",
                                      trainable=False, name="aux_M")
+        self.rank = self.add_weight(shape=(), initializer=tf.keras.initializers.Constant(self.low_rank),
+                                    dtype=tf.int32, trainable=False, name="rank")  # current rank, see rank_adaption
+        # relative norm of K and L^T outside U and V at the last postprocessing, see tail_energy_estimate
+        self.tail_energy = self.add_weight(shape=(2,), initializer="zeros", trainable=False, name="tail_energy")
+        # compiled on the current factors, rebuilt whenever they are reallocated
+        self.rank_adaption_compiled = tf.function(self.truncate_rank)
         # Todo: initializer with low rank
 
     # @tf.function
@@ -738,93 +964,243 @@ class DLRTLayerAdaptiveLinear(keras.layers.Layer):
         :param
         inputs: layer         input
         :param
-        step: step         counter: k := 0, l := 1, s := 2
+        step: step         counter: k := 0, l := 1, s := 2, fused k and l := 3
         :return:
         """
+        width = self.rank_bucket
+        mask = tf.sequence_mask(self.rank, width, dtype=self.k.dtype)  # zero pads the factors beyond the rank
         if step == 0:  # k-step
-            z = tf.matmul(tf.matmul(inputs, self.k[:, :self.low_rank]), self.aux_Vt[:self.low_rank, :])
+            z = tf.matmul(tf.matmul(inputs, self.k[:, :width] * mask), self.aux_Vt[:width, :])
             z = z + self.aux_b
         elif step == 1:  # l-step
-            z = tf.matmul(tf.matmul(inputs, self.aux_U[:, :self.low_rank]), self.l_t[:self.low_rank, :])
+            z = tf.matmul(tf.matmul(inputs, self.aux_U[:, :width]), self.l_t[:width, :] * mask[:, None])
+            z = z + self.aux_b
+        elif step == 3:  # fused k- and l-step
+            z = fused_kl_matmul(inputs, self.k[:, :width] * mask, self.aux_U[:, :width],
+                                self.l_t[:width, :] * mask[:, None], self.aux_Vt[:width, :])
             z = z + self.aux_b
         else:  # s-step
+            mask = tf.sequence_mask(2 * self.rank, 2 * width, dtype=self.s.dtype)
             z = tf.matmul(
-                tf.matmul(tf.matmul(inputs, self.aux_Unp1[:, :2 * self.low_rank]),
-                          self.s[:2 * self.low_rank, :2 * self.low_rank]), self.aux_Vtnp1[:2 * self.low_rank, :])
+                tf.matmul(tf.matmul(inputs, self.aux_Unp1[:, :2 * width]),
+                          self.s[:2 * width, :2 * width] * mask[:, None] * mask[None, :]),
+                self.aux_Vtnp1[:2 * width, :])
             z = z + self.b
 
         return z
 
     # @tf.function
     def k_step_preprocessing(self):
-        k = tf.matmul(self.aux_U[:, :self.low_rank], self.s[:self.low_rank, :self.low_rank])
-        self.k[:, :self.low_rank].assign(k)
+        low_rank = self.rank.read_value()
+        k = tf.matmul(self.aux_U[:, :low_rank], self.s[:low_rank, :low_rank])
+        self.k[:, :low_rank].assign(k)
+        return 0
+
+    # @tf.function
+    def k_step_postprocessing(self):
+        """
+        Postprocessing of the K step without rank adaption: QR of K at the current rank instead of the augmented
+        [K, U]. The augmented half of the new basis stays zero, so the S step only trains the leading r x r block of S.
+        Followed by fixed_rank_update instead of rank_adaption.
+        """
+        low_rank = self.rank.read_value()
+        self.tail_energy[0].assign(basis_residual(self.k[:, :low_rank], self.aux_U[:, :low_rank]))
+        aux_Unp1, _ = tf.linalg.qr(self.k[:, :low_rank])
+        self.aux_Unp1[:, :2 * low_rank].assign(tf.concat((aux_Unp1, tf.zeros_like(aux_Unp1)), axis=1))
+        aux_N = tf.matmul(tf.transpose(self.aux_Unp1[:, :2 * low_rank]), self.aux_U[:, : low_rank])
+        self.aux_N[:2 * low_rank, :low_rank].assign(aux_N)
         return 0
 
     # @tf.function
     def k_step_postprocessing_adapt(self):
-        k_extended = tf.concat((self.k[:, :self.low_rank], self.aux_U[:, :self.low_rank]), axis=1)
+        low_rank = self.rank.read_value()
+        self.tail_energy[0].assign(basis_residual(self.k[:, :low_rank], self.aux_U[:, :low_rank]))
+        k_extended = tf.concat((self.k[:, :low_rank], self.aux_U[:, :low_rank]), axis=1)
         aux_Unp1, _ = tf.linalg.qr(k_extended)
-        self.aux_Unp1[:, :2 * self.low_rank].assign(aux_Unp1)
-        aux_N = tf.matmul(tf.transpose(self.aux_Unp1[:, :2 * self.low_rank]), self.aux_U[:, : self.low_rank])
-        self.aux_N[:2 * self.low_rank, :self.low_rank].assign(aux_N)
+        self.aux_Unp1[:, :2 * low_rank].assign(aux_Unp1)
+        aux_N = tf.matmul(tf.transpose(self.aux_Unp1[:, :2 * low_rank]), self.aux_U[:, : low_rank])
+        self.aux_N[:2 * low_rank, :low_rank].assign(aux_N)
         return 0
 
     # @tf.function
     def l_step_preprocessing(self):
-        l_t = tf.matmul(self.s[:self.low_rank, :self.low_rank], self.aux_Vt[:self.low_rank, :])
-        self.l_t[:self.low_rank, :].assign(l_t)  # = tf.Variable(initial_value=l_t, trainable=True, name="lt_")
+        low_rank = self.rank.read_value()
+        l_t = tf.matmul(self.s[:low_rank, :low_rank], self.aux_Vt[:low_rank, :])
+        self.l_t[:low_rank, :].assign(l_t)  # = tf.Variable(initial_value=l_t, trainable=True, name="lt_")
+        return 0
+
+    # @tf.function
+    def l_step_postprocessing(self):
+        """
+        Postprocessing of the L step without rank adaption, see k_step_postprocessing.
+        """
+        low_rank = self.rank.read_value()
+        self.tail_energy[1].assign(basis_residual(tf.transpose(self.l_t[:low_rank, :]),
+                                                  tf.transpose(self.aux_Vt[:low_rank, :])))
+        aux_Vnp1, _ = tf.linalg.qr(tf.transpose(self.l_t[:low_rank, :]))
+        aux_Vtnp1 = tf.transpose(aux_Vnp1)
+        self.aux_Vtnp1[:2 * low_rank, :].assign(tf.concat((aux_Vtnp1, tf.zeros_like(aux_Vtnp1)), axis=0))
+        aux_M = tf.matmul(self.aux_Vtnp1[:2 * low_rank, :], tf.transpose(self.aux_Vt[: low_rank, :]))
+        self.aux_M[:2 * low_rank, :low_rank].assign(aux_M)
         return 0
 
     # @tf.function
     def l_step_postprocessing_adapt(self):
+        low_rank = self.rank.read_value()
+        self.tail_energy[1].assign(basis_residual(tf.transpose(self.l_t[:low_rank, :]),
+                                                  tf.transpose(self.aux_Vt[:low_rank, :])))
         l_extended = tf.concat(
-            (tf.transpose(self.l_t[:self.low_rank, :]), tf.transpose(self.aux_Vt[:self.low_rank, :])), axis=1)
+            (tf.transpose(self.l_t[:low_rank, :]), tf.transpose(self.aux_Vt[:low_rank, :])), axis=1)
         aux_Vnp1, _ = tf.linalg.qr(l_extended)
-        self.aux_Vtnp1[:2 * self.low_rank, :].assign(tf.transpose(aux_Vnp1))
-        aux_M = tf.matmul(self.aux_Vtnp1[:2 * self.low_rank, :], tf.transpose(self.aux_Vt[: self.low_rank, :]))
-        self.aux_M[:2 * self.low_rank, :self.low_rank].assign(aux_M)
+        self.aux_Vtnp1[:2 * low_rank, :].assign(tf.transpose(aux_Vnp1))
+        aux_M = tf.matmul(self.aux_Vtnp1[:2 * low_rank, :], tf.transpose(self.aux_Vt[: low_rank, :]))
+        self.aux_M[:2 * low_rank, :low_rank].assign(aux_M)
         return 0
 
     # @tf.function
-    def s_step_preprocessing(self):
+    def s_step_preprocessing(self, optimizer=None):
+        """
+        :param optimizer: optimizer of the training loop, a DLRTAdam moves the moments of S to the augmented bases
+        """
+        low_rank = self.rank.read_value()
         s = tf.matmul(
-            tf.matmul(self.aux_N[:2 * self.low_rank, :self.low_rank], self.s[: self.low_rank, :self.low_rank]),
-            tf.transpose(self.aux_M[:2 * self.low_rank, :self.low_rank]))
-        self.s[:2 * self.low_rank, :2 * self.low_rank].assign(s)
+            tf.matmul(self.aux_N[:2 * low_rank, :low_rank], self.s[: low_rank, :low_rank]),
+            tf.transpose(self.aux_M[:2 * low_rank, :low_rank]))
+        self.s[:2 * low_rank, :2 * low_rank].assign(s)
+        if hasattr(optimizer, "change_basis"):
+            optimizer.change_basis(self.s, left=self.aux_N[:2 * low_rank, :low_rank],
+                                   right=self.aux_M[:2 * low_rank, :low_rank])
 
         return 0
 
-    # @tf.function
-    def rank_adaption(self):
-        # 1) compute SVD of S
-        # d=singular values, u2 = left singuar vecs, v2= right singular vecs
-        s_small = self.s[:2 * self.low_rank, :2 * self.low_rank]
-        d, u2, v2 = tf.linalg.svd(s_small)
+    def fixed_rank_update(self, optimizer=None):
+        """
+        Completes a step without rank adaption, in place of rank_adaption after k_step_postprocessing and
+        l_step_postprocessing: the QR factors of K and L become the new bases and S keeps its leading r x r block,
+        there is no SVD and the rank stays.
+        :param optimizer: optimizer of the training loop, a DLRTAdam moves the moments of K and L^T to the new bases
+        """
+        low_rank = self.rank.read_value()
+        if hasattr(optimizer, "change_basis"):
+            # U_new^T U_old and V_new^T V_old are the leading blocks of N and M
+            optimizer.change_basis(self.k, right=self.aux_M[:low_rank, :low_rank])
+            optimizer.change_basis(self.l_t, left=self.aux_N[:low_rank, :low_rank])
+        self.aux_U[:, :low_rank].assign(self.aux_Unp1[:, :low_rank])
+        self.aux_Vt[:low_rank, :].assign(self.aux_Vtnp1[:low_rank, :])
 
-        tol = self.epsAdapt * tf.linalg.norm(d)  # absolute value treshold (try also relative one)
-        rmax = int(tf.floor(d.shape[0] / 2))
-        for j in range(0, 2 * rmax - 1):
-            tmp = tf.linalg.norm(d[j:2 * rmax - 1])
-            if tmp < tol:
-                rmax = j
-                break
+        # update bias
+        self.aux_b.assign(self.b)
+        return 0
 
-        rmax = tf.minimum(rmax, self.rmax_total)
-        rmax = tf.maximum(rmax, 2)
+    def tail_energy_estimate(self):
+        """
+        Cheap estimate of the tail energy of the augmented S, without QR or SVD: the relative norm of the parts of K
+        and L^T outside the bases U and V, which make up the augmented blocks of S. Updated by the K and L
+        postprocessing.
+        :return: estimate as float tensor
+        """
+        return tf.reduce_max(self.tail_energy)
+
+    def rank_adaption(self, optimizer=None):
+        """
+        :param optimizer: optimizer of the training loop, its slots are carried over if the factors have to grow. A
+        DLRTAdam moves the moments of K, L^T and S to the new bases.
+        """
+        # the truncation runs compiled on the rank variable, low_rank mirrors it for the rank bucket and save
+        rmax, d, aux_U, aux_Vt, u2, v2, basis_u, basis_v = self.rank_adaption_compiled()
+        self.low_rank = int(rmax)
+        self.rank_bucket = bucket_rank(self.low_rank, self.rank_bucket_size, self.rmax_total)
+        if self.rank_bucket > self.capacity:
+            # geometric growth, so a rank that keeps rising reallocates only a logarithmic number of times
+            self.set_capacity(min(max(2 * self.capacity, self.rank_bucket), self.rmax_total), optimizer=optimizer)
+        if hasattr(optimizer, "change_basis"):
+            # the columns of K are coefficients in the basis V, the rows of L^T in U and S lives in both
+            optimizer.change_basis(self.k, right=basis_v)
+            optimizer.change_basis(self.l_t, left=basis_u)
+            optimizer.change_basis(self.s, left=tf.transpose(u2), right=v2)
 
         # update s
-        self.s[:rmax, :rmax].assign(tf.linalg.tensor_diag(d[:rmax]))
+        self.s[:self.low_rank, :self.low_rank].assign(tf.linalg.tensor_diag(d))
 
         # update u and v
-        self.aux_U[:, :rmax].assign(tf.matmul(self.aux_Unp1[:, :2 * self.low_rank], u2[:, :rmax]))
-        self.aux_Vt[:rmax, :].assign(tf.matmul(v2[:rmax, :], self.aux_Vtnp1[:2 * self.low_rank, :]))
-        self.low_rank = int(rmax)
+        self.aux_U[:, :self.low_rank].assign(aux_U)
+        self.aux_Vt[:self.low_rank, :].assign(aux_Vt)
+        self.rank.assign(self.low_rank)
 
         # update bias
         self.aux_b.assign(self.b)
         return 0
 
+    def truncate_rank(self):
+        """
+        SVD of the augmented S and truncation to the new rank, compiled as rank_adaption_compiled. Nothing is assigned
+        here, the new rank may not fit into the current capacity.
+        :return: new rank, its singular values, new basis U (input_dim, rank), new basis V^T (rank, units), the
+        truncated singular vectors of S and the changes of basis from the old U and V to the new ones
+        """
+        # 1) compute SVD of S
+        # d=singular values, u2 = left singuar vecs, v2= right singular vecs
+        low_rank = self.rank.read_value()
+        s_small = self.s[:2 * low_rank, :2 * low_rank]
+        # the right singular vectors come as rows, v2 = V^T, see truncated_svd
+        rmax, d, u2, v2 = truncated_svd(s_small, low_rank, self.epsAdapt, method=self.svd_method,
+                                        warm_start=self.aux_M[:2 * low_rank, :low_rank],
+                                        oversampling=self.svd_oversampling,
+                                        power_iterations=self.svd_power_iterations)  # tol=\vartheta in paper
+        rmax = tf.minimum(rmax, self.rmax_total)
+        rmax = tf.maximum(rmax, 2)
+
+        aux_U = tf.matmul(self.aux_Unp1[:, :2 * low_rank], u2[:, :rmax])
+        aux_Vt = tf.matmul(v2[:rmax, :], self.aux_Vtnp1[:2 * low_rank, :])
+        # U_new^T U_old and V_new^T V_old, through N = U_np1^T U_old and M = V_np1^T V_old
+        basis_u = tf.matmul(u2[:, :rmax], self.aux_N[:2 * low_rank, :low_rank], transpose_a=True)
+        basis_v = tf.matmul(v2[:rmax, :], self.aux_M[:2 * low_rank, :low_rank])
+        return rmax, d[:rmax], aux_U, aux_Vt, u2[:, :rmax], v2[:rmax, :], basis_u, basis_v
+
+    def set_capacity(self, capacity, optimizer=None):
+        """
+        Reallocates the factors at width capacity (S and the augmented bases at 2 * capacity) and keeps their leading
+        blocks. Compiled functions still hold the old variables, buffer_generation is incremented to retrace them.
+        :param capacity: new capacity, between rank_bucket and rmax_total
+        :param optimizer: optimizer holding slots for the factors (e.g. Adam moments), they are resized along
+        """
+        self.capacity = capacity
+        self.k = resize_factor(self.k, (self.input_dim, capacity), optimizer)
+        self.l_t = resize_factor(self.l_t, (capacity, self.units), optimizer)
+        self.s = resize_factor(self.s, (2 * capacity, 2 * capacity), optimizer)
+        self.aux_U = resize_factor(self.aux_U, (self.input_dim, capacity), optimizer)
+        self.aux_Unp1 = resize_factor(self.aux_Unp1, (self.input_dim, 2 * capacity), optimizer)
+        self.aux_Vt = resize_factor(self.aux_Vt, (capacity, self.units), optimizer)
+        self.aux_Vtnp1 = resize_factor(self.aux_Vtnp1, (2 * capacity, self.units), optimizer)
+        self.aux_N = resize_factor(self.aux_N, (2 * capacity, capacity), optimizer)
+        self.aux_M = resize_factor(self.aux_M, (2 * capacity, capacity), optimizer)
+        self.buffer_generation += 1
+        self.rank_adaption_compiled = tf.function(self.truncate_rank)
+        return 0
+
+    def shrink_capacity(self, optimizer=None):
+        """
+        Releases the capacity above the current rank bucket.
+        :param optimizer: optimizer holding slots for the factors, they are resized along
+        """
+        if self.capacity > self.rank_bucket:
+            self.set_capacity(self.rank_bucket, optimizer=optimizer)
+        return 0
+
+    def get_active_factors(self, auxiliary=False):
+        """
+        :param auxiliary: include the bases U, V^T, their augmentations and N, M, see memory_report
+        :return: (factor, rows, columns) of the blocks of K, L^T and S in use at the current rank, see DLRTAdam
+        """
+        low_rank = self.rank.read_value()
+        factors = [(self.k, self.input_dim, low_rank), (self.l_t, low_rank, self.units),
+                   (self.s, 2 * low_rank, 2 * low_rank)]
+        if auxiliary:
+            factors += [(self.aux_U, self.input_dim, low_rank), (self.aux_Unp1, self.input_dim, 2 * low_rank),
+                        (self.aux_Vt, low_rank, self.units), (self.aux_Vtnp1, 2 * low_rank, self.units),
+                        (self.aux_N, 2 * low_rank, low_rank), (self.aux_M, 2 * low_rank, low_rank)]
+        return factors
+
     def get_config(self):
         config = super(DLRTLayer, self).get_config()
         config.update({"units": self.units})
@@ -834,60 +1210,69 @@ class DLRTLayerAdaptiveLinear(keras.layers.Layer):
     def save(self, folder_name, layer_id):
         # main_variables
         k_np = self.k[:, :self.low_rank].numpy()
-        np.save(folder_name + "/k" + str(layer_id) + ".npy", k_np)
-        l_t_np = self.l_t[:self.low_rank, :self.low_rank].numpy()
-        np.save(folder_name + "/l_t" + str(layer_id) + ".npy", l_t_np)
+        write_array(folder_name, "k" + str(layer_id), k_np)
+        l_t_np = self.l_t[:self.low_rank, :].numpy()
+        write_array(folder_name, "l_t" + str(layer_id), l_t_np)
         s_np = self.s[:2 * self.low_rank, :2 * self.low_rank].numpy()
-        np.save(folder_name + "/s" + str(layer_id) + ".npy", s_np)
+        write_array(folder_name, "s" + str(layer_id), s_np)
         b_np = self.b.numpy()
-        np.save(folder_name + "/b" + str(layer_id) + ".npy", b_np)
+        write_array(folder_name, "b" + str(layer_id), b_np)
         # aux_variables
         aux_U_np = self.aux_U[:, :self.low_rank].numpy()
-        np.save(folder_name + "/aux_U" + str(layer_id) + ".npy", aux_U_np)
+        write_array(folder_name, "aux_U" + str(layer_id), aux_U_np)
         aux_Unp1_np = self.aux_Unp1[:, :2 * self.low_rank].numpy()
-        np.save(folder_name + "/aux_Unp1" + str(layer_id) + ".npy", aux_Unp1_np)
-        aux_Vt_np = self.aux_Vt[:, :self.low_rank].numpy()
-        np.save(folder_name + "/aux_Vt" + str(layer_id) + ".npy", aux_Vt_np)
-        aux_Vtnp1_np = self.aux_Vtnp1[:, :2 * self.low_rank].numpy()
-        np.save(folder_name + "/aux_Vtnp1" + str(layer_id) + ".npy", aux_Vtnp1_np)
+        write_array(folder_name, "aux_Unp1" + str(layer_id), aux_Unp1_np)
+        aux_Vt_np = self.aux_Vt[:self.low_rank, :].numpy()
+        write_array(folder_name, "aux_Vt" + str(layer_id), aux_Vt_np)
+        aux_Vtnp1_np = self.aux_Vtnp1[:2 * self.low_rank, :].numpy()
+        write_array(folder_name, "aux_Vtnp1" + str(layer_id), aux_Vtnp1_np)
         aux_N_np = self.aux_N[:2 * self.low_rank, :self.low_rank].numpy()
-        np.save(folder_name + "/aux_N" + str(layer_id) + ".npy", aux_N_np)
+        write_array(folder_name, "aux_N" + str(layer_id), aux_N_np)
         aux_M_np = self.aux_M[:2 * self.low_rank, :self.low_rank].numpy()
-        np.save(folder_name + "/aux_M" + str(layer_id) + ".npy", aux_M_np)
+        write_array(folder_name, "aux_M" + str(layer_id), aux_M_np)
         return 0
 
     def load(self, folder_name, layer_id):
 
         # main variables
-        k_np = np.load(folder_name + "/k" + str(layer_id) + ".npy")
+        k_np = read_array(folder_name, "k" + str(layer_id))
         self.low_rank = k_np.shape[1]
         self.k = tf.Variable(initial_value=k_np,
                              trainable=True, name="k_", dtype=tf.float32)
-        l_t_np = np.load(folder_name + "/l_t" + str(layer_id) + ".npy")
+        l_t_np = read_array(folder_name, "l_t" + str(layer_id))
         self.l_t = tf.Variable(initial_value=l_t_np,
                                trainable=True, name="lt_", dtype=tf.float32)
-        s_np = np.load(folder_name + "/s" + str(layer_id) + ".npy")
+        s_np = read_array(folder_name, "s" + str(layer_id))
         self.s = tf.Variable(initial_value=s_np,
                              trainable=True, name="s_", dtype=tf.float32)
+        bias = read_array(folder_name, "b" + str(layer_id))
+        self.b.assign(bias)
+        self.aux_b.assign(bias)
         # aux variables
-        aux_U_np = np.load(folder_name + "/aux_U" + str(layer_id) + ".npy")
+        aux_U_np = read_array(folder_name, "aux_U" + str(layer_id))
         self.aux_U = tf.Variable(initial_value=aux_U_np,
-                                 trainable=True, name="aux_U", dtype=tf.float32)
-        aux_Unp1_np = np.load(folder_name + "/aux_Unp1" + str(layer_id) + ".npy")
+                                 trainable=False, name="aux_U", dtype=tf.float32)
+        aux_Unp1_np = read_array(folder_name, "aux_Unp1" + str(layer_id))
         self.aux_Unp1 = tf.Variable(initial_value=aux_Unp1_np,
-                                    trainable=True, name="aux_Unp1", dtype=tf.float32)
-        Vt_np = np.load(folder_name + "/aux_Vt" + str(layer_id) + ".npy")
+                                    trainable=False, name="aux_Unp1", dtype=tf.float32)
+        Vt_np = read_array(folder_name, "aux_Vt" + str(layer_id))
         self.aux_Vt = tf.Variable(initial_value=Vt_np,
-                                  trainable=True, name="Vt", dtype=tf.float32)
-        vtnp1_np = np.load(folder_name + "/aux_Vtnp1" + str(layer_id) + ".npy")
+                                  trainable=False, name="Vt", dtype=tf.float32)
+        vtnp1_np = read_array(folder_name, "aux_Vtnp1" + str(layer_id))
         self.aux_Vtnp1 = tf.Variable(initial_value=vtnp1_np,
-                                     trainable=True, name="vtnp1", dtype=tf.float32)
-        aux_N_np = np.load(folder_name + "/aux_N" + str(layer_id) + ".npy")
+                                     trainable=False, name="vtnp1", dtype=tf.float32)
+        aux_N_np = read_array(folder_name, "aux_N" + str(layer_id))
         self.aux_N = tf.Variable(initial_value=aux_N_np,
-                                 trainable=True, name="aux_N", dtype=tf.float32)
-        aux_M_np = np.load(folder_name + "/aux_M" + str(layer_id) + ".npy")
+                                 trainable=False, name="aux_N", dtype=tf.float32)
+        aux_M_np = read_array(folder_name, "aux_M" + str(layer_id))
         self.aux_M = tf.Variable(initial_value=aux_M_np,
-                                 trainable=True, name="aux_M", dtype=tf.float32)
+                                 trainable=False, name="aux_M", dtype=tf.float32)
+        # set_capacity pads whatever it gets, a factor of another layout has to fail here
+        check_factor_shapes(self, layer_id)
+        self.rank.assign(self.low_rank)
+        self.rank_bucket = bucket_rank(self.low_rank, self.rank_bucket_size, self.rmax_total)
+        # the archive holds the factors at the saved rank, pad them to the capacity of the rank bucket
+        self.set_capacity(self.rank_bucket)
         return 0
 
     def get_rank(self):
@@ -897,3 +1282,211 @@ class DLRTLayerAdaptiveLinear(keras.layers.Layer):
         full_rank_weights = self.input_dim * self.units
         low_rank_weights = self.low_rank * (self.input_dim + self.units + self.low_rank)
         return low_rank_weights, full_rank_weights
+
+    def export_for_inference(self, batch_size=1):
+        """
+        Freezes the layer at the current rank to the factors U S and V^T of the last rank adaption (bias b), without
+        any integrator state.
+        :param batch_size: expected number of input rows per call, decides between dense and low-rank product
+        :return: DLRTLayerInference
+        """
+        us = tf.matmul(self.aux_U[:, :self.low_rank], self.s[:self.low_rank, :self.low_rank])
+        return DLRTLayerInference(us=us, vt=self.aux_Vt[:self.low_rank, :], b=self.b, activation=False,
+                                  batch_size=batch_size)
+
+
+class DLRTLayerInference(keras.layers.Layer):
+    # Frozen DLRT layer for serving, created by export_for_inference of the DLRT layers
+    def __init__(self, us, vt, b, activation=True, batch_size=1, name="dlrt_inference", **kwargs):
+        """
+        :param us: factor U S (input_dim, r)
+        :param vt: factor V^T (r, units)
+        :param b: bias (units,)
+        :param activation: relu (DLRTLayer, DLRTLayerAdaptive) or none (DLRTLayerLinear, DLRTLayerAdaptiveLinear)
+        :param batch_size: expected number of input rows per call, decides between dense and low-rank product
+        """
+        super(DLRTLayerInference, self).__init__(**kwargs)
+        self.input_dim, self.low_rank = us.shape
+        self.rank_bucket = self.low_rank  # the rank is frozen, keeps get_rank_buckets of the networks working
+        self.buffer_generation = 0
+        self.units = vt.shape[1]
+        self.activation = activation
+        self.dense = prefer_dense_product(self.input_dim, self.units, self.low_rank, batch_size)
+        if self.dense:
+            self.w = tf.Variable(initial_value=tf.matmul(us, vt), trainable=False, name="w_", dtype=tf.float32)
+        else:
+            self.us = tf.Variable(initial_value=us, trainable=False, name="us_", dtype=tf.float32)
+            self.vt = tf.Variable(initial_value=vt, trainable=False, name="vt_", dtype=tf.float32)
+        self.b = tf.Variable(initial_value=b, trainable=False, name="b_", dtype=tf.float32)
+
+    @tf.function
+    def call(self, inputs, step: int = 0):
+        """
+        :param inputs: layer input
+        :param step: unused, keeps the call signature of the training layers
+        :return:
+        """
+        if self.dense:
+            z = tf.matmul(inputs, self.w) + self.b
+        else:
+            z = tf.matmul(tf.matmul(inputs, self.us), self.vt) + self.b
+        if self.activation:
+            return tf.keras.activations.relu(z)
+        return z
+
+    def get_rank(self):
+        return self.low_rank
+
+    def get_weights_num(self):
+        full_rank_weights = self.input_dim * self.units
+        low_rank_weights = self.low_rank * (self.input_dim + self.units)
+        return low_rank_weights, full_rank_weights
+
+
+@tf.custom_gradient
+def fused_kl_matmul(inputs, k, aux_U, l_t, aux_Vt):
+    """
+    Shared forward pass of the K- and L-step. After the K and L preprocessing K = U S and L^T = S V^T, so
+    inputs @ K @ V^T and inputs @ U @ L^T coincide and a single forward pass provides the gradients of both factors.
+    :param inputs: layer input of shape (..., input_dim)
+    :param k: K factor (input_dim, r)
+    :param aux_U: basis U of the current step (input_dim, r)
+    :param l_t: L^T factor (r, units)
+    :param aux_Vt: basis V^T of the current step (r, units)
+    :return: inputs @ K @ V^T
+    """
+    z = tf.matmul(tf.matmul(inputs, k), aux_Vt)
+
+    def grad(dz):
+        # flatten leading (batch, sequence) dims to contract them in the factor gradients
+        inputs_2d = tf.reshape(inputs, (-1, tf.shape(k)[0]))
+        dz_2d = tf.reshape(dz, (-1, tf.shape(aux_Vt)[1]))
+        dz_v = tf.matmul(dz_2d, aux_Vt, transpose_b=True)
+        d_k = tf.matmul(inputs_2d, dz_v, transpose_a=True)
+        d_l_t = tf.matmul(tf.matmul(inputs_2d, aux_U), dz_2d, transpose_a=True)
+        d_inputs = tf.matmul(tf.matmul(dz, aux_Vt, transpose_b=True), k, transpose_b=True)
+        return d_inputs, d_k, None, d_l_t, None
+
+    return z, grad
+
+
+# factors of a DLRT layer that get no gradient in the k (0), l (1), s (2) and fused k and l (3) step
+# b stays in the K and L steps, the forward pass uses the frozen aux_b there, so the tape gives b a zero gradient
+# (unconnected_gradients=ZERO) and the optimizer updates it in all steps, as with the zero-filled gradients before
+STEP_INACTIVE_FACTORS = {0: ("l_t", "s"), 1: ("k", "s"), 2: ("k", "l_t"), 3: ("s",)}
+
+
+def step_weights(model, step):
+    """
+    Weights of an integrator step of the training loops, gradients are taken and applied for these only.
+    :param model: network or layer containing DLRT layers (dense or convolutional)
+    :param step: integrator step, k := 0, l := 1, s := 2, fused k and l := 3
+    :return: trainable weights of model without the DLRT factors that are not part of step
+    """
+    inactive = set()
+    for layer in model.submodules:
+        if hasattr(layer, "aux_U"):  # DLRT layer
+            inactive.update(id(getattr(layer, name)) for name in STEP_INACTIVE_FACTORS.get(step, ())
+                            if hasattr(layer, name))
+    return [weight for weight in model.trainable_weights if id(weight) not in inactive]
+
+
+def basis_residual(factor, basis):
+    """
+    :param factor: updated factor K (or L), (n, r)
+    :param basis: orthonormal basis U (or V) of the last step, (n, r)
+    :return: ||factor - basis basis^T factor|| / ||factor||, the part of factor that the augmented basis adds
+    """
+    residual = factor - tf.matmul(basis, tf.matmul(basis, factor, transpose_a=True))
+    return tf.linalg.norm(residual) / tf.maximum(tf.linalg.norm(factor), 1e-12)
+
+
+def bucket_rank(rank, bucket_size, rmax_total):
+    """
+    Rounds a rank up to the next multiple of bucket_size, capped at rmax_total.
+    :param rank: current rank of the layer
+    :param bucket_size: granularity of the buckets, 1 keeps the exact rank
+    :param rmax_total: maximal rank of the layer
+    :return: slice width of the forward pass
+    """
+    return min(-(-rank // bucket_size) * bucket_size, rmax_total)
+
+
+def prefer_dense_product(input_dim, units, rank, batch_size):
+    """
+    Cost model for a frozen layer: multiply-adds plus weight reads of inputs @ W versus (inputs @ U S) @ V^T, where the
+    low-rank path also writes and reads the (batch_size, rank) intermediate.
+    :param input_dim: input dimension of the layer
+    :param units: output dimension of the layer
+    :param rank: rank of the factorization
+    :param batch_size: number of input rows per call
+    :return: True, if the dense product W = U S V^T is cheaper
+    """
+    dense_cost = (batch_size + 1) * input_dim * units
+    low_rank_cost = (batch_size + 1) * rank * (input_dim + units) + 2 * batch_size * rank
+    return dense_cost <= low_rank_cost
+
+
+def export_layers_for_inference(model, layer_names, batch_size=1):
+    """
+    Freezes the DLRT layers of a network to their thin factors U S and V^T and drops the integrator state, see
+    export_for_inference of the layers. The network can only be evaluated afterwards, the step argument of call is
+    ignored. A compiled call of the network gets a fresh tf.function, its traces hold on to the swapped-out layers.
+    :param model: network or layer holding the DLRT layers as attributes
+    :param layer_names: names of the attributes
+    :param batch_size: expected number of input rows per call, decides per layer between dense and low-rank product
+    """
+    for name in layer_names:
+        setattr(model, name, getattr(model, name).export_for_inference(batch_size=batch_size))
+    call = getattr(type(model), "call", None)
+    if hasattr(call, "python_function"):
+        model.call = tf.function(call.python_function.__get__(model, type(model)))
+    return 0
+
+
+def check_factor_shapes(layer, layer_id):
+    """
+    :param layer: adaptive DLRT layer with the factors of a checkpoint loaded at rank layer.low_rank
+    :param layer_id: id of the layer in the checkpoint
+    :raises ValueError: if a factor does not have the shape of this rank, e.g. a transposed V^T
+    """
+    rank = layer.low_rank
+    shapes = {"k": (layer.input_dim, rank), "l_t": (rank, layer.units), "s": (2 * rank, 2 * rank),
+              "aux_U": (layer.input_dim, rank), "aux_Unp1": (layer.input_dim, 2 * rank),
+              "aux_Vt": (rank, layer.units), "aux_Vtnp1": (2 * rank, layer.units), "aux_N": (2 * rank, rank),
+              "aux_M": (2 * rank, rank)}
+    for name, shape in shapes.items():
+        loaded = tuple(getattr(layer, name).shape)
+        if loaded != shape:
+            raise ValueError("Checkpoint factor " + name + str(layer_id) + " has shape " + str(loaded) + ", expected "
+                             + str(shape) + " at rank " + str(rank))
+    return 0
+
+
+def resize_factor(variable, shape, optimizer=None):
+    """
+    Reallocates a factor at a new shape, keeps the leading block and zero pads the rest. Slots of the optimizer
+    (e.g. Adam moments) are resized the same way and dropped for the old variable, see resize_slots. A factor
+    mirrored by a tf.distribute strategy is reallocated in the scope of that strategy.
+    :param variable: 2d factor of a DLRT layer
+    :param shape: new shape
+    :param optimizer: OptimizerV2 holding slots for variable, or None
+    :return: new tf.Variable
+    """
+    if hasattr(variable, "distribute_strategy") and not tf.distribute.has_strategy():
+        with variable.distribute_strategy.scope():
+            return resize_factor(variable, shape, optimizer)
+    resized = tf.Variable(initial_value=resize_block(variable, shape), trainable=variable.trainable,
+                          name=variable.name.split(":")[0].split("/")[-1], dtype=variable.dtype)
+    resize_slots(optimizer, variable, resized, lambda slot: resize_block(slot, shape))
+    return resized
+
+
+def resize_block(value, shape):
+    """
+    :param value: 2d tensor or variable
+    :param shape: new shape
+    :return: leading block of value, zero padded to shape
+    """
+    block = value[:min(value.shape[0], shape[0]), :min(value.shape[1], shape[1])]
+    return tf.pad(block, [[0, shape[0] - block.shape[0]], [0, shape[1] - block.shape[1]]])
@@ -0,0 +1,248 @@
+import json
+import os
+
+import tensorflow as tf
+
+from .dense_layers import step_weights
+from .memory import get_slots
+from .rank_schedule import adaptive_layers
+from .trace_cache import RankBucketTraceCache
+
+# factors the rank adaption and fixed_rank_update read, synchronized from the first replica across workers
+SYNCHRONIZED_FACTORS = ("s", "aux_Unp1", "aux_Vtnp1", "aux_N", "aux_M")
+
+
+def get_strategy():
+    """
+    :return: MultiWorkerMirroredStrategy if TF_CONFIG describes a cluster, MirroredStrategy over the local devices
+    otherwise
+    """
+    if "TF_CONFIG" in os.environ:
+        return tf.distribute.MultiWorkerMirroredStrategy()
+    return tf.distribute.MirroredStrategy()
+
+
+def is_chief():
+    """
+    :return: True for the process that writes logs and checkpoints: the chief of the TF_CONFIG cluster, worker 0 if
+    there is no chief, or the only process
+    """
+    config = json.loads(os.environ.get("TF_CONFIG", "{}"))
+    task_type, task_index = config.get("task", {}).get("type", "worker"), config.get("task", {}).get("index", 0)
+    if "chief" in config.get("cluster", {}):
+        return task_type == "chief"
+    return task_type == "worker" and task_index == 0
+
+
+def get_num_workers(strategy):
+    return max(strategy.num_replicas_in_sync // len(strategy.extended.worker_devices), 1)
+
+
+class DistributedIntegrator:
+    """
+    Data parallel training step of the unconventional integrator under a tf.distribute strategy. The K, L and S
+    steps take their gradients per replica and all-reduce them in apply_gradients, once per sub-step, so only the
+    gradients of the factors (r(n + m) and (2r)^2 entries per layer) cross the wire instead of the n m entries of a
+    dense layer. The pre- and postprocessing (QR of K and L, SVD of S) runs once per worker in cross-replica context.
+    Its sliced assigns reach only the first local replica of a mirrored variable, mirror_factors copies the factors
+    and their optimizer slots to the other local replicas before the next replica step. With several workers, the
+    factors the rank adaption reads (SYNCHRONIZED_FACTORS) are broadcast from the first replica before the
+    truncation, so floating point differences between the machines cannot let bases or ranks diverge.
+    Model, optimizer and the integrator have to be created in strategy.scope(), the factors of the adaptive layers
+    may be reallocated by rank_adaption.
+    """
+
+    def __init__(self, strategy, model, optimizer, loss_fn, global_batch_size, schedule=None, trace_cache_size=8):
+        """
+        :param strategy: tf.distribute strategy, see get_strategy
+        :param model: network of adaptive DLRT layers with the integrator methods of DLRTNetAdaptive
+        :param optimizer: optimizer for the K, L and S updates
+        :param loss_fn: per example loss loss_fn(labels, output) on the softmax of the network output, i.e. with
+        reduction NONE
+        :param global_batch_size: batch size summed over all replicas, the loss is averaged over it
+        :param schedule: RankAdaptionSchedule, None adapts the rank every step
+        :param trace_cache_size: compiled steps kept per combination of rank buckets
+        """
+        self.strategy = strategy
+        self.model = model
+        self.optimizer = optimizer
+        self.loss_fn = loss_fn
+        self.global_batch_size = global_batch_size
+        self.schedule = schedule
+        self.num_workers = get_num_workers(strategy)
+        self.kl_step_cache = RankBucketTraceCache(self.distributed_kl_step, max_size=trace_cache_size)
+        self.s_step_cache = RankBucketTraceCache(self.distributed_s_step, max_size=trace_cache_size)
+        self.broadcast_cache = RankBucketTraceCache(self.broadcast_factors, max_size=trace_cache_size)
+        self.mirrored = None  # factors and slots copied by mirror_factors, collected again after a reallocation
+        self.mirrored_generation = None
+        self.train_step = 0
+
+    def compute_loss(self, inputs, labels, step):
+        out = tf.keras.activations.softmax(self.model(inputs, step=step, training=True))
+        loss = tf.nn.compute_average_loss(self.loss_fn(labels, out), global_batch_size=self.global_batch_size)
+        if self.model.losses:
+            loss += tf.nn.scale_regularization_loss(tf.add_n(self.model.losses))
+        return loss, out
+
+    def kl_replica_step(self, inputs, labels):
+        # K and L gradients at the same state, applied together: one all-reduce for both
+        with tf.GradientTape() as tape:
+            loss, out = self.compute_loss(inputs, labels, step=0)
+        k_weights = step_weights(self.model, 0)
+        grads_k_step = tape.gradient(loss, k_weights, unconnected_gradients=tf.UnconnectedGradients.ZERO)
+        self.model.set_dlra_bias_grads_to_zero(grads_k_step)
+        with tf.GradientTape() as tape:
+            loss_l, _ = self.compute_loss(inputs, labels, step=1)
+        l_weights = step_weights(self.model, 1)
+        grads_l_step = tape.gradient(loss_l, l_weights, unconnected_gradients=tf.UnconnectedGradients.ZERO)
+        self.model.set_dlra_bias_grads_to_zero(grads_l_step)
+        self.optimizer.apply_gradients(list(zip(grads_k_step, k_weights)) + list(zip(grads_l_step, l_weights)))
+        return loss, out
+
+    def s_replica_step(self, inputs, labels):
+        with tf.GradientTape() as tape:
+            loss, _ = self.compute_loss(inputs, labels, step=2)
+        s_weights = step_weights(self.model, 2)
+        grads_s = tape.gradient(loss, s_weights)
+        self.optimizer.apply_gradients(zip(grads_s, s_weights))
+        return loss
+
+    def distributed_kl_step(self, inputs, labels):
+        loss, out = self.strategy.run(self.kl_replica_step, args=(inputs, labels))
+        return self.strategy.reduce(tf.distribute.ReduceOp.SUM, loss, axis=None), out
+
+    def distributed_s_step(self, inputs, labels):
+        loss = self.strategy.run(self.s_replica_step, args=(inputs, labels))
+        return self.strategy.reduce(tf.distribute.ReduceOp.SUM, loss, axis=None)
+
+    def broadcast_factors(self):
+        """
+        Overwrites SYNCHRONIZED_FACTORS on all replicas with the values of the first replica: an all-reduce sum to
+        which only the first replica contributes.
+        """
+        variables = get_synchronized_factors(self.model)
+
+        def replica_fn():
+            context = tf.distribute.get_replica_context()
+            first = tf.cast(tf.equal(context.replica_id_in_sync_group, 0), tf.float32)
+            return context.all_reduce(tf.distribute.ReduceOp.SUM, [first * variable for variable in variables])
+
+        values = self.strategy.run(replica_fn)
+        for variable, value in zip(variables, values):
+            variable.assign(self.strategy.experimental_local_results(value)[0])
+        return 0
+
+    def mirror_factors(self):
+        """
+        Copies the factors of the adaptive layers and their optimizer slots from the first local replica to the
+        others, after the eager pre- and postprocessing.
+        """
+        generation = [layer.buffer_generation for layer in adaptive_layers(self.model)]
+        if self.mirrored is None or generation != self.mirrored_generation:
+            self.mirrored = get_mirrored_factors(self.model, self.optimizer)
+            self.mirrored_generation = generation
+        for variable in self.mirrored:
+            variable.assign(variable.read_value())
+        return 0
+
+    def __call__(self, inputs, labels):
+        """
+        One integrator step on a distributed batch, e.g. from strategy.experimental_distribute_dataset.
+        :param inputs: per replica inputs
+        :param labels: per replica labels
+        :return: mean loss of the K step over the global batch and the per replica outputs of the K step
+        """
+        self.train_step += 1
+        adapt = self.schedule is None or self.schedule.adapt(self.train_step, self.model)
+        # 1.a) K and L Step Preproccessing
+        self.model.k_step_preprocessing()
+        self.model.l_step_preprocessing()
+        self.mirror_factors()
+
+        # 1.b) K and L Step, gradients all-reduced
+        self.model.toggle_non_s_step_training()
+        loss, out = self.kl_step_cache(self.model.get_rank_buckets(), inputs, labels)
+
+        # Postprocessing K and L, at width 2r only if the rank is adapted after this step
+        if adapt:
+            self.model.k_step_postprocessing_adapt()
+            self.model.l_step_postprocessing_adapt()
+        else:
+            self.model.k_step_postprocessing()
+            self.model.l_step_postprocessing()
+
+        # 2.) S-Step, gradients all-reduced
+        self.model.s_step_preprocessing(optimizer=self.optimizer)
+        self.model.toggle_s_step_training()
+        self.mirror_factors()
+        self.s_step_cache(self.model.get_rank_buckets(), inputs, labels)
+
+        # 3.) Rank Adaptivity on identical factors on all workers
+        if self.num_workers > 1:
+            self.broadcast_cache(self.model.get_rank_buckets())
+        if adapt:
+            # outside of strategy.scope(), sliced assigns of mirrored variables need the cross-replica context of
+            # eager execution, grown factors are mirrored by resize_factor
+            self.model.rank_adaption(optimizer=self.optimizer)
+            if self.schedule is not None:
+                self.schedule.update(self.train_step, self.model)
+            for cache in (self.kl_step_cache, self.s_step_cache, self.broadcast_cache):
+                cache.evict_stale(self.model.get_rank_buckets())
+        else:
+            self.model.fixed_rank_update(optimizer=self.optimizer)
+        self.mirror_factors()
+        return loss, out
+
+    def get_allreduce_bytes(self):
+        """
+        :return: bytes of gradients all-reduced per replica and integrator step, K, L and S step together
+        """
+        weights = step_weights(self.model, 0) + step_weights(self.model, 1) + step_weights(self.model, 2)
+        return sum(weight.shape.num_elements() * weight.dtype.size for weight in weights)
+
+
+def get_synchronized_factors(model):
+    """
+    :return: SYNCHRONIZED_FACTORS of all adaptive DLRT layers of model
+    """
+    return [getattr(layer, name) for layer in adaptive_layers(model) for name in SYNCHRONIZED_FACTORS]
+
+
+def get_mirrored_factors(model, optimizer):
+    """
+    :return: all variables of the adaptive DLRT layers of model and the optimizer slots of their trainable ones
+    """
+    variables = []
+    for layer in adaptive_layers(model):
+        variables += layer.variables
+        for variable in layer.trainable_variables:
+            variables += [slot for _, slot in get_slots(optimizer, variable) or []]
+    return variables
+
+
+def make_reference_step(strategy, model, optimizer, loss_fn, global_batch_size, compressor=None):
+    """
+    Data parallel training step of a full rank network, for comparison with DistributedIntegrator: all n m weights
+    of every layer are all-reduced each step, or their rank r approximations with a compressor.
+    :param compressor: PowerSGDCompressor, built for the trainable weights of model, or None
+    :return: compiled step function on a distributed batch, returns the mean loss over the global batch
+    """
+
+    def replica_step(inputs, labels):
+        with tf.GradientTape() as tape:
+            out = tf.keras.activations.softmax(model(inputs, training=True))
+            loss = tf.nn.compute_average_loss(loss_fn(labels, out), global_batch_size=global_batch_size)
+        grads = tape.gradient(loss, model.trainable_weights)
+        if compressor is None:
+            optimizer.apply_gradients(zip(grads, model.trainable_weights))
+        else:
+            optimizer.apply_gradients(compressor.all_reduce(list(zip(grads, model.trainable_weights))),
+                                      experimental_aggregate_gradients=False)
+        return loss
+
+    @tf.function
+    def distributed_step(inputs, labels):
+        loss = strategy.run(replica_step, args=(inputs, labels))
+        return strategy.reduce(tf.distribute.ReduceOp.SUM, loss, axis=None)
+
+    return distributed_step
@@ -0,0 +1,158 @@
+import numpy as np
+import tensorflow as tf
+
+from .benchmark import count_parameters
+
+# ops whose outputs alias their input or a variable, or hold no activation
+NON_ACTIVATION_OPS = ("Placeholder", "Const", "ReadVariableOp", "VarHandleOp", "NoOp", "Identity", "IdentityN",
+                      "Reshape", "Shape", "ShapeN", "Size", "Rank", "StopGradient")
+
+
+def memory_report(module, optimizer=None, batch_shape=None, **call_kwargs):
+    """
+    Memory footprint of a layer or network. Lists every variable with the bytes it allocates and the bytes in use at
+    the current rank: the adaptive layers allocate their factors beyond the current rank (see get_active_factors),
+    everywhere else the whole variable is in use. Optimizer slots are listed with the variable they belong to, the
+    slot bytes are None if the optimizer does not expose its slots, see get_slots.
+    :param module: layer or network
+    :param optimizer: optimizer of the training loop, its slots of the variables of module are counted
+    :param batch_shape: input shape incl. batch dimension, or a nested structure of tf.TensorSpec for networks with
+    several inputs, e.g. the transformers. None skips the activation memory.
+    :param call_kwargs: keyword arguments of the forward pass for the activation memory, e.g. step=0, training=True
+    :return: dict with the list of variables ("name", "kind", "shape", "allocated_bytes", "in_use_bytes"), the sums
+    per kind (trainable, auxiliary, optimizer_slot, total; None if unknown) allocated and in use, the theoretical
+    bytes of the low-rank parameters (see get_weights_num) and peak_activation_bytes, see activation_bytes
+    """
+    active_shapes = {}
+    for layer in [module] + list(module.submodules):
+        if hasattr(layer, "get_active_factors"):
+            for variable, rows, columns in layer.get_active_factors(auxiliary=True):
+                active_shapes[variable.ref()] = (int(rows), int(columns))
+
+    # variable names are not unique, prefix them with the innermost layer that holds them
+    layer_names = {}
+    for layer in [module] + list(module.submodules):
+        for variable in getattr(layer, "variables", []):
+            layer_names[variable.ref()] = layer.name
+
+    variables = []
+    seen = set()
+    slots_known = True
+    for variable in module.variables:
+        if variable.ref() in seen:
+            continue
+        seen.add(variable.ref())
+        kind = "trainable" if variable.trainable else "auxiliary"
+        in_use_shape = active_shapes.get(variable.ref(), variable.shape)
+        name = layer_names.get(variable.ref(), module.name) + "/" + variable.name
+        variables.append(variable_entry(name, variable, kind, in_use_shape))
+        slots = get_slots(optimizer, variable)
+        slots_known = slots_known and slots is not None
+        for slot_name, slot in slots or []:
+            variables.append(variable_entry(name + "/" + slot_name, slot, "optimizer_slot", in_use_shape))
+
+    allocated = {kind: 0 for kind in ("trainable", "auxiliary", "optimizer_slot")}
+    in_use = dict(allocated)
+    for entry in variables:
+        allocated[entry["kind"]] += entry["allocated_bytes"]
+        in_use[entry["kind"]] += entry["in_use_bytes"]
+    if not slots_known:
+        allocated["optimizer_slot"] = in_use["optimizer_slot"] = None
+    allocated["total"] = None if not slots_known else sum(allocated.values())
+    in_use["total"] = None if not slots_known else sum(in_use.values())
+
+    # r (n + m + r) per DLRT layer plus the other trainable weights, at 4 bytes per float32
+    theoretical = 4 * count_parameters(module)["low_rank"]
+    report = {"variables": variables, "allocated_bytes": allocated, "in_use_bytes": in_use,
+              "theoretical_bytes": theoretical}
+    if batch_shape is not None:
+        report["peak_activation_bytes"] = activation_bytes(module, batch_shape, **call_kwargs)
+    return report
+
+
+def activation_bytes(module, batch_shape, **call_kwargs):
+    """
+    Activation memory of a forward pass, taken from its graph: the sum of all intermediate tensors. A GradientTape
+    keeps these alive until the backward pass, so this is the peak activation memory of a training step (an upper
+    bound, the runtime may fuse or drop some of them).
+    :param module: layer or network
+    :param batch_shape: input shape incl. batch dimension, or a nested structure of tf.TensorSpec
+    :param call_kwargs: keyword arguments of the forward pass
+    :return: bytes
+    """
+    if isinstance(batch_shape, (tuple, list)) and all(isinstance(d, int) for d in batch_shape):
+        input_spec = tf.TensorSpec(batch_shape, tf.float32)
+    else:
+        input_spec = batch_shape
+
+    def forward(inputs):
+        return module(inputs, **call_kwargs)
+
+    return graph_activation_bytes(tf.function(forward, autograph=False).get_concrete_function(input_spec).graph)
+
+
+def graph_activation_bytes(graph):
+    """
+    :return: bytes of all op outputs with known shape in graph, nested function calls (e.g. a call method under
+    @tf.function) are counted through their function graph
+    """
+    total = 0
+    for op in graph.get_operations():
+        if op.type in NON_ACTIVATION_OPS:
+            continue
+        if op.type in ("PartitionedCall", "StatefulPartitionedCall"):
+            function = graph._get_function(op.get_attr("f").name)
+            if function is not None and hasattr(function, "graph"):
+                total += graph_activation_bytes(function.graph)
+                continue
+        for output in op.outputs:
+            if output.shape.is_fully_defined() and output.dtype.is_numpy_compatible and output.dtype != tf.string:
+                total += int(np.prod(output.shape)) * output.dtype.size
+    return total
+
+
+def format_memory_report(report):
+    """
+    :param report: see memory_report
+    :return: report as table, one line per variable followed by the sums in MB
+    """
+    lines = ["%-64s %-15s %-16s %14s %14s" % ("variable", "kind", "shape", "allocated_MB", "in_use_MB")]
+    for entry in report["variables"]:
+        lines.append("%-64s %-15s %-16s %14.3f %14.3f" % (entry["name"], entry["kind"], str(tuple(entry["shape"])),
+                                                          entry["allocated_bytes"] / 2 ** 20,
+                                                          entry["in_use_bytes"] / 2 ** 20))
+    for kind in ("trainable", "auxiliary", "optimizer_slot", "total"):
+        if report["allocated_bytes"][kind] is None:
+            lines.append("%-97s %14s %14s" % ("sum " + kind, "unknown", "unknown"))
+            continue
+        lines.append("%-97s %14.3f %14.3f" % ("sum " + kind, report["allocated_bytes"][kind] / 2 ** 20,
+                                              report["in_use_bytes"][kind] / 2 ** 20))
+    lines.append("%-97s %14.3f" % ("theoretical (low-rank parameters)", report["theoretical_bytes"] / 2 ** 20))
+    if "peak_activation_bytes" in report:
+        lines.append("%-97s %14.3f" % ("peak activations", report["peak_activation_bytes"] / 2 ** 20))
+    return "\n".join(lines)
+
+
+def variable_entry(name, variable, kind, in_use_shape):
+    itemsize = variable.dtype.size
+    return {"name": name, "kind": kind, "shape": [int(d) for d in variable.shape],
+            "allocated_bytes": int(np.prod(variable.shape)) * itemsize,
+            "in_use_bytes": int(np.prod(in_use_shape)) * itemsize}
+
+
+def get_slots(optimizer, variable):
+    """
+    :return: (name, slot) of the optimizer slots (e.g. Adam moments) of variable, empty without optimizer or before the
+    slots exist. None if the optimizer does not expose its slots by name, e.g. the Keras optimizers from TF 2.11 on.
+    """
+    if optimizer is None:
+        return []
+    if not hasattr(optimizer, "get_slot_names"):
+        return None
+    slots = []
+    for slot_name in optimizer.get_slot_names():
+        try:
+            slots.append((slot_name, optimizer.get_slot(variable, slot_name)))
+        except KeyError:
+            pass
+    return slots
@@ -0,0 +1,171 @@
+import tensorflow as tf
+
+# OptimizerV2, the base class of tf.keras.optimizers up to TF 2.10
+OptimizerV2 = getattr(tf.keras.optimizers, "legacy", tf.keras.optimizers).Optimizer
+
+
+class DLRTAdam(OptimizerV2):
+    """
+    Adam for networks of adaptive DLRT layers. The factors K, L^T and S are allocated beyond the current rank, their
+    moments are only updated on the block of the current rank. Variables without gradient are not part of the current
+    integrator step and are skipped, instead of decaying their moments with zero gradients. When rank_adaption or
+    s_step_preprocessing change the bases of a layer, the layer moves the moments to the new bases by change_basis.
+    All other variables get the plain Adam update.
+    The moments of a factor have the shape of its allocation, i.e. the capacity of the layer, and are resized along
+    when the capacity grows or shrinks (resize_slots). They are not resized at each rank change: the compiled steps
+    capture the slot variables, and reallocating them at every rank adaption would retrace every adapted step.
+    """
+
+    def __init__(self, learning_rate=0.001, beta_1=0.9, beta_2=0.999, epsilon=1e-7, name="DLRTAdam", **kwargs):
+        super(DLRTAdam, self).__init__(name, **kwargs)
+        self._set_hyper("learning_rate", kwargs.get("lr", learning_rate))
+        self._set_hyper("decay", self._initial_decay)
+        self._set_hyper("beta_1", beta_1)
+        self._set_hyper("beta_2", beta_2)
+        self.epsilon = epsilon
+        self.factor_layers = []
+        self.active_blocks = {}
+
+    def track_factors(self, model):
+        """
+        Registers the DLRT layers of a network and creates the moments of the trainable weights built so far. The
+        factors of the DLRT layers are built with the layers. Weights built on the first call of the network (e.g.
+        the embeddings and the final dense layer of TransformerDLRT) get their moments in the first trace of the
+        training step instead.
+        :param model: network with adaptive DLRT layers, i.e. layers with get_active_factors
+        """
+        self.factor_layers = [module for module in model.submodules if hasattr(module, "get_active_factors")]
+        self._create_all_weights(model.trainable_weights)
+        return 0
+
+    def apply_gradients(self, grads_and_vars, name=None, experimental_aggregate_gradients=True):
+        # factors that are not part of the current step come without gradient
+        grads_and_vars = [(grad, var) for grad, var in grads_and_vars if grad is not None]
+        # the factors may have been reallocated since the last step, look up the current ones
+        self.active_blocks = {}
+        for layer in self.factor_layers:
+            for factor, rows, columns in layer.get_active_factors():
+                self.active_blocks[factor.ref()] = (rows, columns)
+        return super(DLRTAdam, self).apply_gradients(grads_and_vars, name=name,
+                                                     experimental_aggregate_gradients=experimental_aggregate_gradients)
+
+    def change_basis(self, variable, left=None, right=None):
+        """
+        Moves the moments of a factor to new bases, m <- left m right^T on the block of the old rank. The second
+        moment is moved with the elementwise squares of left and right, which keeps it non-negative.
+        :param variable: factor of a DLRT layer
+        :param left: change of basis of the rows (new rows, old rows), None keeps all rows
+        :param right: change of basis of the columns (new columns, old columns), None keeps all columns
+        """
+        try:
+            moments = [(self.get_slot(variable, "m"), lambda a: a), (self.get_slot(variable, "v"), tf.square)]
+        except KeyError:  # not tracked
+            return 0
+        rows, columns = tf.shape(variable)[0], tf.shape(variable)[1]
+        old_rows, new_rows = (rows, rows) if left is None else (tf.shape(left)[1], tf.shape(left)[0])
+        old_columns, new_columns = (columns, columns) if right is None else (tf.shape(right)[1], tf.shape(right)[0])
+        for moment, transform in moments:
+            block = moment[:old_rows, :old_columns]
+            if left is not None:
+                block = tf.matmul(transform(left), block)
+            if right is not None:
+                block = tf.matmul(block, transform(right), transpose_b=True)
+            moment[:new_rows, :new_columns].assign(block)
+        return 0
+
+    def _create_slots(self, var_list):
+        for var in var_list:
+            self.add_slot(var, "m")
+        for var in var_list:
+            self.add_slot(var, "v")
+
+    def _prepare_local(self, var_device, var_dtype, apply_state):
+        super(DLRTAdam, self)._prepare_local(var_device, var_dtype, apply_state)
+
+        local_step = tf.cast(self.iterations + 1, var_dtype)
+        beta_1_t = tf.identity(self._get_hyper("beta_1", var_dtype))
+        beta_2_t = tf.identity(self._get_hyper("beta_2", var_dtype))
+        beta_1_power = tf.pow(beta_1_t, local_step)
+        beta_2_power = tf.pow(beta_2_t, local_step)
+        lr = apply_state[(var_device, var_dtype)]["lr_t"] * (tf.sqrt(1 - beta_2_power) / (1 - beta_1_power))
+        apply_state[(var_device, var_dtype)].update(
+            dict(lr=lr, epsilon=tf.convert_to_tensor(self.epsilon, var_dtype), beta_1_t=beta_1_t,
+                 one_minus_beta_1_t=1 - beta_1_t, beta_2_t=beta_2_t, one_minus_beta_2_t=1 - beta_2_t))
+
+    def _resource_apply_dense(self, grad, var, apply_state=None):
+        var_device, var_dtype = var.device, var.dtype.base_dtype
+        coefficients = ((apply_state or {}).get((var_device, var_dtype))
+                        or self._fallback_apply_state(var_device, var_dtype))
+        m = self.get_slot(var, "m")
+        v = self.get_slot(var, "v")
+
+        active_block = self.active_blocks.get(var.ref())
+        if active_block is None:
+            m_t = m.assign(coefficients["beta_1_t"] * m + coefficients["one_minus_beta_1_t"] * grad)
+            v_t = v.assign(coefficients["beta_2_t"] * v + coefficients["one_minus_beta_2_t"] * tf.square(grad))
+            var_update = var.assign_sub(coefficients["lr"] * m_t / (tf.sqrt(v_t) + coefficients["epsilon"]))
+            return tf.group(var_update, m_t, v_t)
+
+        # factor of a DLRT layer, only the block of the current rank is in use
+        rows, columns = active_block
+        grad = grad[:rows, :columns]
+        m_t = coefficients["beta_1_t"] * m[:rows, :columns] + coefficients["one_minus_beta_1_t"] * grad
+        v_t = coefficients["beta_2_t"] * v[:rows, :columns] + coefficients["one_minus_beta_2_t"] * tf.square(grad)
+        var_t = var[:rows, :columns] - coefficients["lr"] * m_t / (tf.sqrt(v_t) + coefficients["epsilon"])
+        return tf.group(m[:rows, :columns].assign(m_t), v[:rows, :columns].assign(v_t),
+                        var[:rows, :columns].assign(var_t))
+
+    def _resource_apply_sparse(self, grad, var, indices, apply_state=None):
+        # embeddings, never a DLRT factor
+        var_device, var_dtype = var.device, var.dtype.base_dtype
+        coefficients = ((apply_state or {}).get((var_device, var_dtype))
+                        or self._fallback_apply_state(var_device, var_dtype))
+        m = self.get_slot(var, "m")
+        m_t = m.assign(m * coefficients["beta_1_t"])
+        with tf.control_dependencies([m_t]):
+            m_t = self._resource_scatter_add(m, indices, grad * coefficients["one_minus_beta_1_t"])
+        v = self.get_slot(var, "v")
+        v_t = v.assign(v * coefficients["beta_2_t"])
+        with tf.control_dependencies([v_t]):
+            v_t = self._resource_scatter_add(v, indices, tf.square(grad) * coefficients["one_minus_beta_2_t"])
+        var_update = var.assign_sub(coefficients["lr"] * m_t / (tf.sqrt(v_t) + coefficients["epsilon"]))
+        return tf.group(var_update, m_t, v_t)
+
+    def get_config(self):
+        config = super(DLRTAdam, self).get_config()
+        config.update({
+            "learning_rate": self._serialize_hyperparameter("learning_rate"),
+            "decay": self._initial_decay,
+            "beta_1": self._serialize_hyperparameter("beta_1"),
+            "beta_2": self._serialize_hyperparameter("beta_2"),
+            "epsilon": self.epsilon,
+        })
+        return config
+
+
+def resize_slots(optimizer, variable, resized, resize):
+    """
+    Moves the slots of a factor (e.g. Adam moments) to its reallocation and drops the old ones, so their memory is
+    released. OptimizerV2 has no public API to drop slots, this goes through its slot and weight lists. Other
+    optimizers (e.g. the Keras optimizers from TF 2.11 on) can not carry their state over and raise.
+    :param optimizer: optimizer of the training loop, or None
+    :param variable: factor before the reallocation
+    :param resized: factor after the reallocation
+    :param resize: maps a slot of variable to the initial value of the slot of resized
+    """
+    if optimizer is None:
+        return 0
+    if not isinstance(optimizer, OptimizerV2):
+        raise TypeError("Can not move the slots of " + type(optimizer).__name__ + " to reallocated factors, use an "
+                        "OptimizerV2 (tf.keras.optimizers.legacy from TF 2.11 on) or DLRTAdam")
+    for slot_name in optimizer.get_slot_names():
+        try:
+            slot = optimizer.get_slot(variable, slot_name)
+        except KeyError:  # no slots, e.g. the auxiliary factors or no step taken yet
+            continue
+        optimizer.add_slot(resized, slot_name, initializer=resize(slot))
+    old_slots = optimizer._slots.pop(variable._unique_id, {})
+    if old_slots:
+        old_ids = set(id(slot) for slot in old_slots.values())
+        optimizer._weights = [weight for weight in optimizer._weights if id(weight) not in old_ids]
+    return 0
@@ -0,0 +1,174 @@
+import contextlib
+import functools
+import time
+from collections import OrderedDict
+
+import tensorflow as tf
+
+from .benchmark import synchronize
+
+# integrator functions of the DLRT layers that instrument wraps, where the layer has them
+INSTRUMENTED_METHODS = ("k_step_preprocessing", "k_step_postprocessing", "k_step_postprocessing_adapt",
+                        "l_step_preprocessing", "l_step_postprocessing", "l_step_postprocessing_adapt",
+                        "s_step_preprocessing", "rank_adaption", "fixed_rank_update")
+
+
+class IntegratorProfiler:
+    """
+    Profiling of the integrator loop. phase annotates a block of the training step with a tf.profiler trace
+    annotation and a name scope, instrument does the same for the integrator functions of every DLRT layer of a
+    network. Eagerly executed phases are timed, the summary table lists the time per phase and layer. Inside compiled
+    steps the annotations only take effect while tracing, there the name scopes attribute the ops (QR, SVD, matmul) to
+    phase and layer in the TensorBoard trace, see step for sampling a window of steps.
+    A disabled profiler adds nothing to the training step.
+    """
+
+    def __init__(self, enabled=True, log_dir=None, trace_start=10, trace_steps=0):
+        """
+        :param enabled: False makes phase, instrument and step no-ops
+        :param log_dir: TensorBoard log directory of the sampled trace
+        :param trace_start: training step at which the trace starts
+        :param trace_steps: number of traced training steps, 0 traces nothing
+        """
+        self.enabled = enabled
+        self.log_dir = log_dir
+        self.trace_start = trace_start
+        self.trace_steps = trace_steps
+        self.tracing = False
+        self.step_trace = None  # annotation of the training step opened by begin_step
+        # (phase, layer) -> [calls, total seconds]
+        self.timings = OrderedDict()
+
+    def phase(self, name, layer=""):
+        """
+        :param name: phase name, e.g. "k_step"
+        :param layer: layer name for per-layer phases, "" for phases of the whole network
+        :return: context manager around the phase
+        """
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self._phase(name, layer)
+
+    @contextlib.contextmanager
+    def _phase(self, name, layer):
+        scope = name if not layer else layer + "/" + name
+        eager = tf.executing_eagerly()
+        with tf.profiler.experimental.Trace(scope), tf.name_scope(scope):
+            start = time.perf_counter()
+            yield
+            if eager:
+                synchronize()
+                self.record(name, layer, time.perf_counter() - start)
+
+    def record(self, name, layer, seconds):
+        entry = self.timings.setdefault((name, layer), [0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+        return 0
+
+    def instrument(self, model):
+        """
+        Wraps the integrator functions of all DLRT layers of model into phases named after the layer. Works before the
+        layers are built, the DLRT layers are the submodules with integrator functions but without such sublayers.
+        :param model: network with DLRT layers among its submodules
+        """
+        if not self.enabled:
+            return 0
+        for layer in model.submodules:
+            if not hasattr(layer, "k_step_preprocessing") or any(hasattr(module, "k_step_preprocessing")
+                                                                 for module in layer.submodules):
+                continue
+            for method_name in INSTRUMENTED_METHODS:
+                if hasattr(layer, method_name):
+                    setattr(layer, method_name, self.wrap(getattr(layer, method_name), method_name, layer.name))
+        return 0
+
+    def wrap(self, method, name, layer):
+        @functools.wraps(method)
+        def wrapped(*args, **kwargs):
+            with self.phase(name, layer):
+                return method(*args, **kwargs)
+
+        return wrapped
+
+    def step(self, step):
+        """
+        Marks a training step for the trace viewer and starts or stops the sampled trace window.
+        :param step: index of the training step, counted over all epochs
+        :return: context manager around the training step
+        """
+        if not self.enabled:
+            return contextlib.nullcontext()
+        if self.trace_steps > 0 and self.log_dir is not None:
+            if step == self.trace_start and not self.tracing:
+                tf.profiler.experimental.start(self.log_dir)
+                self.tracing = True
+            elif step >= self.trace_start + self.trace_steps and self.tracing:
+                self.stop_trace()
+        return tf.profiler.experimental.Trace("train", step_num=step, _r=1)
+
+    def begin_step(self, step):
+        """
+        Non-nesting form of step for long loop bodies: opens the annotation of the training step, the next begin_step
+        or end_step closes it.
+        :param step: index of the training step, counted over all epochs
+        """
+        self.end_step()
+        self.step_trace = self.step(step)
+        self.step_trace.__enter__()
+        return 0
+
+    def end_step(self):
+        if self.step_trace is not None:
+            self.step_trace.__exit__(None, None, None)
+            self.step_trace = None
+        return 0
+
+    def stop_trace(self):
+        if self.tracing:
+            tf.profiler.experimental.stop()
+            self.tracing = False
+            print("Profiler trace written to " + self.log_dir)
+        return 0
+
+    def get_summary(self):
+        """
+        :return: list of (phase, layer, calls, total ms, mean ms, share of the network phases) sorted by total time
+        """
+        network_total = sum(total for (_, layer), (_, total) in self.timings.items() if not layer)
+        rows = []
+        for (name, layer), (calls, total) in self.timings.items():
+            share = total / network_total if network_total > 0 else 0.0
+            rows.append((name, layer, calls, 1e3 * total, 1e3 * total / calls, share))
+        return sorted(rows, key=lambda row: -row[3])
+
+    def summary_table(self):
+        lines = ["%-32s %-32s %8s %12s %10s %7s" % ("phase", "layer", "calls", "total_ms", "mean_ms", "share")]
+        for name, layer, calls, total, mean, share in self.get_summary():
+            lines.append("%-32s %-32s %8d %12.1f %10.3f %6.1f%%" % (name, layer or "-", calls, total, mean,
+                                                                   100 * share))
+        return "\n".join(lines)
+
+    def write_summary(self, file_name):
+        """
+        Writes the summary as csv file phase;layer;calls;total_ms;mean_ms;share.
+        """
+        with open(file_name, "w") as f:
+            f.write("phase;layer;calls;total_ms;mean_ms;share\n")
+            for row in self.get_summary():
+                f.write("%s;%s;%d;%.3f;%.4f;%.4f\n" % row)
+        return 0
+
+    def close(self, file_name=None):
+        """
+        Stops a running trace and prints the summary table.
+        :param file_name: optional csv file for the summary, see write_summary
+        """
+        if not self.enabled:
+            return 0
+        self.end_step()
+        self.stop_trace()
+        print(self.summary_table())
+        if file_name is not None:
+            self.write_summary(file_name)
+        return 0
@@ -0,0 +1,100 @@
+import tensorflow as tf
+
+# modes of RankAdaptionSchedule
+ADAPTION_MODES = ("every", "backoff", "trigger")
+
+
+class RankAdaptionSchedule:
+    """
+    Decides at which training steps the DLRT layers adapt their rank. The other steps take the fixed-rank path of the
+    integrator: QR of K and L^T at the current rank instead of the augmented width 2r and no SVD of S, i.e.
+    k_step_postprocessing, l_step_postprocessing and fixed_rank_update in place of the _adapt postprocessing and
+    rank_adaption.
+    "every": adapts every interval steps, interval 1 adapts every step.
+    "backoff": adapts every interval steps, the interval doubles (up to max_interval) after each adaption that left all
+    ranks unchanged and falls back to interval once a rank changes.
+    "trigger": adapts when the tail energy estimate of a layer (see tail_energy_estimate) moved more than threshold away
+    from its value at the last adaption, at the latest after max_interval steps.
+    """
+
+    def __init__(self, mode="every", interval=1, max_interval=64, threshold=0.05):
+        """
+        :param mode: one of ADAPTION_MODES
+        :param interval: steps between two adaptions, initial interval of "backoff"
+        :param max_interval: upper bound of the interval of "backoff" and "trigger"
+        :param threshold: change of the tail energy estimate that triggers an adaption in "trigger"
+        """
+        if mode not in ADAPTION_MODES:
+            raise ValueError("Unknown adaption mode " + str(mode) + ", expected one of " + str(ADAPTION_MODES))
+        self.mode = mode
+        self.base_interval = max(int(interval), 1)
+        self.interval = self.base_interval
+        self.max_interval = max(int(max_interval), self.base_interval)
+        self.threshold = threshold
+        self.last_adaption = None  # training step of the last adaption
+        self.last_ranks = None
+        self.last_tail_energy = None
+        self.adaptions = 0
+        self.skipped = 0
+        self.layers = None  # adaptive layers of the network, collected at the first update
+
+    def adapt(self, step, model):
+        """
+        :param step: training step, counted over all epochs
+        :param model: network of adaptive DLRT layers
+        :return: True, if step adapts the rank
+        """
+        if self.last_adaption is None:
+            decision = True
+        elif self.mode == "trigger":
+            decision = step - self.last_adaption >= self.max_interval or self.tail_energy_changed()
+        else:
+            decision = step - self.last_adaption >= self.interval
+        if not decision:
+            self.skipped += 1
+        return decision
+
+    def update(self, step, model):
+        """
+        Records an adaption, call after rank_adaption.
+        :param step: training step of the adaption
+        :param model: network of adaptive DLRT layers
+        """
+        if self.layers is None:
+            self.layers = adaptive_layers(model)
+        ranks = [layer.low_rank for layer in self.layers]
+        if self.mode == "backoff" and self.last_ranks is not None:
+            if ranks == self.last_ranks:
+                self.interval = min(2 * self.interval, self.max_interval)
+            else:
+                self.interval = self.base_interval
+        if self.mode == "trigger":
+            self.last_tail_energy = get_tail_energy(self.layers)
+        self.last_ranks = ranks
+        self.last_adaption = step
+        self.adaptions += 1
+        return 0
+
+    def tail_energy_changed(self):
+        if self.last_tail_energy is None:
+            return True
+        change = tf.reduce_max(tf.abs(get_tail_energy(self.layers) - self.last_tail_energy))
+        return bool(change > self.threshold)
+
+    def get_stats(self):
+        return {"adaptions": self.adaptions, "skipped": self.skipped, "interval": self.interval}
+
+
+def adaptive_layers(model):
+    """
+    :return: the rank adaptive DLRT layers among the submodules of model (or model itself)
+    """
+    return [layer for layer in [model] + list(model.submodules) if hasattr(layer, "tail_energy_estimate")]
+
+
+def get_tail_energy(layers):
+    """
+    :param layers: adaptive DLRT layers, see adaptive_layers
+    :return: their tail energy estimates, see tail_energy_estimate
+    """
+    return tf.stack([layer.tail_energy_estimate() for layer in layers])
@@ -0,0 +1,71 @@
+import tensorflow as tf
+from collections import OrderedDict
+
+
+class RankBucketTraceCache:
+    """
+    LRU cache of compiled versions of a training or evaluation step, keyed by the rank buckets of the network.
+    The adaptive layers slice their factors at the bucketed rank, so a compiled step stays valid as long as no rank
+    leaves its bucket. Rank drift inside a bucket reuses the cached trace, a new bucket combination traces once.
+    The buffer generation of each layer is part of the key, compiled steps capture the factor variables and a
+    reallocation of the factors (capacity growth or shrink) needs a fresh trace.
+    """
+
+    def __init__(self, python_function, max_size=8, **tf_function_kwargs):
+        """
+        :param python_function: step function to compile
+        :param max_size: number of compiled functions kept, the least recently used one is dropped first
+        :param tf_function_kwargs: passed on to tf.function, e.g. input_signature
+        """
+        self.python_function = python_function
+        self.max_size = max_size
+        self.tf_function_kwargs = tf_function_kwargs
+        self.traces = OrderedDict()
+        self.hits = 0
+        self.retraces = 0
+        self.evictions = 0
+
+    def __call__(self, rank_buckets, *args, **kwargs):
+        """
+        :param rank_buckets: (rank bucket, buffer generation) of all adaptive layers, e.g. model.get_rank_buckets()
+        :param args: arguments of the step function
+        :param kwargs: keyword arguments of the step function
+        :return: output of the step function
+        """
+        key = tuple(rank_buckets)
+        if key in self.traces:
+            self.hits += 1
+            self.traces.move_to_end(key)
+        else:
+            self.retraces += 1
+            self.evict_stale(key)
+            self.traces[key] = tf.function(self.python_function, **self.tf_function_kwargs)
+            if len(self.traces) > self.max_size:
+                self.traces.popitem(last=False)
+        return self.traces[key](*args, **kwargs)
+
+    def evict_stale(self, rank_buckets):
+        """
+        Drops the compiled steps of other buffer generations than the current one. They can not be hit again after a
+        reallocation of the factors, but hold on to the old factor variables and their optimizer slots. Called on
+        every retrace, call it right after the rank adaption to release the memory before the next step.
+        :param rank_buckets: current (rank bucket, buffer generation) of all adaptive layers
+        :return: number of dropped compiled steps
+        """
+        generations = buffer_generations(rank_buckets)
+        stale = [key for key in self.traces if buffer_generations(key) != generations]
+        for key in stale:
+            del self.traces[key]
+        self.evictions += len(stale)
+        return len(stale)
+
+    def get_stats(self):
+        return {"hits": self.hits, "retraces": self.retraces, "evictions": self.evictions, "cached": len(self.traces)}
+
+
+def buffer_generations(rank_buckets):
+    """
+    :param rank_buckets: key of RankBucketTraceCache, (rank bucket, buffer generation) pairs and possibly further flags
+    :return: buffer generations of the key
+    """
+    return tuple(entry[1] for entry in rank_buckets if isinstance(entry, tuple))
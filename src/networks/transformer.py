@@ -5,6 +5,8 @@ import tensorflow as tf
 # Import tf_text to load the ops used by the tokenizer saved model
 import tensorflow_text  # pylint: disable=unused-import
 
+from . import decoding_cache
+
 # global constants
 MAX_TOKENS = 128
 
@@ -128,7 +130,6 @@ class MultiHeadAttention(tf.keras.layers.Layer):
 
         return output, attention_weights
 
-
 def point_wise_feed_forward_network(d_model, dff):
     return tf.keras.Sequential([
         tf.keras.layers.Dense(dff, activation='relu'),  # (batch_size, seq_len, dff)
@@ -197,6 +198,23 @@ class DecoderLayer(tf.keras.layers.Layer):
 
         return out3, attn_weights_block1, attn_weights_block2
 
+    def decode_step(self, x, cache, position, self_mask, padding_mask):
+        """
+        Incremental version of call for the newest target token, inference only, see decoding_cache.decode_step
+        :param x: newest token, (batch_size, 1, d_model)
+        :param cache: decoding cache of the layer, see decoding_cache.init_layer_cache
+        :param position: position of the newest token
+        :param self_mask: padding mask of the cache slots, unwritten slots are masked
+        :return: layer output for the newest token and the updated cache
+        """
+        out1, out2, cache = decoding_cache.attention_blocks_step(self, x, cache, position, self_mask,
+                                                                 padding_mask)
+
+        ffn_output = self.ffn(out2)  # (batch_size, 1, d_model)
+        out3 = self.layernorm3(ffn_output + out2)  # (batch_size, 1, d_model)
+
+        return out3, cache
+
 
 class Encoder(tf.keras.layers.Layer):
     def __init__(self, *, num_layers, d_model, num_heads, dff, input_vocab_size,
@@ -268,7 +286,6 @@ class Decoder(tf.keras.layers.Layer):
         # x.shape == (batch_size, target_seq_len, d_model)
         return x, attention_weights
 
-
 class Transformer(tf.keras.Model):
     def __init__(self, *, num_layers, d_model, num_heads, dff, input_vocab_size,
                  target_vocab_size, rate=0.1):
@@ -312,6 +329,26 @@ class Transformer(tf.keras.Model):
 
         return padding_mask, look_ahead_mask
 
+    def init_decoding_cache(self, inp, max_length):
+        """
+        Encodes the input once for incremental greedy decoding with decode_step, inference only
+        :param inp: input tokens, (batch_size, inp_seq_len)
+        :param max_length: maximal number of decoded tokens
+        :return: decoding cache, holds the encoder side keys and values and the decoder self attention cache
+        """
+        padding_mask = create_padding_mask(inp)
+        enc_output = self.encoder(inp, False, padding_mask)  # (batch_size, inp_seq_len, d_model)
+        return decoding_cache.init_cache(self.decoder, enc_output, padding_mask, max_length)
+
+    def decode_step(self, tar, cache):
+        """
+        :param tar: newest target token, (batch_size, 1)
+        :param cache: decoding cache, see init_decoding_cache
+        :return: logits of the next token (batch_size, 1, target_vocab_size) and the updated cache
+        """
+        dec_output, cache = decoding_cache.decode_step(self.decoder, tar, cache)
+        return self.final_layer(dec_output), cache
+
 
 class CustomSchedule(tf.keras.optimizers.schedules.LearningRateSchedule):
     def __init__(self, d_model, warmup_steps=4000):
@@ -355,12 +392,12 @@ class Translator(tf.Module):
         output_array = tf.TensorArray(dtype=tf.int64, size=0, dynamic_size=True)
         output_array = output_array.write(0, start)
 
-        for i in tf.range(max_length):
-            output = tf.transpose(output_array.stack())
-            predictions, _ = self.transformer([encoder_input, output], training=False)
+        # encode once, each step then only runs the decoder on the newest token
+        cache = self.transformer.init_decoding_cache(encoder_input, max_length)
+        predicted_id = start[tf.newaxis]
 
-            # select the last token from the seq_len dimension
-            predictions = predictions[:, -1:, :]  # (batch_size, 1, vocab_size)
+        for i in tf.range(max_length):
+            predictions, cache = self.transformer.decode_step(predicted_id, cache)  # (batch_size, 1, vocab_size)
 
             predicted_id = tf.argmax(predictions, axis=-1)
 
@@ -1,14 +1,15 @@
 import numpy as np
 import tensorflow as tf
 
-from .dense_layers import DLRTLayerAdaptiveLinear, DLRTLayerAdaptive
+from . import decoding_cache
+from .dense_layers import DLRTLayerAdaptiveLinear, DLRTLayerAdaptive, export_layers_for_inference
 
 # global constants !!!!! DANGEROUS!!!
 MAX_TOKENS = 128
 
 
 class MultiHeadAttention(tf.keras.layers.Layer):
-    def __init__(self, *, d_model, num_heads, tolerance):
+    def __init__(self, *, d_model, num_heads, tolerance, rank_bucket_size=1, svd_method="full"):
         super(MultiHeadAttention, self).__init__()
         self.num_heads = num_heads
         self.d_model = d_model
@@ -19,14 +20,18 @@ class MultiHeadAttention(tf.keras.layers.Layer):
         self.epsilon = tolerance
 
         self.wq = DLRTLayerAdaptiveLinear(input_dim=d_model, units=d_model, low_rank=d_model // 2,
-                                          epsAdapt=self.epsilon)
+                                          epsAdapt=self.epsilon, rank_bucket_size=rank_bucket_size,
+                                          svd_method=svd_method)
         self.wk = DLRTLayerAdaptiveLinear(input_dim=d_model, units=d_model, low_rank=d_model // 2,
-                                          epsAdapt=self.epsilon)
+                                          epsAdapt=self.epsilon, rank_bucket_size=rank_bucket_size,
+                                          svd_method=svd_method)
         self.wv = DLRTLayerAdaptiveLinear(input_dim=d_model, units=d_model, low_rank=d_model // 2,
-                                          epsAdapt=self.epsilon)
+                                          epsAdapt=self.epsilon, rank_bucket_size=rank_bucket_size,
+                                          svd_method=svd_method)
 
         self.dense = DLRTLayerAdaptiveLinear(input_dim=d_model, units=d_model, low_rank=d_model // 2,
-                                             epsAdapt=self.epsilon)
+                                             epsAdapt=self.epsilon, rank_bucket_size=rank_bucket_size,
+                                             svd_method=svd_method)
 
         # Build low-rank
         self.wq.build_model()
@@ -73,6 +78,12 @@ class MultiHeadAttention(tf.keras.layers.Layer):
         self.wv.k_step_preprocessing()
         self.dense.k_step_preprocessing()
 
+    def k_step_postprocessing(self):
+        self.wq.k_step_postprocessing()
+        self.wk.k_step_postprocessing()
+        self.wv.k_step_postprocessing()
+        self.dense.k_step_postprocessing()
+
     def k_step_postprocessing_adapt(self):
         self.wq.k_step_postprocessing_adapt()
         self.wk.k_step_postprocessing_adapt()
@@ -85,27 +96,56 @@ class MultiHeadAttention(tf.keras.layers.Layer):
         self.wv.l_step_preprocessing()
         self.dense.l_step_preprocessing()
 
+    def l_step_postprocessing(self):
+        self.wq.l_step_postprocessing()
+        self.wk.l_step_postprocessing()
+        self.wv.l_step_postprocessing()
+        self.dense.l_step_postprocessing()
+
     def l_step_postprocessing_adapt(self):
         self.wq.l_step_postprocessing_adapt()
         self.wk.l_step_postprocessing_adapt()
         self.wv.l_step_postprocessing_adapt()
         self.dense.l_step_postprocessing_adapt()
 
-    def s_step_preprocessing(self):
-        self.wq.s_step_preprocessing()
-        self.wk.s_step_preprocessing()
-        self.wv.s_step_preprocessing()
-        self.dense.s_step_preprocessing()
-
-    def rank_adaption(self):
-        self.wq.rank_adaption()
-        self.wk.rank_adaption()
-        self.wv.rank_adaption()
-        self.dense.rank_adaption()
+    def s_step_preprocessing(self, optimizer=None):
+        self.wq.s_step_preprocessing(optimizer=optimizer)
+        self.wk.s_step_preprocessing(optimizer=optimizer)
+        self.wv.s_step_preprocessing(optimizer=optimizer)
+        self.dense.s_step_preprocessing(optimizer=optimizer)
+
+    def fixed_rank_update(self, optimizer=None):
+        self.wq.fixed_rank_update(optimizer=optimizer)
+        self.wk.fixed_rank_update(optimizer=optimizer)
+        self.wv.fixed_rank_update(optimizer=optimizer)
+        self.dense.fixed_rank_update(optimizer=optimizer)
+
+    def rank_adaption(self, optimizer=None):
+        self.wq.rank_adaption(optimizer=optimizer)
+        self.wk.rank_adaption(optimizer=optimizer)
+        self.wv.rank_adaption(optimizer=optimizer)
+        self.dense.rank_adaption(optimizer=optimizer)
+
+    def shrink_capacity(self, optimizer=None):
+        self.wq.shrink_capacity(optimizer=optimizer)
+        self.wk.shrink_capacity(optimizer=optimizer)
+        self.wv.shrink_capacity(optimizer=optimizer)
+        self.dense.shrink_capacity(optimizer=optimizer)
 
     def get_rank(self):
         return [self.wq.get_rank(), self.wk.get_rank(), self.wv.get_rank()]
 
+    def get_rank_buckets(self):
+        return [(self.wq.rank_bucket, self.wq.buffer_generation), (self.wk.rank_bucket, self.wk.buffer_generation),
+                (self.wv.rank_bucket, self.wv.buffer_generation), (self.dense.rank_bucket, self.dense.buffer_generation)]
+
+    def export_for_inference(self, batch_size=1):
+        """
+        :param batch_size: expected number of tokens per call, see export_layers_for_inference
+        """
+        export_layers_for_inference(self, ["wq", "wk", "wv", "dense"], batch_size=batch_size)
+        return 0
+
     def get_weights_num(self):
         low_wq, full_wq = self.wq.get_weights_num()
         low_wk, full_wk = self.wk.get_weights_num()
@@ -115,12 +155,15 @@ class MultiHeadAttention(tf.keras.layers.Layer):
 
 
 class EncoderLayer(tf.keras.layers.Layer):
-    def __init__(self, *, d_model, num_heads, dff, rate=0.1, tolerance=0.1):
+    def __init__(self, *, d_model, num_heads, dff, rate=0.1, tolerance=0.1, rank_bucket_size=1, svd_method="full"):
         super(EncoderLayer, self).__init__()
 
-        self.mha = MultiHeadAttention(d_model=d_model, num_heads=num_heads, tolerance=tolerance)
-        self.ffn1 = DLRTLayerAdaptive(input_dim=d_model, units=dff, low_rank=d_model // 2, epsAdapt=tolerance)
-        self.ffn2 = DLRTLayerAdaptiveLinear(input_dim=dff, units=d_model, low_rank=d_model // 2, epsAdapt=tolerance)
+        self.mha = MultiHeadAttention(d_model=d_model, num_heads=num_heads, tolerance=tolerance,
+                                      rank_bucket_size=rank_bucket_size, svd_method=svd_method)
+        self.ffn1 = DLRTLayerAdaptive(input_dim=d_model, units=dff, low_rank=d_model // 2, epsAdapt=tolerance,
+                                      rank_bucket_size=rank_bucket_size, svd_method=svd_method)
+        self.ffn2 = DLRTLayerAdaptiveLinear(input_dim=dff, units=d_model, low_rank=d_model // 2, epsAdapt=tolerance,
+                                            rank_bucket_size=rank_bucket_size, svd_method=svd_method)
 
         # Build low-rank layers
         self.ffn1.build_model()
@@ -152,6 +195,11 @@ class EncoderLayer(tf.keras.layers.Layer):
         self.ffn1.k_step_preprocessing()
         self.ffn2.k_step_preprocessing()
 
+    def k_step_postprocessing(self):
+        self.mha.k_step_postprocessing()
+        self.ffn1.k_step_postprocessing()
+        self.ffn2.k_step_postprocessing()
+
     def k_step_postprocessing_adapt(self):
         self.mha.k_step_postprocessing_adapt()
         self.ffn1.k_step_postprocessing_adapt()
@@ -162,24 +210,51 @@ class EncoderLayer(tf.keras.layers.Layer):
         self.ffn1.l_step_preprocessing()
         self.ffn2.l_step_preprocessing()
 
+    def l_step_postprocessing(self):
+        self.mha.l_step_postprocessing()
+        self.ffn1.l_step_postprocessing()
+        self.ffn2.l_step_postprocessing()
+
     def l_step_postprocessing_adapt(self):
         self.mha.l_step_postprocessing_adapt()
         self.ffn1.l_step_postprocessing_adapt()
         self.ffn2.l_step_postprocessing_adapt()
 
-    def s_step_preprocessing(self):
-        self.mha.s_step_preprocessing()
-        self.ffn1.s_step_preprocessing()
-        self.ffn2.s_step_preprocessing()
+    def s_step_preprocessing(self, optimizer=None):
+        self.mha.s_step_preprocessing(optimizer=optimizer)
+        self.ffn1.s_step_preprocessing(optimizer=optimizer)
+        self.ffn2.s_step_preprocessing(optimizer=optimizer)
+
+    def fixed_rank_update(self, optimizer=None):
+        self.mha.fixed_rank_update(optimizer=optimizer)
+        self.ffn1.fixed_rank_update(optimizer=optimizer)
+        self.ffn2.fixed_rank_update(optimizer=optimizer)
 
-    def rank_adaption(self):
-        self.mha.rank_adaption()
-        self.ffn1.rank_adaption()
-        self.ffn2.rank_adaption()
+    def rank_adaption(self, optimizer=None):
+        self.mha.rank_adaption(optimizer=optimizer)
+        self.ffn1.rank_adaption(optimizer=optimizer)
+        self.ffn2.rank_adaption(optimizer=optimizer)
+
+    def shrink_capacity(self, optimizer=None):
+        self.mha.shrink_capacity(optimizer=optimizer)
+        self.ffn1.shrink_capacity(optimizer=optimizer)
+        self.ffn2.shrink_capacity(optimizer=optimizer)
 
     def get_rank(self):
         return [self.mha.get_rank(), self.ffn1.get_rank(), self.ffn2.get_rank()]
 
+    def get_rank_buckets(self):
+        return self.mha.get_rank_buckets() + [(self.ffn1.rank_bucket, self.ffn1.buffer_generation),
+                                              (self.ffn2.rank_bucket, self.ffn2.buffer_generation)]
+
+    def export_for_inference(self, batch_size=1):
+        """
+        :param batch_size: expected number of tokens per call, see export_layers_for_inference
+        """
+        self.mha.export_for_inference(batch_size=batch_size)
+        export_layers_for_inference(self, ["ffn1", "ffn2"], batch_size=batch_size)
+        return 0
+
     def get_weights_num(self):
         low_mha, full_mha = self.mha.get_weights_num()
         low_ffn1, full_ffn1 = self.ffn1.get_weights_num()
@@ -188,14 +263,18 @@ class EncoderLayer(tf.keras.layers.Layer):
 
 
 class DecoderLayer(tf.keras.layers.Layer):
-    def __init__(self, *, d_model, num_heads, dff, rate=0.1, tolerance=0.1):
+    def __init__(self, *, d_model, num_heads, dff, rate=0.1, tolerance=0.1, rank_bucket_size=1, svd_method="full"):
         super(DecoderLayer, self).__init__()
 
-        self.mha1 = MultiHeadAttention(d_model=d_model, num_heads=num_heads, tolerance=tolerance)
-        self.mha2 = MultiHeadAttention(d_model=d_model, num_heads=num_heads, tolerance=tolerance)
+        self.mha1 = MultiHeadAttention(d_model=d_model, num_heads=num_heads, tolerance=tolerance,
+                                       rank_bucket_size=rank_bucket_size, svd_method=svd_method)
+        self.mha2 = MultiHeadAttention(d_model=d_model, num_heads=num_heads, tolerance=tolerance,
+                                       rank_bucket_size=rank_bucket_size, svd_method=svd_method)
 
-        self.ffn1 = DLRTLayerAdaptive(input_dim=d_model, units=dff, low_rank=d_model // 2, epsAdapt=tolerance)
-        self.ffn2 = DLRTLayerAdaptiveLinear(input_dim=dff, units=d_model, low_rank=d_model // 2, epsAdapt=tolerance)
+        self.ffn1 = DLRTLayerAdaptive(input_dim=d_model, units=dff, low_rank=d_model // 2, epsAdapt=tolerance,
+                                      rank_bucket_size=rank_bucket_size, svd_method=svd_method)
+        self.ffn2 = DLRTLayerAdaptiveLinear(input_dim=dff, units=d_model, low_rank=d_model // 2, epsAdapt=tolerance,
+                                            rank_bucket_size=rank_bucket_size, svd_method=svd_method)
         # Build low-rank layers
         self.ffn1.build_model()
         self.ffn2.build_model()
@@ -228,12 +307,36 @@ class DecoderLayer(tf.keras.layers.Layer):
 
         return out3, attn_weights_block1, attn_weights_block2
 
+    def decode_step(self, x, cache, position, self_mask, padding_mask, step):
+        """
+        Incremental version of call for the newest target token, inference only, see decoding_cache.decode_step
+        :param x: newest token, (batch_size, 1, d_model)
+        :param cache: decoding cache of the layer, see decoding_cache.init_layer_cache
+        :param position: position of the newest token
+        :param self_mask: padding mask of the cache slots, unwritten slots are masked
+        :return: layer output for the newest token and the updated cache
+        """
+        out1, out2, cache = decoding_cache.attention_blocks_step(self, x, cache, position, self_mask,
+                                                                 padding_mask, step)
+
+        ffn_output = self.ffn1(out1, step)  # (batch_size, 1, dff)
+        ffn_output = self.ffn2(ffn_output, step)  # (batch_size, 1, d_model)
+        out3 = self.layernorm3(ffn_output + out2)  # (batch_size, 1, d_model)
+
+        return out3, cache
+
     def k_step_preprocessing(self):
         self.mha1.k_step_preprocessing()
         self.mha2.k_step_preprocessing()
         self.ffn1.k_step_preprocessing()
         self.ffn2.k_step_preprocessing()
 
+    def k_step_postprocessing(self):
+        self.mha1.k_step_postprocessing()
+        self.mha2.k_step_postprocessing()
+        self.ffn1.k_step_postprocessing()
+        self.ffn2.k_step_postprocessing()
+
     def k_step_postprocessing_adapt(self):
         self.mha1.k_step_postprocessing_adapt()
         self.mha2.k_step_postprocessing_adapt()
@@ -246,27 +349,58 @@ class DecoderLayer(tf.keras.layers.Layer):
         self.ffn1.l_step_preprocessing()
         self.ffn2.l_step_preprocessing()
 
+    def l_step_postprocessing(self):
+        self.mha1.l_step_postprocessing()
+        self.mha2.l_step_postprocessing()
+        self.ffn1.l_step_postprocessing()
+        self.ffn2.l_step_postprocessing()
+
     def l_step_postprocessing_adapt(self):
         self.mha1.l_step_postprocessing_adapt()
         self.mha2.l_step_postprocessing_adapt()
         self.ffn1.l_step_postprocessing_adapt()
         self.ffn2.l_step_postprocessing_adapt()
 
-    def s_step_preprocessing(self):
-        self.mha1.s_step_preprocessing()
-        self.mha2.s_step_preprocessing()
-        self.ffn1.s_step_preprocessing()
-        self.ffn2.s_step_preprocessing()
-
-    def rank_adaption(self):
-        self.mha1.rank_adaption()
-        self.mha2.rank_adaption()
-        self.ffn1.rank_adaption()
-        self.ffn2.rank_adaption()
+    def s_step_preprocessing(self, optimizer=None):
+        self.mha1.s_step_preprocessing(optimizer=optimizer)
+        self.mha2.s_step_preprocessing(optimizer=optimizer)
+        self.ffn1.s_step_preprocessing(optimizer=optimizer)
+        self.ffn2.s_step_preprocessing(optimizer=optimizer)
+
+    def fixed_rank_update(self, optimizer=None):
+        self.mha1.fixed_rank_update(optimizer=optimizer)
+        self.mha2.fixed_rank_update(optimizer=optimizer)
+        self.ffn1.fixed_rank_update(optimizer=optimizer)
+        self.ffn2.fixed_rank_update(optimizer=optimizer)
+
+    def rank_adaption(self, optimizer=None):
+        self.mha1.rank_adaption(optimizer=optimizer)
+        self.mha2.rank_adaption(optimizer=optimizer)
+        self.ffn1.rank_adaption(optimizer=optimizer)
+        self.ffn2.rank_adaption(optimizer=optimizer)
+
+    def shrink_capacity(self, optimizer=None):
+        self.mha1.shrink_capacity(optimizer=optimizer)
+        self.mha2.shrink_capacity(optimizer=optimizer)
+        self.ffn1.shrink_capacity(optimizer=optimizer)
+        self.ffn2.shrink_capacity(optimizer=optimizer)
 
     def get_rank(self):
         return [self.mha1.get_rank(), self.mha2.get_rank(), self.ffn1.get_rank(), self.ffn2.get_rank()]
 
+    def get_rank_buckets(self):
+        return self.mha1.get_rank_buckets() + self.mha2.get_rank_buckets() + [
+            (self.ffn1.rank_bucket, self.ffn1.buffer_generation), (self.ffn2.rank_bucket, self.ffn2.buffer_generation)]
+
+    def export_for_inference(self, batch_size=1):
+        """
+        :param batch_size: expected number of tokens per call, see export_layers_for_inference
+        """
+        self.mha1.export_for_inference(batch_size=batch_size)
+        self.mha2.export_for_inference(batch_size=batch_size)
+        export_layers_for_inference(self, ["ffn1", "ffn2"], batch_size=batch_size)
+        return 0
+
     def get_weights_num(self):
         low_mha1, full_mha1 = self.mha1.get_weights_num()
         low_mha2, full_mha2 = self.mha2.get_weights_num()
@@ -277,7 +411,7 @@ class DecoderLayer(tf.keras.layers.Layer):
 
 class Encoder(tf.keras.layers.Layer):
     def __init__(self, *, num_layers, d_model, num_heads, dff, input_vocab_size,
-                 rate=0.1, tolerance):
+                 rate=0.1, tolerance, rank_bucket_size=1, svd_method="full"):
         super(Encoder, self).__init__()
 
         self.d_model = d_model
@@ -287,7 +421,8 @@ class Encoder(tf.keras.layers.Layer):
         self.pos_encoding = positional_encoding(MAX_TOKENS, self.d_model)
 
         self.enc_layers = [
-            EncoderLayer(d_model=d_model, num_heads=num_heads, dff=dff, rate=rate, tolerance=tolerance)
+            EncoderLayer(d_model=d_model, num_heads=num_heads, dff=dff, rate=rate, tolerance=tolerance,
+                         rank_bucket_size=rank_bucket_size, svd_method=svd_method)
             for _ in range(num_layers)]
 
         self.dropout = tf.keras.layers.Dropout(rate)
@@ -312,6 +447,10 @@ class Encoder(tf.keras.layers.Layer):
         for i in range(self.num_layers):
             self.enc_layers[i].k_step_preprocessing()
 
+    def k_step_postprocessing(self):
+        for i in range(self.num_layers):
+            self.enc_layers[i].k_step_postprocessing()
+
     def k_step_postprocessing_adapt(self):
         for i in range(self.num_layers):
             self.enc_layers[i].k_step_postprocessing_adapt()
@@ -320,17 +459,29 @@ class Encoder(tf.keras.layers.Layer):
         for i in range(self.num_layers):
             self.enc_layers[i].l_step_preprocessing()
 
+    def l_step_postprocessing(self):
+        for i in range(self.num_layers):
+            self.enc_layers[i].l_step_postprocessing()
+
     def l_step_postprocessing_adapt(self):
         for i in range(self.num_layers):
             self.enc_layers[i].l_step_postprocessing_adapt()
 
-    def s_step_preprocessing(self):
+    def s_step_preprocessing(self, optimizer=None):
+        for i in range(self.num_layers):
+            self.enc_layers[i].s_step_preprocessing(optimizer=optimizer)
+
+    def fixed_rank_update(self, optimizer=None):
         for i in range(self.num_layers):
-            self.enc_layers[i].s_step_preprocessing()
+            self.enc_layers[i].fixed_rank_update(optimizer=optimizer)
 
-    def rank_adaption(self):
+    def rank_adaption(self, optimizer=None):
         for i in range(self.num_layers):
-            self.enc_layers[i].rank_adaption()
+            self.enc_layers[i].rank_adaption(optimizer=optimizer)
+
+    def shrink_capacity(self, optimizer=None):
+        for i in range(self.num_layers):
+            self.enc_layers[i].shrink_capacity(optimizer=optimizer)
 
     def get_rank(self):
         ranks = []
@@ -338,6 +489,20 @@ class Encoder(tf.keras.layers.Layer):
             ranks.append(self.enc_layers[i].get_rank())
         return ranks
 
+    def get_rank_buckets(self):
+        buckets = []
+        for i in range(self.num_layers):
+            buckets += self.enc_layers[i].get_rank_buckets()
+        return buckets
+
+    def export_for_inference(self, batch_size=1):
+        """
+        :param batch_size: expected number of tokens per call, see export_layers_for_inference
+        """
+        for i in range(self.num_layers):
+            self.enc_layers[i].export_for_inference(batch_size=batch_size)
+        return 0
+
     def get_weights_num(self):
         low = 0
         full = 0
@@ -350,7 +515,7 @@ class Encoder(tf.keras.layers.Layer):
 
 class Decoder(tf.keras.layers.Layer):
     def __init__(self, *, num_layers, d_model, num_heads, dff, target_vocab_size,
-                 rate=0.1, tolerance=0.1):
+                 rate=0.1, tolerance=0.1, rank_bucket_size=1, svd_method="full"):
         super(Decoder, self).__init__()
 
         self.d_model = d_model
@@ -360,7 +525,8 @@ class Decoder(tf.keras.layers.Layer):
         self.pos_encoding = positional_encoding(MAX_TOKENS, d_model)
 
         self.dec_layers = [
-            DecoderLayer(d_model=d_model, num_heads=num_heads, dff=dff, rate=rate, tolerance=tolerance)
+            DecoderLayer(d_model=d_model, num_heads=num_heads, dff=dff, rate=rate, tolerance=tolerance,
+                         rank_bucket_size=rank_bucket_size, svd_method=svd_method)
             for _ in range(num_layers)]
         self.dropout = tf.keras.layers.Dropout(rate)
 
@@ -388,6 +554,10 @@ class Decoder(tf.keras.layers.Layer):
         for i in range(self.num_layers):
             self.dec_layers[i].k_step_preprocessing()
 
+    def k_step_postprocessing(self):
+        for i in range(self.num_layers):
+            self.dec_layers[i].k_step_postprocessing()
+
     def k_step_postprocessing_adapt(self):
         for i in range(self.num_layers):
             self.dec_layers[i].k_step_postprocessing_adapt()
@@ -396,17 +566,29 @@ class Decoder(tf.keras.layers.Layer):
         for i in range(self.num_layers):
             self.dec_layers[i].l_step_preprocessing()
 
+    def l_step_postprocessing(self):
+        for i in range(self.num_layers):
+            self.dec_layers[i].l_step_postprocessing()
+
     def l_step_postprocessing_adapt(self):
         for i in range(self.num_layers):
             self.dec_layers[i].l_step_postprocessing_adapt()
 
-    def s_step_preprocessing(self):
+    def s_step_preprocessing(self, optimizer=None):
         for i in range(self.num_layers):
-            self.dec_layers[i].s_step_preprocessing()
+            self.dec_layers[i].s_step_preprocessing(optimizer=optimizer)
 
-    def rank_adaption(self):
+    def fixed_rank_update(self, optimizer=None):
         for i in range(self.num_layers):
-            self.dec_layers[i].rank_adaption()
+            self.dec_layers[i].fixed_rank_update(optimizer=optimizer)
+
+    def rank_adaption(self, optimizer=None):
+        for i in range(self.num_layers):
+            self.dec_layers[i].rank_adaption(optimizer=optimizer)
+
+    def shrink_capacity(self, optimizer=None):
+        for i in range(self.num_layers):
+            self.dec_layers[i].shrink_capacity(optimizer=optimizer)
 
     def get_rank(self):
         ranks = []
@@ -414,6 +596,20 @@ class Decoder(tf.keras.layers.Layer):
             ranks.append(self.dec_layers[i].get_rank())
         return ranks
 
+    def get_rank_buckets(self):
+        buckets = []
+        for i in range(self.num_layers):
+            buckets += self.dec_layers[i].get_rank_buckets()
+        return buckets
+
+    def export_for_inference(self, batch_size=1):
+        """
+        :param batch_size: expected number of tokens per call, see export_layers_for_inference
+        """
+        for i in range(self.num_layers):
+            self.dec_layers[i].export_for_inference(batch_size=batch_size)
+        return 0
+
     def get_weights_num(self):
         low = 0
         full = 0
@@ -426,15 +622,17 @@ class Decoder(tf.keras.layers.Layer):
 
 class TransformerDLRT(tf.keras.Model):
     def __init__(self, *, num_layers, d_model, num_heads, dff, input_vocab_size,
-                 target_vocab_size, rate=0.1, tolerance=0.1):
+                 target_vocab_size, rate=0.1, tolerance=0.1, rank_bucket_size=1, svd_method="full"):
         super().__init__()
         self.encoder = Encoder(num_layers=num_layers, d_model=d_model,
                                num_heads=num_heads, dff=dff,
-                               input_vocab_size=input_vocab_size, rate=rate, tolerance=tolerance)
+                               input_vocab_size=input_vocab_size, rate=rate, tolerance=tolerance,
+                               rank_bucket_size=rank_bucket_size, svd_method=svd_method)
 
         self.decoder = Decoder(num_layers=num_layers, d_model=d_model,
                                num_heads=num_heads, dff=dff,
-                               target_vocab_size=target_vocab_size, rate=rate, tolerance=tolerance)
+                               target_vocab_size=target_vocab_size, rate=rate, tolerance=tolerance,
+                               rank_bucket_size=rank_bucket_size, svd_method=svd_method)
 
         self.final_layer = tf.keras.layers.Dense(target_vocab_size)  # stays full rank
         self.target_vocab_size = target_vocab_size
@@ -468,10 +666,34 @@ class TransformerDLRT(tf.keras.Model):
 
         return padding_mask, look_ahead_mask
 
+    def init_decoding_cache(self, inp, max_length, step):
+        """
+        Encodes the input once for incremental greedy decoding with decode_step, inference only
+        :param inp: input tokens, (batch_size, inp_seq_len)
+        :param max_length: maximal number of decoded tokens
+        :return: decoding cache, holds the encoder side keys and values and the decoder self attention cache
+        """
+        padding_mask = create_padding_mask(inp)
+        enc_output = self.encoder(inp, False, padding_mask, step)  # (batch_size, inp_seq_len, d_model)
+        return decoding_cache.init_cache(self.decoder, enc_output, padding_mask, max_length, step)
+
+    def decode_step(self, tar, cache, step):
+        """
+        :param tar: newest target token, (batch_size, 1)
+        :param cache: decoding cache, see init_decoding_cache
+        :return: logits of the next token (batch_size, 1, target_vocab_size) and the updated cache
+        """
+        dec_output, cache = decoding_cache.decode_step(self.decoder, tar, cache, step)
+        return self.final_layer(dec_output), cache
+
     def k_step_preprocessing(self):
         self.encoder.k_step_preprocessing()
         self.decoder.k_step_preprocessing()
 
+    def k_step_postprocessing(self):
+        self.encoder.k_step_postprocessing()
+        self.decoder.k_step_postprocessing()
+
     def k_step_postprocessing_adapt(self):
         self.encoder.k_step_postprocessing_adapt()
         self.decoder.k_step_postprocessing_adapt()
@@ -480,21 +702,60 @@ class TransformerDLRT(tf.keras.Model):
         self.encoder.l_step_preprocessing()
         self.decoder.l_step_preprocessing()
 
+    def l_step_postprocessing(self):
+        self.encoder.l_step_postprocessing()
+        self.decoder.l_step_postprocessing()
+
     def l_step_postprocessing_adapt(self):
         self.encoder.l_step_postprocessing_adapt()
         self.decoder.l_step_postprocessing_adapt()
 
-    def s_step_preprocessing(self):
-        self.encoder.s_step_preprocessing()
-        self.decoder.s_step_preprocessing()
+    def s_step_preprocessing(self, optimizer=None):
+        self.encoder.s_step_preprocessing(optimizer=optimizer)
+        self.decoder.s_step_preprocessing(optimizer=optimizer)
+
+    def fixed_rank_update(self, optimizer=None):
+        """
+        Completes a step without rank adaption, see RankAdaptionSchedule.
+        :param optimizer: optimizer of the training loop, a DLRTAdam moves the moments of K and L^T to the new bases
+        """
+        self.encoder.fixed_rank_update(optimizer=optimizer)
+        self.decoder.fixed_rank_update(optimizer=optimizer)
 
-    def rank_adaption(self):
-        self.encoder.rank_adaption()
-        self.decoder.rank_adaption()
+    def rank_adaption(self, optimizer=None):
+        """
+        :param optimizer: optimizer of the training loop, its slots are carried over when a layer grows its factors
+        """
+        self.encoder.rank_adaption(optimizer=optimizer)
+        self.decoder.rank_adaption(optimizer=optimizer)
+
+    def shrink_capacity(self, optimizer=None):
+        """
+        Releases the capacity of the DLRT layers above their current rank bucket. Compiled steps keyed on
+        get_rank_buckets retrace afterwards.
+        :param optimizer: optimizer of the training loop, its slots are resized along
+        """
+        self.encoder.shrink_capacity(optimizer=optimizer)
+        self.decoder.shrink_capacity(optimizer=optimizer)
 
     def get_rank(self):
         return [self.encoder.get_rank(), self.decoder.get_rank()]
 
+    def get_rank_buckets(self):
+        # pairs of rank bucket and buffer generation per DLRT layer, a reallocation of the factors retraces as well
+        return self.encoder.get_rank_buckets() + self.decoder.get_rank_buckets()
+
+    def export_for_inference(self, batch_size=1):
+        """
+        Freezes all DLRT layers to their thin factors U S and V^T and drops the integrator state. The transformer can
+        only be evaluated afterwards, the step argument of call is ignored.
+        :param batch_size: expected number of tokens per call (batch size times sequence length), decides per layer
+        between dense and low-rank product
+        """
+        self.encoder.export_for_inference(batch_size=batch_size)
+        self.decoder.export_for_inference(batch_size=batch_size)
+        return 0
+
     def get_weights_num(self):
         low_encoder, full_encoder = self.encoder.get_weights_num()
         low_decoder, full_decoder = self.decoder.get_weights_num()
@@ -504,18 +765,6 @@ class TransformerDLRT(tf.keras.Model):
         low, full = self.get_weights_num()
         return low / full
 
-    @staticmethod
-    def set_none_grads_to_zero(grads, weights):
-        """
-        :param grads: gradients of current tape
-        :param weights: weights of current model
-        :return: sets the nonexistent gradients to zero (i K step, the grads of S and L step are None, which throws annoying warnings)
-        """
-        for i in range(len(grads)):
-            if grads[i] is None:
-                grads[i] = tf.zeros(shape=weights[i].shape, dtype=tf.float32)
-        return 0
-
     # @staticmethod
     # def set_dlra_bias_grads_to_zero(grads):
     #    """
@@ -570,12 +819,12 @@ class Translator(tf.Module):
         output_array = tf.TensorArray(dtype=tf.int64, size=0, dynamic_size=True)
         output_array = output_array.write(0, start)
 
-        for i in tf.range(max_length):
-            output = tf.transpose(output_array.stack())
-            predictions, _ = self.transformer([encoder_input, output], training=False)
+        # encode once, each step then only runs the decoder on the newest token
+        cache = self.transformer.init_decoding_cache(encoder_input, max_length, step=0)
+        predicted_id = start[tf.newaxis]
 
-            # select the last token from the seq_len dimension
-            predictions = predictions[:, -1:, :]  # (batch_size, 1, vocab_size)
+        for i in tf.range(max_length):
+            predictions, cache = self.transformer.decode_step(predicted_id, cache, step=0)  # (batch_size, 1, vocab_size)
 
             predicted_id = tf.argmax(predictions, axis=-1)
 
@@ -595,7 +844,7 @@ class Translator(tf.Module):
         # `tf.function` prevents us from using the attention_weights that were
         # calculated on the last iteration of the loop. So recalculate them outside
         # the loop.
-        _, attention_weights = self.transformer([encoder_input, output[:, :-1]], training=False)
+        _, attention_weights = self.transformer([encoder_input, output[:, :-1]], training=False, step=0)
 
         return text, tokens, attention_weights
 
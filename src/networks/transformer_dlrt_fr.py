@@ -1,6 +1,7 @@
 import numpy as np
 import tensorflow as tf
 
+from . import decoding_cache
 from .dense_layers import DLRTLayerLinear, DLRTLayer
 
 # global constants !!!!! DANGEROUS!!!
@@ -213,6 +214,24 @@ class DecoderLayer(tf.keras.layers.Layer):
 
         return out3, attn_weights_block1, attn_weights_block2
 
+    def decode_step(self, x, cache, position, self_mask, padding_mask, step):
+        """
+        Incremental version of call for the newest target token, inference only, see decoding_cache.decode_step
+        :param x: newest token, (batch_size, 1, d_model)
+        :param cache: decoding cache of the layer, see decoding_cache.init_layer_cache
+        :param position: position of the newest token
+        :param self_mask: padding mask of the cache slots, unwritten slots are masked
+        :return: layer output for the newest token and the updated cache
+        """
+        out1, out2, cache = decoding_cache.attention_blocks_step(self, x, cache, position, self_mask,
+                                                                 padding_mask, step)
+
+        ffn_output = self.ffn1(out1, step)  # (batch_size, 1, dff)
+        ffn_output = self.ffn2(ffn_output, step)  # (batch_size, 1, d_model)
+        out3 = self.layernorm3(ffn_output + out2)  # (batch_size, 1, d_model)
+
+        return out3, cache
+
     def k_step_preprocessing(self):
         self.mha1.k_step_preprocessing()
         self.mha2.k_step_preprocessing()
@@ -439,6 +458,26 @@ class TransformerDLRTFR(tf.keras.Model):
 
         return padding_mask, look_ahead_mask
 
+    def init_decoding_cache(self, inp, max_length, step):
+        """
+        Encodes the input once for incremental greedy decoding with decode_step, inference only
+        :param inp: input tokens, (batch_size, inp_seq_len)
+        :param max_length: maximal number of decoded tokens
+        :return: decoding cache, holds the encoder side keys and values and the decoder self attention cache
+        """
+        padding_mask = create_padding_mask(inp)
+        enc_output = self.encoder(inp, False, padding_mask, step)  # (batch_size, inp_seq_len, d_model)
+        return decoding_cache.init_cache(self.decoder, enc_output, padding_mask, max_length, step)
+
+    def decode_step(self, tar, cache, step):
+        """
+        :param tar: newest target token, (batch_size, 1)
+        :param cache: decoding cache, see init_decoding_cache
+        :return: logits of the next token (batch_size, 1, target_vocab_size) and the updated cache
+        """
+        dec_output, cache = decoding_cache.decode_step(self.decoder, tar, cache, step)
+        return self.final_layer(dec_output), cache
+
     def k_step_preprocessing(self):
         self.encoder.k_step_preprocessing()
         self.decoder.k_step_preprocessing()
@@ -471,18 +510,6 @@ class TransformerDLRTFR(tf.keras.Model):
         low, full = self.get_weights_num()
         return low / full
 
-    @staticmethod
-    def set_none_grads_to_zero(grads, weights):
-        """
-        :param grads: gradients of current tape
-        :param weights: weights of current model
-        :return: sets the nonexistent gradients to zero (i K step, the grads of S and L step are None, which throws annoying warnings)
-        """
-        for i in range(len(grads)):
-            if grads[i] is None:
-                grads[i] = tf.zeros(shape=weights[i].shape, dtype=tf.float32)
-        return 0
-
     # @staticmethod
     # def set_dlra_bias_grads_to_zero(grads):
     #    """
@@ -537,12 +564,12 @@ class Translator(tf.Module):
         output_array = tf.TensorArray(dtype=tf.int64, size=0, dynamic_size=True)
         output_array = output_array.write(0, start)
 
-        for i in tf.range(max_length):
-            output = tf.transpose(output_array.stack())
-            predictions, _ = self.transformer([encoder_input, output], training=False)
+        # encode once, each step then only runs the decoder on the newest token
+        cache = self.transformer.init_decoding_cache(encoder_input, max_length, step=0)
+        predicted_id = start[tf.newaxis]
 
-            # select the last token from the seq_len dimension
-            predictions = predictions[:, -1:, :]  # (batch_size, 1, vocab_size)
+        for i in tf.range(max_length):
+            predictions, cache = self.transformer.decode_step(predicted_id, cache, step=0)  # (batch_size, 1, vocab_size)
 
             predicted_id = tf.argmax(predictions, axis=-1)
 
@@ -562,7 +589,7 @@ class Translator(tf.Module):
         # `tf.function` prevents us from using the attention_weights that were
         # calculated on the last iteration of the loop. So recalculate them outside
         # the loop.
-        _, attention_weights = self.transformer([encoder_input, output[:, :-1]], training=False)
+        _, attention_weights = self.transformer([encoder_input, output[:, :-1]], training=False, step=0)
 
         return text, tokens, attention_weights
 
@@ -1,13 +1,37 @@
 import tensorflow as tf
 
+from networks.trace_cache import RankBucketTraceCache
+
 MAX_TOKENS = 128
 
 
 class Translator(tf.Module):
-    def __init__(self, tokenizers, transformer, dlra: False):
+    def __init__(self, tokenizers, transformer, dlra: False, incremental=True):
+        """
+        :param tokenizers: pt and en tokenizers
+        :param transformer: Transformer, TransformerDLRT or TransformerDLRTFR
+        :param dlra: True for the DLRT transformers, which are evaluated with step=0
+        :param incremental: encode the sentence once and decode with cached keys and values, one token per step.
+                            False re-runs the whole transformer on the full prefix for every token.
+        """
         self.tokenizers = tokenizers
         self.transformer = transformer
         self.dlra = dlra
+        self.incremental = incremental
+        # source lengths and encoder shapes differ per sentence, generalize the shapes instead of tracing each length
+        self.encode_cache = RankBucketTraceCache(self.encode, max_size=2, reduce_retracing=True)
+        self.decode_cache = RankBucketTraceCache(self.decode, max_size=2, reduce_retracing=True)
+        self.search_step_cache = RankBucketTraceCache(self.search_step, max_size=2, reduce_retracing=True)
+
+    def encode(self, encoder_input, max_length):
+        if self.dlra:
+            return self.transformer.init_decoding_cache(encoder_input, max_length, step=0)
+        return self.transformer.init_decoding_cache(encoder_input, max_length)
+
+    def decode(self, token, cache):
+        if self.dlra:
+            return self.transformer.decode_step(token, cache, step=0)
+        return self.transformer.decode_step(token, cache)
 
     def __call__(self, sentence, max_length=MAX_TOKENS):
         # The input sentence is Portuguese, hence adding the `[START]` and `[END]` tokens.
@@ -30,12 +54,21 @@ class Translator(tf.Module):
         output_array = tf.TensorArray(dtype=tf.int64, size=0, dynamic_size=True)
         output_array = output_array.write(0, start)
 
+        if self.incremental:
+            rank_buckets = self.transformer.get_rank_buckets() if hasattr(self.transformer, "get_rank_buckets") else []
+            # encode once, each step then only runs the decoder on the newest token
+            cache = self.encode_cache(rank_buckets, encoder_input, max_length)
+            predicted_id = start[tf.newaxis]
+
         for i in tf.range(max_length):
-            output = tf.transpose(output_array.stack())
-            if self.dlra:
-                predictions, _ = self.transformer([encoder_input, output], training=False, step=0)
+            if self.incremental:
+                predictions, cache = self.decode_cache(rank_buckets, predicted_id, cache)
             else:
-                predictions, _ = self.transformer([encoder_input, output], training=False)
+                output = tf.transpose(output_array.stack())
+                if self.dlra:
+                    predictions, _ = self.transformer([encoder_input, output], training=False, step=0)
+                else:
+                    predictions, _ = self.transformer([encoder_input, output], training=False)
 
             # Select the last token from the `seq_len` dimension.
             predictions = predictions[:, -1:, :]  # Shape `(batch_size, 1, vocab_size)`.
@@ -63,3 +96,101 @@ class Translator(tf.Module):
         else:
             _, attention_weights = self.transformer([encoder_input, output[:, :-1]], training=False)
         return text, tokens, attention_weights
+
+    def translate_batch(self, sentences, max_length=MAX_TOKENS, beam_size=1, bucket_size=64):
+        """
+        Translates a batch of sentences, e.g. one batch of a tf.data pipeline. The sentences are sorted by source
+        length and decoded in lockstep in buckets of bucket_size sentences, each bucket is only padded to its longest
+        sentence. Decoding of a sentence stops at its end token, the bucket stops once all sentences are finished.
+        :param sentences: Portuguese sentences, string tensor (batch_size,)
+        :param max_length: maximal number of decoded tokens
+        :param beam_size: 1 for greedy decoding, else beam search with beam_size hypotheses per sentence
+        :param bucket_size: number of sentences decoded together
+        :return: English translations (batch_size,) and their tokens (batch_size, None), in the order of sentences
+        """
+        tokenized = self.tokenizers.pt.tokenize(sentences)  # ragged, (batch_size, None)
+        order = tf.argsort(tokenized.row_lengths())
+
+        start_end = self.tokenizers.en.tokenize([''])[0]
+        start = start_end[0]
+        end = start_end[1]
+
+        outputs = []
+        for first in range(0, int(tf.shape(order)[0]), bucket_size):
+            encoder_input = tf.gather(tokenized, order[first:first + bucket_size]).to_tensor()
+            outputs.append(self.decode_bucket(encoder_input, start, end, max_length, beam_size))
+        output = tf.gather(tf.concat(outputs, axis=0), tf.argsort(order))  # back to the order of sentences
+
+        text = self.tokenizers.en.detokenize(output)
+        tokens = self.tokenizers.en.lookup(output)
+        return text, tokens
+
+    def decode_bucket(self, encoder_input, start, end, max_length, beam_size):
+        """
+        :param encoder_input: padded source tokens, (batch_size, inp_seq_len)
+        :return: decoded tokens including start and end token, ragged (batch_size, None)
+        """
+        batch_size = tf.shape(encoder_input)[0]
+        rank_buckets = self.transformer.get_rank_buckets() if hasattr(self.transformer, "get_rank_buckets") else []
+
+        # each sentence is decoded beam_size times, at first only the first hypothesis is alive
+        encoder_input = tf.repeat(encoder_input, beam_size, axis=0)  # (batch_size * beam_size, inp_seq_len)
+        scores = tf.tile(tf.concat([[0.0], tf.fill([beam_size - 1], -1e9)], axis=0), [batch_size])
+        finished = tf.zeros(tf.shape(encoder_input)[0], dtype=tf.bool)
+        tokens = tf.fill((tf.shape(encoder_input)[0], 1), start)
+
+        cache = self.encode_cache(rank_buckets, encoder_input, max_length)
+        for i in range(max_length):
+            tokens, cache, scores, finished = self.search_step_cache(rank_buckets, tokens, cache, scores, finished,
+                                                                     end, beam_size)
+            if tf.reduce_all(finished):
+                break
+
+        # top_k keeps the hypotheses of a sentence sorted by score, the first one is the best
+        tokens = tf.gather(tokens, tf.range(batch_size) * beam_size)
+
+        # cut after the end token
+        is_end = tf.equal(tokens, end)
+        lengths = tf.where(tf.reduce_any(is_end, axis=1), tf.argmax(tf.cast(is_end, tf.int32), axis=1) + 1,
+                           tf.cast(tf.shape(tokens)[1], tf.int64))
+        return tf.RaggedTensor.from_tensor(tokens, lengths=lengths)
+
+    def search_step(self, tokens, cache, scores, finished, end, beam_size):
+        """
+        Decodes the next token of all hypotheses
+        :param tokens: decoded tokens, (batch_size * beam_size, tokens)
+        :param cache: decoding cache of the transformer
+        :param scores: summed log probabilities of the hypotheses, (batch_size * beam_size,)
+        :param finished: hypotheses that already decoded the end token, (batch_size * beam_size,)
+        :param end: end token
+        :param beam_size: number of hypotheses per sentence
+        :return: tokens, cache, scores and finished of the extended hypotheses
+        """
+        predictions, cache = self.decode(tokens[:, -1:], cache)
+        log_probs = tf.nn.log_softmax(predictions[:, 0, :], axis=-1)  # (batch_size * beam_size, vocab_size)
+        vocab_size = tf.shape(log_probs)[1]
+
+        # finished hypotheses are only extended by padding, at no cost
+        padding = tf.one_hot(0, vocab_size, on_value=0.0, off_value=-1e9)
+        log_probs = tf.where(finished[:, tf.newaxis], padding, log_probs)
+
+        if beam_size == 1:
+            predicted_id = tf.argmax(log_probs, axis=-1)
+            scores = scores + tf.reduce_max(log_probs, axis=-1)
+        else:
+            candidates = tf.reshape(scores[:, tf.newaxis] + log_probs, (-1, beam_size * vocab_size))
+            scores, index = tf.math.top_k(candidates, k=beam_size)  # (batch_size, beam_size)
+
+            # hypotheses the new ones extend
+            parent = index // vocab_size + tf.range(tf.shape(index)[0])[:, tf.newaxis] * beam_size
+            parent = tf.reshape(parent, (-1,))
+            predicted_id = tf.cast(tf.reshape(index % vocab_size, (-1,)), tf.int64)
+            scores = tf.reshape(scores, (-1,))
+
+            tokens = tf.gather(tokens, parent)
+            finished = tf.gather(finished, parent)
+            cache = tf.nest.map_structure(lambda t: tf.gather(t, parent) if t.shape.rank else t, cache)
+
+        tokens = tf.concat([tokens, predicted_id[:, tf.newaxis]], axis=1)
+        finished = tf.logical_or(finished, tf.equal(predicted_id, end))
+        return tokens, cache, scores, finished
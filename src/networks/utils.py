@@ -1,8 +1,15 @@
+import multiprocessing
 from os import path, makedirs
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from networks.translator import Translator
+from networks.bleu import sentence_bleu_scores, corpus_bleu_score
+from networks.trace_cache import RankBucketTraceCache
 
 import tensorflow as tf
 
+WRITE_BUFFER_SIZE = 1 << 20  # test output files are flushed once per chunk
+
 
 def create_csv_logger_cb(folder_name: str):
     '''
@@ -85,9 +92,8 @@ def list_of_lists_to_string(list_o_lists: list) -> str:
     return res
 
 
-def test_transformer(transformer, tokenizers, test_examples, filename, dlra: False):
-    from nltk.translate.bleu_score import sentence_bleu
-
+def test_transformer(transformer, tokenizers, test_examples, filename, dlra: False, batch_size=64, beam_size=1,
+                     num_workers=4):
     # Test the translator
     translator = Translator(tokenizers, transformer, dlra)
 
@@ -96,25 +102,121 @@ def test_transformer(transformer, tokenizers, test_examples, filename, dlra: Fal
     n = len(test_examples)
 
     cumulative_bleu = 0.0
-    for (batch, (inp, tar)) in enumerate(test_examples):
-        translated_text, translated_tokens, attention_weights = translator(tf.constant(inp))
+    count = 0
+    references = []
+    hypotheses = []
+    pending = deque()  # (chunk, future of its sentence bleu scores), in order of the test set
+
+    # the bleu scores of a batch are computed in the pool, while the next batch is translated. The workers are
+    # spawned, a forked worker would inherit the TF runtime of the parent and can deadlock on its threads.
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("spawn")) as pool, \
+            open(f_pt, "a", buffering=WRITE_BUFFER_SIZE) as log_pt, \
+            open(f_en_pred, "a", buffering=WRITE_BUFFER_SIZE) as log_en_pred, \
+            open(f_en_ref, "a", buffering=WRITE_BUFFER_SIZE) as log_en_ref:
+        logs = (log_pt, log_en_pred, log_en_ref)
+
+        # translate a whole batch of sentences at once
+        for (inp_batch, tar_batch) in test_examples.batch(batch_size):
+            translated_texts, _ = translator.translate_batch(inp_batch, beam_size=beam_size)
+
+            chunk = ([str(inp) for inp in inp_batch.numpy()], [str(text) for text in translated_texts.numpy()],
+                     [str(tar) for tar in tar_batch.numpy()])
+            # make list of words
+            pre_lists = [text.split(" ") for text in chunk[1]]
+            tar_lists = [tar.split(" ") for tar in chunk[2]]
+            hypotheses += pre_lists
+            references += tar_lists
+            pending.append((chunk, pool.submit(sentence_bleu_scores, tar_lists, pre_lists)))
+
+            # write all chunks with finished scores
+            while pending and pending[0][1].done():
+                chunk, future = pending.popleft()
+                cumulative_bleu, count = write_test_chunk(logs, chunk, future.result(), cumulative_bleu, count, n)
+
+        corpus_bleu = pool.submit(corpus_bleu_score, references, hypotheses)
+        while pending:
+            chunk, future = pending.popleft()
+            cumulative_bleu, count = write_test_chunk(logs, chunk, future.result(), cumulative_bleu, count, n)
+
+        log_en_pred.write(str(cumulative_bleu / n) + " | corpus bleu: " + str(corpus_bleu.result()) +
+                          " | +++++++++++ END OF FILE +++++++++++ \n")
+    print("Mean sentence bleu score: " + str(cumulative_bleu / n) + ". Corpus bleu score: " + str(corpus_bleu.result()))
 
-        # make list of words
-        pre_list = str(translated_text.numpy()).split(" ")
-        tar_list = str(tar.numpy()).split(" ")
-
-        # compute bleu score
-        score = sentence_bleu(references=[tar_list], hypothesis=pre_list)
-        cumulative_bleu += score
-        with open(f_pt, "a") as log:
-            log.write(str(inp.numpy()) + "\n")
-        with open(f_en_pred, "a") as log:
-            log.write(str(score) + " | " + str(translated_text.numpy()) + "\n")
-        with open(f_en_ref, "a") as log:
-            log.write(str(tar.numpy()) + "\n")
-        print("tested on example:" + str(batch) + " of " + str(n) + ". Bleu score: " + str(score))
+    return 0
 
-    with open(f_en_pred, "a") as log:
-        log.write(str(cumulative_bleu / n) + " | +++++++++++ END OF FILE +++++++++++ \n")
 
-    return 0
+def write_test_chunk(logs, chunk, scores, cumulative_bleu, count, n):
+    """
+    Writes one chunk of test translations and flushes the files once
+    :param logs: open pt_in, en_pred and en_ref files
+    :param chunk: lists of inputs, predictions and references
+    :param scores: sentence bleu scores of the chunk
+    :return: updated cumulative bleu score and number of written examples
+    """
+    log_pt, log_en_pred, log_en_ref = logs
+    inps, preds, tars = chunk
+    log_pt.writelines(inp + "\n" for inp in inps)
+    log_en_pred.writelines(str(score) + " | " + pred + "\n" for score, pred in zip(scores, preds))
+    log_en_ref.writelines(tar + "\n" for tar in tars)
+    for log in logs:
+        log.flush()
+
+    for score in scores:
+        cumulative_bleu += score
+        print("tested on example:" + str(count) + " of " + str(n) + ". Bleu score: " + str(score))
+        count += 1
+    return cumulative_bleu, count
+
+
+def make_eval_dataset(x, y, batch_size=1000):
+    """
+    :param x: inputs
+    :param y: labels
+    :param batch_size: evaluation batch size
+    :return: batched and prefetched tf.data.Dataset for ClassificationEvaluator
+    """
+    return tf.data.Dataset.from_tensor_slices((x, y)).batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+
+class ClassificationEvaluator:
+    """
+    Streams a tf.data.Dataset batchwise through a compiled inference step and accumulates mean loss and accuracy,
+    instead of one forward pass over the whole array.
+    """
+
+    def __init__(self, model, loss_fn, step=None, trace_cache_size=4):
+        """
+        :param model: network, evaluated with training=False
+        :param loss_fn: loss function, evaluated on the softmax of the network output
+        :param step: step argument of the DLRT networks, None for networks without integrator steps
+        :param trace_cache_size: compiled steps kept for the rank buckets of adaptive networks
+        """
+        self.model = model
+        self.loss_fn = loss_fn
+        self.step = step
+        self.loss_metric = tf.keras.metrics.Mean()
+        self.acc_metric = tf.keras.metrics.Accuracy()
+        self.eval_step_cache = RankBucketTraceCache(self.eval_step, max_size=trace_cache_size)
+
+    def eval_step(self, x, y):
+        if self.step is None:
+            out = self.model(x, training=False)
+        else:
+            out = self.model(x, step=self.step, training=False)
+        out = tf.keras.activations.softmax(out)
+        # weight the batch mean with the batch size, the result is the mean over all samples
+        self.loss_metric.update_state(self.loss_fn(y, out), sample_weight=tf.cast(tf.shape(x)[0], tf.float32))
+        self.acc_metric.update_state(tf.math.argmax(out, 1), y)
+        return 0
+
+    def evaluate(self, dataset):
+        """
+        :param dataset: tf.data.Dataset of (input, label) batches, see make_eval_dataset
+        :return: mean loss and accuracy over the dataset
+        """
+        self.loss_metric.reset_state()
+        self.acc_metric.reset_state()
+        rank_buckets = self.model.get_rank_buckets() if hasattr(self.model, "get_rank_buckets") else []
+        for x, y in dataset:
+            self.eval_step_cache(rank_buckets, x, y)
+        return self.loss_metric.result().numpy(), self.acc_metric.result().numpy()
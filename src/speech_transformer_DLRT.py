@@ -5,14 +5,22 @@ import tensorflow as tf
 import tensorflow_datasets as tfds
 
 from optparse import OptionParser
+from networks.dense_layers import step_weights
+from networks.datasets import make_bucketed_batches
 from networks.utils import create_csv_logger_cb, list_of_lists_to_string, test_transformer
+from networks.profiling import IntegratorProfiler
+from networks.rank_schedule import RankAdaptionSchedule
+from networks.trace_cache import RankBucketTraceCache
+from networks.optimizers import DLRTAdam
 
+import functools
 import time
 
 # global constants # specify training
 MAX_TOKENS = 128
 BUFFER_SIZE = 20000
-BATCH_SIZE = 64
+TOKEN_BUDGET = 4096  # padded tokens per batch in each language
+TOKEN_CACHE_DIR = "token_cache"  # token ids of the splits, reused across runs
 EPOCHS = 400
 
 # global model
@@ -30,7 +38,8 @@ loss_object = tf.keras.losses.SparseCategoricalCrossentropy(
     from_logits=True, reduction='none')
 
 
-def train(tolerance):
+def train(tolerance, rank_bucket_size=8, trace_cache_size=8, profile=0, trace_start=10, trace_steps=0,
+          svd_method="full", adapt_mode="every", adapt_interval=1, adapt_threshold=0.05):
     filename = "./logs/DLRA_transformer_f/tolerance_" + str(tolerance)
     filename_check = "./weight_checks/DLRA_transformer_f/tolerance_" + str(tolerance)
 
@@ -47,8 +56,8 @@ def train(tolerance):
 
     # investigate data
 
-    train_batches = make_batches(train_examples)
-    val_batches = make_batches(val_examples)
+    train_batches = make_batches(train_examples, "train")
+    val_batches = make_batches(val_examples, "validation", shuffle=False)
 
     num_layers = 4
     d_model = 128
@@ -58,8 +67,8 @@ def train(tolerance):
 
     learning_rate = networks.transformer.CustomSchedule(d_model)
 
-    optimizer = tf.keras.optimizers.Adam(learning_rate, beta_1=0.9, beta_2=0.98,
-                                         epsilon=1e-9)
+    # Adam updating the moments only on the active rank blocks of the factors, see track_factors below
+    optimizer = DLRTAdam(learning_rate, beta_1=0.9, beta_2=0.98, epsilon=1e-9)
 
     train_loss = tf.keras.metrics.Mean(name='train_loss')
     train_accuracy = tf.keras.metrics.Mean(name='train_accuracy')
@@ -75,7 +84,10 @@ def train(tolerance):
         input_vocab_size=tokenizers.pt.get_vocab_size().numpy(),
         target_vocab_size=tokenizers.en.get_vocab_size().numpy(),
         rate=dropout_rate,
-        tolerance=tolerance)
+        tolerance=tolerance,
+        rank_bucket_size=rank_bucket_size,
+        svd_method=svd_method)
+    optimizer.track_factors(transformer)
 
     checkpoint_path = filename_check + '/checkpoints'
 
@@ -97,6 +109,15 @@ def train(tolerance):
     with open(file_name, "a") as log:
         log.write(log_string)
 
+    # time per integrator phase and layer, optionally a TensorBoard trace of trace_steps steps. The integrator phases
+    # run inside the compiled train step and are only visible in the trace, rank adaption runs eagerly and is timed.
+    profiler = IntegratorProfiler(enabled=profile == 1, log_dir=filename + "/profile", trace_start=trace_start,
+                                  trace_steps=trace_steps)
+    profiler.instrument(transformer)
+    # steps between two rank adaptions take the fixed-rank path of the integrator
+    schedule = RankAdaptionSchedule(mode=adapt_mode, interval=adapt_interval, threshold=adapt_threshold)
+    train_step = 0
+
     # The @tf.function trace-compiles train_step into a TF graph for faster
     # execution. The function specializes to the precise shape of the argument
     # tensors. To avoid re-tracing due to the variable sequence lengths or variable
@@ -107,64 +128,75 @@ def train(tolerance):
         tf.TensorSpec(shape=(None, None), dtype=tf.int64),
     ]
 
-    @tf.function(input_signature=train_step_signature)
-    def train_step_low_rank(inp, tar):
+    # The ranks change during training, so the train and validation steps are compiled once per combination of
+    # rank buckets (see RankBucketTraceCache below) instead of a single @tf.function.
+    def train_step_low_rank(inp, tar, adapt=True):
         tar_inp = tar[:, :-1]
         tar_real = tar[:, 1:]
 
         # 1.a) K and L Step Preproccessing
-        transformer.k_step_preprocessing()
-        transformer.l_step_preprocessing()
+        with profiler.phase("kl_preprocessing"):
+            transformer.k_step_preprocessing()
+            transformer.l_step_preprocessing()
 
         # 1.b) Tape Gradients for K-Step
-        # transformer.toggle_non_s_step_training()
-        with tf.GradientTape() as tape:
-            predictions, _ = transformer([inp, tar_inp], training=True, step=0)
-            loss = loss_function(tar_real, predictions)
+        with profiler.phase("k_step"):
+            # transformer.toggle_non_s_step_training()
+            with tf.GradientTape() as tape:
+                predictions, _ = transformer([inp, tar_inp], training=True, step=0)
+                loss = loss_function(tar_real, predictions)
 
-        # Gradient updates for k step
-        grads_k_step = tape.gradient(loss, transformer.trainable_weights)
-        transformer.set_none_grads_to_zero(grads_k_step, transformer.trainable_weights)
-        # transformer.set_dlra_bias_grads_to_zero(grads_k_step)
+            # Gradient updates for k step
+            k_weights = step_weights(transformer, 0)
+            grads_k_step = tape.gradient(loss, k_weights, unconnected_gradients=tf.UnconnectedGradients.ZERO)
+            # transformer.set_dlra_bias_grads_to_zero(grads_k_step)
 
         train_loss(loss)
         train_accuracy(accuracy_function(tar_real, predictions))
 
         # 1.b) Tape Gradients for L-Step
-        with tf.GradientTape() as tape:
-            predictions, _ = transformer([inp, tar_inp], training=True, step=1)
-            loss = loss_function(tar_real, predictions)
+        with profiler.phase("l_step"):
+            with tf.GradientTape() as tape:
+                predictions, _ = transformer([inp, tar_inp], training=True, step=1)
+                loss = loss_function(tar_real, predictions)
 
-        grads_l_step = tape.gradient(loss, transformer.trainable_weights)
-        transformer.set_none_grads_to_zero(grads_l_step, transformer.trainable_weights)
-        # transformer.set_dlra_bias_grads_to_zero(grads_l_step)
+            l_weights = step_weights(transformer, 1)
+            grads_l_step = tape.gradient(loss, l_weights, unconnected_gradients=tf.UnconnectedGradients.ZERO)
+            # transformer.set_dlra_bias_grads_to_zero(grads_l_step)
 
         # Gradient update for K and L
-        optimizer.apply_gradients(zip(grads_k_step, transformer.trainable_weights))
-        optimizer.apply_gradients(zip(grads_l_step, transformer.trainable_weights))
-
-        # Postprocessing K and L
-        transformer.k_step_postprocessing_adapt()
-        transformer.l_step_postprocessing_adapt()
+        with profiler.phase("kl_update"):
+            optimizer.apply_gradients(zip(grads_k_step, k_weights))
+            optimizer.apply_gradients(zip(grads_l_step, l_weights))
+
+        # Postprocessing K and L, at width 2r only if the rank is adapted after this step
+        with profiler.phase("kl_postprocessing"):
+            if adapt:
+                transformer.k_step_postprocessing_adapt()
+                transformer.l_step_postprocessing_adapt()
+            else:
+                transformer.k_step_postprocessing()
+                transformer.l_step_postprocessing()
 
         # S-Step Preprocessing
-        transformer.s_step_preprocessing()
+        with profiler.phase("s_preprocessing"):
+            transformer.s_step_preprocessing(optimizer=optimizer)
 
         # transformer.toggle_s_step_training()
 
         # 3.b) Tape Gradients
-        with tf.GradientTape() as tape:
-            predictions, _ = transformer([inp, tar_inp], training=True, step=2)
-            loss = loss_function(tar_real, predictions)
+        with profiler.phase("s_step"):
+            with tf.GradientTape() as tape:
+                predictions, _ = transformer([inp, tar_inp], training=True, step=2)
+                loss = loss_function(tar_real, predictions)
 
-        # 3.c) Apply Gradients
-        grads_s = tape.gradient(loss, transformer.trainable_weights)
-        transformer.set_none_grads_to_zero(grads_s, transformer.trainable_weights)
-        optimizer.apply_gradients(zip(grads_s, transformer.trainable_weights))  # All gradients except K and L matrix
+            # 3.c) Apply Gradients
+            s_weights = step_weights(transformer, 2)
+            grads_s = tape.gradient(loss, s_weights)
+            optimizer.apply_gradients(zip(grads_s, s_weights))  # All gradients except K and L matrix
 
         return 0
 
-    @tf.function(input_signature=train_step_signature)
     def validation_step(inp, tar):
         tar_inp = tar[:, :-1]
         tar_real = tar[:, 1:]
@@ -175,6 +207,13 @@ def train(tolerance):
         validation_loss(loss)
         validation_accuracy(accuracy_function(tar_real, predictions))
 
+    train_step_cache = RankBucketTraceCache(train_step_low_rank, max_size=trace_cache_size,
+                                            input_signature=train_step_signature)
+    fixed_rank_step_cache = RankBucketTraceCache(functools.partial(train_step_low_rank, adapt=False),
+                                                 max_size=trace_cache_size, input_signature=train_step_signature)
+    validation_step_cache = RankBucketTraceCache(validation_step, max_size=trace_cache_size,
+                                                 input_signature=train_step_signature)
+
     ranks = []
     for epoch in range(EPOCHS):
         start = time.time()
@@ -186,19 +225,36 @@ def train(tolerance):
 
         # inp -> portuguese, tar -> english
         for (batch, (inp, tar)) in enumerate(train_batches):
-            train_step_low_rank(inp, tar)
-            # Rank Adaptivity
-            transformer.rank_adaption()
+            train_step += 1
+            adapt = schedule.adapt(train_step, transformer)
+            with profiler.step(train_step):
+                with profiler.phase("train_step"):
+                    if adapt:
+                        train_step_cache(transformer.get_rank_buckets(), inp, tar)
+                    else:
+                        fixed_rank_step_cache(transformer.get_rank_buckets(), inp, tar)
+                # Rank Adaptivity
+                with profiler.phase("rank_adaption"):
+                    if adapt:
+                        transformer.rank_adaption(optimizer=optimizer)
+                        schedule.update(train_step, transformer)
+                        # steps compiled on reallocated factors can not be hit again, release their variables
+                        for cache in (train_step_cache, fixed_rank_step_cache, validation_step_cache):
+                            cache.evict_stale(transformer.get_rank_buckets())
+                    else:
+                        transformer.fixed_rank_update(optimizer=optimizer)
 
             if batch % 50 == 0:
                 print(
                     f'Epoch {epoch + 1} Batch {batch} Loss {train_loss.result():.4f} Accuracy {train_accuracy.result():.4f}')
                 print("Ranks:")
                 print(transformer.get_rank())
+                print("Trace cache: " + str(train_step_cache.get_stats()))
+                print("Rank adaption: " + str(schedule.get_stats()))
 
         # compute validation
         for (batch, (inp, tar)) in enumerate(val_batches):
-            validation_step(inp, tar)
+            validation_step_cache(transformer.get_rank_buckets(), inp, tar)
 
         # Log Data of current epoch
         log_string = str(epoch) + ";" + str(time.time() - start) + ";" + str(train_loss.result().numpy()) + ";" + str(
@@ -217,35 +273,17 @@ def train(tolerance):
 
         print(f'Time taken for 1 epoch: {time.time() - start:.2f} secs\n')
 
+    profiler.close(file_name=filename + "/profile_summary.csv")
     test_transformer(transformer, tokenizers, test_examples, filename, dlra=True)
     return 0
 
 
-def filter_max_tokens(pt, en):
-    num_tokens = tf.maximum(tf.shape(pt)[1], tf.shape(en)[1])
-    return num_tokens < MAX_TOKENS
-
-
-def tokenize_pairs(pt, en):
-    pt = tokenizers.pt.tokenize(pt)
-    # Convert from ragged to dense, padding with zeros.
-    pt = pt.to_tensor()
-
-    en = tokenizers.en.tokenize(en)
-    # Convert from ragged to dense, padding with zeros.
-    en = en.to_tensor()
-    return pt, en
-
-
-def make_batches(ds):
-    return (
-        ds
-        .cache()
-        .shuffle(BUFFER_SIZE)
-        .batch(BATCH_SIZE)
-        .map(tokenize_pairs, num_parallel_calls=tf.data.AUTOTUNE)
-        .filter(filter_max_tokens)
-        .prefetch(tf.data.AUTOTUNE))
+def make_batches(ds, split, shuffle=True):
+    # batches of about TOKEN_BUDGET tokens of sentences of similar length, tokenized once into the token cache, see
+    # make_bucketed_batches
+    return make_bucketed_batches(ds, tokenizers, max_tokens=MAX_TOKENS, token_budget=TOKEN_BUDGET,
+                                 buffer_size=BUFFER_SIZE, shuffle=shuffle, cache_dir=TOKEN_CACHE_DIR,
+                                 cache_name="ted_hrlr_translate/pt_to_en/" + split)
 
 
 def loss_function(real, pred):
@@ -276,10 +314,26 @@ if __name__ == '__main__':
     parser = OptionParser()
     parser.add_option("-t", "--tolerance", dest="tolerance", default=0.05)
     parser.add_option("-e", "--epochs", dest="epochs", default=500)
+    parser.add_option("-p", "--profile", dest="profile", default=0)
+    parser.add_option("--trace_start", dest="trace_start", default=10)
+    parser.add_option("--trace_steps", dest="trace_steps", default=0)
+    parser.add_option("-b", "--rank_bucket", dest="rank_bucket", default=8)
+    parser.add_option("--svd", dest="svd_method", default="full")
+    parser.add_option("--adapt_mode", dest="adapt_mode", default="every")
+    parser.add_option("--adapt_interval", dest="adapt_interval", default=1)
+    parser.add_option("--adapt_threshold", dest="adapt_threshold", default=0.05)
 
     (options, args) = parser.parse_args()
     options.tolerance = float(options.tolerance)
     options.epochs = int(options.epochs)
+    options.rank_bucket = int(options.rank_bucket)
+    options.profile = int(options.profile)
+    options.trace_start = int(options.trace_start)
+    options.trace_steps = int(options.trace_steps)
+    options.adapt_interval = int(options.adapt_interval)
+    options.adapt_threshold = float(options.adapt_threshold)
     EPOCHS = options.epochs
 
-    train(tolerance=options.tolerance)
+    train(tolerance=options.tolerance, rank_bucket_size=options.rank_bucket, profile=options.profile,
+          trace_start=options.trace_start, trace_steps=options.trace_steps, svd_method=options.svd_method,
+          adapt_mode=options.adapt_mode, adapt_interval=options.adapt_interval, adapt_threshold=options.adapt_threshold)
@@ -5,14 +5,18 @@ import tensorflow as tf
 import tensorflow_datasets as tfds
 
 from optparse import OptionParser
+from networks.dense_layers import step_weights
+from networks.datasets import make_bucketed_batches
 from networks.utils import create_csv_logger_cb, list_of_lists_to_string, test_transformer
+from networks.profiling import IntegratorProfiler
 
 import time
 
 # global constants # specify training
 MAX_TOKENS = 128
 BUFFER_SIZE = 20000
-BATCH_SIZE = 64
+TOKEN_BUDGET = 4096  # padded tokens per batch in each language
+TOKEN_CACHE_DIR = "token_cache"  # token ids of the splits, reused across runs
 EPOCHS = 400
 
 # global model
@@ -30,7 +34,7 @@ loss_object = tf.keras.losses.SparseCategoricalCrossentropy(
     from_logits=True, reduction='none')
 
 
-def train(low_rank):
+def train(low_rank, profile=0, trace_start=10, trace_steps=0):
     filename = "./logs/big_DLRA_FR_transformer_f/fix_rank_" + str(low_rank)
     filename_check = "./weight_checks/big_DLRA_FR_transformer_f/fix_rank_" + str(low_rank)
 
@@ -47,8 +51,8 @@ def train(low_rank):
 
     # investigate data
 
-    train_batches = make_batches(train_examples)
-    val_batches = make_batches(val_examples)
+    train_batches = make_batches(train_examples, "train")
+    val_batches = make_batches(val_examples, "validation", shuffle=False)
 
     num_layers = 6
     d_model = 512
@@ -98,6 +102,13 @@ def train(low_rank):
     with open(file_name, "a") as log:
         log.write(log_string)
 
+    # time per integrator phase and layer, optionally a TensorBoard trace of trace_steps steps. The integrator phases
+    # run inside the compiled train step and are only visible in the trace.
+    profiler = IntegratorProfiler(enabled=profile == 1, log_dir=filename + "/profile", trace_start=trace_start,
+                                  trace_steps=trace_steps)
+    profiler.instrument(transformer)
+    train_step = 0
+
     # The @tf.function trace-compiles train_step into a TF graph for faster
     # execution. The function specializes to the precise shape of the argument
     # tensors. To avoid re-tracing due to the variable sequence lengths or variable
@@ -114,54 +125,61 @@ def train(low_rank):
         tar_real = tar[:, 1:]
 
         # 1.a) K and L Step Preproccessing
-        transformer.k_step_preprocessing()
-        transformer.l_step_preprocessing()
+        with profiler.phase("kl_preprocessing"):
+            transformer.k_step_preprocessing()
+            transformer.l_step_preprocessing()
 
         # 1.b) Tape Gradients for K-Step
-        # transformer.toggle_non_s_step_training()
-        with tf.GradientTape() as tape:
-            predictions, _ = transformer([inp, tar_inp], training=True, step=0)
-            loss = loss_function(tar_real, predictions)
+        with profiler.phase("k_step"):
+            # transformer.toggle_non_s_step_training()
+            with tf.GradientTape() as tape:
+                predictions, _ = transformer([inp, tar_inp], training=True, step=0)
+                loss = loss_function(tar_real, predictions)
 
-        # Gradient updates for k step
-        grads_k_step = tape.gradient(loss, transformer.trainable_weights)
-        transformer.set_none_grads_to_zero(grads_k_step, transformer.trainable_weights)
-        # transformer.set_dlra_bias_grads_to_zero(grads_k_step)
+            # Gradient updates for k step
+            k_weights = step_weights(transformer, 0)
+            grads_k_step = tape.gradient(loss, k_weights, unconnected_gradients=tf.UnconnectedGradients.ZERO)
+            # transformer.set_dlra_bias_grads_to_zero(grads_k_step)
 
         train_loss(loss)
         train_accuracy(accuracy_function(tar_real, predictions))
 
         # 1.b) Tape Gradients for L-Step
-        with tf.GradientTape() as tape:
-            predictions, _ = transformer([inp, tar_inp], training=True, step=1)
-            loss = loss_function(tar_real, predictions)
+        with profiler.phase("l_step"):
+            with tf.GradientTape() as tape:
+                predictions, _ = transformer([inp, tar_inp], training=True, step=1)
+                loss = loss_function(tar_real, predictions)
 
-        grads_l_step = tape.gradient(loss, transformer.trainable_weights)
-        transformer.set_none_grads_to_zero(grads_l_step, transformer.trainable_weights)
-        # transformer.set_dlra_bias_grads_to_zero(grads_l_step)
+            l_weights = step_weights(transformer, 1)
+            grads_l_step = tape.gradient(loss, l_weights, unconnected_gradients=tf.UnconnectedGradients.ZERO)
+            # transformer.set_dlra_bias_grads_to_zero(grads_l_step)
 
         # Gradient update for K and L
-        optimizer.apply_gradients(zip(grads_k_step, transformer.trainable_weights))
-        optimizer.apply_gradients(zip(grads_l_step, transformer.trainable_weights))
+        with profiler.phase("kl_update"):
+            optimizer.apply_gradients(zip(grads_k_step, k_weights))
+            optimizer.apply_gradients(zip(grads_l_step, l_weights))
 
         # Postprocessing K and L
-        transformer.k_step_postprocessing()
-        transformer.l_step_postprocessing()
+        with profiler.phase("kl_postprocessing"):
+            transformer.k_step_postprocessing()
+            transformer.l_step_postprocessing()
 
         # S-Step Preprocessing
-        transformer.s_step_preprocessing()
+        with profiler.phase("s_preprocessing"):
+            transformer.s_step_preprocessing()
 
         # transformer.toggle_s_step_training()
 
         # 3.b) Tape Gradients
-        with tf.GradientTape() as tape:
-            predictions, _ = transformer([inp, tar_inp], training=True, step=2)
-            loss = loss_function(tar_real, predictions)
+        with profiler.phase("s_step"):
+            with tf.GradientTape() as tape:
+                predictions, _ = transformer([inp, tar_inp], training=True, step=2)
+                loss = loss_function(tar_real, predictions)
 
-        # 3.c) Apply Gradients
-        grads_s = tape.gradient(loss, transformer.trainable_weights)
-        transformer.set_none_grads_to_zero(grads_s, transformer.trainable_weights)
-        optimizer.apply_gradients(zip(grads_s, transformer.trainable_weights))  # All gradients except K and L matrix
+            # 3.c) Apply Gradients
+            s_weights = step_weights(transformer, 2)
+            grads_s = tape.gradient(loss, s_weights)
+            optimizer.apply_gradients(zip(grads_s, s_weights))  # All gradients except K and L matrix
 
         return 0
 
@@ -188,7 +206,9 @@ def train(low_rank):
 
         # inp -> portuguese, tar -> english
         for (batch, (inp, tar)) in enumerate(train_batches):
-            train_step_low_rank(inp, tar)
+            train_step += 1
+            with profiler.step(train_step), profiler.phase("train_step"):
+                train_step_low_rank(inp, tar)
             if batch % 50 == 0:
                 print(
                     f'Epoch {epoch + 1} Batch {batch} Loss {train_loss.result():.4f} Accuracy {train_accuracy.result():.4f}')
@@ -216,35 +236,17 @@ def train(low_rank):
 
         print(f'Time taken for 1 epoch: {time.time() - start:.2f} secs\n')
 
+    profiler.close(file_name=filename + "/profile_summary.csv")
     test_transformer(transformer, tokenizers, test_examples, filename, dlra=True)
     return 0
 
 
-def filter_max_tokens(pt, en):
-    num_tokens = tf.maximum(tf.shape(pt)[1], tf.shape(en)[1])
-    return num_tokens < MAX_TOKENS
-
-
-def tokenize_pairs(pt, en):
-    pt = tokenizers.pt.tokenize(pt)
-    # Convert from ragged to dense, padding with zeros.
-    pt = pt.to_tensor()
-
-    en = tokenizers.en.tokenize(en)
-    # Convert from ragged to dense, padding with zeros.
-    en = en.to_tensor()
-    return pt, en
-
-
-def make_batches(ds):
-    return (
-        ds
-        .cache()
-        .shuffle(BUFFER_SIZE)
-        .batch(BATCH_SIZE)
-        .map(tokenize_pairs, num_parallel_calls=tf.data.AUTOTUNE)
-        .filter(filter_max_tokens)
-        .prefetch(tf.data.AUTOTUNE))
+def make_batches(ds, split, shuffle=True):
+    # batches of about TOKEN_BUDGET tokens of sentences of similar length, tokenized once into the token cache, see
+    # make_bucketed_batches
+    return make_bucketed_batches(ds, tokenizers, max_tokens=MAX_TOKENS, token_budget=TOKEN_BUDGET,
+                                 buffer_size=BUFFER_SIZE, shuffle=shuffle, cache_dir=TOKEN_CACHE_DIR,
+                                 cache_name="ted_hrlr_translate/pt_to_en/" + split)
 
 
 def loss_function(real, pred):
@@ -275,10 +277,17 @@ if __name__ == '__main__':
     parser = OptionParser()
     parser.add_option("-r", "--low_rank", dest="low_rank", default=50)
     parser.add_option("-e", "--epochs", dest="epochs", default=500)
+    parser.add_option("-p", "--profile", dest="profile", default=0)
+    parser.add_option("--trace_start", dest="trace_start", default=10)
+    parser.add_option("--trace_steps", dest="trace_steps", default=0)
 
     (options, args) = parser.parse_args()
     options.low_rank = int(options.low_rank)
     options.epochs = int(options.epochs)
+    options.profile = int(options.profile)
+    options.trace_start = int(options.trace_start)
+    options.trace_steps = int(options.trace_steps)
     EPOCHS = options.epochs
 
-    train(low_rank=options.low_rank)
+    train(low_rank=options.low_rank, profile=options.profile, trace_start=options.trace_start,
+          trace_steps=options.trace_steps)
@@ -4,6 +4,7 @@ import tensorflow as tf
 import tensorflow_datasets as tfds
 
 from optparse import OptionParser
+from networks.datasets import make_bucketed_batches
 from networks.utils import create_csv_logger_cb, list_of_lists_to_string, test_transformer
 
 import time
@@ -11,7 +12,8 @@ import time
 # global constants # specify training
 MAX_TOKENS = 128
 BUFFER_SIZE = 20000
-BATCH_SIZE = 64
+TOKEN_BUDGET = 4096  # padded tokens per batch in each language
+TOKEN_CACHE_DIR = "token_cache"  # token ids of the splits, reused across runs
 EPOCHS = 400
 
 # global model
@@ -47,8 +49,8 @@ def train():
 
     # investigate data
 
-    train_batches = make_batches(train_examples)
-    val_batches = make_batches(val_examples)
+    train_batches = make_batches(train_examples, "train")
+    val_batches = make_batches(val_examples, "validation", shuffle=False)
 
     num_layers = 6
     d_model = 512
@@ -167,31 +169,12 @@ def train():
     return 0
 
 
-def filter_max_tokens(pt, en):
-    num_tokens = tf.maximum(tf.shape(pt)[1], tf.shape(en)[1])
-    return num_tokens < MAX_TOKENS
-
-
-def tokenize_pairs(pt, en):
-    pt = tokenizers.pt.tokenize(pt)
-    # Convert from ragged to dense, padding with zeros.
-    pt = pt.to_tensor()
-
-    en = tokenizers.en.tokenize(en)
-    # Convert from ragged to dense, padding with zeros.
-    en = en.to_tensor()
-    return pt, en
-
-
-def make_batches(ds):
-    return (
-        ds
-        .cache()
-        .shuffle(BUFFER_SIZE)
-        .batch(BATCH_SIZE)
-        .map(tokenize_pairs, num_parallel_calls=tf.data.AUTOTUNE)
-        .filter(filter_max_tokens)
-        .prefetch(tf.data.AUTOTUNE))
+def make_batches(ds, split, shuffle=True):
+    # batches of about TOKEN_BUDGET tokens of sentences of similar length, tokenized once into the token cache, see
+    # make_bucketed_batches
+    return make_bucketed_batches(ds, tokenizers, max_tokens=MAX_TOKENS, token_budget=TOKEN_BUDGET,
+                                 buffer_size=BUFFER_SIZE, shuffle=shuffle, cache_dir=TOKEN_CACHE_DIR,
+                                 cache_name="ted_hrlr_translate/pt_to_en/" + split)
 
 
 def loss_function(real, pred):
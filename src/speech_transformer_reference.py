@@ -4,14 +4,18 @@ import tensorflow as tf
 import tensorflow_datasets as tfds
 
 from optparse import OptionParser
+from networks.datasets import make_bucketed_batches
 from networks.utils import create_csv_logger_cb, test_transformer
+from networks.distributed import get_strategy
+from networks.compression import PowerSGDCompressor
 
 import time
 
 # global constants # specify training
 MAX_TOKENS = 128
 BUFFER_SIZE = 20000
-BATCH_SIZE = 64
+TOKEN_BUDGET = 4096  # padded tokens per batch in each language
+TOKEN_CACHE_DIR = "token_cache"  # token ids of the splits, reused across runs
 EPOCHS = 400
 
 # global model
@@ -29,7 +33,14 @@ loss_object = tf.keras.losses.SparseCategoricalCrossentropy(
     from_logits=True, reduction='none')
 
 
-def train():
+def train(distributed=0, compression_rank=0):
+    """
+    :param distributed: 1 trains data parallel under get_strategy, e.g. on several workers described by TF_CONFIG.
+    TOKEN_BUDGET is then the token budget per replica.
+    :param compression_rank: rank of the all-reduced gradients of the weight matrices, 0 all-reduces them dense, see
+    PowerSGDCompressor
+    """
+    strategy = get_strategy() if distributed == 1 else tf.distribute.get_strategy()
     filename = "./logs/transformer"
     filename_check = "./weight_checks/transformer"
 
@@ -46,8 +57,14 @@ def train():
 
     # investigate data
 
-    train_batches = make_batches(train_examples)
-    val_batches = make_batches(val_examples)
+    # the distributed dataset splits a global batch evenly between the replicas, each of them needs a non-empty part
+    train_batches = make_batches(train_examples, "train", token_budget=TOKEN_BUDGET * strategy.num_replicas_in_sync,
+                                 batch_multiple=strategy.num_replicas_in_sync, drop_remainder=distributed == 1)
+    if distributed == 1:
+        options = tf.data.Options()
+        options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.DATA
+        train_batches = strategy.experimental_distribute_dataset(train_batches.with_options(options))
+    val_batches = make_batches(val_examples, "validation", shuffle=False)
     # test_batches = make_batches(test_examples)
 
     num_layers = 4
@@ -58,23 +75,36 @@ def train():
 
     learning_rate = networks.transformer.CustomSchedule(d_model)
 
-    optimizer = tf.keras.optimizers.Adam(learning_rate, beta_1=0.9, beta_2=0.98,
-                                         epsilon=1e-9)
-
-    train_loss = tf.keras.metrics.Mean(name='train_loss')
-    train_accuracy = tf.keras.metrics.Mean(name='train_accuracy')
     validation_loss = tf.keras.metrics.Mean(name='validation_loss')
     validation_accuracy = tf.keras.metrics.Mean(name='validation_accuracy')
 
-    # build model
-    transformer = networks.transformer.Transformer(
-        num_layers=num_layers,
-        d_model=d_model,
-        num_heads=num_heads,
-        dff=dff,
-        input_vocab_size=tokenizers.pt.get_vocab_size().numpy(),
-        target_vocab_size=tokenizers.en.get_vocab_size().numpy(),
-        rate=dropout_rate)
+    # model, optimizer and training metrics are mirrored across the replicas
+    with strategy.scope():
+        optimizer = tf.keras.optimizers.Adam(learning_rate, beta_1=0.9, beta_2=0.98,
+                                             epsilon=1e-9)
+
+        train_loss = tf.keras.metrics.Mean(name='train_loss')
+        train_accuracy = tf.keras.metrics.Mean(name='train_accuracy')
+
+        # build model
+        transformer = networks.transformer.Transformer(
+            num_layers=num_layers,
+            d_model=d_model,
+            num_heads=num_heads,
+            dff=dff,
+            input_vocab_size=tokenizers.pt.get_vocab_size().numpy(),
+            target_vocab_size=tokenizers.en.get_vocab_size().numpy(),
+            rate=dropout_rate)
+
+        compressor = None
+        if compression_rank > 0:
+            # the weights are created at the first call
+            transformer([tf.zeros((1, 2), tf.int64), tf.zeros((1, 2), tf.int64)], training=False)
+            compressor = PowerSGDCompressor(rank=compression_rank)
+            compressor.build(transformer.trainable_variables)
+            compressed_bytes, dense_bytes = compressor.get_allreduce_bytes(transformer.trainable_variables)
+            print("all-reduced gradient bytes per replica and step: " + str(compressed_bytes) + " instead of " + str(
+                dense_bytes))
 
     checkpoint_path = filename_check + '/checkpoints'
 
@@ -111,9 +141,15 @@ def train():
             predictions, _ = transformer([inp, tar_inp],
                                          training=True)
             loss = loss_function(tar_real, predictions)
+            # the gradients are summed over the replicas, scale the loss to their mean
+            scaled_loss = loss / strategy.num_replicas_in_sync
 
-        gradients = tape.gradient(loss, transformer.trainable_variables)
-        optimizer.apply_gradients(zip(gradients, transformer.trainable_variables))
+        gradients = tape.gradient(scaled_loss, transformer.trainable_variables)
+        if compressor is None:
+            optimizer.apply_gradients(zip(gradients, transformer.trainable_variables))
+        else:
+            optimizer.apply_gradients(compressor.all_reduce(list(zip(gradients, transformer.trainable_variables))),
+                                      experimental_aggregate_gradients=False)
 
         train_loss(loss)
         train_accuracy(accuracy_function(tar_real, predictions))
@@ -129,6 +165,11 @@ def train():
         validation_loss(loss)
         validation_accuracy(accuracy_function(tar_real, predictions))
 
+    @tf.function(experimental_relax_shapes=True)
+    def distributed_train_step(inp, tar):
+        # the replicas run the uncompiled step, the per replica inputs do not bind to its input_signature
+        strategy.run(train_step.python_function, args=(inp, tar))
+
     for epoch in range(EPOCHS):
         start = time.time()
 
@@ -140,8 +181,11 @@ def train():
 
         # inp -> portuguese, tar -> english
         for (batch, (inp, tar)) in enumerate(train_batches):
-            train_step(inp, tar)
-      
+            if distributed == 1:
+                distributed_train_step(inp, tar)
+            else:
+                train_step(inp, tar)
+
             if batch % 50 == 0:
                 print(
                     f'Epoch {epoch + 1} Batch {batch} Loss {train_loss.result():.4f} Accuracy {train_accuracy.result():.4f}')
@@ -175,31 +219,13 @@ def print_translation(sentence, tokens, ground_truth):
     print(f'{"Ground truth":15s}: {ground_truth}')
 
 
-def filter_max_tokens(pt, en):
-    num_tokens = tf.maximum(tf.shape(pt)[1], tf.shape(en)[1])
-    return num_tokens < MAX_TOKENS
-
-
-def tokenize_pairs(pt, en):
-    pt = tokenizers.pt.tokenize(pt)
-    # Convert from ragged to dense, padding with zeros.
-    pt = pt.to_tensor()
-
-    en = tokenizers.en.tokenize(en)
-    # Convert from ragged to dense, padding with zeros.
-    en = en.to_tensor()
-    return pt, en
-
-
-def make_batches(ds):
-    return (
-        ds
-        .cache()
-        .shuffle(BUFFER_SIZE)
-        .batch(BATCH_SIZE)
-        .map(tokenize_pairs, num_parallel_calls=tf.data.AUTOTUNE)
-        .filter(filter_max_tokens)
-        .prefetch(tf.data.AUTOTUNE))
+def make_batches(ds, split, shuffle=True, token_budget=TOKEN_BUDGET, batch_multiple=1, drop_remainder=False):
+    # batches of about token_budget tokens of sentences of similar length, tokenized once into the token cache, see
+    # make_bucketed_batches
+    return make_bucketed_batches(ds, tokenizers, max_tokens=MAX_TOKENS, token_budget=token_budget,
+                                 buffer_size=BUFFER_SIZE, shuffle=shuffle, batch_multiple=batch_multiple,
+                                 drop_remainder=drop_remainder, cache_dir=TOKEN_CACHE_DIR,
+                                 cache_name="ted_hrlr_translate/pt_to_en/" + split)
 
 
 def loss_function(real, pred):
@@ -230,8 +256,12 @@ if __name__ == '__main__':
     parser = OptionParser()
 
     parser.add_option("-e", "--epochs", dest="epochs", default=200)
+    parser.add_option("--distributed", dest="distributed", default=0)
+    parser.add_option("-c", "--compression_rank", dest="compression_rank", default=0)
     (options, args) = parser.parse_args()
     options.epochs = int(options.epochs)
+    options.distributed = int(options.distributed)
+    options.compression_rank = int(options.compression_rank)
     EPOCHS = options.epochs
 
-    train()
+    train(distributed=options.distributed, compression_rank=options.compression_rank)
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from networks.checkpoint import AsyncCheckpointWriter, load_checkpoint, save_checkpoint
+from networks.dense_dlrt_nets import DLRTNetAdaptive
+from networks.optimizers import DLRTAdam
+
+
+def make_net(rank_bucket_size=1):
+    model = DLRTNetAdaptive(input_dim=12, output_dim=3, low_rank=3, dlra_layer_dim=16, tol=0.2, rmax_total=8,
+                            rank_bucket_size=rank_bucket_size)
+    model.build_model()
+    return model
+
+
+def train(model, steps=6):
+    optimizer = DLRTAdam(learning_rate=1e-2)
+    optimizer.track_factors(model)
+    loss_fn = tf.keras.losses.SparseCategoricalCrossentropy()
+    rng = np.random.RandomState(0)
+    for _ in range(steps):
+        x = tf.constant(rng.standard_normal((32, 12)).astype(np.float32))
+        y = tf.constant(rng.randint(0, 3, 32))
+        model.fused_train_step(x, y, loss_fn, optimizer)
+        model.rank_adaption(optimizer=optimizer)
+    return model
+
+
+@pytest.mark.parametrize("archive", [True, False])
+@pytest.mark.parametrize("rank_bucket_size", [1, 4])
+def test_save_load_reproduces_the_network(tmp_path, archive, rank_bucket_size):
+    tf.random.set_seed(0)
+    model = train(make_net(rank_bucket_size))
+    folder_name = str(tmp_path)
+    if archive:
+        save_checkpoint(model, folder_name)
+    else:
+        model.save(folder_name=folder_name)
+
+    loaded = make_net(rank_bucket_size)
+    if archive:
+        load_checkpoint(loaded, folder_name)
+    else:
+        loaded.load(folder_name=folder_name)
+
+    assert loaded.get_low_ranks() == model.get_low_ranks()
+    x = tf.constant(np.random.RandomState(1).standard_normal((8, 12)).astype(np.float32))
+    for step in (0, 1, 2, 3):
+        np.testing.assert_allclose(loaded(x, step=step).numpy(), model(x, step=step).numpy(), rtol=0, atol=1e-6)
+
+
+def test_load_refuses_factors_of_another_shape(tmp_path):
+    tf.random.set_seed(0)
+    model = train(make_net(), steps=2)
+    folder_name = str(tmp_path)
+    model.save(folder_name=folder_name)
+    aux_vt = np.load(folder_name + "/aux_Vt1.npy")
+    np.save(folder_name + "/aux_Vt1.npy", aux_vt.T)
+
+    with pytest.raises(ValueError, match="aux_Vt1"):
+        make_net().load(folder_name=folder_name)
+
+
+def test_async_writer_keeps_only_pending_writes_and_refuses_saves_after_close(tmp_path):
+    tf.random.set_seed(0)
+    model = make_net()
+    with AsyncCheckpointWriter() as checkpoint_writer:
+        for i in range(4):
+            checkpoint_writer.save(model, folder_name=str(tmp_path)).result()
+        # the finished writes of the previous saves are dropped
+        assert len(checkpoint_writer.futures) == 1
+
+    loaded = make_net()
+    load_checkpoint(loaded, str(tmp_path))
+    x = tf.constant(np.random.RandomState(1).standard_normal((8, 12)).astype(np.float32))
+    np.testing.assert_allclose(loaded(x, step=0).numpy(), model(x, step=0).numpy(), rtol=0, atol=1e-6)
+    with pytest.raises(RuntimeError, match="closed"):
+        checkpoint_writer.save(model, folder_name=str(tmp_path))
@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from networks.convolutional_layers import DLRALayerConv, first_factor_conv, supports_factorized_conv
+
+
+@pytest.mark.parametrize("image_dims", [(8, 8, 3), (9, 7, 2)])
+@pytest.mark.parametrize("size, stride, rate", [((3, 3), (1, 1), (1, 1)), ((3, 3), (2, 2), (1, 1)),
+                                                ((3, 3), (1, 1), (2, 2)), ((5, 3), (1, 2), (1, 1)),
+                                                ((2, 2), (1, 1), (1, 1))])
+def test_factorized_conv_matches_the_patch_matrix(image_dims, size, stride, rate):
+    assert supports_factorized_conv(stride, rate)
+    rng = np.random.RandomState(0)
+    inputs = tf.constant(rng.standard_normal((2,) + image_dims).astype(np.float32))
+    u = tf.constant(rng.standard_normal((size[0] * size[1] * image_dims[2], 4)).astype(np.float32))
+
+    factorized = first_factor_conv(inputs, u, size, stride, rate, factorized=True)
+    patches = first_factor_conv(inputs, u, size, stride, rate, factorized=False)
+    assert factorized.shape == patches.shape
+    np.testing.assert_allclose(factorized.numpy(), patches.numpy(), rtol=1e-5, atol=1e-5)
+
+
+def test_factorized_layer_matches_the_patch_layer():
+    tf.random.set_seed(0)
+    layers = [DLRALayerConv(low_rank=3, stride=(1, 1), rate=(1, 1), size=(3, 3), filters=8, image_dims=(8, 8, 2),
+                            factorized=factorized) for factorized in (False, True)]
+    for layer in layers:
+        layer.build_model()
+    for weight, copy in zip(layers[0].weights, layers[1].weights):
+        copy.assign(weight)
+    inputs = tf.random.normal((2, 8, 8, 2))
+    for step in (0, 1, 2):
+        np.testing.assert_allclose(layers[1](inputs, step=step).numpy(), layers[0](inputs, step=step).numpy(),
+                                   rtol=1e-5, atol=1e-5)
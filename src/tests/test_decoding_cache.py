@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from networks.transformer_dlrt import TransformerDLRT
+from networks.transformer_dlrt_fr import TransformerDLRTFR
+
+
+def assert_cached_decoding_matches_call(model, **step):
+    """Feeds the target one token at a time through the cache and compares each step with the full call"""
+    inp = tf.constant([[5, 3, 8, 2, 0, 0], [7, 1, 4, 9, 6, 2]], dtype=tf.int64)  # the first sentence is padded
+    tar = tf.constant([[1, 4, 6, 2, 3], [1, 8, 2, 0, 0]], dtype=tf.int64)
+    logits, _ = model([inp, tar], training=False, **step)  # (batch_size, tar_seq_len, target_vocab_size)
+
+    cache = model.init_decoding_cache(inp, 8, **step)
+    for i in range(tar.shape[1]):
+        step_logits, cache = model.decode_step(tar[:, i:i + 1], cache, **step)
+        np.testing.assert_allclose(step_logits[:, 0].numpy(), logits[:, i].numpy(), rtol=1e-4, atol=1e-5)
+
+
+def test_cached_decoding_matches_the_full_call_of_the_transformer():
+    transformer = pytest.importorskip("networks.transformer")
+    tf.random.set_seed(0)
+    model = transformer.Transformer(num_layers=2, d_model=16, num_heads=2, dff=24, input_vocab_size=12,
+                                    target_vocab_size=10)
+    assert_cached_decoding_matches_call(model)
+
+
+def test_cached_decoding_matches_the_full_call_of_the_dlrt_transformer():
+    tf.random.set_seed(0)
+    model = TransformerDLRT(num_layers=2, d_model=16, num_heads=2, dff=24, input_vocab_size=12,
+                            target_vocab_size=10, tolerance=0.1, rank_bucket_size=4)
+    assert_cached_decoding_matches_call(model, step=0)
+
+
+def test_cached_decoding_matches_the_full_call_of_the_fixed_rank_dlrt_transformer():
+    tf.random.set_seed(0)
+    model = TransformerDLRTFR(num_layers=2, d_model=16, num_heads=2, dff=24, input_vocab_size=12,
+                              target_vocab_size=10, low_rank=4)
+    assert_cached_decoding_matches_call(model, step=0)
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from networks.decompositions import SVD_METHODS, truncated_svd, truncation_rank
+
+
+def make_augmented_s(rng, low_rank, decay):
+    """
+    :return: random S (2r x 2r) with singular values decay^j, decay = 1 gives a flat spectrum of a Gaussian matrix
+    """
+    size = 2 * low_rank
+    if decay == 1.0:
+        return rng.standard_normal((size, size)).astype(np.float32)
+    u, _ = np.linalg.qr(rng.standard_normal((size, size)))
+    v, _ = np.linalg.qr(rng.standard_normal((size, size)))
+    return ((u * decay ** np.arange(size)) @ v.T).astype(np.float32)
+
+
+@pytest.mark.parametrize("method", SVD_METHODS[1:])
+@pytest.mark.parametrize("low_rank", [2, 4, 6, 8, 12, 16])
+def test_backends_pick_the_rank_of_the_full_svd(method, low_rank):
+    rng = np.random.RandomState(low_rank)
+    tf.random.set_seed(low_rank)
+    for decay in (1.0, 0.9, 0.7, 0.5):
+        for eps_adapt in (0.01, 0.05, 0.1, 0.2, 0.4):
+            s = tf.constant(make_augmented_s(rng, low_rank, decay))
+            warm_start = tf.constant(rng.standard_normal((2 * low_rank, low_rank)).astype(np.float32))
+            full_rank = truncated_svd(s, tf.constant(low_rank), eps_adapt)[0]
+            rank, d, u, vt = truncated_svd(s, tf.constant(low_rank), eps_adapt, method=method,
+                                           warm_start=warm_start)
+            assert int(rank) == int(full_rank), (decay, eps_adapt)
+            assert u.shape[1] >= int(rank) and vt.shape[0] >= int(rank)
+
+
+@pytest.mark.parametrize("method", SVD_METHODS[1:])
+@pytest.mark.parametrize("low_rank", [16, 32, 64])
+def test_sketch_resolves_the_rank_with_orthonormal_factors(method, low_rank):
+    rng = np.random.RandomState(low_rank)
+    tf.random.set_seed(low_rank)
+    for decay in (0.5, 0.7):
+        s_np = make_augmented_s(rng, low_rank, decay)
+        warm_start = tf.constant(rng.standard_normal((2 * low_rank, low_rank)).astype(np.float32))
+        rank, d, u, vt = truncated_svd(tf.constant(s_np), tf.constant(low_rank), 0.1, method=method,
+                                       warm_start=warm_start)
+        rank, d, u, vt = int(rank), d.numpy(), u.numpy(), vt.numpy()
+        # the sketch of width r + 8 < 2r resolved the rank itself, without the full SVD
+        assert len(d) == low_rank + 8
+
+        u_np, d_np, vt_np = np.linalg.svd(s_np.astype(np.float64))
+        np.testing.assert_allclose(d[:rank], d_np[:rank], rtol=1e-4)
+        np.testing.assert_allclose(u.T @ u, np.eye(len(d)), atol=1e-5)
+        np.testing.assert_allclose(vt @ vt.T, np.eye(len(d)), atol=1e-5)
+        # the truncation is as good as the one of the exact SVD
+        truncated = (u[:, :rank] * d[:rank]) @ vt[:rank, :]
+        optimal = (u_np[:, :rank] * d_np[:rank]) @ vt_np[:rank, :]
+        np.testing.assert_allclose(truncated, optimal, atol=1e-5)
+
+
+def loop_truncation_rank(singular_values, eps_adapt):
+    """
+    Truncation rule as the scalar loop the rank adaption ran before truncation_rank.
+    """
+    tol = eps_adapt * np.linalg.norm(singular_values)
+    rmax = len(singular_values) // 2
+    for j in range(0, 2 * rmax - 1):
+        if np.linalg.norm(singular_values[j:2 * rmax - 1]) < tol:
+            return j
+    return rmax
+
+
+@pytest.mark.parametrize("low_rank", [1, 2, 3, 5, 8, 20])
+def test_truncation_rank_matches_the_loop(low_rank):
+    rng = np.random.RandomState(low_rank)
+    for decay in (1.0, 0.9, 0.5, 0.1):
+        for eps_adapt in (0.0, 0.01, 0.1, 0.3, 0.9):
+            d = np.sort(rng.uniform(size=2 * low_rank) * decay ** np.arange(2 * low_rank))[::-1]
+            d = d.astype(np.float32)
+            assert int(truncation_rank(tf.constant(d), eps_adapt)) == loop_truncation_rank(d, eps_adapt)
@@ -0,0 +1,36 @@
+import numpy as np
+import tensorflow as tf
+
+from networks.dense_dlrt_nets import DLRTNetAdaptive
+from networks.dense_layers import step_weights
+
+
+def factor_gradients(model, inputs, labels, step):
+    loss_fn = tf.keras.losses.SparseCategoricalCrossentropy()
+    with tf.GradientTape() as tape:
+        loss = loss_fn(labels, tf.keras.activations.softmax(model(inputs, step=step)))
+    weights = step_weights(model, step)
+    grads = tape.gradient(loss, weights, unconnected_gradients=tf.UnconnectedGradients.ZERO)
+    return loss, {weight.ref(): grad for weight, grad in zip(weights, grads)}
+
+
+def test_fused_kl_pass_gives_the_gradients_of_the_separate_k_and_l_passes():
+    tf.random.set_seed(0)
+    model = DLRTNetAdaptive(input_dim=12, output_dim=3, low_rank=3, dlra_layer_dim=16, tol=0.2, rmax_total=8)
+    model.build_model()
+    model.k_step_preprocessing()
+    model.l_step_preprocessing()
+    model.toggle_non_s_step_training()
+    inputs = tf.random.normal((32, 12))
+    labels = tf.random.uniform((32,), maxval=3, dtype=tf.int64)
+
+    loss_k, grads_k = factor_gradients(model, inputs, labels, 0)
+    loss_l, grads_l = factor_gradients(model, inputs, labels, 1)
+    loss_kl, grads_kl = factor_gradients(model, inputs, labels, 3)
+    np.testing.assert_allclose(loss_kl.numpy(), loss_k.numpy(), rtol=1e-6)
+    np.testing.assert_allclose(loss_kl.numpy(), loss_l.numpy(), rtol=1e-6)
+    for layer in (model.dlraBlockInput, model.dlraBlock1, model.dlraBlock2, model.dlraBlock3):
+        np.testing.assert_allclose(grads_kl[layer.k.ref()].numpy(), grads_k[layer.k.ref()].numpy(), rtol=1e-4,
+                                   atol=1e-6)
+        np.testing.assert_allclose(grads_kl[layer.l_t.ref()].numpy(), grads_l[layer.l_t.ref()].numpy(), rtol=1e-4,
+                                   atol=1e-6)
@@ -1,5 +1,6 @@
 from xmlrpc.client import boolean
 from networks.conv_nets import VGG15DLRANHead_NoDLRA
+from networks.dense_layers import step_weights
 from networks.utils import create_csv_logger_cb
 
 import tensorflow as tf
@@ -181,11 +182,11 @@ def train(start_rank, tolerance, load_model):
                 # Compute reconstruction loss
                 loss = loss_fn(batch_train[1], out)
                 loss += sum(model.losses)  # Add KLD regularization loss
-            grads_k_step = tape.gradient(loss, model.trainable_weights)
-            model.set_none_grads_to_zero(grads_k_step, model.trainable_weights)
+            k_weights = step_weights(model, 0)
+            grads_k_step = tape.gradient(loss, k_weights, unconnected_gradients=tf.UnconnectedGradients.ZERO)
             model.set_dlra_bias_grads_to_zero(grads_k_step)
 
-            optimizer.apply_gradients(zip(grads_k_step, model.trainable_weights))
+            optimizer.apply_gradients(zip(grads_k_step, k_weights))
 
             # Network monotoring and verbosity
             loss_metric.update_state(loss)